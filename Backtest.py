@@ -0,0 +1,325 @@
+#!/usr/bin/python
+'''
+This provides a what-if backtester: it replays a controller configuration (an NVM file, sprinklerNVM.pkl) over one
+or more years, with historical weather if there is any, and reports the water used, the peak concurrent flow and the
+length of the nightly watering window, so the effect of changing a timer or a zone duration is known before it is
+pushed to the sites.
+
+    python Backtest.py sprinklerNVM.pkl --weather weather/ --changes longer.json --changes weekly.json
+    python Backtest.py site1.pkl site2.pkl --start 2024-01-01 --years 2 --dogRate 0.5 --flow 4.5
+
+Every configuration given is a scenario, and so is each of them with each --changes file applied, a JSON list of
+changes as /api/batch takes (ConfigChanges.py), i.e. [{"table": "zoneTable", "index": 2, "field": "wateringTime",
+"value": 30}].  The scenarios are run in parallel, one per core.
+
+The scheduling semantics are those of Scheduler.py: INT timers every Interval days from the first day and DoW timers
+on their days, at their start times; the zones of a timer queued one at a time in zone order and then its multi
+zones as one group, each queue entry starting when the previous one has finished; the scheduled down time and the
+blackout windows (Blackout.py) pausing the queue and the running zones, which resume when they end; dog mode sprays (at --dogRate detections a day on the zones with dog detect on)
+reducing the next scheduled watering, no shorter than the minimum; and, with Weather Adjust on, the watering times
+scaled by the previous day's weather multiplier (WeatherAdjust.py), rain enough skipping the watering.
+
+Rather than stepping a clock, each scenario is a few arrays over the days: the timer triggers, the watering seconds
+of every zone on every day, the dog detections since each zone's previous watering (cumulative sums), and one pass
+over the queue entries in start time order, vectorized over the days, for the start and end times.  A queue which
+runs past the next day's first start time is counted as an overrun rather than carried over.
+'''
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import time
+import numpy
+import Blackout
+import ConfigChanges
+import ControllerConfig
+import Scheduler
+import WeatherAdjust
+
+DAY            = 24 * 60 * 60
+DEFAULT_FLOW   = 5.0  # gallons per minute of a zone without one in --flows
+DEFAULT_YEARS  = 1
+BLACKOUT_SPAN  = 2 * DAY  # seconds after each day's midnight the blackout windows holding its queue are looked for in
+BLACKOUT_COUNT = 8    # blackout windows per day, the most a day's queue is held by
+
+# The values the controller's pages offer, used to validate changes as SprinklerController.changeOptions(), the
+# watering times and intervals those of the controller configuration file (--config)
+TIMER_TYPES    = ['INT', 'DoW']
+DAYS           = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+RELAY_COUNT    = 64   # changes are checked against the largest controller rather than a particular one
+
+
+def applyChanges(tables, changes, settings=ControllerConfig.DEFAULTS):
+    '''
+    Returns a copy of tables with the changes applied, the watering times and intervals offered those of the
+    controller settings (ControllerConfig.py), raises ConfigChanges.changeError if one is not valid.
+    '''
+    tables = ConfigChanges.copyTables(tables)
+    options = {'wateringTimes': settings['WATERING_TIMES'], 'intervals': settings['INTERVALS'], 'timerTypes': TIMER_TYPES,
+               'days': DAYS, 'relayCount': RELAY_COUNT}
+    ConfigChanges.applyChanges(changes, tables, options, time.time())
+    return tables
+
+
+def startSeconds(startTime):
+    '''
+    Returns the seconds after midnight of a timer start time, i.e. '8:00PM'.
+    '''
+    clock = datetime.datetime.strptime(startTime, '%I:%M%p')
+    return clock.hour * 3600 + clock.minute * 60
+
+
+def timerTriggers(timerTable, days):
+    '''
+    Returns a (days, timers) boolean array of the days each timer triggers on.
+    '''
+    dayNumbers = numpy.arange(len(days))
+    weekdays = (days.astype(int) + 4) % 7  # 1970-01-01 was a Thursday, Sunday is 0 as DAYS
+    triggers = numpy.zeros((len(days), len(timerTable)), dtype=bool)
+    for timer, settings in enumerate(timerTable):
+        if settings['Type'] == 'INT':
+            triggers[:, timer] = dayNumbers % settings['Interval'] == 0
+        else:
+            checked = numpy.array([settings[day] == 'checked' for day in DAYS])
+            triggers[:, timer] = checked[weekdays]
+    return triggers
+
+
+def queueEntries(zoneTable, timerTable):
+    '''
+    Returns the queue entries a day can have, in the order they are queued: [(timer, [zones])].
+    '''
+    entries = []
+    for timer in sorted(range(len(timerTable)), key=lambda timer: startSeconds(timerTable[timer]['startTime'])):
+        zones = [zone for zone in range(len(zoneTable))
+                 if zoneTable[zone]['timer'] - 1 == timer and zoneTable[zone]['wateringTime'] != 0]
+        entries.extend((timer, [zone]) for zone in zones if not zoneTable[zone]['multiZone'])
+        multiZones = [zone for zone in zones if zoneTable[zone]['multiZone']]
+        if multiZones:
+            entries.append((timer, multiZones))
+    return entries
+
+
+def blackoutWindows(rows, days):
+    '''
+    Returns the blackout windows which may hold each day's queue as two (days, BLACKOUT_COUNT) arrays of their starts
+    and ends in seconds from the day's midnight, in order, empty windows at Scheduler.END_OF_TIME where a day has
+    fewer.  None if the windows cover the whole week, nothing scheduled ever runs.
+    '''
+    calendar = Blackout.blackoutCalendar(rows)
+    if calendar.always:
+        return None
+    starts = numpy.full((len(days), BLACKOUT_COUNT), float(Scheduler.END_OF_TIME))
+    ends = starts.copy()
+    if not calendar.weeklyStarts and not calendar.onceStarts:
+        return starts, ends
+    for day, date in enumerate(days.astype(datetime.date)):
+        midnight = datetime.datetime.combine(date, datetime.time())
+        for window, (start, end) in enumerate(calendar.upcoming(midnight, BLACKOUT_COUNT)):
+            start, end = (start - midnight).total_seconds(), (end - midnight).total_seconds()
+            if start >= BLACKOUT_SPAN:
+                break
+            starts[day, window], ends[day, window] = start, end
+    return starts, ends
+
+
+def backtest(tables, days, multipliers=None, dogRate=0.0, flows=None, seed=0):
+    '''
+    Replays a configuration over days.
+
+    Args:
+        tables (dictionary): the NVM tables, a configuration without a blackouts table has no blackout windows
+        days (datetime64[D] array): consecutive days
+        multipliers (array): (days, zones) weather multipliers, NaN for none, used if Weather Adjust is on
+        dogRate (float): dog detections a day on each zone with dog detect on, used if dog mode is on
+        flows (list): gallons per minute of each zone, DEFAULT_FLOW for zones past the end
+        seed (int): seed of the dog detections, the same for every scenario so they are comparable
+
+    Returns:
+        dictionary of results
+    '''
+    zoneTable, timerTable, config = tables['zoneTable'], tables['timerTable'], tables['config']
+    zoneCount = len(zoneTable)
+    flow = numpy.full(zoneCount, DEFAULT_FLOW)
+    configured = numpy.asarray((flows or [])[:zoneCount], dtype=float)
+    flow[:len(configured)] = configured
+    triggers = timerTriggers(timerTable, days)
+    starts = numpy.array([startSeconds(timer['startTime']) for timer in timerTable], dtype=float)
+
+    # Watering seconds of every zone on every day
+    timers = numpy.array([zone['timer'] - 1 for zone in zoneTable])
+    minutes = numpy.array([zone['wateringTime'] for zone in zoneTable], dtype=float)
+    valid = (timers >= 0) & (timers < len(timerTable)) & (minutes > 0)
+    watered = numpy.zeros((len(days), zoneCount), dtype=bool)
+    watered[:, valid] = triggers[:, timers[valid]]
+    scale = numpy.ones((len(days), zoneCount))
+    if config.get('weatherAdjust') and multipliers is not None:
+        scale = numpy.nan_to_num(multipliers[:, :zoneCount], nan=1.0)
+    detections = numpy.zeros((len(days), zoneCount))
+    if config.get('dogMode') and dogRate > 0:
+        dogZones = numpy.array([zone['dogDetectOn'] for zone in zoneTable])
+        detections = numpy.random.default_rng(seed).poisson(dogRate, (len(days), zoneCount)) * dogZones
+    # detections since the previous watering of each zone, from cumulative sums up to the day before
+    cumulative = numpy.vstack((numpy.zeros(zoneCount), numpy.cumsum(detections, axis=0)))
+    dayNumbers = numpy.arange(len(days))[:, None]
+    previous = numpy.maximum.accumulate(numpy.where(watered, dayNumbers, -1), axis=0)
+    previous = numpy.vstack((numpy.full(zoneCount, -1), previous[:-1]))
+    detectCount = cumulative[:-1] - numpy.take_along_axis(cumulative, previous + 1, axis=0)
+    detectCount += numpy.array([zone['detectCount'] for zone in zoneTable]) * (previous < 0)  # counted before the first day
+    seconds = numpy.maximum(Scheduler.MIN_WATERING_TIME, 60 * minutes * scale - Scheduler.DOG_WARNING_DURATION * detectCount)
+    seconds = numpy.where(watered & (scale > 0), seconds, 0)
+    blackouts = blackoutWindows(tables.get('blackouts', []), days)
+    if config.get('allOff') or blackouts is None:
+        seconds[:] = 0
+        detections[:] = 0
+    skipped = int(numpy.count_nonzero(watered & (scale <= 0)))
+
+    # The queue, one entry at a time for every day at once
+    downTimer = tables['scheduledDownTime']['timer'] - 1
+    downDuration = 60 * tables['scheduledDownTime']['duration']
+    downStart = numpy.full(len(days), numpy.inf)
+    if 0 <= downTimer < len(timerTable):
+        downStart[triggers[:, downTimer]] = starts[downTimer]
+    downEnd = downStart + downDuration
+    previousEnd = numpy.full(len(days), -numpy.inf)
+    firstStart = numpy.full(len(days), numpy.inf)
+    lastEnd = numpy.full(len(days), -numpy.inf)
+    peakFlow = numpy.zeros(len(days))
+    held = numpy.zeros(len(days), dtype=int)
+    blackoutStarts, blackoutEnds = blackouts if blackouts is not None else numpy.zeros((2, len(days), 0))
+    for timer, zones in queueEntries(zoneTable, timerTable):
+        duration = seconds[:, zones].max(axis=1)
+        active = duration > 0
+        start = numpy.maximum(starts[timer], previousEnd)
+        start = numpy.where((start >= downStart) & (start < downEnd), downEnd, start)
+        end = start + duration
+        end = numpy.where((start < downStart) & (downStart < end), end + downDuration, end)
+        for window in range(blackoutStarts.shape[1]): # in order, a window holds the entry until it ends
+            blackoutStart, blackoutEnd = blackoutStarts[:, window], blackoutEnds[:, window]
+            late = active & (start >= blackoutStart) & (start < blackoutEnd)
+            stretched = active & (start < blackoutStart) & (blackoutStart < end)
+            held += late | stretched
+            end = numpy.where(late, end + blackoutEnd - start, numpy.where(stretched, end + blackoutEnd - blackoutStart, end))
+            start = numpy.where(late, blackoutEnd, start)
+        previousEnd = numpy.where(active, end, previousEnd)
+        firstStart = numpy.where(active, numpy.minimum(firstStart, start), firstStart)
+        lastEnd = numpy.where(active, numpy.maximum(lastEnd, end), lastEnd)
+        peakFlow = numpy.maximum(peakFlow, ((seconds[:, zones] > 0) * flow[zones]).sum(axis=1))
+
+    wateringDays = numpy.isfinite(firstStart)
+    window = numpy.where(wateringDays, lastEnd - firstStart, 0)
+    earliest = starts.min() if len(starts) else 0
+    gallons = (seconds * flow).sum(axis=0) / 60
+    dogGallons = (detections * Scheduler.DOG_WARNING_DURATION * flow).sum() / 60
+    return {'days'            : len(days),
+            'wateringDays'    : int(wateringDays.sum()),
+            'gallons'         : float(gallons.sum() + dogGallons),
+            'dogGallons'      : float(dogGallons),
+            'zoneGallons'     : {zone['name']: round(float(value), 1) for zone, value in zip(zoneTable, gallons)},
+            'peakFlow'        : float(peakFlow.max(initial=0)),
+            'meanWindowHours' : float(window[wateringDays].mean() / 3600) if wateringDays.any() else 0.0,
+            'maxWindowHours'  : float(window.max(initial=0) / 3600),
+            'overruns'        : int(numpy.count_nonzero(lastEnd > DAY + earliest)),
+            'blackoutHolds'   : int(held.sum()),
+            'skipped'         : skipped}
+
+
+def runScenario(scenario):
+    '''
+    ProcessPoolExecutor worker, returns (name, results, seconds).
+    '''
+    name, tables, days, multipliers, dogRate, flows = scenario
+    start = time.perf_counter()
+    results = backtest(tables, days, multipliers, dogRate, flows)
+    return name, results, time.perf_counter() - start
+
+
+def weatherMultipliers(directory, days):
+    '''
+    Returns the (days, zones) multipliers a watering on each day would use, the previous day's, NaN without data.
+    '''
+    settings, records = WeatherAdjust.readFiles([entry.path for entry in WeatherAdjust.weatherFiles(directory)])
+    multipliers = numpy.full((len(days), WeatherAdjust.MAX_ZONES), numpy.nan)
+    if not records:
+        return multipliers
+    weatherDays, tmin, tmax, rain = WeatherAdjust.dailyWeather(records)
+    et0, deficits, weather = WeatherAdjust.computeMultipliers(weatherDays, tmin, tmax, rain, settings)
+    rows = (days - weatherDays[0]).astype(int) - 1
+    known = (rows >= 0) & (rows < len(weatherDays))
+    multipliers[known] = weather[rows[known]]
+    return multipliers
+
+
+def weatherDays(directory):
+    '''
+    Returns the first and last day of the weather records in directory, None if there are none.
+    '''
+    settings, records = WeatherAdjust.readFiles([entry.path for entry in WeatherAdjust.weatherFiles(directory)])
+    return (min(records), max(records)) if records else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay controller configurations over historical years')
+    parser.add_argument('configs', nargs='+', help='NVM files (sprinklerNVM.pkl format)')
+    parser.add_argument('--changes', action='append', default=[], help='JSON list of changes, a candidate for every config')
+    parser.add_argument('--weather', help='weather directory (WeatherAdjust.py), the days replayed default to its records')
+    parser.add_argument('--start', help='first day, YYYY-MM-DD, default January 1st of last year')
+    parser.add_argument('--years', type=float, help=f'years to replay, default {DEFAULT_YEARS} or the weather records')
+    parser.add_argument('--dogRate', type=float, default=0.0, help='dog detections a day per dog detect zone')
+    parser.add_argument('--flow', type=float, default=DEFAULT_FLOW, help='gallons per minute of every zone')
+    parser.add_argument('--flows', help='JSON list of gallons per minute by zone')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='scenarios run at once')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--config', default='sc_config.txt', help='controller configuration file, for the watering times and intervals')
+    args = parser.parse_args()
+    try:
+        settings = ControllerConfig.readConfig(args.config)
+    except (ControllerConfig.configError, OSError) as error:
+        parser.error(f"{args.config}: {error}")
+
+    recorded = weatherDays(args.weather) if args.weather else None
+    if args.start:
+        first = datetime.date.fromisoformat(args.start)
+    elif recorded and not args.years:
+        first = recorded[0]
+    else:
+        first = datetime.date(datetime.date.today().year - 1, 1, 1)
+    if args.years or not recorded:
+        count = round(365.25 * (args.years or DEFAULT_YEARS))
+    else:
+        count = (recorded[1] - first).days + 1
+    days = numpy.arange(numpy.datetime64(first), numpy.datetime64(first) + count)
+    multipliers = weatherMultipliers(args.weather, days) if args.weather else None
+    flows = []
+    if args.flows:
+        with open(args.flows) as flowsFile:
+            flows = [args.flow if value is None else value for value in json.load(flowsFile)]
+    flows += [args.flow] * WeatherAdjust.MAX_ZONES
+
+    scenarios = []
+    for path in args.configs:
+        tables = ConfigChanges.readTables(path)
+        name = os.path.basename(path)
+        scenarios.append((name, tables, days, multipliers, args.dogRate, flows))
+        for changesPath in args.changes:
+            with open(changesPath) as changesFile:
+                changes = json.load(changesFile)
+            try:
+                scenarios.append((f"{name} + {os.path.basename(changesPath)}", applyChanges(tables, changes, settings), days, multipliers, args.dogRate, flows))
+            except ConfigChanges.changeError as error:
+                parser.error(f"{changesPath} change {error.index}: {error.value}")
+
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(args.workers, len(scenarios))) as pool:
+        results = list(pool.map(runScenario, scenarios))
+    elapsed = time.perf_counter() - start
+
+    if args.json:
+        print(json.dumps({name: result for name, result, seconds in results}, indent=2))
+    else:
+        print(f"{len(days)} days from {days[0]}, {len(scenarios)} scenarios in {elapsed:.2f}s")
+        print(f"{'scenario':40} {'gallons':>10} {'peak gpm':>9} {'window h':>9} {'max h':>7} {'days':>5} {'overruns':>8} {'skipped':>7}")
+        for name, result, seconds in results:
+            print(f"{name[:40]:40} {result['gallons']:10.0f} {result['peakFlow']:9.1f} {result['meanWindowHours']:9.2f} "
+                  f"{result['maxWindowHours']:7.2f} {result['wateringDays']:5} {result['overruns']:8} {result['skipped']:7}")
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+'''
+Message to ack latency of the Dog Detector JSON server (JsonServer.py) with many detectors connected at once.
+
+Each client holds its own connection and sends WatchDog / Dog Warning messages back to back, waiting for every
+ack, using newline delimited, length prefixed and (legacy) unterminated framing in turn, with some messages split
+across writes.  Dog Warnings are handled by a no-op handler, the relays are not involved.  With the in process
+server the client threads share the interpreter with the server, use --host for latency under many clients.
+
+Examples:
+    # in process server on an ephemeral port
+    python Benchmarks/detectorLatency.py --clients 16 --messages 2000
+
+    # a running controller
+    python Benchmarks/detectorLatency.py --host 192.168.1.20 --port 2579 --type WatchDog
+'''
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import JsonServer
+
+FRAMINGS = ('newline', 'length', 'legacy')
+
+
+def encode(message, framing):
+    data = json.dumps(message).encode('utf-8')
+    if framing == 'length':
+        return struct.pack('>I', len(data)) + data
+    if framing == 'newline':
+        return data + b'\n'
+    return data
+
+
+def readAck(sock, buffer, decoder):
+    while True:
+        messages = decoder.feed(buffer.pop()) if buffer else []
+        if messages:
+            return messages[0][0]
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        buffer.append(data)
+
+
+def runClient(host, port, messages, messageType, latencies, errors):
+    decoder = JsonServer.frameDecoder()
+    with socket.create_connection((host, port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = []
+        for count in range(messages):
+            framing = FRAMINGS[count % len(FRAMINGS)]
+            frame = encode({"Type": messageType}, framing)
+            start = time.perf_counter()
+            if count % 7 == 0:  # split across two writes
+                sock.sendall(frame[:5])
+                sock.sendall(frame[5:])
+            else:
+                sock.sendall(frame)
+            ack = readAck(sock, buffer, decoder)
+            latencies.append(time.perf_counter() - start)
+            if ack.get("Type") != JsonServer.ACKS.get(messageType):
+                errors.append(ack)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure Dog Detector message to ack latency')
+    parser.add_argument('--host', help='server to measure, default an in process server')
+    parser.add_argument('--port', type=int, default=JsonServer.JSON_SERVER_PORT)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=1000, help='messages per client')
+    parser.add_argument('--type', default='Dog Warning', choices=sorted(JsonServer.ACKS))
+    args = parser.parse_args()
+
+    host, port = args.host, args.port
+    if host is None:
+        server = JsonServer.jsonServer({"Dog Warning": lambda message, peer: None}, host='127.0.0.1', port=0)
+        server.start()
+        host, port = '127.0.0.1', server.port
+
+    latencies, errors = [], []
+    threads = [threading.Thread(target=runClient, args=(host, port, args.messages, args.type, latencies, errors))
+               for _ in range(args.clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    def percentile(fraction):
+        return 1e6 * latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+    print(f"{len(latencies)} messages from {args.clients} clients in {elapsed:.2f}s, {len(latencies) / elapsed:.0f} msg/s, {len(errors)} bad acks")
+    print(f"ack latency us  p50 {percentile(0.50):.0f}  p95 {percentile(0.95):.0f}  p99 {percentile(0.99):.0f}  max {1e6 * latencies[-1]:.0f}")
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+'''
+End to end Dog Warning latency: from the detector sending an event to the relay register write on the
+(simulated) I2C bus, for each of the detector paths:
+
+    tcp         - JSON message on an established connection
+    tcpConnect  - new connection per event, as a detector reconnecting after a drop
+    udp         - signed UDP event datagram
+
+The JSON server (JsonServer.py), dog mode scheduler (DogMode.py) and relay controller (RelayController.py) run in
+process with Simulation/smbus.py as the bus.  Each event turns the dog mode zone on and the spray is left to end
+before the next event, so every event measures a full off -> on transition.  RelayController.closeNOrelays sleeps
+after turning relays off, which limits the event rate but is not part of the measured latency.
+
+Example:
+    python Benchmarks/dogLatency.py --events 100
+'''
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'Simulation'))
+import RelayController
+import DogMode
+import JsonServer
+
+ADDRESS_LIST = [0x3f, 0x3b]
+DOG_ZONE     = 0
+KEY          = b'benchmark key'
+PATHS        = ('tcp', 'tcpConnect', 'udp')
+
+
+class relayProbe:
+    """
+    Records when a non zero OutPort value is written, i.e. the dog mode zone's relay closed.
+    """
+    def __init__(self, bus):
+        self.write    = bus.write_byte_data
+        self.closed   = threading.Event()
+        self.opened   = threading.Event()
+        self.closedAt = None
+        bus.write_byte_data = self.writeByteData
+
+    def writeByteData(self, address, register, value):
+        result = self.write(address, register, value)
+        if register == RelayController.addressMap['OutPort'] and address == ADDRESS_LIST[0]:
+            if value:
+                self.closedAt = time.perf_counter()
+                self.closed.set()
+            else:
+                self.opened.set()
+        return result
+
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(fraction * len(sortedValues)))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure Dog Warning event to relay latency for the TCP and UDP paths')
+    parser.add_argument('--events', type=int, default=50, help='events per path')
+    parser.add_argument('--path', action='append', choices=PATHS, help='path(s) to measure, default all')
+    args = parser.parse_args()
+
+    RelayController.defaultBus.verbose(-1)
+    probe = relayProbe(RelayController.defaultBus)
+    relays = RelayController.relayCont(ADDRESS_LIST)
+    relays.open()
+    zonesOn = set()
+    relayLock = threading.Lock()
+
+    def turnOn(zones):
+        with relayLock:
+            zonesOn.update(zones)
+            relays.closeNOrelays([zone + 1 for zone in zonesOn])
+        return zones
+
+    def turnOff(sprayed):
+        with relayLock:
+            zonesOn.difference_update(sprayed)
+            relays.closeNOrelays([zone + 1 for zone in zonesOn])
+
+    dogMode = DogMode.dogScheduler(lambda: [DOG_ZONE], turnOn, turnOff, warningDuration=0.01, maxDuration=0.01,
+                                   cooldown=0, burst=1e9, ratePerHour=1e12)
+    dogMode.start()
+    server = JsonServer.jsonServer({"Dog Warning": lambda message, peer: dogMode.detect()}, host='127.0.0.1', port=0, udpKey=KEY)
+    server.start()
+
+    tcp = socket.create_connection(('127.0.0.1', server.port))
+    tcp.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    warning = json.dumps({"Type": "Dog Warning"}).encode('utf-8') + b'\n'
+    seq = 0
+
+    def send(path):
+        global seq
+        if path == 'tcp':
+            tcp.sendall(warning)
+        elif path == 'tcpConnect':
+            with socket.create_connection(('127.0.0.1', server.port)) as connection:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                connection.sendall(warning)
+                connection.recv(64)
+        else:
+            seq += 1
+            udp.sendto(JsonServer.encodeEvent(KEY, 1, 1, seq), ('127.0.0.1', server.udpPort))
+
+    for path in args.path or PATHS:
+        latencies = []
+        for _ in range(args.events):
+            probe.closed.clear()
+            probe.opened.clear()
+            start = time.perf_counter()
+            send(path)
+            if not probe.closed.wait(5):
+                print(f"{path}: relay did not close")
+                break
+            latencies.append(probe.closedAt - start)
+            probe.opened.wait(5)  # spray over, the zone is off again
+            time.sleep(0.3)       # closeNOrelays sleeps after turning the relay off
+        latencies.sort()
+        if latencies:
+            print(f"{path:11s} {len(latencies):4d} events  event to relay us  p50 {1e6 * percentile(latencies, 0.5):7.0f}  "
+                  f"p95 {1e6 * percentile(latencies, 0.95):7.0f}  p99 {1e6 * percentile(latencies, 0.99):7.0f}  max {1e6 * latencies[-1]:7.0f}")
@@ -0,0 +1,327 @@
+#!/usr/bin/python
+'''
+HTTP load generator and scenario suite for the SprinklerController Flask UI and API.
+
+A number of simulated clients (phones, an automation system ...) each hold a keep-alive connection and issue requests
+drawn from a weighted scenario for a fixed duration, while the controller's timer thread runs and relay changes go
+through the (simulated) I2C bus with its sleeps and retries.  The run reports throughput, p50 / p95 / p99 latency and
+error rate per scenario and samples the CPU and RSS of the controller process from /proc.
+
+Each result is appended, tagged with the git commit, to Benchmarks/results/loadTest.jsonl so runs can be compared
+across commits with --compare.
+
+Examples:
+    # start a simulated controller (Simulation/smbus.py on the path) and run every scenario
+    python Benchmarks/loadTest.py --launch
+
+    # run the mixed scenario against an already running controller
+    python Benchmarks/loadTest.py --url http://127.0.0.1:5000 --pid 1234 --scenario mixed --clients 8 --duration 30
+
+    # compare the latest results of this commit with the previous commit measured
+    python Benchmarks/loadTest.py --compare
+
+--launch requires private.py to exist (see README.md).  The launched controller uses a scratch NVM file so the
+repository's sprinklerNVM.pkl is not modified.
+'''
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+REPO_DIR     = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FILE = os.path.join(REPO_DIR, 'Benchmarks', 'results', 'loadTest.jsonl')
+NUM_ZONES    = 9
+WATERING     = [0, 3, 5, 10, 15, 20, 25, 30, 40, 50, 60, 90, 120]
+
+
+def formBody(fields):
+    return urllib.parse.urlencode(fields), 'application/x-www-form-urlencoded'
+
+
+def jsonBody(document):
+    return json.dumps(document), 'application/json'
+
+
+'''
+Scenario requests are (weight, name, method, path, body) where body is None or a function of the zone index returning
+(body, content type).  A zone index is drawn for every request and substituted for {zone} in the path.
+'''
+def zoneToggle(zone):
+    return formBody({'zoneButton': f"{zone} on {random.choice(['on', 'off'])}"})
+
+def zoneSelect(zone):
+    return formBody({f"{zone} wateringTime": random.choice(WATERING)})
+
+def zoneFormPost(zone):
+    fields = {f"{zone} wateringTime": random.choice(WATERING) for zone in range(NUM_ZONES)}
+    fields.update({f"{zone} timer": 1 for zone in range(NUM_ZONES)})
+    fields['saveButton'] = 'save'
+    return formBody(fields)
+
+def timerDayToggle(zone):
+    return formBody({f"0 {random.choice(['Sunday', 'Monday', 'Wednesday', 'Friday'])}": random.choice(['on', ''])})
+
+def settingsPost(zone):
+    return formBody({'multiZone': random.choice(WATERING[1:]), 'singleZone': random.choice(WATERING[1:]), 'settingButton': 'save'})
+
+def apiZoneSelect(zone):
+    return jsonBody({'field': 'wateringTime', 'value': random.choice(WATERING)})
+
+def apiBatch(zone):
+    return jsonBody({'changes': [{'table': 'zoneTable', 'index': zone, 'field': 'wateringTime', 'value': random.choice(WATERING)}
+                                 for zone in range(NUM_ZONES)]})
+
+SCENARIOS = {
+    'browse':   [(4, 'GET /zones',          'GET',  '/zones',    None),
+                 (2, 'GET /timers',         'GET',  '/timers',   None),
+                 (1, 'GET /settings',       'GET',  '/settings', None)],
+    'mixed':    [(5, 'GET /zones',          'GET',  '/zones',    None),
+                 (2, 'GET /timers',         'GET',  '/timers',   None),
+                 (1, 'GET /settings',       'GET',  '/settings', None),
+                 (2, 'POST /zones/<i> sel', 'POST', '/zones/{zone}', zoneSelect),
+                 (1, 'POST /zones/<i> btn', 'POST', '/zones/{zone}', zoneToggle),
+                 (1, 'POST /timers/0',      'POST', '/timers/0', timerDayToggle)],
+    'forms':    [(3, 'POST /zones',         'POST', '/zones',    zoneFormPost),
+                 (1, 'POST /settings',      'POST', '/settings', settingsPost)],
+    'api':      [(4, 'GET /api/zones',      'GET',  '/api/zones', None),
+                 (2, 'POST /api/zones/<i>', 'POST', '/api/zones/{zone}', apiZoneSelect),
+                 (1, 'POST /api/batch',     'POST', '/api/batch', apiBatch),
+                 (1, 'GET /api/config',     'GET',  '/api/config', None)],
+    'relays':   [(1, 'POST /zones/<i> btn', 'POST', '/zones/{zone}', zoneToggle)],
+}
+
+
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return None
+    return sortedValues[min(len(sortedValues) - 1, int(fraction * len(sortedValues)))]
+
+
+class processSampler:
+    """
+    Samples CPU time and RSS of a process from /proc while a scenario runs.
+    """
+    def __init__(self, pid, interval=0.5):
+        self.pid      = pid
+        self.interval = interval
+        self.samples  = []
+        self.stopped  = threading.Event()
+        self.thread   = threading.Thread(target=self.run, daemon=True)
+
+    def read(self):
+        with open(f"/proc/{self.pid}/stat") as statFile:
+            fields = statFile.read().rsplit(')', 1)[1].split()
+        cpuSeconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime + stime
+        rssKiB = 0
+        with open(f"/proc/{self.pid}/status") as statusFile:
+            for line in statusFile:
+                if line.startswith('VmRSS:'):
+                    rssKiB = int(line.split()[1])
+        return time.monotonic(), cpuSeconds, rssKiB
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.samples.append(self.read())
+            except (OSError, IndexError, ValueError):
+                return
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        if self.pid:
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if len(self.samples) < 2:
+            return {}
+        cpu = [100 * (b[1] - a[1]) / (b[0] - a[0]) for a, b in zip(self.samples, self.samples[1:]) if b[0] > a[0]]
+        first, last = self.samples[0], self.samples[-1]
+        return {'cpuPercentMean': round(100 * (last[1] - first[1]) / (last[0] - first[0]), 1),
+                'cpuPercentMax':  round(max(cpu), 1),
+                'rssKiBStart':    first[2],
+                'rssKiBMax':      max(sample[2] for sample in self.samples),
+                'rssKiBEnd':      last[2]}
+
+
+def runClient(host, port, requests, weights, deadline, records, timeout):
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    while time.monotonic() < deadline:
+        weight, name, method, path, body = random.choices(requests, weights)[0]
+        zone = random.randrange(NUM_ZONES)
+        path = path.format(zone=zone)
+        headers = {'Accept-Encoding': 'gzip'}
+        payload = None
+        if body is not None:
+            payload, headers['Content-Type'] = body(zone)
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status < 400
+            if response.getheader('Connection', '').lower() == 'close':
+                connection.close()
+        except (OSError, http.client.HTTPException):
+            ok = False
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        records.append((name, time.perf_counter() - start, ok))
+    connection.close()
+
+
+def runScenario(scenario, url, clients, duration, pid, timeout):
+    parsed = urllib.parse.urlparse(url)
+    requests = SCENARIOS[scenario]
+    weights = [request[0] for request in requests]
+    records = []
+    sampler = processSampler(pid).start()
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=runClient, args=(parsed.hostname, parsed.port or 80, requests, weights, deadline, records, timeout))
+               for _ in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    resources = sampler.stop()
+
+    def summarize(entries):
+        latencies = sorted(latency for name, latency, ok in entries)
+        errors = sum(1 for name, latency, ok in entries if not ok)
+        return {'requests':      len(entries),
+                'throughput':    round(len(entries) / elapsed, 2),
+                'errorRate':     round(errors / len(entries), 4) if entries else None,
+                'p50ms':         round(1000 * percentile(latencies, 0.50), 2) if entries else None,
+                'p95ms':         round(1000 * percentile(latencies, 0.95), 2) if entries else None,
+                'p99ms':         round(1000 * percentile(latencies, 0.99), 2) if entries else None}
+
+    result = summarize(records)
+    result['perRequest'] = {name: summarize([record for record in records if record[0] == name])
+                            for name in sorted({record[0] for record in records})}
+    result['process'] = resources
+    return result
+
+
+def gitCommit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD'], cwd=REPO_DIR).returncode != 0
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def launchController(port):
+    '''
+    Starts SprinklerController.py with the simulated smbus module and a scratch NVM file, returning the process
+    once /zones responds.
+    '''
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join([os.path.join(REPO_DIR, 'Simulation'), REPO_DIR, environment.get('PYTHONPATH', '')])
+    scratch = tempfile.mkdtemp(prefix='sprinklerLoad')
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'SprinklerController.py'), '--nvmFile', os.path.join(scratch, 'sprinklerNVM.pkl'),
+                                '--port', str(port)], cwd=REPO_DIR, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"SprinklerController.py exited with {process.returncode}, is private.py present?")
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/zones')
+            if connection.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError("SprinklerController.py did not start serving within 30 seconds")
+
+
+def compare():
+    if not os.path.isfile(RESULTS_FILE):
+        print("No results recorded yet")
+        return
+    with open(RESULTS_FILE) as resultsFile:
+        results = [json.loads(line) for line in resultsFile if line.strip()]
+    commits = []
+    for result in results:
+        if result['commit'] not in commits:
+            commits.append(result['commit'])
+    current = commits[-1]
+    previous = commits[-2] if len(commits) > 1 else None
+    latest = {}
+    for result in results:
+        latest[(result['commit'], result['scenario'])] = result
+    print(f"{'scenario':10s} {'metric':14s} {previous or '-':>14s} {current:>14s} {'change':>8s}")
+    for scenario in SCENARIOS:
+        now = latest.get((current, scenario))
+        before = latest.get((previous, scenario))
+        if now is None:
+            continue
+        for metric in ('throughput', 'p50ms', 'p95ms', 'p99ms', 'errorRate'):
+            newValue = now[metric]
+            oldValue = before[metric] if before else None
+            change = f"{100 * (newValue - oldValue) / oldValue:+.1f}%" if oldValue and newValue is not None else ''
+            print(f"{scenario:10s} {metric:14s} {str(oldValue):>14s} {str(newValue):>14s} {change:>8s}")
+        for metric in ('cpuPercentMean', 'rssKiBMax'):
+            newValue = now['process'].get(metric)
+            oldValue = before['process'].get(metric) if before else None
+            print(f"{scenario:10s} {metric:14s} {str(oldValue):>14s} {str(newValue):>14s}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test the SprinklerController web UI and API')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='base url of a running controller')
+    parser.add_argument('--pid', type=int, help='process id of the controller, for CPU / RSS sampling')
+    parser.add_argument('--launch', action='store_true', help='start a simulated controller for the run')
+    parser.add_argument('--port', type=int, default=5077, help='port for the launched controller')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='scenario(s) to run, default all')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=20, help='seconds per scenario')
+    parser.add_argument('--timeout', type=float, default=10, help='per request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=2579)
+    parser.add_argument('--compare', action='store_true', help='compare the latest results of the last two commits measured')
+    parser.add_argument('--noSave', action='store_true', help='do not record the results')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare()
+        sys.exit(0)
+
+    random.seed(args.seed)
+    controller = None
+    url, pid = args.url, args.pid
+    if args.launch:
+        controller = launchController(args.port)
+        url, pid = f"http://127.0.0.1:{args.port}", controller.pid
+    try:
+        commit = gitCommit()
+        for scenario in args.scenario or list(SCENARIOS):
+            result = runScenario(scenario, url, args.clients, args.duration, pid, args.timeout)
+            result.update({'commit': commit, 'scenario': scenario, 'clients': args.clients, 'duration': args.duration,
+                           'time': datetime.datetime.now().isoformat(timespec='seconds')})
+            print(f"{scenario:8s} {result['throughput']:8.1f} req/s  p50 {result['p50ms']}ms  p95 {result['p95ms']}ms  "
+                  f"p99 {result['p99ms']}ms  errors {100 * (result['errorRate'] or 0):.2f}%  "
+                  f"cpu {result['process'].get('cpuPercentMean')}%  rss {result['process'].get('rssKiBMax')}KiB")
+            for name, summary in result['perRequest'].items():
+                print(f"    {name:22s} {summary['requests']:6d}  p50 {summary['p50ms']}ms  p99 {summary['p99ms']}ms  errors {summary['errorRate']}")
+            if not args.noSave:
+                os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+                with open(RESULTS_FILE, 'a') as resultsFile:
+                    resultsFile.write(json.dumps(result) + '\n')
+    finally:
+        if controller is not None:
+            controller.terminate()
+            controller.wait()
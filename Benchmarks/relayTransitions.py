@@ -0,0 +1,134 @@
+#!/usr/bin/python
+'''
+Relay transition sequencing under simulated back EMF: the same sequence of relay transitions is written with the
+cards written at once and with break before make (RelayController.py), on Simulation/smbus.py with its back EMF
+model, and the I2C statistics of each are compared.
+
+The transitions are those of the controller: a scheduled zone handing over to the next, multi zone groups starting
+and ending, dog mode sprays and manual zones coming and going.  Each is written as setRelays does, up to three
+attempts.  Per transition the table shows the time, the bus transactions, the registers found corrupt and rewritten,
+the attempts which failed (bus faults) and the transitions which left a relay or register wrong (actuation errors).
+
+The model's rates are not measurements of the hats, they only need to be high enough for the difference to show;
+compare the sprinkler_i2c_events_total counters at /metrics before and after on the real hardware.  The quiet gap
+and decay are scaled down from the controller's so a run takes seconds, keep the gap longer than the decay.
+
+--trace records the I2C trace (I2CTrace.py) of the cards written at once, for Benchmarks/replayTrace.py.
+
+Examples:
+    python Benchmarks/relayTransitions.py
+    python Benchmarks/relayTransitions.py --transitions 1000 --rate 0.5 --faultShare 0.3
+    python Benchmarks/relayTransitions.py --trace /tmp/trace.bin
+'''
+import argparse
+import os
+import random
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'Simulation'))
+import FlexPrint
+import RelayController
+import smbus
+
+ADDRESS_LIST = [0x3f, 0x3b]
+ATTEMPTS     = 3   # As setRelays
+MODES        = (('at once', False), ('break before make', True))
+
+
+def makeTransitions(count, relayCount, seed):
+    '''
+    Returns count relay lists, each the relays closed after a transition.
+    '''
+    generator = random.Random(seed)
+    relays = list(range(1, relayCount + 1))
+    closed = set()
+    transitions = []
+    for _ in range(count):
+        kind = generator.random()
+        if kind < 0.4:   # the scheduled zone (group) hands over to the next
+            scheduled = set(generator.sample(relays, generator.choice((1, 1, 2, 3))))
+            closed = {relay for relay in closed if generator.random() < 0.2} | scheduled
+        elif kind < 0.7: # a dog mode spray or manual zone starts or ends
+            closed ^= {generator.choice(relays)}
+        elif kind < 0.9: # everything off, the end of the watering
+            closed = set()
+        else:            # several zones at once, i.e. a large multi zone group
+            closed = set(generator.sample(relays, generator.randrange(4, 9)))
+        transitions.append(sorted(closed))
+    return transitions
+
+
+def expectedRegisters(relayList, cards):
+    values = [0] * cards
+    for relay in relayList:
+        values[(relay - 1) // RelayController.regSize] |= RelayController.relayMaskList[(relay - 1) % RelayController.regSize]
+    return values
+
+
+def runMode(breakBeforeMake, transitions, args, trace=None):
+    '''
+    Writes transitions with one sequencing, recording them to the I2C trace file trace, returns the statistics.
+    '''
+    bus = smbus.SMBus(1)
+    bus.verbose(-1)
+    relays = RelayController.relayCont(ADDRESS_LIST, bus=bus)
+    relays.open()
+    relays.sequencing(breakBeforeMake, args.gap)
+    bus.backEmf(args.rate, args.registerRate, args.faultShare, args.decay, seed=args.seed)
+    relays.counters.clear()
+    if trace:
+        relays.startTrace(trace)
+    times, failedAttempts, actuationErrors = [], 0, 0
+    for relayList in transitions:
+        start = time.perf_counter()
+        for _ in range(ATTEMPTS):
+            try:
+                relays.closeNOrelays(relayList)
+                break
+            except RelayController.relayError:
+                failedAttempts += 1
+        times.append(time.perf_counter() - start)
+        expected = expectedRegisters(relayList, len(ADDRESS_LIST))
+        for card, address in enumerate(ADDRESS_LIST):
+            registers = bus.memory[address]
+            if (registers[RelayController.addressMap['OutPort']] != expected[card] or
+                registers[RelayController.addressMap['Config']] != RelayController.ALL_ENABLE_RELAY_CONTROL or
+                registers[RelayController.addressMap['Polarity']] != RelayController.ALL_CONTROLS_NOT_INVERTED):
+                actuationErrors += 1
+                break
+    relays.stopTrace()
+    times.sort()
+    counters = relays.counters
+    return {'meanMs'         : 1e3 * sum(times) / len(times),
+            'p99Ms'          : 1e3 * times[int(0.99 * (len(times) - 1))],
+            'transactions'   : (counters['reads'] + counters['writes']) / len(transitions),
+            'corrupt'        : counters['corrupt'],
+            'rewrites'       : counters['rewrites'],
+            'failedAttempts' : failedAttempts,
+            'actuationErrors': actuationErrors,
+            'emf'            : dict(bus.emfCounts)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare relay transition sequencing under simulated back EMF')
+    parser.add_argument('--transitions', type=int, default=300)
+    parser.add_argument('--rate', type=float, default=0.3, help='probability a transaction in a transient is corrupted, per relay turned off')
+    parser.add_argument('--registerRate', type=float, default=0.02, help='probability a turn off corrupts a register directly, per relay')
+    parser.add_argument('--faultShare', type=float, default=0.2, help='share of the corrupted transactions which are bus faults')
+    parser.add_argument('--decay', type=float, default=0.01, help='seconds a back EMF transient lasts')
+    parser.add_argument('--gap', type=float, default=0.015, help='quiet gap, seconds (the controller uses RelayController.QUIET_GAP)')
+    parser.add_argument('--seed', type=int, default=2579)
+    parser.add_argument('--trace', help='file to record the I2C trace of the cards written at once to')
+    args = parser.parse_args()
+
+    FlexPrint.setLevel('RelayController', 'CRITICAL') # the corruption found is counted, not logged
+    transitions = makeTransitions(args.transitions, RelayController.regSize * len(ADDRESS_LIST), args.seed)
+    print(f"{'sequencing':18s} {'mean ms':>8s} {'p99 ms':>8s} {'I2C/trans':>9s} {'corrupt':>8s} {'rewrites':>8s} "
+          f"{'failed':>7s} {'wrong':>6s}  back EMF")
+    for name, breakBeforeMake in MODES:
+        result = runMode(breakBeforeMake, transitions, args, None if breakBeforeMake else args.trace)
+        print(f"{name:18s} {result['meanMs']:8.2f} {result['p99Ms']:8.2f} {result['transactions']:9.2f} {result['corrupt']:8d} "
+              f"{result['rewrites']:8d} {result['failedAttempts']:7d} {result['actuationErrors']:6d}  {result['emf']}")
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+'''
+Replays an I2C trace recorded in the field (I2C_TRACE in sc_config.txt, see I2CTrace.py) through the current
+relayCont (RelayController.py) on Simulation/smbus.py's ReplaySMBus, so a night of corruption can be re-run against
+new retry and check logic.  The transitions and checks of the trace are repeated in order, each transition with up
+to three attempts as setRelays, and the outcomes and transition latency are compared with those recorded:
+
+    transactions    - bus reads and writes
+    corruptReads    - reads which did not return the value last written
+    busErrors       - transactions which raised
+    rewrites        - registers rewritten by the check (replay only)
+    failedAttempts  - transition attempts which raised (replay only)
+
+With --realTime every transaction takes its recorded duration and the transitions start at their recorded times, so
+a trace takes as long to replay as it took to record; by default it is replayed as fast as possible, the quiet gaps
+of the logic under test included (--gap 0 leaves them out).
+
+Examples:
+    python Benchmarks/replayTrace.py i2c-trace.bin
+    python Benchmarks/replayTrace.py i2c-trace.bin --atOnce
+    python Benchmarks/replayTrace.py i2c-trace.bin --realTime
+    python Benchmarks/relayTransitions.py --trace /tmp/trace.bin && python Benchmarks/replayTrace.py /tmp/trace.bin --gap 0.015
+'''
+import argparse
+import collections
+import datetime
+import os
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'Simulation'))
+import FlexPrint
+import I2CTrace
+import RelayController
+import smbus
+
+ATTEMPTS = 3 # As setRelays
+COLUMNS  = ('transactions', 'transitions', 'checks', 'corruptReads', 'busErrors', 'rewrites', 'failedAttempts', 'meanMs', 'p99Ms', 'maxMs')
+
+
+def relayList(cards, addressList):
+    '''
+    Returns the relay numbers, for closeNOrelays, of a transition's [(address, OutPort value)].
+    '''
+    relays = []
+    for address, value in cards:
+        card = addressList.index(address)
+        relays.extend(1 + card * RelayController.regSize + bit for bit, mask in enumerate(RelayController.relayMaskList) if value & mask)
+    return sorted(relays)
+
+
+def replay(records, realTime=False, breakBeforeMake=True, quietGap=RelayController.QUIET_GAP):
+    '''
+    Runs the transitions and checks of a trace through relayCont on a ReplaySMBus, returns the counts and transition
+    latencies.
+    '''
+    bus = smbus.ReplaySMBus(1, records, realTime=realTime)
+    bus.verbose(-1)
+    relays = None
+    latencies, failedAttempts, checks = [], 0, 0
+    initial = I2CTrace.shadows(records)
+    replayStart = time.perf_counter()
+    for (kind, moment, cards), items in I2CTrace.operations(records):
+        if realTime:
+            time.sleep(max(0, moment - (time.perf_counter() - replayStart)))
+        if kind == 'transition':
+            addressList = [address for address, value in cards]
+            if relays is None: # the hats were initialized, as open() does, before the trace started
+                relays = RelayController.relayCont(addressList, bus=bus)
+                relays.sequencing(breakBeforeMake, quietGap)
+                for address, shadow in zip(addressList, relays.shadowCopy):
+                    shadow.update({RelayController.addressMap['OutPort'] : RelayController.ALL_RELAYS_IN_NORMAL_STATE,
+                                   RelayController.addressMap['Polarity']: RelayController.ALL_CONTROLS_NOT_INVERTED,
+                                   RelayController.addressMap['Config']  : RelayController.ALL_ENABLE_RELAY_CONTROL})
+                    shadow.update(initial.get(address, {})) # as recording started, relays on included
+            elif addressList != relays.getAddressList():
+                relays.setAddressList(addressList)
+        if relays is None:
+            continue
+        checks += kind == 'check'
+        start = time.perf_counter()
+        for _ in range(ATTEMPTS):
+            try:
+                if kind == 'transition':
+                    relays.closeNOrelays(relayList(cards, relays.getAddressList()))
+                else:
+                    relays.checkState()
+                break
+            except RelayController.relayError:
+                failedAttempts += 1
+        if kind == 'transition':
+            latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    counters = relays.counters if relays else collections.Counter()
+    return {'transactions'   : counters['reads'] + counters['writes'],
+            'transitions'    : len(latencies),
+            'checks'         : checks,
+            'corruptReads'   : bus.replayCounts['flipped'],
+            'busErrors'      : counters['busErrors'],
+            'rewrites'       : counters['rewrites'],
+            'failedAttempts' : failedAttempts,
+            'meanMs'         : 1e3 * sum(latencies) / len(latencies) if latencies else 0,
+            'p99Ms'          : 1e3 * I2CTrace.percentile(latencies, 0.99),
+            'maxMs'          : 1e3 * latencies[-1] if latencies else 0,
+            'replay'         : dict(bus.replayCounts)}
+
+
+def row(name, result):
+    return f"{name:9s}" + ''.join(f"{result[column]:>15.6g}" if column in result else f"{'-':>15s}" for column in COLUMNS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay an I2C trace of the relay hats through the current relayCont')
+    parser.add_argument('trace', help='trace file recorded with I2C_TRACE')
+    parser.add_argument('--realTime', action='store_true', help='replay at the recorded timing, default as fast as possible')
+    parser.add_argument('--atOnce', action='store_true', help='write every card at once instead of break before make')
+    parser.add_argument('--gap', type=float, default=RelayController.QUIET_GAP, help='quiet gap, seconds')
+    parser.add_argument('--summary', action='store_true', help='only summarize the recorded trace')
+    args = parser.parse_args()
+
+    start, records = I2CTrace.readTrace(args.trace)
+    length = records[-1].time if records else 0
+    print(f"{args.trace}: started {datetime.datetime.fromtimestamp(start):%Y-%m-%d %H:%M:%S}, {length / 3600:.2f} hours, "
+          f"{len(records)} records")
+    print(f"{'':9s}" + ''.join(f"{column:>15s}" for column in COLUMNS))
+    print(row('recorded', I2CTrace.summarize(records)))
+    if not args.summary:
+        FlexPrint.setLevel('RelayController', 'CRITICAL') # the corruption found is counted, not logged
+        replayed = replay(records, args.realTime, not args.atOnce, args.gap)
+        print(row('replayed', replayed))
+        print(f"replay bus: {replayed['replay']}")
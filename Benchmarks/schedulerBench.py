@@ -0,0 +1,293 @@
+#!/usr/bin/python
+'''
+Micro-benchmark of the scheduler's decision core, Scheduler.schedulerStep(), without the state store, relays or
+clock around it.
+
+Each case is a generated configuration, from the 9 zones / 5 timers of a house up to 64 zones / 500 timers, with one
+of three schedules:
+
+    spread      - timer start times spread over the day
+    collision   - every timer starts at one of three times, so many zone groups are queued at once
+    downtime    - as spread, with a two hour down time every day in the middle of the watering
+
+and is stepped through simulated days at the controller's tick interval (TIMER_SAMPLE_INTERVAL).  The per-tick cost
+is the mean and p99 time of a step; the per-trigger cost is the extra time of the steps in which timers triggered,
+per timer triggered.
+
+The results are compared with the baselines in Benchmarks/schedulerBaseline.json and the run fails (exit status 1)
+if any case is slower than its baseline by more than the threshold.  So that a busy or frequency scaled machine is
+not taken for a regression, each case is preceded by a fixed pure Python calibration loop and the comparison is of
+the tick time relative to it.  Baselines are still machine specific, record them with --save on the machine the
+comparisons are made on.  Every run is also appended, tagged with the git commit, to
+Benchmarks/results/schedulerBench.jsonl.
+
+--restarts checks instead that a restart does not change the water delivered: a house's evening watering is stepped
+through without a restart and then with restarts at points of the watering, and after it, each restart losing the
+run time state and going back to the tables last persisted (SAVE_NOW at once, SAVE_SOON NVM_UPDATE_INTERVAL later,
+as SprinklerController.py).  The seconds each zone was on must match those without a restart to within two ticks,
+the on and off times are only seen at the ticks; the run fails (exit status 1) if they do not.
+
+Examples:
+    python Benchmarks/schedulerBench.py
+    python Benchmarks/schedulerBench.py --case 64x500-collision --days 4
+    python Benchmarks/schedulerBench.py --save
+    python Benchmarks/schedulerBench.py --restarts
+'''
+import argparse
+import copy
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+REPO_DIR      = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(REPO_DIR, 'Benchmarks', 'schedulerBaseline.json')
+RESULTS_FILE  = os.path.join(REPO_DIR, 'Benchmarks', 'results', 'schedulerBench.jsonl')
+sys.path.insert(0, REPO_DIR)
+import Scheduler
+
+TIMER_SAMPLE_INTERVAL = 45    # Seconds between scheduler passes, as SprinklerController.py
+NVM_UPDATE_INTERVAL   = 10    # Seconds before a SAVE_SOON is persisted, as SprinklerController.py
+SIZES                 = [(9, 5), (16, 20), (32, 100), (64, 500)]
+SCHEDULES             = ('spread', 'collision', 'downtime')
+DEFAULT_THRESHOLD     = 1.5   # a case fails if it takes more than this times its baseline
+DAYS                  = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+WATERING_TIMES        = [3, 5, 10, 15, 20, 25, 30]
+FIRST_DAY             = datetime.datetime(2026, 6, 1)
+RESTARTS              = [('mid zone',           '8:04PM',  60),
+                         ('between zones',      '8:21PM',  30),
+                         ('mid pass',           '8:30PM',  60),
+                         ('after a pass',       '8:50PM',  60),
+                         ('multi zone group',   '9:05PM', 300),
+                         ('long outage',        '8:40PM', 3600),
+                         ('second timer',       '10:03PM', 120),
+                         ('after the watering', '11:30PM', 60)]
+
+
+def clockText(minutes):
+    return (datetime.datetime(2000, 1, 1) + datetime.timedelta(minutes=minutes)).strftime("%-I:%M%p")
+
+
+def makeTables(zones, timers, schedule, seed):
+    '''
+    Returns the tables of a generated configuration.
+    '''
+    generator = random.Random(seed)
+    collisions = [clockText(minutes) for minutes in (5 * 60, 20 * 60, 22 * 60)]
+    timerTable = []
+    for timer in range(timers):
+        if schedule == 'collision':
+            startTime = generator.choice(collisions)
+        else:
+            startTime = clockText(generator.randrange(24 * 60))
+        settings = {'labeled': True, 'selected': False, 'startTime': startTime, 'Type': generator.choice(('INT', 'DoW')),
+                    'Interval': generator.choice((1, 2, 3)), 'lastTimeOn': 0}
+        settings.update({day: 'checked' if generator.random() < 0.5 else '' for day in DAYS})
+        timerTable.append(settings)
+    zoneTable = [{'name': f"Zone {zone + 1}", 'relay': zone + 1, 'on': False, 'wateringTime': generator.choice(WATERING_TIMES),
+                  'timer': generator.randrange(timers) + 1, 'multiZone': generator.random() < 0.3, 'dogDetectOn': False,
+                  'detectCount': generator.choice((0, 0, 1, 3)), 'manualStartTime': Scheduler.END_OF_TIME}
+                 for zone in range(zones)]
+    scheduledDownTime = {'duration': 0, 'timer': 0}
+    if schedule == 'downtime':
+        timerTable.append({'labeled': True, 'selected': False, 'startTime': clockText(21 * 60), 'Type': 'INT', 'Interval': 1,
+                           'lastTimeOn': 0, **{day: '' for day in DAYS}})
+        scheduledDownTime = {'duration': 120, 'timer': len(timerTable)}
+    return {'zoneTable': zoneTable, 'timerTable': timerTable, 'autoShutOff': {'multiZone': 60, 'singleZone': 15},
+            'scheduledDownTime': scheduledDownTime}
+
+
+def runCase(zones, timers, schedule, days, seed):
+    '''
+    Steps a generated configuration through days, returns the timings in microseconds.
+    '''
+    tables = makeTables(zones, timers, schedule, seed)
+    run = Scheduler.schedulerState()
+    timerTable = tables['timerTable']
+    start = FIRST_DAY.timestamp()
+    quiet, triggering, triggers, starts = [], [], 0, 0
+    for offset in range(0, days * 24 * 60 * 60, TIMER_SAMPLE_INTERVAL):
+        timeInSeconds = start + offset
+        currentDatetime = FIRST_DAY + datetime.timedelta(seconds=offset)
+        before = time.perf_counter()
+        result = Scheduler.schedulerStep(tables, run, timeInSeconds, currentDatetime)
+        elapsed = time.perf_counter() - before
+        triggered = sum(1 for timer in timerTable if timer['lastTimeOn'] == timeInSeconds)
+        if triggered:
+            triggering.append(elapsed)
+            triggers += triggered
+        else:
+            quiet.append(elapsed)
+        starts += result.relayMode == "as scheduled"
+    steps = sorted(quiet + triggering)
+    quietMean = sum(quiet) / len(quiet) if quiet else 0
+    perTrigger = (sum(triggering) - quietMean * len(triggering)) / triggers if triggers else 0
+    return {'steps'      : len(steps),
+            'triggers'   : triggers,
+            'starts'     : starts,
+            'tickUs'     : round(1e6 * sum(steps) / len(steps), 3),
+            'tickP99Us'  : round(1e6 * steps[int(0.99 * (len(steps) - 1))], 3),
+            'triggerUs'  : round(1e6 * max(perTrigger, 0), 3)}
+
+
+def houseTables():
+    '''
+    Returns the tables of a house: timer 0 at 8:00PM waters zones 0-3 for 10 minutes each, timer 1 at 9:00PM zones
+    4 and 5 on their own and 6-8 as a multi zone group, 5 to 15 minutes.  Both last ran the day before.
+    '''
+    lastTimeOn = (FIRST_DAY - datetime.timedelta(days=1)).replace(hour=20).timestamp()
+    timerTable = [{'labeled': True, 'selected': False, 'startTime': startTime, 'Type': 'INT', 'Interval': 1, 'lastTimeOn': lastTimeOn,
+                   **{day: '' for day in DAYS}} for startTime in ('8:00PM', '9:00PM')]
+    zones = [(10, 1, False)] * 4 + [(15, 2, False), (5, 2, False), (10, 2, True), (10, 2, True), (5, 2, True)]
+    zoneTable = [{'name': f"Zone {zone + 1}", 'relay': zone + 1, 'on': False, 'wateringTime': minutes, 'timer': timer,
+                  'multiZone': multiZone, 'dogDetectOn': False, 'detectCount': 0, 'manualStartTime': Scheduler.END_OF_TIME}
+                 for zone, (minutes, timer, multiZone) in enumerate(zones)]
+    return {'zoneTable': zoneTable, 'timerTable': timerTable, 'autoShutOff': {'multiZone': 60, 'singleZone': 15},
+            'scheduledDownTime': {'duration': 0, 'timer': 0}}
+
+
+def runEvening(restart=None):
+    '''
+    Steps the house from 7PM to 1AM, restarting at restart, (clock text, seconds the controller is down), returns the
+    seconds each zone was on.
+    '''
+    tables = houseTables()
+    run = Scheduler.schedulerState()
+    first = FIRST_DAY.replace(hour=19)
+    restartAt = downUntil = None
+    if restart:
+        clock = datetime.datetime.strptime(restart[0], '%I:%M%p')
+        restartAt = first.replace(hour=clock.hour, minute=clock.minute).timestamp()
+        downUntil = restartAt + restart[1]
+    saves = []  # (time persisted, tables)
+    delivered = [0] * len(tables['zoneTable'])
+    for offset in range(0, 6 * 60 * 60, TIMER_SAMPLE_INTERVAL):
+        timeInSeconds = first.timestamp() + offset
+        if restartAt is not None and timeInSeconds >= restartAt:
+            if timeInSeconds < downUntil:
+                continue
+            tables = copy.deepcopy(max((save for save in saves if save[0] <= restartAt), key=lambda save: save[0])[1])
+            for zone in tables['zoneTable']: # as SprinklerController.loadState()
+                zone['on'] = False
+                zone['manualStartTime'] = 0
+            run = Scheduler.schedulerState()
+            restartAt = None
+        result = Scheduler.schedulerStep(tables, run, timeInSeconds, first + datetime.timedelta(seconds=offset))
+        if result.save or not saves:
+            saves.append((timeInSeconds + (0 if result.save == Scheduler.SAVE_NOW else NVM_UPDATE_INTERVAL), copy.deepcopy(tables)))
+        for zone, settings in enumerate(tables['zoneTable']):
+            if settings['on'] and (restartAt is None or timeInSeconds + TIMER_SAMPLE_INTERVAL <= restartAt):
+                delivered[zone] += TIMER_SAMPLE_INTERVAL
+            elif settings['on']:
+                delivered[zone] += restartAt - timeInSeconds
+    return delivered
+
+
+def checkRestarts():
+    '''
+    Compares the water delivered with restarts to that without, returns the names of the restarts which differ.
+    '''
+    expected = runEvening()
+    failed = []
+    print(f"{'restart':20s} {'at':>8s} {'down s':>7s} {'scheduled s':>12s} {'delivered s':>12s} {'worst zone s':>13s}")
+    print(f"{'none':20s} {'-':>8s} {'-':>7s} {sum(expected):12d} {sum(expected):12d} {0:13d}")
+    for name, clock, down in RESTARTS:
+        delivered = runEvening((clock, down))
+        worst = max((got - want for got, want in zip(delivered, expected)), key=abs)
+        if abs(worst) > 2 * TIMER_SAMPLE_INTERVAL:
+            failed.append(name)
+        print(f"{name:20s} {clock:>8s} {down:7d} {sum(expected):12d} {round(sum(delivered)):12d} {round(worst):13d}"
+              f"{'  WRONG' if name in failed else ''}")
+    return failed
+
+
+def calibrate(rounds=5):
+    '''
+    Returns the fastest of rounds runs of a fixed loop of the dictionary, list and string work a step does, seconds.
+    '''
+    rows = [{'timer': row % 7, 'startTime': clockText(row), 'lastTimeOn': 0} for row in range(500)]
+    fastest = None
+    for _ in range(rounds):
+        before = time.perf_counter()
+        for _ in range(20):
+            [row for row in rows if row['startTime'] == '8:00PM' and row['lastTimeOn'] < 1e9]
+            {row['timer'] for row in rows}
+        elapsed = time.perf_counter() - before
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+    return fastest
+
+
+def gitCommit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD'], cwd=REPO_DIR).returncode != 0
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+if __name__ == "__main__":
+    cases = {f"{zones}x{timers}-{schedule}": (zones, timers, schedule) for zones, timers in SIZES for schedule in SCHEDULES}
+    parser = argparse.ArgumentParser(description='Benchmark Scheduler.schedulerStep against the recorded baselines')
+    parser.add_argument('--case', action='append', choices=sorted(cases), help='case(s) to run, default all')
+    parser.add_argument('--days', type=int, default=2, help='simulated days per case')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per case, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=2579)
+    parser.add_argument('--threshold', type=float, help=f'slowdown ratio which fails, default the baseline file\'s or {DEFAULT_THRESHOLD}')
+    parser.add_argument('--save', action='store_true', help='record the results as the baselines')
+    parser.add_argument('--noSave', action='store_true', help='do not append the results to the results file')
+    parser.add_argument('--restarts', action='store_true', help='check the water delivered across restarts instead')
+    args = parser.parse_args()
+
+    if args.restarts:
+        failed = checkRestarts()
+        if failed:
+            print(f"{len(failed)} restart(s) changed the water delivered: {', '.join(failed)}")
+        sys.exit(1 if failed else 0)
+
+    baselines = {'threshold': DEFAULT_THRESHOLD, 'cases': {}}
+    if os.path.isfile(BASELINE_FILE):
+        with open(BASELINE_FILE) as baselineFile:
+            baselines = json.load(baselineFile)
+    threshold = args.threshold or baselines.get('threshold', DEFAULT_THRESHOLD)
+
+    results = {}
+    regressions = []
+    print(f"{'case':22s} {'steps':>6s} {'triggers':>8s} {'tick us':>9s} {'p99 us':>9s} {'trigger us':>10s} {'baseline':>9s} {'ratio':>6s}")
+    for name in args.case or list(cases):
+        runs = []
+        for _ in range(args.repeat):
+            calibration = calibrate()
+            runs.append(runCase(*cases[name], args.days, args.seed))
+            calibration = (calibration + calibrate()) / 2
+            runs[-1]['relative'] = runs[-1]['tickUs'] / (1e6 * calibration)
+        result = min(runs, key=lambda run: run['relative'])
+        result['triggerUs'] = min(run['triggerUs'] for run in runs)
+        results[name] = result
+        baseline = baselines['cases'].get(name)
+        ratio = result['relative'] / baseline['relative'] if baseline else None
+        if ratio and ratio > threshold:
+            regressions.append(name)
+        print(f"{name:22s} {result['steps']:6d} {result['triggers']:8d} {result['tickUs']:9.2f} {result['tickP99Us']:9.2f} "
+              f"{result['triggerUs']:10.2f} {baseline['tickUs'] if baseline else '-':>9} {f'{ratio:.2f}' if ratio else '-':>6s}"
+              f"{'  REGRESSION' if name in regressions else ''}")
+
+    commit = gitCommit()
+    if not args.noSave:
+        os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+        with open(RESULTS_FILE, 'a') as resultsFile:
+            resultsFile.write(json.dumps({'commit': commit, 'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                                          'days': args.days, 'cases': results}) + '\n')
+    if args.save:
+        baselines['cases'].update(results)
+        baselines.update(threshold=threshold, commit=commit, days=args.days)
+        with open(BASELINE_FILE, 'w') as baselineFile:
+            json.dump(baselines, baselineFile, indent=2, sort_keys=True)
+            baselineFile.write('\n')
+        print(f"Baselines saved to {BASELINE_FILE}")
+    elif regressions:
+        print(f"{len(regressions)} case(s) slower than {threshold}x their baseline: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+'''
+Metrics (Metrics.py) per event cost and scrape check.
+
+- Times counter inc(), gauge set(), histogram observe() and a labelled observe() in a tight loop and reports the
+  cost per event, with a plain function call as the baseline.
+- Updates a counter and a histogram from many threads at once, some of which finish before the scrape, and checks
+  no event is lost.
+- Scrapes /metrics, from --url or the in process registry, and checks every line parses as the Prometheus text
+  format and every histogram's buckets are cumulative and end with +Inf equal to _count.
+
+Example:
+    python Benchmarks/scrapeMetrics.py
+    python Benchmarks/scrapeMetrics.py --url http://127.0.0.1:5000/metrics
+'''
+import argparse
+import math
+import os
+import re
+import sys
+import threading
+import timeit
+import urllib.request
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import Metrics
+
+SAMPLE_LINE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*",?)*\})? (\S+)$')
+LABEL_PAIR  = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def perEvent(statement, namespace, number):
+    return min(timeit.repeat(statement, globals=namespace, number=number, repeat=5)) / number
+
+
+def parse(text):
+    '''
+    Parses a scrape, returning {(name, labels): value} and raising ValueError on the first malformed line.
+    '''
+    samples = {}
+    types = {}
+    for lineNumber, line in enumerate(text.splitlines(), 1):
+        if not line:
+            continue
+        if line.startswith('#'):
+            parts = line.split(None, 3)
+            if len(parts) >= 4 and parts[1] == 'TYPE':
+                if parts[3] not in ('counter', 'gauge', 'histogram', 'summary', 'untyped'):
+                    raise ValueError(f"line {lineNumber}: unknown type {parts[3]}")
+                types[parts[2]] = parts[3]
+            continue
+        match = SAMPLE_LINE.match(line)
+        if match is None:
+            raise ValueError(f"line {lineNumber}: malformed sample {line!r}")
+        name, labels, value = match.group(1), match.group(2) or '', match.group(3)
+        samples[(name, tuple(LABEL_PAIR.findall(labels)))] = float(value.replace('+Inf', 'inf'))
+    return samples, types
+
+
+def checkHistograms(samples, types):
+    problems = []
+    for name, kind in types.items():
+        if kind != 'histogram':
+            continue
+        series = {}
+        for (sampleName, labels), value in samples.items():
+            if sampleName == name + '_bucket':
+                key = tuple(pair for pair in labels if pair[0] != 'le')
+                le = float(dict(labels)['le'].replace('+Inf', 'inf'))
+                series.setdefault(key, []).append((le, value))
+        for key, buckets in series.items():
+            buckets.sort()
+            counts = [count for le, count in buckets]
+            if counts != sorted(counts):
+                problems.append(f"{name}{key}: buckets not cumulative")
+            if buckets[-1][0] != math.inf:
+                problems.append(f"{name}{key}: no +Inf bucket")
+            elif samples.get((name + '_count', key)) != buckets[-1][1]:
+                problems.append(f"{name}{key}: +Inf bucket differs from _count")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the metrics per event cost and check a /metrics scrape')
+    parser.add_argument('--url', help='scrape this /metrics URL instead of the in process registry')
+    parser.add_argument('--events', type=int, default=200000, help='events per timing loop')
+    parser.add_argument('--threads', type=int, default=16, help='threads updating concurrently')
+    args = parser.parse_args()
+
+    counter = Metrics.registerCounter('benchmark_events_total', 'Benchmark counter')
+    gauge = Metrics.registerGauge('benchmark_level', 'Benchmark gauge')
+    histogram = Metrics.registerHistogram('benchmark_seconds', 'Benchmark histogram')
+    labelled = Metrics.registerHistogram('benchmark_route_seconds', 'Benchmark labelled histogram', ('route', 'method', 'status'))
+
+    def nothing(value=1):
+        pass
+
+    namespace = {'counter': counter, 'gauge': gauge, 'histogram': histogram, 'labelled': labelled, 'nothing': nothing}
+    print("Per event cost (ns)")
+    for label, statement in (('function call baseline', 'nothing(0.003)'),
+                             ('counter inc()', 'counter.inc()'),
+                             ('gauge set()', 'gauge.set(3)'),
+                             ('histogram observe()', 'histogram.observe(0.003)'),
+                             ('labels().observe()', "labelled.labels('/zones', 'GET', 200).observe(0.003)")):
+        print(f"    {label:24s} {1e9 * perEvent(statement, namespace, args.events):7.0f}")
+
+    perThread = args.events // args.threads
+    concurrent = Metrics.registerCounter('benchmark_concurrent_total', 'Concurrent counter')
+    concurrentSeconds = Metrics.registerHistogram('benchmark_concurrent_seconds', 'Concurrent histogram')
+
+    def update():
+        for _ in range(perThread):
+            concurrent.inc()
+            concurrentSeconds.observe(0.01)
+
+    threads = [threading.Thread(target=update) for _ in range(args.threads)]
+    for thread in threads[:args.threads // 2]:  # half finish, and are retired, before the first scrape
+        thread.start()
+        thread.join()
+    Metrics.render()
+    for thread in threads[args.threads // 2:]:
+        thread.start()
+    for thread in threads[args.threads // 2:]:
+        thread.join()
+    expected = perThread * args.threads
+    total, count = concurrent.default.value(), sum(concurrentSeconds.default.value()[:-1])  # buckets, without the sum
+    print(f"Concurrent updates from {args.threads} threads: counter {total}, histogram count {count}, "
+          f"expected {expected}  {'ok' if total == expected and count == expected else 'LOST EVENTS'}")
+
+    if args.url:
+        with urllib.request.urlopen(args.url, timeout=10) as response:
+            contentType = response.headers.get('Content-Type')
+            text = response.read().decode('utf-8')
+    else:
+        contentType = Metrics.CONTENT_TYPE
+        start = timeit.default_timer()
+        text = Metrics.render()
+        print(f"In process render of {len(text.splitlines())} lines took {1e3 * (timeit.default_timer() - start):.2f}ms")
+    try:
+        samples, types = parse(text)
+    except ValueError as error:
+        print(f"Scrape does not parse: {error}")
+        sys.exit(1)
+    problems = checkHistograms(samples, types)
+    for problem in problems:
+        print(f"    {problem}")
+    print(f"Scrape: {len(samples)} samples in {len(types)} families, Content-Type {contentType}  "
+          f"{'ok' if not problems else 'INVALID'}")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+'''
+This provides the blackout calendar, the windows in which scheduled watering is not allowed: municipal watering
+restrictions by weekday and hour, mowing days, one-off rain delays and maintenance holds.  Each window is a row of
+the blackouts table:
+
+    {'name': 'City restriction', 'repeat': 'weekly', 'days': 'Monday Wednesday Friday', 'start': '10:00AM', 'end': '6:00PM'}
+    {'name': 'Rain delay',       'repeat': 'once',   'days': '', 'start': '2026-10-20 06:00', 'end': '2026-10-22 06:00'}
+
+A weekly window whose end is not after its start runs past midnight into the next day.  Windows may overlap.
+
+The calendar merges the windows into two sorted lists of disjoint intervals, the weekly ones in seconds from Sunday
+midnight and the one-off ones in seconds of local time, so "is watering allowed now, and until when" is a bisection of
+each, O(log n) in the number of windows:
+
+    calendar = Blackout.blackoutCalendar(snap.blackouts)
+    allowed, until = calendar.status(localDatetime())   # until is None when nothing ends / starts a blackout
+
+Times are local wall clock times, as the timers' start times.
+'''
+import bisect
+import datetime
+
+WEEKLY, ONCE  = 'weekly', 'once'
+REPEATS       = (WEEKLY, ONCE)
+DAYS          = ('Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday')
+TIME_FORMAT   = '%I:%M%p'         # weekly windows, as the timers' start times
+DATE_FORMAT   = '%Y-%m-%d %H:%M'  # one-off windows
+DAY           = 24 * 60 * 60
+WEEK          = 7 * DAY
+EPOCH         = datetime.datetime(1970, 1, 4) # a Sunday, local seconds are counted from it
+UPCOMING      = 5 # Blackouts listed by upcoming()
+
+DEFAULT_ROW   = {'name': 'Blackout', 'repeat': WEEKLY, 'days': '', 'start': '12:00AM', 'end': '6:00AM'}
+
+
+def localSeconds(moment):
+    return (moment - EPOCH).total_seconds()
+
+
+def localDatetime(seconds):
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def parseDays(value):
+    '''
+    Returns the day names of value (a list or a string separated by spaces or commas, full names or three letter
+    abbreviations, any case) as a space separated string in week order.
+
+    Raises:
+        ValueError: a day is not recognized
+    '''
+    items = value if isinstance(value, (list, tuple)) else str(value).replace(',', ' ').split()
+    days = set()
+    for item in items:
+        matches = [day for day in DAYS if day.lower() == str(item).lower() or day[:3].lower() == str(item).lower()]
+        if not matches:
+            raise ValueError(f"{item} is not a day of the week")
+        days.add(matches[0])
+    return ' '.join(day for day in DAYS if day in days)
+
+
+def rowIntervals(row):
+    '''
+    Returns the intervals of a window, weekly ones as [(start, end)] in seconds from Sunday midnight (end may be
+    past WEEK), one-off ones in local seconds.
+
+    Raises:
+        ValueError, KeyError: the row is not a valid window
+    '''
+    if row['repeat'] == WEEKLY:
+        start = datetime.datetime.strptime(row['start'], TIME_FORMAT)
+        end = datetime.datetime.strptime(row['end'], TIME_FORMAT)
+        startSeconds = 3600 * start.hour + 60 * start.minute
+        endSeconds = 3600 * end.hour + 60 * end.minute
+        if endSeconds <= startSeconds:
+            endSeconds += DAY
+        return [(DAY * DAYS.index(day) + startSeconds, DAY * DAYS.index(day) + endSeconds) for day in parseDays(row['days']).split()]
+    if row['repeat'] == ONCE:
+        start = localSeconds(datetime.datetime.strptime(row['start'], DATE_FORMAT))
+        end = localSeconds(datetime.datetime.strptime(row['end'], DATE_FORMAT))
+        if end <= start:
+            raise ValueError(f"{row['name']} ends before it starts")
+        return [(start, end)]
+    raise ValueError(f"{row['repeat']} is not one of {REPEATS}")
+
+
+def checkRow(row):
+    '''
+    Raises ValueError if row is not a valid window.
+    '''
+    try:
+        rowIntervals(row)
+    except KeyError as error:
+        raise ValueError(f"Blackout window missing {error}")
+
+
+def merge(intervals):
+    '''
+    Returns the union of intervals as sorted lists of the starts and ends of disjoint intervals.
+    '''
+    starts, ends = [], []
+    for start, end in sorted(intervals):
+        if ends and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+def containing(starts, ends, seconds):
+    index = bisect.bisect_right(starts, seconds) - 1
+    if index >= 0 and seconds < ends[index]:
+        return ends[index]
+    return None
+
+
+class blackoutCalendar:
+    """
+    The merged blackout windows of a blackouts table.  Rows which are not valid windows are skipped, see errors.
+
+    Methods:
+        status(moment)            - (allowed, until): whether scheduled watering is allowed at moment, a datetime, and
+                                    the datetime that changes, None if it never does
+        upcoming(moment, count)   - [(start, end)] datetimes of the blackouts in progress or to come
+    """
+    def __init__(self, rows):
+        weekly, once = [], []
+        self.errors = []
+        for index, row in enumerate(rows):
+            try:
+                (weekly if row['repeat'] == WEEKLY else once).extend(rowIntervals(row))
+            except (ValueError, KeyError) as error:
+                self.errors.append(f"Blackout {index}: {error}")
+        split = []
+        for start, end in weekly: # keep weekly intervals within the week, a window running past Saturday midnight wraps
+            if end > WEEK:
+                split.append((0, end - WEEK))
+                end = WEEK
+            split.append((start, end))
+        self.weeklyStarts, self.weeklyEnds = merge(split)
+        self.onceStarts, self.onceEnds = merge(once)
+        self.always = self.weeklyStarts[:1] == [0] and self.weeklyEnds[:1] == [WEEK]
+
+    def weeklyEnd(self, seconds):
+        week = seconds - seconds % WEEK
+        end = containing(self.weeklyStarts, self.weeklyEnds, seconds % WEEK)
+        return None if end is None else week + end
+
+    def weeklyNext(self, seconds):
+        if not self.weeklyStarts:
+            return None
+        week = seconds - seconds % WEEK
+        index = bisect.bisect_right(self.weeklyStarts, seconds % WEEK)
+        return week + self.weeklyStarts[index] if index < len(self.weeklyStarts) else week + WEEK + self.weeklyStarts[0]
+
+    def onceNext(self, seconds):
+        index = bisect.bisect_right(self.onceStarts, seconds)
+        return self.onceStarts[index] if index < len(self.onceStarts) else None
+
+    def blockedUntil(self, seconds):
+        '''
+        Returns the end, local seconds, of the blackout in progress at seconds, following windows which overlap or
+        adjoin it, None if there is none.
+        '''
+        end = None
+        while True:
+            ends = [found for found in (self.weeklyEnd(seconds), containing(self.onceStarts, self.onceEnds, seconds)) if found is not None]
+            if not ends:
+                return end
+            end = seconds = max(ends)
+
+    def status(self, moment):
+        if self.always:
+            return False, None
+        seconds = localSeconds(moment)
+        end = self.blockedUntil(seconds)
+        if end is not None:
+            return False, localDatetime(end)
+        starts = [found for found in (self.weeklyNext(seconds), self.onceNext(seconds)) if found is not None]
+        return True, localDatetime(min(starts)) if starts else None
+
+    def upcoming(self, moment, count=UPCOMING):
+        blackouts = []
+        if self.always:
+            return blackouts
+        seconds = localSeconds(moment)
+        while len(blackouts) < count:
+            allowed, until = self.status(localDatetime(seconds))
+            if allowed:
+                if until is None:
+                    break
+                seconds = localSeconds(until)
+                continue
+            blackouts.append((localDatetime(seconds), until)) # one in progress is listed from moment
+            seconds = localSeconds(until)
+        return blackouts
@@ -0,0 +1,558 @@
+#!/usr/bin/python
+'''
+This provides the validation and application of user changes to the sprinkler controller tables.  A change is a
+small dictionary naming the table, the row (for zoneTable / timerTable), the field and the new value:
+
+    {"table": "zoneTable",  "index": 0, "field": "wateringTime", "value": 30}
+    {"table": "timerTable", "index": 1, "field": "startTime",    "value": "730p"}
+    {"table": "timerTable", "op": "add"}
+    {"table": "timerTable", "op": "delete", "index": 4}
+    {"table": "config",     "field": "dogMode", "value": true}
+    {"table": "blackouts",  "op": "add"}
+    {"table": "blackouts",  "index": 0, "field": "days", "value": "Mon Wed Fri"}
+
+The pages, the row endpoints and the batch / import endpoints all go through the same functions so a change has the
+same meaning wherever it comes from.  applyChanges() is transactional: the changes are applied, in order, to scratch
+copies of the tables and the working tables are only replaced once every change has been validated, so a batch is
+either applied in full or not at all.  Callers hold the state store lock (state.mutate()) around applyChanges().
+
+The export / import helpers convert the persistent part of the tables to and from a JSON document or a CSV file with
+one "table,index,field,value" row per setting, both of which import as a batch of changes.  Only the settings the
+controller owns are exported and imported, NVM files of older versions carry others (i.e. the dog mode shut off
+times once kept in autoShutOff) which are dropped.
+
+    python ConfigChanges.py sprinklerNVM.pkl
+
+checks that the configuration of an NVM file survives the export / import round trip, as JSON and as CSV.
+'''
+import Blackout
+import csv
+import datetime
+import io
+import pickle
+import re
+
+# Fields holding run time state which are never exported, imported or changed by users
+RUNTIME_FIELDS = {'zoneTable':  ('on', 'detectCount', 'manualStartTime', 'wateringLeft', 'wateringLeftAt'),
+                  'timerTable': ('lastTimeOn', 'labeled', 'selected')}
+
+ZONE_FIELDS     = {'name': str, 'relay': int, 'on': bool, 'multiZone': bool, 'dogDetectOn': bool, 'wateringTime': int, 'timer': int}
+CONFIG_FIELDS   = ('allOff', 'dogMode', 'weatherAdjust')
+SETTING_FIELDS  = {'config': CONFIG_FIELDS, 'autoShutOff': ('multiZone', 'singleZone'), 'scheduledDownTime': ('duration', 'timer')}
+BLACKOUT_FIELDS = ('name', 'repeat', 'days', 'start', 'end')
+TABLES          = ('zoneTable', 'timerTable', 'config', 'autoShutOff', 'scheduledDownTime', 'blackouts')
+RESIZABLE       = ('timerTable', 'blackouts') # Tables whose rows are added and deleted by changes
+DATE_FORMATS    = (Blackout.DATE_FORMAT, '%Y-%m-%dT%H:%M', '%Y-%m-%d %I:%M%p', '%Y-%m-%d')
+
+
+class changeError(ValueError):
+    """Exception Class for an invalid change, index is the position of the change in its batch"""
+    def __init__(self, value, index=None):
+        self.value = value
+        self.index = index
+
+    def __str__(self):
+        return (repr(self.value))
+
+
+def parseTime(timeString, default):
+    '''
+    parseTime performs some slick handling of user input with a great degree of flexibility
+    to allow users to enter time in the fewest number of characters.  It handles the following:
+    1) entry in 24 hour or AM / PM automatically detected
+    2) AM PM detection on either A, AM, P, PM.
+    3) Automatic completion of times when minutes are not provided
+
+    Examples:
+    7:00 AM can be entered as 7, 7:00, 7a, 7A, 7am, 7AM, 7:00a, 7:00A, 7:00am, 7:00AM ...
+    7:30 AM can be entered as 730, 730a, 730A, 730am, 730AM, 7:30, 7:30a, 7:30A, 7:30am, 7:30AM ...
+    8:30 PM can be entered as 830p, 830pm, 830PM, 8:30p, 8:30pm, 8:30P, 8:30PM, 2030, 20:30
+
+    Args:
+        timestring (string): user input
+        default (string): value to return (existing value) should the input not be valid
+
+    Returns:
+        Time formated as HH:MM{PM/AM}
+    '''
+    regexPM  = re.compile('[^pP]')
+    regexNum = re.compile('[^0-9]')
+    newPM    = regexPM.sub('', timeString)
+    if newPM.upper() == 'P':
+        newTimeString = 'PM'
+    else:
+        newTimeString = 'AM'
+    newTime  = regexNum.sub('', timeString)
+    if len(newTime) == 0:
+        return default
+    else:
+        newTimeInt = int(newTime)
+    if newTimeInt > 0 and newTimeInt < 13:
+        return f"{newTimeInt}:00{newTimeString}"
+    elif newTimeInt > 12 and newTimeInt < 23:
+        return f"{newTimeInt-12}:00PM"
+    elif newTimeInt > 99 and newTimeInt < 1260 and newTimeInt%100 < 60:
+        return f"{int(newTimeInt/100)}:{newTimeInt%100:02d}{newTimeString}"
+    elif newTimeInt > 1299 and newTimeInt < 2360 and newTimeInt%100 < 60:
+        return f"{int((newTimeInt-1200)/100)}:{newTimeInt%100}PM"
+    else:
+        return default
+
+
+def toBool(value):
+    if isinstance(value, str):
+        if value.lower() in ('true', 'on', '1', 'yes'):
+            return True
+        if value.lower() in ('false', 'off', '0', 'no', ''):
+            return False
+        raise changeError(f"{value} is not a boolean")
+    return bool(value)
+
+
+def configureTimerLabels(timerTable):
+    '''
+    On the timers.html page header rows for the timer tables need to be present for the first
+    row and prior to any row with a different timer type than the preceding rwo.  This function
+    scans through the configurations to set which rows require a header.
+
+    Returns:
+        True if any label changed
+    '''
+    changed = False
+    for row in range(len(timerTable)):
+        labeled = row == 0 or timerTable[row]['Type'] != timerTable[row-1]['Type']
+        if timerTable[row]['labeled'] != labeled:
+            timerTable[row]['labeled'] = labeled
+            changed = True
+    return changed
+
+
+class changeResult:
+    """
+    Outcome of applying changes.
+
+    Attributes:
+        applied (int)         - number of changes applied
+        modified (set)        - names of the tables with modified values
+        relayChange (bool)    - the relays need to be set (a zone on state, the relay of a zone on or allOff changed)
+        relabeled (set)       - timer rows, other than those changed, whose label changed
+    """
+    def __init__(self):
+        self.applied     = 0
+        self.modified    = set()
+        self.relayChange = False
+        self.relabeled   = set()
+
+
+class changeSet:
+    """
+    Applies changes to a set of tables.  options holds the values the user interface offers:
+
+        wateringTimes, intervals, timerTypes, days (list of day names), relayCount
+    """
+    def __init__(self, tables, options, now):
+        self.tables  = tables
+        self.options = options
+        self.now     = now
+        self.result  = changeResult()
+
+    def apply(self, change):
+        if not isinstance(change, dict):
+            raise changeError("A change must be an object")
+        table = change.get('table')
+        if table not in TABLES:
+            raise changeError(f"Unknown table {table}")
+        op = change.get('op', 'set')
+        if table == 'timerTable' and op in ('add', 'delete'):
+            self.resizeTimers(op, change.get('index'))
+        elif table == 'blackouts' and op in ('add', 'delete'):
+            self.resizeBlackouts(op, change.get('index'))
+        elif op != 'set':
+            raise changeError(f"Unknown operation {op} for {table}")
+        elif table == 'zoneTable':
+            self.setZoneField(self.rowIndex(table, change.get('index')), change.get('field'), change.get('value'))
+        elif table == 'timerTable':
+            self.setTimerField(self.rowIndex(table, change.get('index')), change.get('field'), change.get('value'))
+        elif table == 'blackouts':
+            self.setBlackoutField(self.rowIndex(table, change.get('index')), change.get('field'), change.get('value'))
+        else:
+            self.setSetting(table, change.get('field'), change.get('value'))
+        self.result.applied += 1
+
+    def rowIndex(self, table, index):
+        try:
+            index = int(index)
+        except (TypeError, ValueError):
+            raise changeError(f"{table} changes require an integer index")
+        if not 0 <= index < len(self.tables[table]):
+            raise changeError(f"{table} row {index} does not exist")
+        return index
+
+    def store(self, table, row, field, value):
+        target = self.tables[table] if row is None else self.tables[table][row]
+        if target.get(field) == value:
+            return False
+        target[field] = value
+        self.result.modified.add(table)
+        return True
+
+    def setZoneField(self, index, field, value):
+        if field not in ZONE_FIELDS:
+            raise changeError(f"Unknown zone field {field}")
+        try:
+            value = toBool(value) if ZONE_FIELDS[field] is bool else ZONE_FIELDS[field](value)
+        except (TypeError, ValueError):
+            raise changeError(f"Invalid value {value} for zone field {field}")
+        if field == 'wateringTime' and value not in self.options['wateringTimes']:
+            raise changeError(f"Watering time {value} is not one of {self.options['wateringTimes']}")
+        if field == 'timer' and not 1 <= value <= len(self.tables['timerTable']):
+            raise changeError(f"Timer {value} does not exist")
+        if field == 'relay' and not 1 <= value <= self.options.get('relayCount', 64):
+            raise changeError(f"Relay {value} does not exist")
+        if self.store('zoneTable', index, field, value) and (field == 'on' or field == 'relay' and self.tables['zoneTable'][index]['on']):
+            self.result.relayChange = True # a zone on moved to another relay opens the old one and closes the new one
+        if field == 'on' and value: # User has manually turned on zone
+            self.tables['zoneTable'][index]['manualStartTime'] = self.now
+
+    def setTimerField(self, index, field, value):
+        timerTable = self.tables['timerTable']
+        if field == 'startTime':
+            value = parseTime(str(value), default=None)
+            if value is None:
+                raise changeError(f"Invalid start time for timer {index}")
+        elif field == 'Type':
+            if value not in self.options['timerTypes']:
+                raise changeError(f"Timer type {value} is not one of {self.options['timerTypes']}")
+        elif field == 'Interval':
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise changeError(f"Invalid interval {value}")
+            if value not in self.options['intervals']:
+                raise changeError(f"Interval {value} is not one of {self.options['intervals']}")
+        elif field == 'selected':
+            value = toBool(value)
+        elif field in self.options['days']:
+            value = 'checked' if value in ('on', 'checked', True) else ''  #Necessary as key state is returned as on instead of checked
+        else:
+            raise changeError(f"Unknown timer field {field}")
+        if self.store('timerTable', index, field, value) and field == 'Type':
+            labels = [row['labeled'] for row in timerTable]
+            configureTimerLabels(timerTable)
+            self.result.relabeled.update(timer for timer, row in enumerate(timerTable) if timer != index and row['labeled'] != labels[timer])
+
+    def resizeTimers(self, op, index):
+        timerTable = self.tables['timerTable']
+        if op == 'add':
+            timerTable.append(dict(timerTable[len(timerTable)-1], lastTimeOn=0, selected=False))
+        else:
+            index = self.rowIndex('timerTable', index)
+            if len(timerTable) == 1:
+                raise changeError("The last timer can not be deleted")
+            timerTable.pop(index)
+            for zone in self.tables['zoneTable']:
+                if zone['timer'] > len(timerTable):
+                    zone['timer'] = len(timerTable)
+            if self.tables['scheduledDownTime'].get('timer', 0) > len(timerTable):
+                self.tables['scheduledDownTime']['timer'] = 0
+            self.result.modified.update(('zoneTable', 'scheduledDownTime'))
+        configureTimerLabels(timerTable)
+        self.result.modified.add('timerTable')
+        self.result.relabeled.update(range(len(timerTable)))
+
+    def resizeBlackouts(self, op, index):
+        if op == 'add':
+            self.tables['blackouts'].append(dict(Blackout.DEFAULT_ROW))
+        else:
+            self.tables['blackouts'].pop(self.rowIndex('blackouts', index))
+        self.result.modified.add('blackouts')
+
+    def setBlackoutField(self, index, field, value):
+        if field not in BLACKOUT_FIELDS:
+            raise changeError(f"Unknown blackout field {field}")
+        if field == 'name':
+            value = str(value).strip()
+            if not value:
+                raise changeError(f"Blackout {index} needs a name")
+        elif field == 'repeat':
+            if value not in Blackout.REPEATS:
+                raise changeError(f"Repeat {value} is not one of {list(Blackout.REPEATS)}")
+        elif field == 'days':
+            try:
+                value = Blackout.parseDays(value)
+            except ValueError as error:
+                raise changeError(str(error))
+        else:
+            value = parseMoment(str(value))
+            if value is None:
+                raise changeError(f"Invalid {field} time for blackout {index}")
+        self.store('blackouts', index, field, value)
+
+    def setSetting(self, table, field, value):
+        if table == 'config':
+            if field not in CONFIG_FIELDS:
+                raise changeError(f"Unknown config field {field}")
+            value = toBool(value)
+            if self.store(table, None, field, value) and field == 'allOff':
+                self.result.relayChange = True
+            return
+        if field not in SETTING_FIELDS[table]:
+            raise changeError(f"Unknown {table} field {field}")
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise changeError(f"Invalid value {value} for {table} field {field}")
+        if table == 'scheduledDownTime' and field == 'timer':
+            if not 0 <= value <= len(self.tables['timerTable']):
+                raise changeError(f"Timer {value} does not exist")
+        elif value not in self.options['wateringTimes']:
+            raise changeError(f"{value} is not one of {self.options['wateringTimes']}")
+        self.store(table, None, field, value)
+
+
+def parseMoment(value):
+    '''
+    Returns the start or end of a blackout window, a date and time (Blackout.DATE_FORMAT) for a one-off window or
+    a time of day as parseTime for a weekly one, None if value is neither.
+    '''
+    for dateFormat in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.strip(), dateFormat).strftime(Blackout.DATE_FORMAT)
+        except ValueError:
+            pass
+    if '-' in value:
+        return None
+    return parseTime(value, None)
+
+
+def copyTables(tables):
+    return {name: dict(table) if isinstance(table, dict) else [dict(row) for row in table] for name, table in tables.items()}
+
+
+def applyChanges(changes, tables, options, now):
+    '''
+    Validates and applies a list of changes as a single transaction.  The changes are applied to scratch copies of
+    the tables, the working tables are only updated (in place, so references held elsewhere remain valid) once all
+    of the changes have been applied successfully.  Must be called while holding the state store lock.
+
+    Args:
+        changes (list of dictionaries): changes, see the module description
+        tables (dictionary): working tables by name, as yielded by state.mutate()
+        options (dictionary): wateringTimes, intervals, timerTypes, days, relayCount
+        now (float): time used for manual start times
+
+    Returns:
+        changeResult
+
+    Raises:
+        changeError, with the index of the failing change, if any change is not valid.  No table is modified.
+    '''
+    scratch = changeSet(copyTables(tables), options, now)
+    for index, change in enumerate(changes):
+        try:
+            scratch.apply(change)
+        except changeError as error:
+            error.index = index
+            raise
+    if 'blackouts' in scratch.result.modified: # a window is checked as a whole once all of its fields are set
+        for row in scratch.tables['blackouts']:
+            try:
+                Blackout.checkRow(row)
+            except ValueError as error:
+                raise changeError(str(error))
+    for name, table in scratch.tables.items():
+        if isinstance(table, dict):
+            if table != tables[name]:
+                tables[name].clear()
+                tables[name].update(table)
+        elif table != tables[name]:
+            tables[name][:] = table
+    return scratch.result
+
+
+def ownedSettings(name, table):
+    '''
+    Returns the settings of a config, autoShutOff or scheduledDownTime table the controller owns, without the keys
+    older versions left in NVM files.
+    '''
+    return {field: value for field, value in table.items() if field in SETTING_FIELDS[name]}
+
+
+def readTables(path, owned=True):
+    '''
+    Reads the tables of an NVM file (SprinklerController.py's format), the settings tables without the keys of older
+    versions unless owned is False.  Files written before the blackout calendar have no blackouts table, it is empty.
+
+    Returns:
+        dictionary of the tables by name
+
+    Raises:
+        OSError, EOFError, pickle.UnpicklingError
+    '''
+    with open(path, 'rb') as nvmFile:
+        tables = {name: pickle.load(nvmFile) for name in TABLES[:-1]}
+        try:
+            tables['blackouts'] = pickle.load(nvmFile)
+        except EOFError:
+            tables['blackouts'] = []
+    if owned:
+        for name in SETTING_FIELDS:
+            tables[name] = ownedSettings(name, tables[name])
+    return tables
+
+
+def exportConfig(snapshot):
+    '''
+    Returns the persistent configuration held in a state snapshot as a JSON serializable dictionary.
+    '''
+    document = {}
+    for name in TABLES:
+        table = snapshot.thaw(name)
+        if isinstance(table, list):
+            for row in table:
+                for field in RUNTIME_FIELDS.get(name, ()):
+                    row.pop(field, None)
+        else:
+            table = ownedSettings(name, table)
+        document[name] = table
+    return document
+
+
+def importChanges(document, snapshot):
+    '''
+    Converts an exported configuration document into the list of changes which, applied to the state in
+    snapshot, reproduces the document.  Timers and blackouts are added or deleted to match the document; zones are matched
+    by position and must already exist.  Settings the controller does not own, exported by older versions, are
+    dropped.
+    '''
+    changes = []
+    for name in RESIZABLE:
+        count = len(getattr(snapshot, name))
+        target = len(document.get(name, getattr(snapshot, name)))
+        for _ in range(count, target):
+            changes.append({'table': name, 'op': 'add'})
+        for index in range(count - 1, target - 1, -1):
+            changes.append({'table': name, 'op': 'delete', 'index': index})
+    for name in TABLES:
+        if name not in document:
+            continue
+        if isinstance(document[name], list):
+            if name == 'zoneTable' and len(document[name]) > len(snapshot.zoneTable):
+                raise changeError(f"The configuration has {len(document[name])} zones, this controller has {len(snapshot.zoneTable)}")
+            for index, row in enumerate(document[name]):
+                for field, value in row.items():
+                    if field not in RUNTIME_FIELDS.get(name, ()):
+                        changes.append({'table': name, 'index': index, 'field': field, 'value': value})
+        else:
+            for field, value in ownedSettings(name, document[name]).items():
+                changes.append({'table': name, 'field': field, 'value': value})
+    return changes
+
+
+def diffChanges(old, new):
+    '''
+    Returns the compact list of changes that turns the configuration document old into new (both as returned by
+    exportConfig), i.e. only the fields that differ plus any timer / blackout additions / deletions.
+    '''
+    changes = []
+    for name in RESIZABLE:
+        oldCount, newCount = len(old.get(name, [])), len(new.get(name, []))
+        for _ in range(oldCount, newCount):
+            changes.append({'table': name, 'op': 'add'})
+        for index in range(oldCount - 1, newCount - 1, -1):
+            changes.append({'table': name, 'op': 'delete', 'index': index})
+    for name in TABLES:
+        if name not in new:
+            continue
+        if isinstance(new[name], list):
+            for index, row in enumerate(new[name]):
+                oldRow = old[name][index] if index < len(old.get(name, [])) else {}
+                for field, value in row.items():
+                    if oldRow.get(field) != value:
+                        changes.append({'table': name, 'index': index, 'field': field, 'value': value})
+        else:
+            for field, value in new[name].items():
+                if old.get(name, {}).get(field) != value:
+                    changes.append({'table': name, 'field': field, 'value': value})
+    return changes
+
+
+def documentToCSV(document):
+    '''
+    Writes a configuration document (as returned by exportConfig) as "table,index,field,value" rows.
+    '''
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['table', 'index', 'field', 'value'])
+    for name in TABLES:
+        if isinstance(document[name], list):
+            for index, row in enumerate(document[name]):
+                for field, value in row.items():
+                    writer.writerow([name, index, field, value])
+        else:
+            for field, value in document[name].items():
+                writer.writerow([name, '', field, value])
+    return output.getvalue()
+
+
+def documentFromCSV(text):
+    '''
+    Reads "table,index,field,value" rows (as written by documentToCSV) into a configuration document.  Values are
+    kept as strings, the change set converts them to the type of the field when the document is imported.
+    '''
+    document = {}
+    for row in csv.DictReader(io.StringIO(text)):
+        name = row['table']
+        if name not in TABLES:
+            raise changeError(f"Unknown table {name}")
+        if row.get('index', '') == '':
+            document.setdefault(name, {})[row['field']] = row['value']
+        else:
+            table = document.setdefault(name, [])
+            index = int(row['index'])
+            while len(table) <= index:
+                table.append({})
+            table[index][row['field']] = row['value']
+    return document
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import ControllerConfig
+    import StateStore
+
+    parser = argparse.ArgumentParser(description='Check that the configuration of an NVM file survives export and import')
+    parser.add_argument('nvmFile', nargs='?', default='sprinklerNVM.pkl')
+    args = parser.parse_args()
+
+    tables = readTables(args.nvmFile, owned=False) # as written, the keys of older versions included
+    options = {'wateringTimes': ControllerConfig.DEFAULTS['WATERING_TIMES'], 'intervals': ControllerConfig.DEFAULTS['INTERVALS'],
+               'timerTypes': ['INT', 'DoW'], 'days': ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']}
+    snapshot = StateStore.stateStore(**tables).snapshot()
+    exported = exportConfig(snapshot)
+    failed = False
+    for name, document in (('JSON', json.loads(json.dumps(exported))), ('CSV', documentFromCSV(documentToCSV(exported)))):
+        store = StateStore.stateStore(**copyTables(tables))
+        try:
+            with store.mutate() as working:
+                result = applyChanges(importChanges(document, store.snapshot()), working, options, 0)
+        except changeError as error:
+            print(f"{name}: import rejected, change {error.index}: {error}")
+            failed = True
+            continue
+        same = exportConfig(store.snapshot()) == exported
+        failed |= not same
+        print(f"{name}: {result.applied} changes applied, {'configuration unchanged' if same else 'CONFIGURATION CHANGED'}")
+
+    # moving a zone which is on to another relay must set the relays, one which is off need not
+    options['relayCount'] = 64
+    for on in (True, False):
+        working = copyTables(tables)
+        working['zoneTable'][0]['on'] = on
+        result = applyChanges([{'table': 'zoneTable', 'index': 0, 'field': 'relay', 'value': working['zoneTable'][0]['relay'] % 64 + 1}],
+                              working, options, 0)
+        correct = result.relayChange == on
+        failed |= not correct
+        print(f"relay of a zone {'on' if on else 'off'} changed: relays {'set' if result.relayChange else 'not set'}{'' if correct else ', WRONG'}")
+    raise SystemExit(1 if failed else 0)
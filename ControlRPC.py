@@ -0,0 +1,140 @@
+#!/usr/bin/python
+'''
+This provides the local RPC between the web front end and the control core when they run as separate processes
+(SprinklerController.py --role web / --role core).
+
+Requests and responses are single line JSON objects on a Unix domain socket:
+
+    {"id": 7, "method": "applyChanges", "params": {"changes": [...], "flush": false}}
+    {"id": 7, "result": {...}}
+    {"id": 7, "error": {"type": "changeError", "value": "...", "index": 2}}
+
+The server runs each connection in its own thread, the web front end keeps one connection per request thread and
+reconnects when the core has restarted.  The socket is only accessible to the user (and group) running the
+controller.
+'''
+from FlexPrint import fprint
+import json
+import os
+import socket
+import socketserver
+import threading
+
+SOCKET_MODE  = 0o660
+CALL_TIMEOUT = 10  # Seconds to wait for the core to answer a call
+MAX_LINE     = 4 * 1024 * 1024
+
+
+class remoteError(Exception):
+    """
+    An exception raised by the method on the core.  kind is the exception's class name, value its message and
+    index the index attribute of a ConfigChanges.changeError.
+    """
+    def __init__(self, kind, value, index=None):
+        super().__init__(f"{kind}: {value}")
+        self.kind  = kind
+        self.value = value
+        self.index = index
+
+
+class rpcUnavailable(ConnectionError):
+    """
+    The core could not be reached, or closed the connection before answering.
+    """
+
+
+class rpcHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        methods = self.server.methods
+        while True:
+            line = self.rfile.readline(MAX_LINE)
+            if not line:
+                break
+            request = {}
+            try:
+                request = json.loads(line)
+                method = methods[request['method']]
+                response = {'id': request.get('id'), 'result': method(**request.get('params', {}))}
+            except Exception as error:
+                if not isinstance(error, ValueError):  # invalid changes are expected, anything else is a fault
+                    fprint(f"Control RPC {request.get('method')} failed: {error!r}")
+                response = {'id': request.get('id'), 'error': {'type': type(error).__name__,
+                                                               'value': str(getattr(error, 'value', error)),
+                                                               'index': getattr(error, 'index', None)}}
+            self.wfile.write(json.dumps(response, default=list).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class rpcServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves methods, a dictionary of name -> function(**params) returning a JSON serializable result, on the
+    Unix socket at path.
+
+    Methods:
+        start() - starts serving in a daemon thread, returns the thread
+    """
+    daemon_threads = True
+
+    def __init__(self, path, methods):
+        self.path    = path
+        self.methods = methods
+        if os.path.exists(path):  # left by a core which did not exit cleanly
+            os.unlink(path)
+        super().__init__(path, rpcHandler)
+        os.chmod(path, SOCKET_MODE)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='controlRPC', daemon=True)
+        thread.start()
+        return thread
+
+
+class rpcClient:
+    """
+    Calls the core's methods, call(method, **params) returns the result or raises remoteError / rpcUnavailable.
+    """
+    def __init__(self, path, timeout=CALL_TIMEOUT):
+        self.path    = path
+        self.timeout = timeout
+        self.local   = threading.local()  # connection per thread
+        self.counter = 0
+
+    def connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        connection.connect(self.path)
+        self.local.connection = connection
+        self.local.reader = connection.makefile('rb')
+        return connection
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            self.local.reader.close()
+            connection.close()
+            self.local.connection = None
+
+    def call(self, method, **params):
+        self.counter += 1
+        request = json.dumps({'id': self.counter, 'method': method, 'params': params}).encode('utf-8') + b'\n'
+        connection = getattr(self.local, 'connection', None)
+        try:
+            if connection is not None:
+                try:
+                    connection.sendall(request)
+                except OSError:  # kept open across a restart of the core, the request was not sent
+                    self.close()
+                    connection = None
+            if connection is None:
+                self.connect().sendall(request)
+            line = self.local.reader.readline(MAX_LINE)
+            if not line:
+                raise ConnectionResetError("core closed the connection")
+        except OSError as error:
+            self.close()
+            raise rpcUnavailable(f"control core unavailable at {self.path}: {error}")
+        response = json.loads(line)
+        if 'error' in response:
+            error = response['error']
+            raise remoteError(error['type'], error['value'], error.get('index'))
+        return response['result']
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+'''
+This provides the controller configuration file, sc_config.txt, and its watcher.  The file holds one KEY=VALUE
+setting per line, # starts a comment and settings which are left out keep their defaults:
+
+    ENABLE_WATCHDOG=1
+    RELAY_STACKS=0x3f, 0x3b                     # I2C addresses of the relay hats, in relay order
+    WATERING_TIMES=0, 3, 5, 10, 15, 20, 25, 30, 40, 50, 60, 90, 120
+    INTERVALS=1, 2, 3, 4, 5, 6, 7, 14
+    TIMER_SAMPLE_INTERVAL=45                    # seconds between scheduler passes, under a minute
+    LIVE_STATE_INTERVAL=1                       # seconds between live state file updates
+    NVM_UPDATE_INTERVAL=10                      # seconds between checks for settings to save
+    BREAK_BEFORE_MAKE=1                         # relays turning off are written before those turning on
+    RELAY_QUIET_GAP=0.25                        # seconds without I2C traffic after relays turn off
+    I2C_TRACE=                                  # file to record the relay hats' I2C transactions to, empty for none
+
+The controller reads it at start and the watcher polls its modification time, every CHECK_INTERVAL seconds, while it
+runs.  A changed file is validated in full before anything is applied, a file with any invalid setting is reported
+and ignored, so the controller keeps running with the last good settings.  The changed settings are handed to a
+callback which applies them live:
+
+    watcher = ControllerConfig.configWatcher(CONFIG_FILE, applyConfig)
+    settings = watcher.settings
+    watcher.start()
+'''
+from FlexPrint import fprint
+import os
+import threading
+import time
+
+CHECK_INTERVAL  = 5  # Seconds between checks of the file's modification time
+ADDRESS_RANGE   = range(0x38, 0x40) # 7 bit addresses the TI PCA9534A of the relay hats can be jumpered to
+MAX_MINUTES     = 24 * 60
+MAX_QUIET_GAP   = 2  # Seconds, the longest quiet gap after relays turn off
+
+DEFAULTS = {'ENABLE_WATCHDOG'      : False,
+            'RELAY_STACKS'         : [0x3f, 0x3b],
+            'WATERING_TIMES'       : [0, 3, 5, 10, 15, 20, 25, 30, 40, 50, 60, 90, 120],
+            'INTERVALS'            : [1, 2, 3, 4, 5, 6, 7, 14],
+            'TIMER_SAMPLE_INTERVAL': 45,
+            'LIVE_STATE_INTERVAL'  : 1,
+            'NVM_UPDATE_INTERVAL'  : 10,
+            'BREAK_BEFORE_MAKE'    : True,
+            'RELAY_QUIET_GAP'      : 0.25,
+            'I2C_TRACE'            : ''}
+
+RESTART_SETTINGS = ('ENABLE_WATCHDOG',) # Take effect the next time the controller starts
+
+
+class configError(ValueError):
+    """Exception Class for an invalid configuration file, line is the line number of the setting"""
+    def __init__(self, value, line=None):
+        self.value = value
+        self.line  = line
+
+    def __str__(self):
+        return (repr(self.value if self.line is None else f"line {self.line}: {self.value}"))
+
+
+def parseList(value, convert):
+    return [convert(item.strip()) for item in value.split(',') if item.strip()]
+
+
+def parseValue(key, value):
+    '''
+    Returns the value of one setting, raises ValueError if it is malformed or out of range.
+    '''
+    if key in ('ENABLE_WATCHDOG', 'BREAK_BEFORE_MAKE'):
+        if value not in ('0', '1'):
+            raise ValueError("must be 0 or 1")
+        return value == '1'
+    if key == 'RELAY_STACKS':
+        addresses = parseList(value, lambda item: int(item, 0))
+        if not addresses:
+            raise ValueError("at least one relay hat is needed")
+        if len(set(addresses)) != len(addresses):
+            raise ValueError("addresses must be unique")
+        for address in addresses:
+            if address not in ADDRESS_RANGE:
+                raise ValueError(f"{hex(address)} is not a relay hat address, {hex(ADDRESS_RANGE[0])} to {hex(ADDRESS_RANGE[-1])}")
+        return addresses
+    if key == 'I2C_TRACE':
+        return value
+    if key in ('WATERING_TIMES', 'INTERVALS'):
+        values = parseList(value, int)
+        minimum = 0 if key == 'WATERING_TIMES' else 1
+        if not values or min(values) < minimum or max(values) > MAX_MINUTES:
+            raise ValueError(f"must be a list of whole numbers from {minimum} to {MAX_MINUTES}")
+        return sorted(set(values))
+    seconds = float(value)
+    if key == 'RELAY_QUIET_GAP':
+        if not 0 <= seconds <= MAX_QUIET_GAP:
+            raise ValueError(f"must be from 0 to {MAX_QUIET_GAP} seconds")
+        return seconds
+    if key == 'TIMER_SAMPLE_INTERVAL' and not 1 <= seconds < 60:
+        raise ValueError("must be at least 1 and under 60 seconds so no start time is missed")
+    if not 0 < seconds <= 3600:
+        raise ValueError("must be over 0 and at most 3600 seconds")
+    return seconds
+
+
+def parseConfig(text):
+    '''
+    Parses the text of a configuration file.
+
+    Args:
+        text (string): KEY=VALUE lines
+
+    Returns:
+        dictionary of every setting, DEFAULTS for those not in text
+
+    Raises:
+        configError: the first invalid line
+    '''
+    settings = dict(DEFAULTS)
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        key, separator, value = line.partition('=')
+        key, value = key.strip(), value.strip()
+        if not separator:
+            raise configError(f"expected KEY=VALUE, found {line}", number)
+        if key not in DEFAULTS:
+            raise configError(f"unknown setting {key}", number)
+        try:
+            settings[key] = parseValue(key, value)
+        except ValueError as error:
+            raise configError(f"{key}: {error}", number)
+    return settings
+
+
+def readConfig(path):
+    '''
+    Returns the settings of the configuration file at path, DEFAULTS if there is none.
+
+    Raises:
+        configError, OSError
+    '''
+    if not os.path.isfile(path):
+        return dict(DEFAULTS)
+    with open(path) as configFile:
+        return parseConfig(configFile.read())
+
+
+def changedSettings(old, new):
+    return [key for key in DEFAULTS if old[key] != new[key]]
+
+
+class configWatcher:
+    """
+    Watches a configuration file, applying changes while the controller runs.
+
+    Args:
+        path (string): the configuration file
+        apply (function): apply(old settings, new settings, changed keys), called from the watcher's thread
+        interval (float): seconds between checks
+
+    Methods:
+        check()  - applies the file if it changed since the last check, returns the changed keys
+        start()  - starts a daemon thread calling check() every interval
+        status() - settings, the last error and when the file was last applied
+
+    Attributes:
+        settings (dictionary): the settings applied, those of the file when the watcher was created (DEFAULTS if it
+                               was missing or invalid)
+    """
+    def __init__(self, path, apply, interval=CHECK_INTERVAL):
+        self.path     = path
+        self.apply    = apply
+        self.interval = interval
+        self.lock     = threading.Lock()
+        self.error    = None
+        self.applied  = None
+        self.thread   = None
+        self.identity = self.fileIdentity()
+        try:
+            self.settings = readConfig(path)
+            self.applied  = time.time()
+        except (configError, OSError) as error:
+            self.error    = str(error)
+            self.settings = dict(DEFAULTS)
+            fprint(f"Configuration file {path} not used, {self.error}")
+
+    def fileIdentity(self):
+        try:
+            stat = os.stat(self.path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def check(self):
+        with self.lock:
+            identity = self.fileIdentity()
+            if identity == self.identity:
+                return []
+            self.identity = identity
+            try:
+                settings = readConfig(self.path)
+            except (configError, OSError) as error:
+                self.error = str(error)
+                fprint(f"Configuration file {self.path} ignored, {self.error}")
+                return []
+            self.error = None
+            old, self.settings = self.settings, settings
+            changed = changedSettings(old, settings)
+            if changed:
+                fprint(f"Configuration file {self.path} changed: {', '.join(changed)}")
+                self.apply(old, settings, changed)
+            self.applied = time.time()
+            return changed
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as error: # a failure applying one change must not stop later ones
+                fprint(f"Error applying configuration file {self.path}: {error}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='configWatcher', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def status(self):
+        with self.lock:
+            return {'settings': {key: [hex(address) for address in value] if key == 'RELAY_STACKS' else value
+                                 for key, value in self.settings.items()},
+                    'error': self.error, 'applied': self.applied}
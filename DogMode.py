@@ -0,0 +1,182 @@
+#!/usr/bin/python
+'''
+This provides the dog mode scheduler.  A single thread owns every dog mode activation and keeps the end time of
+each active zone in a deadline heap, sleeping on a condition until the next deadline or detection.  Dog Warnings
+from the JSON server only record the detection and wake the scheduler, so the detector's connection never waits
+on the zone table or the relays.
+
+- A warning turns on every dog mode zone which is off, for warningDuration seconds.
+- Further warnings while a zone is spraying extend its window to warningDuration seconds from the latest warning,
+  up to maxDuration seconds from when it was turned on.
+- Once a spray ends the zone ignores warnings for cooldown seconds, and each zone is limited by a token bucket to
+  burst activations at once, refilled at ratePerHour.
+- The zones are only turned off by the scheduler if it turned them on, and only if nothing else has taken them
+  over (see release()).
+
+The seconds each zone actually sprayed are returned to the controller so the zone's detectCount, and with it the
+reduction of the next scheduled watering, matches the water delivered instead of the number of warnings.
+'''
+from FlexPrint import fprint
+import heapq
+import threading
+import time
+
+
+class dogScheduler:
+    """
+    Deadline scheduler for dog mode activations.
+
+    Args:
+        candidates (function): returns the zones dog mode may turn on now, [] when dog mode is off
+        turnOn (function): turnOn(zones) turns on the zones, returning those which were actually turned on
+        turnOff (function): turnOff({zone: seconds sprayed}) accounts the spray and turns the zones off
+        warningDuration, maxDuration, cooldown (float): seconds
+        burst (int), ratePerHour (float): per zone activation rate limit
+        clock (function): monotonic time source
+
+    Methods:
+        start()        - starts the scheduler thread
+        detect()       - records a Dog Warning, safe to call from any thread, never blocks on the relays
+        sprayed()      - {zone: seconds sprayed so far} of the sprays in progress
+        release(zones) - stops managing zones taken over by scheduled / manual watering, returns {zone: seconds sprayed}
+        status()       - active zones with seconds remaining and the activation counters
+    """
+    def __init__(self, candidates, turnOn, turnOff, warningDuration=60, maxDuration=5 * 60, cooldown=30,
+                 burst=3, ratePerHour=10, clock=time.monotonic):
+        self.candidates      = candidates
+        self.turnOn          = turnOn
+        self.turnOff         = turnOff
+        self.warningDuration = warningDuration
+        self.maxDuration     = maxDuration
+        self.cooldown        = cooldown
+        self.burst           = burst
+        self.refillRate      = ratePerHour / 3600
+        self.clock           = clock
+        self.condition       = threading.Condition()
+        self.detections      = 0
+        self.active          = {}  # zone -> [turned on time, deadline]
+        self.deadlines       = []  # heap of (deadline, zone), stale entries are skipped
+        self.cooldownUntil   = {}  # zone -> time
+        self.tokens          = {}  # zone -> (tokens, time)
+        self.counters        = {'warnings': 0, 'activations': 0, 'extensions': 0, 'cooledDown': 0, 'rateLimited': 0}
+        self.thread          = None
+
+    def detect(self):
+        with self.condition:
+            self.detections += 1
+            self.counters['warnings'] += 1
+            self.condition.notify()
+
+    def sprayed(self):
+        with self.condition:
+            now = self.clock()
+            return {zone: now - start for zone, (start, deadline) in self.active.items()}
+
+    def release(self, zones):
+        sprayed = {}
+        with self.condition:
+            now = self.clock()
+            for zone in zones:
+                if zone in self.active:
+                    sprayed[zone] = now - self.active.pop(zone)[0]
+        return sprayed
+
+    def status(self):
+        with self.condition:
+            now = self.clock()
+            return {'active': {zone: max(0, deadline - now) for zone, (start, deadline) in self.active.items()},
+                    **self.counters}
+
+    def takeToken(self, zone, now):
+        tokens, last = self.tokens.get(zone, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.refillRate)
+        if tokens < 1:
+            self.tokens[zone] = (tokens, now)
+            return False
+        self.tokens[zone] = (tokens - 1, now)
+        return True
+
+    def refundToken(self, zone):
+        tokens, last = self.tokens[zone]
+        self.tokens[zone] = (min(self.burst, tokens + 1), last)
+
+    def nextWork(self):
+        '''
+        Waits for a detection or an expired deadline, returning (detected, expired zones).  Called with the
+        condition held.
+        '''
+        while True:
+            now = self.clock()
+            expired = []
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, zone = heapq.heappop(self.deadlines)
+                if zone in self.active and self.active[zone][1] == deadline:
+                    expired.append(zone)
+            if self.detections or expired:
+                detected = self.detections > 0
+                self.detections = 0
+                return detected, expired
+            self.condition.wait(self.deadlines[0][0] - now if self.deadlines else None)
+
+    def handleDetection(self):
+        zones = self.candidates()  # outside the condition, reads the zone table
+        activate = []
+        with self.condition:
+            now = self.clock()
+            for zone in zones:
+                if zone in self.active:
+                    start, deadline = self.active[zone]
+                    newDeadline = min(now + self.warningDuration, start + self.maxDuration)
+                    if newDeadline > deadline:
+                        self.active[zone][1] = newDeadline
+                        heapq.heappush(self.deadlines, (newDeadline, zone))
+                        self.counters['extensions'] += 1
+                elif now < self.cooldownUntil.get(zone, 0):
+                    self.counters['cooledDown'] += 1
+                elif not self.takeToken(zone, now):
+                    self.counters['rateLimited'] += 1
+                else:
+                    activate.append(zone)
+        if not activate:
+            return
+        turnedOn = []
+        try:
+            turnedOn = self.turnOn(activate)
+        finally:
+            with self.condition:
+                for zone in set(activate) - set(turnedOn): # taken over or not turned on, the token was not used
+                    self.refundToken(zone)
+        with self.condition:
+            now = self.clock()
+            for zone in turnedOn:
+                self.active[zone] = [now, now + self.warningDuration]
+                heapq.heappush(self.deadlines, (now + self.warningDuration, zone))
+                self.counters['activations'] += 1
+
+    def handleExpired(self, zones):
+        sprayed = {}
+        with self.condition:
+            now = self.clock()
+            for zone in zones:
+                if zone in self.active:  # not released in the meantime
+                    sprayed[zone] = now - self.active.pop(zone)[0]
+                    self.cooldownUntil[zone] = now + self.cooldown
+        if sprayed:
+            self.turnOff(sprayed)
+
+    def run(self):
+        while True:
+            with self.condition:
+                detected, expired = self.nextWork()
+            try:
+                if expired:
+                    self.handleExpired(expired)
+                if detected:
+                    self.handleDetection()
+            except Exception as error:
+                fprint(f"Dog mode scheduler error: {error!r}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='dogMode', daemon=True)
+        self.thread.start()
+        return self.thread
@@ -1,9 +1,202 @@
+'''
+fprint is a print replacement backed by logging, so messages are leveled and written by a background thread
+instead of the caller doing the I/O.
 
+- fprint(*args, level=INFO) keeps the print signature.  The message goes to the logger of the calling module,
+  if that logger is not enabled for the level the arguments are never formatted.
+- flog(level, format, *args) formats logging style, %s / %x ..., in the writer thread, for messages on hot paths
+  (pass values which do not change afterwards, not lists or dictionaries which are still being updated).
+- Records are appended to a bounded queue, with no lock taken, and written every WRITE_INTERVAL seconds by the
+  writer thread.  If the writer falls behind records are dropped (and counted) rather than blocking the caller.
+- stdout / stderr are chosen by FLEX_PRINT_STD_OUT / FLEX_PRINT_STD_ERR in config.py, as before.  setup() adds a
+  size bounded rotating log file, i.e. on the RAM disk.
+- Levels are per module (logger name, '__main__' for SprinklerController.py) and may be changed at runtime with
+  setLevel(), the root level applies to modules without their own.
+'''
 from config import *
+from logging import DEBUG, INFO, WARNING, ERROR, CRITICAL
+import atexit
+import collections
+import logging
+import logging.handlers
 import sys
+import threading
 
-def fprint(*args, **kwargs):
-    if FLEX_PRINT_STD_ERR:
-        print(*args, file=sys.stderr, **kwargs)
-    if FLEX_PRINT_STD_OUT:
-        print(*args, **kwargs)
\ No newline at end of file
+QUEUE_SIZE     = 10000           # Records waiting for the writer before new ones are dropped
+WRITE_INTERVAL = 0.1             # Seconds between writes of the queued records
+LOG_MAX_BYTES  = 1024 * 1024     # Size of the log file before it is rotated
+LOG_BACKUPS    = 2               # Rotated log files kept
+FILE_FORMAT    = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+LEVEL_NAMES    = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+# Records do not need the caller's source line or process details, skipping them halves the cost of a record
+logging._srcfile           = None
+logging.logProcesses       = False
+logging.logMultiprocessing = False
+
+
+class queuedHandler(logging.Handler):
+    """
+    Queues records for the writer thread, which passes them to handlers.  Records are neither formatted nor
+    written in the calling thread.
+
+    Methods:
+        addHandler(handler) - adds a handler the writer passes records to
+        flush()             - waits until everything queued has been written
+        close()             - writes everything queued and stops the writer thread
+    """
+    def __init__(self, maxRecords=QUEUE_SIZE, interval=WRITE_INTERVAL):
+        super().__init__()
+        self.records    = collections.deque()
+        self.maxRecords = maxRecords
+        self.interval   = interval
+        self.handlers   = ()
+        self.dropped    = 0
+        self.wake       = threading.Event()
+        self.written    = threading.Condition()
+        self.cycles     = 0   # writes completed
+        self.stopped    = False
+        self.thread     = threading.Thread(target=self.run, name='flexPrint', daemon=True)
+        self.thread.start()
+
+    def handle(self, record):
+        if len(self.records) < self.maxRecords:
+            self.records.append(record)  # deque appends are atomic, no lock needed
+        else:
+            self.dropped += 1
+        return True
+
+    emit = handle
+
+    def addHandler(self, handler):
+        self.handlers = self.handlers + (handler,)
+
+    def write(self):
+        records = self.records
+        while records:
+            record = records.popleft()
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        for handler in self.handlers:
+            handler.flush()
+
+    def run(self):
+        while not self.stopped:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.write()
+            except Exception:
+                pass
+            with self.written:
+                self.cycles += 1
+                self.written.notify_all()
+
+    def flush(self):
+        if self.thread is threading.current_thread():
+            return
+        with self.written:  # a write may already be under way, the one after it includes every record queued now
+            target = self.cycles + 2
+            while self.cycles < target and self.thread.is_alive():
+                self.wake.set()
+                self.written.wait(self.interval)
+
+    def close(self):
+        if not self.stopped:
+            self.stopped = True
+            self.wake.set()
+            self.thread.join()
+            self.write()
+        super().close()
+
+
+writer     = queuedHandler()
+if FLEX_PRINT_STD_ERR:
+    writer.addHandler(logging.StreamHandler(sys.stderr))
+if FLEX_PRINT_STD_OUT:
+    writer.addHandler(logging.StreamHandler(sys.stdout))
+rootLogger = logging.getLogger()
+rootLogger.addHandler(writer)
+rootLogger.setLevel(INFO)
+loggers    = {}
+atexit.register(writer.close)
+
+
+def callerLogger():
+    name = sys._getframe(2).f_globals.get('__name__', '__main__')
+    logger = loggers.get(name)
+    if logger is None:
+        logger = loggers.setdefault(name, logging.getLogger(name))
+    return logger
+
+
+def fprint(*args, sep=' ', end='\n', file=None, flush=False, level=INFO):
+    '''
+    print replacement, writes args at level to the calling module's logger.  file is ignored, where the
+    output goes is set by config.py and setup().  flush waits until the message has been written.
+    '''
+    logger = callerLogger()
+    if logger.isEnabledFor(level):
+        message = sep.join(map(str, args))
+        if end != '\n':
+            message += end
+        logger.log(level, message)
+        if flush:
+            writer.flush()
+
+
+def flog(level, format, *args):
+    '''
+    Writes format % args at level to the calling module's logger, formatted in the writer thread.
+    '''
+    logger = callerLogger()
+    if logger.isEnabledFor(level):
+        logger.log(level, format, *args)
+
+
+def setup(filename=None, level=None, levels=None, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS):
+    '''
+    Adds a rotating log file and sets the root / per module levels.
+
+    Args:
+        filename (string): log file, None for no file
+        level (int or string): root level
+        levels (dict): module name -> level
+        maxBytes (int): size at which the file is rotated
+        backupCount (int): rotated files kept
+    '''
+    if filename:
+        fileHandler = logging.handlers.RotatingFileHandler(filename, maxBytes=maxBytes, backupCount=backupCount)
+        fileHandler.setFormatter(logging.Formatter(FILE_FORMAT))
+        writer.addHandler(fileHandler)
+    if level is not None:
+        setLevel(None, level)
+    for name, moduleLevel in (levels or {}).items():
+        setLevel(name, moduleLevel)
+
+
+def setLevel(name, level):
+    '''
+    Sets the level of module name (None or 'root' for the root level), level is a number or one of LEVEL_NAMES.
+    '''
+    if isinstance(level, str):
+        if level.upper() not in LEVEL_NAMES:
+            raise ValueError(f"level must be one of {', '.join(LEVEL_NAMES)}")
+        level = getattr(logging, level.upper())
+    logging.getLogger(None if name == 'root' else name).setLevel(level)
+
+
+def getLevels():
+    '''
+    Returns {module name: level name} for the root ('root') and every module with its own level.
+    '''
+    levels = {'root': logging.getLevelName(rootLogger.level)}
+    for name, logger in sorted(logging.Logger.manager.loggerDict.items()):
+        if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET:
+            levels[name] = logging.getLevelName(logger.level)
+    return levels
+
+
+def dropped():
+    return writer.dropped
@@ -0,0 +1,598 @@
+#!/usr/bin/python
+'''
+This provides hub mode: one process supervising many sites, with one web front end, one /metrics endpoint and
+one event loop for all of them, instead of a Flask UI per property.
+
+Each site is one of:
+
+    local   - a controller core in this process: its own state store, scheduler (Scheduler.py) and relayCont on
+              its own bus, a real I2C port or a simulated one (Simulation/smbus.py).  Sites share nothing but the
+              event loop and the worker threads, an exception in one site is counted against it and the others
+              carry on.
+    remote  - a controller on its own Pi (SprinklerController.py).  The hub keeps a copy of its configuration,
+              changes made in the hub are pushed to the controller's /api/batch as compact deltas, only the fields
+              that differ from what the controller last acknowledged (ConfigChanges.diffChanges), several edits
+              made while a push is pending or the controller is unreachable go as one.  The controller's zones are
+              polled for the overview.
+
+The event loop runs the scheduler pass over every local site each TIMER_SAMPLE_INTERVAL, the pushes, polls and
+NVM writes.  Anything which blocks, the relay writes (closeNOrelays waits a quiet gap after relays turn off), HTTP
+to remote controllers and file writes, runs on worker threads, so one slow bus or unreachable Pi never delays the
+other sites.  Each site's
+configuration is saved to <data directory>/<site>.pkl in the SprinklerController.py NVM format, so a simulated
+site can be copied to a Pi as its sprinklerNVM.pkl.
+
+    python Hub.py --sites sites.json --port 5000
+    python Hub.py --simulate 200 --port 5000
+
+sites.json:
+
+    [{"name": "elm-street", "addresses": [63, 59], "bus": "simulated"},
+     {"name": "pump-house", "addresses": [63], "bus": 1},
+     {"name": "lake-house", "remote": "http://lake-house.local:5000"}]
+
+Dog mode, notifications, the watchdog and the live state file are features of a controller on its own Pi and are
+not run for hub sites.
+'''
+from FlexPrint import fprint, flog, WARNING
+import FlexPrint
+from flask import Flask, render_template, request, jsonify, make_response, abort
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import copy
+import datetime
+import importlib.util
+import json
+import os
+import pickle
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+try:
+    import smbus
+except ImportError:  # not a Pi, the relay controller runs on the simulated bus
+    sys.path.append(os.path.join(REPO_DIR, 'Simulation'))
+    import smbus
+import RelayController
+import StateStore
+import ConfigChanges
+import ControllerConfig
+import Scheduler
+import StaticAssets
+import Metrics
+
+TIMER_SAMPLE_INTERVAL = 45    # Seconds between scheduler passes, as SprinklerController.py
+NVM_UPDATE_INTERVAL   = 10    # Seconds between writes of changed site configurations
+PUSH_RETRY_INTERVAL   = 30    # Seconds before a failed push to a remote controller is retried
+POLL_INTERVAL         = 60    # Seconds between polls of the remote controllers' zones
+HTTP_TIMEOUT          = 10    # Seconds to wait for a remote controller
+RELAY_WORKERS         = 16    # Threads writing relays, a site's writes are serialized on one of them at a time
+HTTP_WORKERS          = 8     # Threads pushing to and polling remote controllers
+YIELD_EVERY           = 50    # Sites ticked between yields to the rest of the event loop
+RECENT_EVENTS         = 20    # Relay transitions and errors kept per site for the overview
+DEFAULT_ADDRESSES     = [0x3f, 0x3b]
+DEFAULT_NVM_FILE      = os.path.join(REPO_DIR, 'sprinklerNVM.pkl')  # Template for new sites
+DEFAULT_CONFIG_FILE   = os.path.join(REPO_DIR, 'sc_config.txt')     # WATERING_TIMES and INTERVALS (ControllerConfig.py)
+SITE_NAME             = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+END_OF_TIME           = Scheduler.END_OF_TIME
+
+# The values the controller's pages offer, used to validate changes as SprinklerController.changeOptions(), the
+# watering times and intervals those of the controller configuration file (--config)
+controllerSettings = dict(ControllerConfig.DEFAULTS)
+TIMER_TYPES    = ['INT', 'DoW']
+DAYS           = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+hubTickSeconds   = Metrics.registerHistogram('sprinkler_hub_tick_seconds', 'Time for one scheduler pass over every local site')
+setRelaysSeconds = Metrics.registerHistogram('sprinkler_set_relays_seconds', 'setRelays duration, including I2C retries')
+pushSeconds      = Metrics.registerHistogram('sprinkler_hub_push_seconds', 'Time to push a configuration delta to a remote controller')
+
+simulatedSMBus = None
+
+
+def simulatedBus():
+    '''
+    Returns a new, silent, simulated bus.  Simulation/smbus.py is loaded by path so --simulate never drives a
+    real bus, even on a Pi.
+    '''
+    global simulatedSMBus
+    if simulatedSMBus is None:
+        spec = importlib.util.spec_from_file_location('simulatedSMBus', os.path.join(REPO_DIR, 'Simulation', 'smbus.py'))
+        simulatedSMBus = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(simulatedSMBus)
+    bus = simulatedSMBus.SMBus(1)
+    bus.verbose(-1)
+    return bus
+
+
+def httpJson(method, url, body=None):
+    '''
+    Makes a JSON request to a remote controller, returns (status, decoded reply).
+    '''
+    data = None if body is None else json.dumps(body).encode('utf-8')
+    httpRequest = urllib.request.Request(url, data=data, method=method, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(httpRequest, timeout=HTTP_TIMEOUT) as response:
+            return response.status, json.loads(response.read() or b'null')
+    except urllib.error.HTTPError as error:
+        try:
+            return error.code, json.loads(error.read() or b'null')
+        except ValueError:
+            return error.code, None
+
+
+class site:
+    """
+    One site of the hub, local or remote (see above).
+
+    Args:
+        name (string): unique, used in URLs and metric labels
+        nvmFile (string): where the site's configuration is kept
+        addresses (list): relay card addresses, local sites
+        bus: SMBus instance for the site's relays, local sites
+        remote (string): base URL of the site's controller, remote sites
+
+    Methods:
+        applyChanges(changes) - validates and applies a batch of changes (ConfigChanges.py), returns changeResult
+        requestRelays(mode)   - queues a write of the relays, coalescing requests while one is in progress
+        requestCheck()        - queues a check of the relays (checkState) behind any write in progress
+        writeNVM()            - writes the configuration if it changed since the last write
+        push()                - sends the configuration delta to a remote controller, True when it is up to date
+        poll()                - reads a remote controller's zones
+        status()              - dictionary for the overview and /api/sites
+    """
+    def __init__(self, hub, name, nvmFile, addresses=None, bus=None, remote=None):
+        self.hub        = hub
+        self.name       = name
+        self.nvmFile    = nvmFile
+        self.remote     = remote.rstrip('/') if remote else None
+        self.addresses  = list(addresses or DEFAULT_ADDRESSES)
+        self.counters   = collections.Counter()
+        self.events     = collections.deque(maxlen=RECENT_EVENTS)
+        try:
+            tables = ConfigChanges.readTables(nvmFile)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            tables = ConfigChanges.readTables(DEFAULT_NVM_FILE)
+        for zone in tables['zoneTable']:
+            zone['on'] = False
+            zone['manualStartTime'] = END_OF_TIME
+        self.tables     = tables
+        self.state      = StateStore.stateStore(**tables)
+        self.savedVersion = self.state.snapshot().version
+        self.relayLock  = threading.Lock()
+        self.relayMode  = None   # mode of the write requested while one is queued or running
+        self.relayCheck = False  # a check of the relays (checkState) requested while a write is queued or running
+        self.relayQueued = False
+        self.relayShadow = set()
+        self.relays     = None
+        self.scheduler  = None
+        self.pushed     = None   # configuration document the remote controller last acknowledged
+        self.pushError  = None
+        self.rejected   = None   # configuration document the remote controller rejected
+        self.adoptError = None   # why the remote controller's configuration could not be adopted, until a change is made here
+        self.retryAt    = 0
+        self.remoteZones = None
+        if remote is None:
+            self.relays = RelayController.relayCont(self.addresses, bus=bus)
+            self.relays.open()
+            self.scheduler = Scheduler.wateringScheduler(self.state, self.requestRelays)
+
+    def options(self):
+        return {'wateringTimes': controllerSettings['WATERING_TIMES'],
+                'intervals'    : controllerSettings['INTERVALS'],
+                'timerTypes'   : TIMER_TYPES,
+                'days'         : DAYS,
+                'relayCount'   : RelayController.regSize * len(self.addresses)}
+
+    def applyChanges(self, changes):
+        names = {change.get('table') for change in changes if isinstance(change, dict)} & set(ConfigChanges.TABLES)
+        if 'timerTable' in names:
+            names.update(('zoneTable', 'scheduledDownTime'))  # deleting timers re-targets zones and the down time
+        with self.state.mutate(*names) as tables:
+            result = ConfigChanges.applyChanges(changes, tables, self.options(), time.time())
+        if result.relayChange and self.relays is not None:
+            self.requestRelays("manually")
+        if result.modified and self.remote is not None:
+            self.adoptError = None
+            self.hub.wake()
+        return result
+
+    def requestRelays(self, mode):
+        with self.relayLock:
+            self.relayMode = mode
+            if self.relayQueued:
+                return
+            self.relayQueued = True
+        self.hub.relayPool.submit(self.writeRelays)
+
+    def requestCheck(self):
+        with self.relayLock:
+            self.relayCheck = True
+            if self.relayQueued:
+                return
+            self.relayQueued = True
+        self.hub.relayPool.submit(self.writeRelays)
+
+    def writeRelays(self):
+        while True:
+            with self.relayLock:
+                mode, self.relayMode   = self.relayMode, None
+                check, self.relayCheck = self.relayCheck, False
+                if mode is None and not check:
+                    self.relayQueued = False
+                    return
+            if mode is not None:
+                self.setRelays(mode)
+            if check:
+                try:
+                    self.relays.checkState()
+                except Exception as error:
+                    self.counters['relayErrors'] += 1
+                    self.events.append((time.time(), f"Failed to check relays: {error}"))
+
+    def setRelays(self, mode):
+        start    = time.perf_counter()
+        snap     = self.state.snapshot()
+        zonesOn  = set()
+        if not snap.config['allOff']:
+            zonesOn = {zone for zone in range(len(snap.zoneTable)) if snap.zoneTable[zone]['on']}
+        for attempt in range(3):
+            try:
+                self.relays.closeNOrelays([snap.zoneTable[zone]['relay'] for zone in sorted(zonesOn)])
+                break
+            except Exception as error:
+                self.counters['relayErrors'] += 1
+                self.events.append((time.time(), f"Failed attempt {attempt + 1} to set relays: {error}"))
+                time.sleep(0.25)
+        stamp = time.time()
+        for zone in sorted(zonesOn - self.relayShadow):
+            self.events.append((stamp, f"Zone {snap.zoneTable[zone]['name']} {mode} turned on"))
+        for zone in sorted(self.relayShadow - zonesOn):
+            self.events.append((stamp, f"Zone {snap.zoneTable[zone]['name']} {mode} turned off"))
+        self.relayShadow = zonesOn
+        self.counters['relaySets'] += 1
+        setRelaysSeconds.observe(time.perf_counter() - start)
+
+    def tick(self, timeInSeconds, currentDatetime):
+        try:
+            if self.scheduler.tick(timeInSeconds, currentDatetime):
+                self.requestCheck()  # serialized with the site's relay writes
+        except Exception as error:
+            self.counters['tickErrors'] += 1
+            self.events.append((time.time(), f"Scheduler error {error!r}"))
+            flog(WARNING, "Site %s scheduler error %r", self.name, error)
+
+    def writeNVM(self):
+        snap = self.state.snapshot()
+        if snap.version == self.savedVersion:
+            return False
+        zoneTable = snap.thaw('zoneTable')
+        for zone in zoneTable:
+            zone['on'] = False
+        temporary = self.nvmFile + '.tmp'
+        with open(temporary, 'wb') as nvmFile:
+            pickle.dump(zoneTable, nvmFile)
+            for name in ConfigChanges.TABLES[1:]:
+                pickle.dump(snap.thaw(name), nvmFile)
+        os.replace(temporary, self.nvmFile)
+        self.savedVersion = snap.version
+        return True
+
+    def pending(self):
+        '''
+        Returns the delta not yet acknowledged by the remote controller, None before it has been reached.
+        '''
+        if self.pushed is None:
+            return None
+        return ConfigChanges.diffChanges(self.pushed, ConfigChanges.exportConfig(self.state.snapshot()))
+
+    def push(self):
+        start = time.perf_counter()
+        try:
+            if self.pushed is None:
+                status, document = httpJson('GET', self.remote + '/api/config')
+                if status != 200 or not isinstance(document, dict):
+                    raise ConnectionError(f"configuration request answered {status}")
+                if self.state.snapshot().version == self.savedVersion and not self.counters['pushes']:
+                    try:
+                        self.adopt(document)  # nothing changed here yet, the controller's configuration is current
+                    except ConfigChanges.changeError as error: # the same configuration would fail again, not retried
+                        self.adoptError = f"configuration not adopted: {error}"
+                        self.pushError = self.adoptError
+                        self.counters['adoptRejected'] += 1
+                        return True
+                self.pushed = document
+            document = ConfigChanges.exportConfig(self.state.snapshot())
+            delta = ConfigChanges.diffChanges(self.pushed, document)
+            if delta and document != self.rejected:
+                status, reply = httpJson('POST', self.remote + '/api/batch', {'changes': delta})
+                if status == 400:  # retrying the same delta would fail again, wait for the next change
+                    self.pushError = f"rejected: {reply}"
+                    self.rejected = document
+                    self.counters['pushRejected'] += 1
+                    return True
+                if status != 200:
+                    raise ConnectionError(f"batch answered {status}")
+                self.pushed = document
+                self.counters['pushes'] += 1
+                self.counters['pushedChanges'] += len(delta)
+                pushSeconds.observe(time.perf_counter() - start)
+                self.pushError = None
+            return True
+        except (OSError, ValueError, ConnectionError) as error:
+            self.pushError = str(error)
+            self.counters['pushErrors'] += 1
+            self.retryAt = time.monotonic() + PUSH_RETRY_INTERVAL
+            return False
+
+    def adopt(self, document):
+        changes = ConfigChanges.importChanges(document, self.state.snapshot())
+        with self.state.mutate() as tables:
+            ConfigChanges.applyChanges(changes, tables, self.options(), time.time())
+        self.savedVersion = -1  # written at the next NVM pass
+
+    def poll(self):
+        try:
+            status, reply = httpJson('GET', self.remote + '/api/zones')
+            if status != 200:
+                raise ConnectionError(f"zones request answered {status}")
+            self.remoteZones = reply.get('zones')
+            self.counters['polls'] += 1
+        except (OSError, ValueError, AttributeError, ConnectionError) as error:
+            self.remoteZones = None
+            self.counters['pollErrors'] += 1
+
+    def zonesOn(self):
+        if self.remote is not None:
+            return [zone['name'] for zone in self.remoteZones or () if zone.get('on')]
+        snap = self.state.snapshot()
+        return [snap.zoneTable[zone]['name'] for zone in sorted(self.relayShadow) if zone < len(snap.zoneTable)]
+
+    def status(self):
+        status = {'name': self.name, 'kind': 'remote' if self.remote else 'local', 'version': self.state.snapshot().version,
+                  'zonesOn': self.zonesOn(), 'counters': dict(self.counters),
+                  'events': [f"{time.strftime('%H:%M:%S', time.localtime(stamp))} {text}" for stamp, text in self.events]}
+        if self.remote is not None:
+            pending = self.pending()
+            status.update(remote=self.remote, reachable=self.remoteZones is not None, pushError=self.pushError, adoptError=self.adoptError,
+                          pendingChanges=None if pending is None else len(pending))
+        else:
+            status.update(queueDepth=self.scheduler.queueDepth(), downTime=self.scheduler.downTime, blackedOut=self.scheduler.blackedOut,
+                          addresses=[hex(address) for address in self.addresses])
+        return status
+
+
+class hub:
+    """
+    The sites, the event loop and the worker threads.
+
+    Methods:
+        addSite(site)  - adds a site, before start()
+        start()        - starts the event loop thread
+        wake()         - asks the event loop to push changed remote sites now, safe from any thread
+    """
+    def __init__(self, dataDirectory):
+        self.dataDirectory = dataDirectory
+        self.sites      = {}
+        self.relayPool  = concurrent.futures.ThreadPoolExecutor(RELAY_WORKERS, thread_name_prefix='hubRelays')
+        self.httpPool   = concurrent.futures.ThreadPoolExecutor(HTTP_WORKERS, thread_name_prefix='hubHttp')
+        self.filePool   = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='hubNVM')
+        self.loop       = None
+        self.pushEvent  = None
+        self.thread     = None
+        self.lastTick   = None
+        os.makedirs(dataDirectory, exist_ok=True)
+
+    def addSite(self, name, addresses=None, bus=None, remote=None):
+        if not SITE_NAME.match(name) or name in self.sites:
+            raise ValueError(f"site name {name!r} is not valid or not unique")
+        if remote is None and bus is None:
+            raise ValueError(f"site {name} needs a bus or a remote controller")
+        self.sites[name] = site(self, name, os.path.join(self.dataDirectory, name + '.pkl'), addresses, bus, remote)
+        return self.sites[name]
+
+    def localSites(self):
+        return [item for item in self.sites.values() if item.remote is None]
+
+    def remoteSites(self):
+        return [item for item in self.sites.values() if item.remote is not None]
+
+    def wake(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.pushEvent.set)
+
+    async def tickSites(self):
+        while True:
+            start = time.perf_counter()
+            timeInSeconds = time.time()
+            currentDatetime = datetime.datetime.fromtimestamp(timeInSeconds)
+            for count, item in enumerate(self.localSites(), 1):
+                item.tick(timeInSeconds, currentDatetime)
+                if count % YIELD_EVERY == 0:
+                    await asyncio.sleep(0)
+            self.lastTick = time.time()
+            hubTickSeconds.observe(time.perf_counter() - start)
+            await asyncio.sleep(TIMER_SAMPLE_INTERVAL)
+
+    async def pushSites(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.pushEvent.wait(), PUSH_RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.pushEvent.clear()
+            now = time.monotonic()
+            due = [item for item in self.remoteSites() if now >= item.retryAt and item.adoptError is None and (item.pushed is None or item.pending())]
+            if due:
+                await asyncio.gather(*(self.loop.run_in_executor(self.httpPool, item.push) for item in due))
+
+    async def pollSites(self):
+        while True:
+            remotes = self.remoteSites()
+            if remotes:
+                await asyncio.gather(*(self.loop.run_in_executor(self.httpPool, item.poll) for item in remotes))
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def saveSites(self):
+        while True:
+            await asyncio.sleep(NVM_UPDATE_INTERVAL)
+            for item in self.sites.values():
+                try:
+                    await self.loop.run_in_executor(self.filePool, item.writeNVM)
+                except OSError as error:
+                    flog(WARNING, "Site %s unable to save its configuration: %s", item.name, error)
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.pushEvent = asyncio.Event()
+        self.loop.run_until_complete(asyncio.gather(self.tickSites(), self.pushSites(), self.pollSites(), self.saveSites()))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='hub', daemon=True)
+        self.thread.start()
+        return self.thread
+
+
+app = Flask(__name__)
+assets = StaticAssets.assetPipeline(os.path.join(REPO_DIR, 'static')).register(app)
+sites = None  # hub, created in main
+
+Metrics.gaugeFunction('sprinkler_hub_sites', 'Sites supervised by the hub', lambda: collections.Counter(
+    'remote' if item.remote else 'local' for item in sites.sites.values()), ('kind',))
+Metrics.gaugeFunction('sprinkler_hub_site_zones_on', 'Zones on per site', lambda: {
+    item.name: len(item.zonesOn()) for item in sites.sites.values()}, ('site',))
+Metrics.gaugeFunction('sprinkler_hub_site_queue_depth', 'Zone groups queued for scheduled watering per local site', lambda: {
+    item.name: item.scheduler.queueDepth() for item in sites.localSites()}, ('site',))
+Metrics.gaugeFunction('sprinkler_hub_site_pending_changes', 'Changes not yet acknowledged per remote site', lambda: {
+    item.name: len(item.pending() or ()) for item in sites.remoteSites()}, ('site',))
+Metrics.counterFunction('sprinkler_hub_site_events_total', 'Relay writes, errors, pushes and polls per site', lambda: {
+    (item.name, event): count for item in sites.sites.values() for event, count in item.counters.items()}, ('site', 'event'))
+Metrics.counterFunction('sprinkler_hub_site_i2c_events_total', 'Relay hat I2C transactions, corruption found and rewrites per local site', lambda: {
+    (item.name, event): count for item in sites.localSites() for event, count in item.relays.counters.items()}, ('site', 'event'))
+Metrics.gaugeFunction('sprinkler_hub_last_tick_age_seconds', 'Seconds since the last scheduler pass',
+                      lambda: time.time() - sites.lastTick if sites.lastTick else None)
+Metrics.counterFunction('sprinkler_log_dropped_total', 'Log messages dropped with the log writer behind', FlexPrint.dropped)
+
+
+def siteOr404(name):
+    item = sites.sites.get(name)
+    if item is None:
+        abort(404)
+    return item
+
+
+def changeReply(item, result):
+    return {'site': item.name, 'version': item.state.snapshot().version, 'applied': result.applied,
+            'modified': sorted(result.modified), 'relaysSet': result.relayChange}
+
+
+@app.route("/")
+def overview():
+    return render_template("hub.html", sites=[item.status() for item in sites.sites.values()])
+
+@app.route("/api/sites", methods=["GET"])
+def apiSites():
+    return jsonify(sites=[item.status() for item in sites.sites.values()])
+
+@app.route("/api/sites/<name>/zones", methods=["GET"])
+def apiSiteZones(name):
+    item = siteOr404(name)
+    snap = item.state.snapshot()
+    return jsonify(site=name, version=snap.version, zones=snap.thaw('zoneTable'))
+
+@app.route("/api/sites/<name>/config", methods=["GET"])
+def apiSiteConfig(name):
+    return jsonify(ConfigChanges.exportConfig(siteOr404(name).state.snapshot()))
+
+@app.route("/api/sites/<name>/batch", methods=["POST"])
+def apiSiteBatch(name):
+    '''
+    Transactional batch of changes to one site, {"changes": [<change>, ...]} as the controller's /api/batch.
+    '''
+    item = siteOr404(name)
+    changes = (request.get_json(silent=True) or {}).get('changes')
+    if not isinstance(changes, list):
+        return jsonify(error="Expected {\"changes\": [...]}"), 400
+    try:
+        result = item.applyChanges(changes)
+    except ConfigChanges.changeError as error:
+        return jsonify(error=error.value, change=error.index), 400
+    return jsonify(changeReply(item, result))
+
+@app.route("/api/batch", methods=["POST"])
+def apiBatch():
+    '''
+    The same changes applied to several sites, {"sites": [<name>, ...] or "*", "changes": [...]}.  Each site's
+    batch is a transaction of its own, the reply lists the outcome per site.
+    '''
+    body = request.get_json(silent=True)
+    body = body if isinstance(body, dict) else {}
+    changes = body.get('changes')
+    names = body.get('sites')
+    if not isinstance(changes, list) or not (names == '*' or isinstance(names, list) and all(isinstance(name, str) for name in names)):
+        return jsonify(error="Expected {\"sites\": [...] or \"*\", \"changes\": [...]}"), 400
+    names = list(sites.sites) if names == '*' else names
+    unknown = [name for name in names if name not in sites.sites]
+    if unknown:
+        return jsonify(error=f"Unknown sites {unknown}"), 400
+    results = []
+    for name in names:
+        item = sites.sites[name]
+        try:
+            results.append(changeReply(item, item.applyChanges(copy.deepcopy(changes))))
+        except ConfigChanges.changeError as error:
+            results.append({'site': name, 'error': error.value, 'change': error.index})
+    return jsonify(results=results)
+
+@app.route("/metrics")
+def metrics():
+    response = make_response(Metrics.render())
+    response.headers['Content-Type'] = Metrics.CONTENT_TYPE
+    return response
+
+@app.route("/healthz")
+def healthz():
+    stale = sites.lastTick is not None and time.time() - sites.lastTick > 3 * TIMER_SAMPLE_INTERVAL
+    status = {'sites': len(sites.sites), 'lastTick': sites.lastTick, 'loop': sites.thread is not None and sites.thread.is_alive()}
+    return jsonify(status), 503 if stale or not status['loop'] else 200
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run many controller sites in one process')
+    parser.add_argument('--sites', help='JSON file listing the sites')
+    parser.add_argument('--simulate', type=int, default=0, help='add this many simulated local sites')
+    parser.add_argument('--data', default='/var/ramdisk/hub/' if os.path.isdir('/var/ramdisk') else '/tmp/hub/',
+                        help='directory for the site configurations')
+    parser.add_argument('--port', type=int, default=5000, help='port for the web interface')
+    parser.add_argument('--config', default=DEFAULT_CONFIG_FILE, help='controller configuration file, for the watering times and intervals')
+    args = parser.parse_args()
+    try:
+        controllerSettings.update(ControllerConfig.readConfig(args.config))
+    except (ControllerConfig.configError, OSError) as error:
+        parser.error(f"{args.config}: {error}")
+
+    sites = hub(args.data)
+    FlexPrint.setup(os.path.join(args.data, 'hub.log'))
+    if args.sites:
+        with open(args.sites) as sitesFile:
+            for entry in json.load(sitesFile):
+                if entry.get('remote'):
+                    sites.addSite(entry['name'], remote=entry['remote'])
+                else:
+                    port = entry.get('bus', 'simulated')
+                    bus = simulatedBus() if port == 'simulated' else smbus.SMBus(int(port))
+                    sites.addSite(entry['name'], entry.get('addresses'), bus)
+    for number in range(args.simulate):
+        sites.addSite(f"sim{number + 1:03d}", DEFAULT_ADDRESSES, simulatedBus())
+    if not sites.sites:
+        parser.error("no sites, give --sites and / or --simulate")
+    fprint(f"Hub: {len(sites.localSites())} local and {len(sites.remoteSites())} remote sites")
+    sites.start()
+    app.run(host='0.0.0.0', port=args.port, threaded=True)
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+'''
+This provides the I2C bus traces of the relay hats, so corruption seen in the field can be re-run on a development
+machine against new retry and check logic.  relayCont (RelayController.py) records every transaction, with its result
+and timing, while a trace is started (I2C_TRACE in sc_config.txt):
+
+    relays.startTrace('/home/pi/i2c-trace.bin')
+
+A trace is a header, b'I2CT', the format version and the time it started (seconds from the epoch), followed by one
+12 byte record per transaction:
+
+    microseconds since the previous record started (uint32), duration in microseconds (uint32), kind, I2C address,
+    register, value (one byte each), little endian
+
+The kinds are READ and WRITE, READ_ERROR and WRITE_ERROR for transactions which raised, and the marks relayCont
+writes at the start of each transition, a TRANSITION record per card with the card's index as the register and the
+OutPort value being set, and of each checkState(), CHECK.  GAP records carry the time between records further apart
+than a uint32 of microseconds.  A trace opens with a SHADOW record per register relayCont holds a shadow copy of,
+its value when recording started, so the reads before the first write of a register have a value to compare with.
+
+Simulation/smbus.py's ReplaySMBus plays a trace back: reads return, in order per register, the recorded value's
+difference from the value last written, applied to what the code under test wrote, and the recorded errors are
+raised.  Benchmarks/replayTrace.py replays the transitions and checks of a trace through the current relayCont and
+compares the outcomes and latency with those recorded.
+'''
+from FlexPrint import fprint
+import collections
+import struct
+import threading
+import time
+
+MAGIC          = b'I2CT'
+VERSION        = 1
+HEADER         = struct.Struct('<4sBd')
+RECORD         = struct.Struct('<IIBBBB')
+MAX_DELTA      = 0xffffffff    # Microseconds, the longest time a record can be after the previous one
+MAX_TRACE_SIZE = 64 * 1024 * 1024 # Bytes, recording stops at this size
+
+READ, WRITE, READ_ERROR, WRITE_ERROR, TRANSITION, CHECK, GAP, SHADOW = range(8)
+KIND_NAMES   = ('read', 'write', 'readError', 'writeError', 'transition', 'check', 'gap', 'shadow')
+TRANSACTIONS = (READ, WRITE, READ_ERROR, WRITE_ERROR)
+MARKS        = (TRANSITION, CHECK)
+
+transaction = collections.namedtuple('transaction', 'time duration kind address register value')
+
+
+class traceError(ValueError):
+    """Exception Class for a file which is not an I2C trace"""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return (repr(self.value))
+
+
+class traceWriter:
+    """
+    Writes a trace file.  Thread safe, records are buffered and flushed at each mark.
+
+    Methods:
+        record(kind, address, register, value, start, duration) - start is a time.perf_counter() value, seconds
+        mark(kind, address, register, value)                    - a TRANSITION or CHECK mark, now
+        close()
+    """
+    def __init__(self, path):
+        self.path     = path
+        self.lock     = threading.Lock()
+        self.file     = open(path, 'wb')
+        self.origin   = time.perf_counter()
+        self.previous = 0   # microseconds from origin of the last record's start
+        self.size     = HEADER.size
+        self.file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+
+    def record(self, kind, address, register, value, start, duration):
+        with self.lock:
+            if self.file is None:
+                return
+            offset = max(int(1e6 * (start - self.origin)), self.previous)
+            delta = offset - self.previous
+            while delta > MAX_DELTA:
+                self.file.write(RECORD.pack(MAX_DELTA, 0, GAP, 0, 0, 0))
+                delta -= MAX_DELTA
+            self.file.write(RECORD.pack(delta, min(int(1e6 * duration), MAX_DELTA), kind, address, register, value & 0xff))
+            self.previous = offset
+            self.size += RECORD.size
+            if kind in MARKS:
+                self.file.flush()
+            if self.size >= MAX_TRACE_SIZE:
+                fprint(f"I2C trace {self.path} reached {MAX_TRACE_SIZE} bytes, recording stopped")
+                self.file.close()
+                self.file = None
+
+    def mark(self, kind, address=0, register=0, value=0):
+        self.record(kind, address, register, value, time.perf_counter(), 0)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def readTrace(path):
+    '''
+    Reads a trace file.
+
+    Returns:
+        (start, records): start seconds from the epoch, records a list of transactions with times in seconds from
+        the start of the trace, GAP records folded in
+
+    Raises:
+        traceError, OSError
+    '''
+    with open(path, 'rb') as traceFile:
+        data = traceFile.read()
+    if len(data) < HEADER.size:
+        raise traceError(f"{path} is not an I2C trace")
+    magic, version, start = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise traceError(f"{path} is not a version {VERSION} I2C trace")
+    records = []
+    offset = 0
+    end = HEADER.size + (len(data) - HEADER.size) // RECORD.size * RECORD.size # a partial last record is dropped
+    for delta, duration, kind, address, register, value in RECORD.iter_unpack(data[HEADER.size:end]):
+        offset += delta
+        if kind != GAP:
+            records.append(transaction(offset / 1e6, duration / 1e6, kind, address, register, value))
+    return start, records
+
+
+def deviations(records):
+    '''
+    Returns, for each READ record, the bits in which the value read differs from the value last written to the
+    register in the trace, or its SHADOW value, {record index: bits}.  Non zero bits are corruption (or a glitch of
+    the read).  Reads of a register with neither are left out, its value is not known.
+    '''
+    written = {}
+    flips = {}
+    for index, record in enumerate(records):
+        key = (record.address, record.register)
+        if record.kind in (WRITE, SHADOW):
+            written[key] = record.value
+        elif record.kind == READ and key in written:
+            flips[index] = record.value ^ written[key]
+    return flips
+
+
+def operations(records):
+    '''
+    Returns the transitions and checks of a trace in order, ('transition', time, [(address, OutPort value)]) or
+    ('check', time, None), each with the records which followed it until the next one, as (operation, records).  A
+    transition which ended with an error and was attempted again, as setRelays does, is one transition.
+    '''
+    result = []
+    for record in records:
+        if record.kind == TRANSITION:
+            if record.register and result and result[-1][0][0] == 'transition':
+                result[-1][0][2].append((record.address, record.value)) # the next card of the same transition
+                continue
+            result.append((('transition', record.time, [(record.address, record.value)]), []))
+        elif record.kind == CHECK:
+            result.append((('check', record.time, None), []))
+        elif result:
+            result[-1][1].append(record)
+    merged = []
+    for operation, items in result:
+        if (merged and operation[0] == 'transition' and merged[-1][0][0] == 'transition' and operation[2] == merged[-1][0][2]
+            and merged[-1][1] and merged[-1][1][-1].kind in (READ_ERROR, WRITE_ERROR)):
+            merged[-1][1].extend(items)
+        else:
+            merged.append((operation, items))
+    return merged
+
+
+def shadows(records):
+    '''
+    Returns the register values at the start of a trace, {address: {register: value}}, from its SHADOW records.
+    '''
+    result = collections.defaultdict(dict)
+    for record in records:
+        if record.kind == SHADOW:
+            result[record.address][record.register] = record.value
+    return dict(result)
+
+
+def latency(operation, records):
+    return (records[-1].time + records[-1].duration - operation[1]) if records else 0
+
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(fraction * len(sortedValues)))] if sortedValues else 0
+
+
+def summarize(records):
+    '''
+    Returns the counts and transition latencies of a recorded trace.
+    '''
+    kinds = collections.Counter(KIND_NAMES[record.kind] for record in records)
+    flips = deviations(records)
+    latencies = sorted(latency(operation, items) for operation, items in operations(records) if operation[0] == 'transition')
+    return {'transactions'   : sum(kinds[KIND_NAMES[kind]] for kind in TRANSACTIONS),
+            'transitions'    : len(latencies),
+            'checks'         : kinds['check'],
+            'corruptReads'   : sum(1 for bits in flips.values() if bits),
+            'busErrors'      : kinds['readError'] + kinds['writeError'],
+            'meanMs'         : 1e3 * sum(latencies) / len(latencies) if latencies else 0,
+            'p99Ms'          : 1e3 * percentile(latencies, 0.99),
+            'maxMs'          : 1e3 * latencies[-1] if latencies else 0}
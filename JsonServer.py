@@ -0,0 +1,346 @@
+#!/usr/bin/python
+'''
+This provides the JSON server the Dog Detector(s) connect to.  It is an asyncio server running in its own thread
+so any number of detectors can stay connected at once, a reconnecting detector never waits for another to
+disconnect, and a detector which stops reading its acks only stalls its own connection.
+
+Framing
+=======
+Each connection may use either framing, selected per message by its first byte:
+
+- newline delimited JSON, {"Type": "Dog Warning"}\\n.  Messages without the newline, as sent by the original
+  detectors ({"Type": "Dog Warning"}{"Type": "WatchDog"}), are also accepted, a message is complete as soon as
+  the JSON value is complete, whether or not it arrived in one read.
+- length prefixed JSON, a 4 byte big endian length followed by that many bytes of UTF-8 JSON.
+
+Acks are sent back in the framing of the message: {"Type": "Dog Warning Ack"}\\n or length prefixed.  Messages
+larger than MAX_MESSAGE_SIZE or which are not valid JSON close the connection.
+
+Connections which send nothing for IDLE_TIMEOUT seconds are closed by the server, so a detector which has
+gone away never holds a connection open.  The detector's WatchDog message is still acknowledged, but is no
+longer needed to find out whether the server is alive - a detector that reconnects after its connection is
+closed gets served straight away.
+
+UDP fast path
+=============
+When a key is configured, the server also listens for UDP datagrams on the same port number.  A datagram is a
+single fixed layout event, so a warning costs one packet with no connection to set up or re-establish:
+
+    offset  size  field
+         0     4  magic b'SCDT'
+         4     1  version, 1
+         5     1  type, 1 Dog Warning, 2 WatchDog, 3 ack (server to detector)
+         6     1  flags, bit 0 requests an ack
+         7     1  reserved, 0
+         8     2  detector id
+        10     4  sequence number
+        14     8  timestamp, microseconds since the epoch
+        22    16  HMAC-SHA256 of bytes 0-21 with the shared key, truncated to 16 bytes
+
+All fields are big endian.  Datagrams with a bad MAC, a timestamp more than MAX_CLOCK_SKEW seconds from the
+controller's clock, or a (detector id, sequence number) already seen within the skew window are dropped, so a
+detector may send each event more than once to cover packet loss and a captured datagram can not be replayed.
+The ack, when requested, is the same layout with type 3 and the event's detector id and sequence number.
+
+Message handlers are called on the server's event loop, in the order the messages arrive, after the ack has
+been queued.  UDP events are passed to the same handlers as {"Type": "Dog Warning", "detectorId": id, "seq": n}.
+Handlers must not block.
+'''
+from FlexPrint import fprint
+import asyncio
+import collections
+import hashlib
+import hmac
+import json
+import socket
+import struct
+import threading
+import time
+
+JSON_SERVER_HOST  = '0.0.0.0'
+JSON_SERVER_PORT  = 2579
+MAX_MESSAGE_SIZE  = 64 * 1024   # Bytes, larger messages close the connection
+IDLE_TIMEOUT      = 5 * 60      # Seconds without a message before a connection is closed
+WRITE_HIGH_WATER  = 16 * 1024   # Bytes of unsent acks before writes wait on the detector (backpressure)
+LENGTH_PREFIX     = struct.Struct('>I')
+
+ACKS = {"Dog Warning": "Dog Warning Ack", "WatchDog": "WatchDog Ack"}
+UNKNOWN_ACK = "Unknown Message Ack"
+
+EVENT_MAGIC       = b'SCDT'
+EVENT_VERSION     = 1
+EVENT_HEADER      = struct.Struct('>4sBBBBHIQ')
+EVENT_MAC_SIZE    = 16
+EVENT_SIZE        = EVENT_HEADER.size + EVENT_MAC_SIZE
+EVENT_TYPES       = {1: "Dog Warning", 2: "WatchDog"}
+EVENT_ACK         = 3
+EVENT_ACK_FLAG    = 0x01
+MAX_CLOCK_SKEW    = 30          # Seconds a datagram's timestamp may differ from the controller's clock
+HEARTBEAT_INTERVAL = 1          # Seconds between heartbeats from the event loop
+
+
+class framingError(ValueError):
+    pass
+
+
+class frameDecoder:
+    """
+    Splits the bytes received on one connection into JSON messages.
+
+    feed(data) returns a list of (message, lengthPrefixed) tuples for every message completed by data, keeping
+    any partial message for the next call.
+    """
+    def __init__(self, maxSize=MAX_MESSAGE_SIZE):
+        self.buffer  = bytearray()
+        self.maxSize = maxSize
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while True:
+            start = 0
+            while start < len(self.buffer) and self.buffer[start] in b' \t\r\n':
+                start += 1
+            del self.buffer[:start]
+            if not self.buffer:
+                return messages
+            if self.buffer[0] == 0:  # length prefixed, no message is 16MB so the first byte is always zero
+                if len(self.buffer) < LENGTH_PREFIX.size:
+                    return messages
+                length, = LENGTH_PREFIX.unpack_from(self.buffer)
+                if length > self.maxSize:
+                    raise framingError(f"message of {length} bytes exceeds {self.maxSize}")
+                if len(self.buffer) < LENGTH_PREFIX.size + length:
+                    return messages
+                payload = bytes(self.buffer[LENGTH_PREFIX.size:LENGTH_PREFIX.size + length])
+                del self.buffer[:LENGTH_PREFIX.size + length]
+                messages.append((self.decode(payload), True))
+                continue
+            newline = self.buffer.find(b'\n')
+            text = bytes(self.buffer if newline < 0 else self.buffer[:newline])
+            try:
+                decoded = text.decode('utf-8')
+                message, end = self.decoder.raw_decode(decoded)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                if newline >= 0:
+                    raise framingError(f"invalid JSON message {text[:80]!r}")
+                if len(self.buffer) > self.maxSize:
+                    raise framingError(f"message exceeds {self.maxSize} bytes")
+                return messages  # incomplete, wait for more
+            del self.buffer[:len(decoded[:end].encode('utf-8'))]
+            messages.append((message, False))
+
+    def decode(self, payload):
+        try:
+            return json.loads(payload)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            raise framingError(f"invalid JSON message {payload[:80]!r}")
+
+
+def encodeFrame(message, lengthPrefixed):
+    data = json.dumps(message).encode('utf-8')
+    if lengthPrefixed:
+        return LENGTH_PREFIX.pack(len(data)) + data
+    return data + b'\n'
+
+
+def eventMac(key, header):
+    return hmac.new(key, header, hashlib.sha256).digest()[:EVENT_MAC_SIZE]
+
+
+def encodeEvent(key, eventType, detectorId, seq, timestamp=None, flags=0):
+    '''
+    Builds a signed UDP event datagram, timestamp defaults to now.
+    '''
+    if timestamp is None:
+        timestamp = int(time.time() * 1e6)
+    header = EVENT_HEADER.pack(EVENT_MAGIC, EVENT_VERSION, eventType, flags, 0, detectorId, seq, timestamp)
+    return header + eventMac(key, header)
+
+
+def decodeEvent(key, datagram):
+    '''
+    Verifies a UDP event datagram, returning (type, flags, detectorId, seq, timestamp) or None if the datagram
+    is malformed or not signed with key.
+    '''
+    if len(datagram) != EVENT_SIZE:
+        return None
+    header, mac = datagram[:EVENT_HEADER.size], datagram[EVENT_HEADER.size:]
+    magic, version, eventType, flags, reserved, detectorId, seq, timestamp = EVENT_HEADER.unpack(header)
+    if magic != EVENT_MAGIC or version != EVENT_VERSION:
+        return None
+    if not hmac.compare_digest(mac, eventMac(key, header)):
+        return None
+    return eventType, flags, detectorId, seq, timestamp
+
+
+class eventProtocol(asyncio.DatagramProtocol):
+    """
+    Receives UDP event datagrams for a jsonServer, dropping unsigned, stale and duplicate events.
+    """
+    def __init__(self, server, key):
+        self.server    = server
+        self.key       = key
+        self.transport = None
+        self.seen      = {}  # (detectorId, seq) -> time seen
+        self.lastPrune = 0
+        self.counters  = {'events': 0, 'duplicates': 0, 'rejected': 0}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def isDuplicate(self, detectorId, seq, now):
+        if now - self.lastPrune > MAX_CLOCK_SKEW:
+            self.seen = {key: seen for key, seen in self.seen.items() if now - seen < 2 * MAX_CLOCK_SKEW}
+            self.lastPrune = now
+        if (detectorId, seq) in self.seen:
+            return True
+        self.seen[(detectorId, seq)] = now
+        return False
+
+    def datagram_received(self, datagram, peer):
+        event = decodeEvent(self.key, datagram)
+        now = time.time()
+        if event is None or abs(now - event[4] / 1e6) > MAX_CLOCK_SKEW:
+            self.counters['rejected'] += 1
+            return
+        eventType, flags, detectorId, seq, timestamp = event
+        if flags & EVENT_ACK_FLAG:  # acked even when a duplicate, the detector may have missed the first ack
+            self.transport.sendto(encodeEvent(self.key, EVENT_ACK, detectorId, seq), peer)
+        if self.isDuplicate(detectorId, seq, now):
+            self.counters['duplicates'] += 1
+            return
+        self.counters['events'] += 1
+        messageType = EVENT_TYPES.get(eventType)
+        self.server.received['udp', messageType or 'unknown'] += 1
+        handler = self.server.handlers.get(messageType)
+        if handler is not None:
+            try:
+                handler({"Type": messageType, "detectorId": detectorId, "seq": seq}, peer)
+            except Exception as error:
+                fprint(f"JSON server handler for UDP {messageType} failed: {error!r}")
+
+
+class jsonServer:
+    """
+    Multi-client JSON server for the Dog Detector(s).
+
+    Args:
+        handlers (dict): message Type -> function(message, peer) called on the event loop for each message
+        host, port: address to listen on
+        idleTimeout (float): seconds without a message before a connection is closed
+        udpKey (bytes): shared HMAC key for the UDP fast path, None disables UDP
+        udpPort: UDP port, defaults to the TCP port
+        heartbeat (WatchDog.heartbeat): beaten every HEARTBEAT_INTERVAL from the event loop, so a blocked loop
+                                       stops the watchdog being petted
+
+    Methods:
+        start()  - runs the server in a daemon thread, returns once it is listening
+        stop()   - stops listening for new connections
+    """
+    def __init__(self, handlers, host=JSON_SERVER_HOST, port=JSON_SERVER_PORT, idleTimeout=IDLE_TIMEOUT, udpKey=None, udpPort=None,
+                 heartbeat=None):
+        self.handlers    = handlers
+        self.host        = host
+        self.port        = port
+        self.idleTimeout = idleTimeout
+        self.udpKey      = udpKey
+        self.udpPort     = udpPort
+        self.udp         = None  # eventProtocol when the UDP fast path is enabled
+        self.heartbeat   = heartbeat
+        self.loop        = None
+        self.server      = None
+        self.thread      = None
+        self.ready       = threading.Event()
+        self.connections = 0
+        self.messages    = 0
+        self.received    = collections.Counter()  # (transport, message Type) -> messages, updated on the event loop only
+
+    async def handleMessage(self, message, lengthPrefixed, writer, peer):
+        messageType = message.get("Type") if isinstance(message, dict) else None
+        ackType = ACKS.get(messageType, UNKNOWN_ACK)
+        writer.write(encodeFrame({"Type": ackType}, lengthPrefixed))
+        self.messages += 1
+        self.received['tcp', messageType if ackType != UNKNOWN_ACK else 'unknown'] += 1
+        if ackType == UNKNOWN_ACK:
+            fprint("Unknown message type from", peer, message)
+        handler = self.handlers.get(messageType)
+        if handler is not None:
+            try:
+                handler(message, peer)
+            except Exception as error:
+                fprint(f"JSON server handler for {messageType} failed: {error!r}")
+        await writer.drain()  # only waits when the detector has WRITE_HIGH_WATER bytes of acks unread
+
+    async def handleConnection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+        decoder = frameDecoder()
+        self.connections += 1
+        fprint('Connected by', peer)
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(4096), self.idleTimeout)
+                except asyncio.TimeoutError:
+                    fprint(f"Closing idle connection from {peer}")
+                    break
+                if not data:
+                    break
+                for message, lengthPrefixed in decoder.feed(data):
+                    await self.handleMessage(message, lengthPrefixed, writer, peer)
+        except framingError as error:
+            fprint(f"Closing connection from {peer}: {error}")
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def beat(self):
+        while True:
+            self.heartbeat.beat()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handleConnection, self.host, self.port, reuse_address=True)
+        self.port = self.server.sockets[0].getsockname()[1]
+        if self.udpKey:
+            transport, self.udp = await self.loop.create_datagram_endpoint(lambda: eventProtocol(self, self.udpKey),
+                                                                           local_addr=(self.host, self.udpPort or self.port))
+            self.udpPort = transport.get_extra_info('sockname')[1]
+        if self.heartbeat is not None:
+            self.heartbeatTask = asyncio.create_task(self.beat())
+        self.ready.set()
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except OSError as error:
+            fprint(f"Error: JSON server unable to listen on {self.host}:{self.port} {error}")
+        finally:
+            self.ready.set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='jsonServer', daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self.thread
+
+    def stop(self):
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
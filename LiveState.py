@@ -0,0 +1,189 @@
+#!/usr/bin/python
+'''
+This provides the live state file: a fixed layout binary snapshot of the relays, zones and queue, published by the
+controller into a memory mapped file on the RAM disk for local consumers (the dog detector, a dashboard kiosk, a
+logging sidecar ...).  Readers map the file and read it at any rate without any request to, or work in, the
+controller.
+
+The file is guarded by a seqlock.  The writer makes the sequence number odd, writes the fields and makes it even
+again, a reader reads the sequence number, the fields and the sequence number again and retries if it was odd or
+has changed.  Python has no memory barriers, the writer relies on the ordering of the individual stores which the
+interpreter (a lock operation between each) provides in practice.  The sequence number is only ever written on its
+own, struct.pack_into() clears the whole region it packs before filling it in, which would briefly make a
+sequence number packed along with the other fields even (zero).
+
+Layout, little endian, LAYOUT_VERSION 1:
+
+    offset  size
+     0       4   magic b'SCLS'
+     4       4   sequence number (u32, odd while being written)
+     8       2   layout version (u16)
+    10       2   zone count (u16)
+    12       4   reserved
+    16       8   state version (u64), the state store snapshot version
+    24       8   published (f64), time.time() of the write
+    32       8   relay bitmap (u64), bit n set when relay n+1 is closed
+    40       2   queue depth (u16), zone groups waiting to be watered
+    42       2   flags (u16), FLAG_DOWN_TIME | FLAG_ALL_OFF | FLAG_DOG_MODE | FLAG_BLACKOUT
+    44       4   reserved
+    48     8 * zone count, per zone:
+             4   remaining seconds (f32) of the current watering, 0 when off
+             1   zone flags (u8), ZONE_ON | ZONE_SCHEDULED | ZONE_MANUAL | ZONE_DOG
+             3   reserved
+
+Reader example:
+
+    reader = LiveState.liveStateReader('/var/ramdisk/sprinklerLive.bin')
+    state = reader.read()
+    state.relays, state.zones[0].remaining, state.zones[0].on
+
+or python LiveState.py --watch 1
+'''
+import argparse
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC          = b'SCLS'
+LAYOUT_VERSION = 1
+MAX_ZONES      = 64
+SEQUENCE       = struct.Struct('<I')
+SEQUENCE_AT    = 4
+HEADER         = struct.Struct('<HHIQdQHHI')  # from layout version to the reserved word at 44
+HEADER_AT      = 8
+ZONES_AT       = HEADER_AT + HEADER.size
+ZONE           = struct.Struct('<fB3x')
+FILE_SIZE      = ZONES_AT + ZONE.size * MAX_ZONES
+READ_RETRIES   = 10000
+
+FLAG_DOWN_TIME = 0x01
+FLAG_ALL_OFF   = 0x02
+FLAG_DOG_MODE  = 0x04
+FLAG_BLACKOUT  = 0x08 # a blackout window (Blackout.py) holds the schedule
+
+ZONE_ON        = 0x01
+ZONE_SCHEDULED = 0x02
+ZONE_MANUAL    = 0x04
+ZONE_DOG       = 0x08
+
+liveState = collections.namedtuple('liveState', 'version published relays queueDepth downTime allOff dogMode blackout zones')
+zoneState = collections.namedtuple('zoneState', 'remaining on scheduled manual dog')
+
+
+class liveStatePublisher:
+    """
+    Writer side of the live state file.  The file is written in place, readers which have it mapped keep working
+    across restarts of the controller.
+
+    Methods:
+        publish(version, relays, queueDepth, flags, zones) - writes a new state, zones is [(remaining, zone flags)]
+        close()                                            - unmaps the file
+    """
+    def __init__(self, path):
+        self.path     = path
+        self.lock     = threading.Lock()
+        self.sequence = 0
+        descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(descriptor).st_size < FILE_SIZE:
+                os.ftruncate(descriptor, FILE_SIZE)
+            self.map = mmap.mmap(descriptor, FILE_SIZE)
+        finally:
+            os.close(descriptor)
+        self.publishes = 0
+        if self.map[:4] == MAGIC:
+            self.sequence = SEQUENCE.unpack_from(self.map, SEQUENCE_AT)[0] & ~1  # carry on from a previous writer
+        else:
+            self.publish(0, 0, 0, 0, [])  # a new file, readers may open it before the first real state
+            self.map[:4] = MAGIC
+
+    def publish(self, version, relays, queueDepth, flags, zones):
+        zones = zones[:MAX_ZONES]
+        with self.lock:
+            self.sequence = (self.sequence + 1) & 0xffffffff
+            SEQUENCE.pack_into(self.map, SEQUENCE_AT, self.sequence)
+            HEADER.pack_into(self.map, HEADER_AT, LAYOUT_VERSION, len(zones), 0, version, time.time(), relays,
+                             min(queueDepth, 0xffff), flags, 0)
+            offset = ZONES_AT
+            for remaining, zoneFlags in zones:
+                ZONE.pack_into(self.map, offset, remaining, zoneFlags)
+                offset += ZONE.size
+            self.sequence = (self.sequence + 1) & 0xffffffff
+            SEQUENCE.pack_into(self.map, SEQUENCE_AT, self.sequence)
+            self.publishes += 1
+
+    def close(self):
+        self.map.close()
+
+
+class liveStateReader:
+    """
+    Reader side of the live state file, read() returns a consistent liveState.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as liveFile:
+            self.map = mmap.mmap(liveFile.fileno(), FILE_SIZE, access=mmap.ACCESS_READ)
+        if self.map[:4] != MAGIC:
+            raise ValueError(f"{path} is not a live state file")
+
+    def read(self):
+        live = self.map
+        for attempt in range(READ_RETRIES):
+            before = SEQUENCE.unpack_from(live, SEQUENCE_AT)[0]
+            if before & 1:
+                if attempt % 100 == 99:
+                    time.sleep(0)  # let the writer finish
+                continue
+            header = HEADER.unpack_from(live, HEADER_AT)
+            count = min(header[1], MAX_ZONES)
+            zones = [ZONE.unpack_from(live, ZONES_AT + ZONE.size * zone) for zone in range(count)]
+            if SEQUENCE.unpack_from(live, SEQUENCE_AT)[0] == before:
+                break
+        else:
+            raise TimeoutError("live state is being written continuously")
+        layout, count, reserved, version, published, relays, queueDepth, flags, pad = header
+        if layout != LAYOUT_VERSION:
+            raise ValueError(f"live state layout {layout} is not supported, expected {LAYOUT_VERSION}")
+        return liveState(version, published, relays, queueDepth, bool(flags & FLAG_DOWN_TIME), bool(flags & FLAG_ALL_OFF),
+                         bool(flags & FLAG_DOG_MODE), bool(flags & FLAG_BLACKOUT),
+                         tuple(zoneState(remaining, bool(zoneFlags & ZONE_ON), bool(zoneFlags & ZONE_SCHEDULED),
+                                         bool(zoneFlags & ZONE_MANUAL), bool(zoneFlags & ZONE_DOG))
+                               for remaining, zoneFlags in zones))
+
+    def close(self):
+        self.map.close()
+
+
+def describe(state):
+    relays = [relay + 1 for relay in range(64) if state.relays >> relay & 1]
+    lines = [f"version {state.version}  published {time.strftime('%H:%M:%S', time.localtime(state.published))}  "
+             f"relays {relays}  queue {state.queueDepth}  downTime {state.downTime}  allOff {state.allOff}  dogMode {state.dogMode}  blackout {state.blackout}"]
+    for index, zone in enumerate(state.zones):
+        if zone.on or zone.remaining:
+            kinds = [kind for kind in ('scheduled', 'manual', 'dog') if getattr(zone, kind)]
+            lines.append(f"    zone {index}: {'on ' if zone.on else 'off'} {zone.remaining:7.0f}s remaining  {' '.join(kinds)}")
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Print the controller live state')
+    parser.add_argument('--path', default='/var/ramdisk/sprinklerLive.bin' if os.path.isdir('/var/ramdisk') else '/tmp/sprinklerLive.bin')
+    parser.add_argument('--watch', type=float, help='print again every WATCH seconds')
+    parser.add_argument('--rate', action='store_true', help='measure how many reads per second a reader can make')
+    args = parser.parse_args()
+
+    reader = liveStateReader(args.path)
+    if args.rate:
+        count, start = 0, time.perf_counter()
+        while time.perf_counter() - start < 2:
+            reader.read()
+            count += 1
+        print(f"{count / (time.perf_counter() - start):.0f} reads/s")
+    while True:
+        print(describe(reader.read()))
+        if not args.watch:
+            break
+        time.sleep(args.watch)
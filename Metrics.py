@@ -0,0 +1,285 @@
+#!/usr/bin/python
+'''
+This provides the application metrics served at /metrics in the Prometheus text format (version 0.0.4).
+
+Counters and histograms are sharded per thread: each thread updates its own shard, found through a
+threading.local, so an update is an attribute lookup and a list element add with no lock taken.  Only the
+thread owning a shard writes it, a scrape sums the shards and folds in those of threads which have finished
+(Flask runs each request in its own thread) so the shards do not accumulate.  Gauges are a single value, set
+by assignment.  Values the application already counts (dog mode, the UDP listener, the outbox ...) are exposed
+with gaugeFunction / counterFunction which are only called when /metrics is scraped.
+
+    timerTicks = Metrics.registerCounter('sprinkler_timer_ticks_total', 'Timer thread loop iterations')
+    timerTicks.inc()
+    setRelaysSeconds = Metrics.registerHistogram('sprinkler_set_relays_seconds', 'setRelays duration')
+    setRelaysSeconds.observe(elapsed)
+    httpRequests = Metrics.registerCounter('sprinkler_http_requests_total', 'HTTP requests', ('route', 'method', 'status'))
+    httpRequests.labels('/zones', 'GET', 200).inc()
+
+Labelled children should be looked up once and kept where the label values are fixed, otherwise labels() costs
+a dictionary lookup on every call.  Benchmarks/scrapeMetrics.py measures the per event cost and checks the output parses.
+'''
+import bisect
+import math
+import threading
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE    = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def formatValue(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def formatLabels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class shardedValues:
+    """
+    A fixed length list of numbers per thread, summed on read.
+    """
+    def __init__(self, size):
+        self.size    = size
+        self.local   = threading.local()
+        self.lock    = threading.Lock()  # only taken the first time a thread updates and when reading
+        self.shards  = []                # (thread, values)
+        self.retired = [0] * size        # totals of finished threads
+
+    def shard(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = [0] * self.size
+            with self.lock:
+                self.shards.append((threading.current_thread(), values))
+            return values
+
+    def read(self):
+        with self.lock:
+            alive = []
+            total = list(self.retired)
+            for thread, values in self.shards:
+                for index in range(self.size):
+                    total[index] += values[index]
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:  # finished threads never write again, fold them into the retired totals
+                    for index in range(self.size):
+                        self.retired[index] += values[index]
+            self.shards = alive
+        return total
+
+
+class counterChild:
+    def __init__(self):
+        self.values = shardedValues(1)
+        self.local  = self.values.local
+
+    def inc(self, amount=1):
+        try:
+            self.local.values[0] += amount
+        except AttributeError:
+            self.values.shard()[0] += amount
+
+    def value(self):
+        return self.values.read()[0]
+
+
+class gaugeChild:
+    def __init__(self):
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    def value(self):
+        return self.current
+
+
+class histogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.values  = shardedValues(len(buckets) + 2)  # per bucket (+Inf last), then sum
+        self.local   = self.values.local
+
+    def observe(self, value, bisectLeft=bisect.bisect_left):
+        try:
+            values = self.local.values
+        except AttributeError:
+            values = self.values.shard()
+        values[bisectLeft(self.buckets, value)] += 1
+        values[-1] += value
+
+    def value(self):
+        return self.values.read()
+
+
+class metric:
+    """
+    A metric family.  Without labels the child's update method (inc / set / observe) is bound directly onto
+    the family, so an update costs a single call.  Each kind sets the class of its children, childClass.
+    """
+    kind       = None
+    childClass = None
+
+    def __init__(self, name, help, labelNames=()):
+        self.name       = name
+        self.help       = help
+        self.labelNames = tuple(labelNames)
+        self.children   = {}
+        self.cache      = {}  # label values as passed to labels() -> child, skips the str() conversions
+        self.lock       = threading.Lock()
+        if not self.labelNames:
+            self.default = self.labels()
+            for method in ('inc', 'set', 'observe'):
+                if hasattr(self.default, method):
+                    setattr(self, method, getattr(self.default, method))
+
+    def newChild(self):
+        return self.childClass()
+
+    def labels(self, *values):
+        child = self.cache.get(values)
+        if child is None:
+            if len(values) != len(self.labelNames):
+                raise ValueError(f"{self.name} expects labels {self.labelNames}")
+            with self.lock:
+                child = self.children.setdefault(tuple(str(value) for value in values), self.newChild())
+                self.cache[values] = child
+        return child
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        lines = self.header()
+        for values, child in list(self.children.items()):
+            lines.append(f"{self.name}{formatLabels(self.labelNames, values)} {formatValue(child.value())}")
+        return lines
+
+
+class counter(metric):
+    kind       = 'counter'
+    childClass = counterChild
+
+
+class gauge(metric):
+    kind       = 'gauge'
+    childClass = gaugeChild
+
+
+class histogram(metric):
+    kind       = 'histogram'
+    childClass = histogramChild
+
+    def __init__(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelNames)
+
+    def newChild(self):
+        return self.childClass(self.buckets)
+
+    def render(self):
+        lines = self.header()
+        for values, child in list(self.children.items()):
+            totals = child.value()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), totals):
+                cumulative += count
+                le = f'le="{formatValue(float(bound))}"'
+                lines.append(f"{self.name}_bucket{formatLabels(self.labelNames, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{formatLabels(self.labelNames, values)} {formatValue(totals[-1])}")
+            lines.append(f"{self.name}_count{formatLabels(self.labelNames, values)} {cumulative}")
+        return lines
+
+
+class functionMetric(metric):
+    """
+    A metric whose value(s) are read from function() when scraped.  function returns a number, or, for a
+    metric with labels, a dictionary of label value tuples to numbers.
+    """
+    def __init__(self, name, help, function, labelNames=(), kind='gauge'):
+        self.function = function
+        self.kind     = kind
+        self.name       = name
+        self.help       = help
+        self.labelNames = tuple(labelNames)
+
+    def render(self):
+        lines = self.header()
+        try:
+            result = self.function()
+        except Exception:
+            return lines
+        if result is None:
+            return lines
+        if not self.labelNames:
+            result = {(): result}
+        for values, value in result.items():
+            values = values if isinstance(values, tuple) else (values,)
+            lines.append(f"{self.name}{formatLabels(self.labelNames, values)} {formatValue(value)}")
+        return lines
+
+
+class metricsRegistry:
+    """
+    The metrics served by /metrics, in registration order.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock    = threading.Lock()
+
+    def register(self, item):
+        with self.lock:
+            return self.metrics.setdefault(item.name, item)
+
+    def render(self, include=None, exclude=()):
+        '''
+        Renders every metric, or only those named in include, skipping any named in exclude.
+        '''
+        with self.lock:
+            items = [item for name, item in self.metrics.items()
+                     if (include is None or name in include) and name not in exclude]
+        lines = []
+        for item in items:
+            lines.extend(item.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = metricsRegistry()
+
+
+def registerCounter(name, help, labelNames=()):
+    return REGISTRY.register(counter(name, help, labelNames))
+
+
+def registerGauge(name, help, labelNames=()):
+    return REGISTRY.register(gauge(name, help, labelNames))
+
+
+def registerHistogram(name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(histogram(name, help, labelNames, buckets))
+
+
+def gaugeFunction(name, help, function, labelNames=()):
+    return REGISTRY.register(functionMetric(name, help, function, labelNames, 'gauge'))
+
+
+def counterFunction(name, help, function, labelNames=()):
+    return REGISTRY.register(functionMetric(name, help, function, labelNames, 'counter'))
+
+
+def render(include=None, exclude=()):
+    return REGISTRY.render(include, exclude)
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+'''
+This provides the notification outbox.  sendEmail / sendTextMessage only write the message to a file in the
+outbox directory on the RAM disk and return, a background sender thread delivers the messages so the timer
+thread and the relay retry loops never wait on the network.
+
+- Messages are written to a temporary name and renamed into the outbox, so the sender never reads a partial
+  message and the queue survives a restart of the controller (the RAM disk is only cleared by a reboot).
+- The SMTP connection is kept open between messages, checked with NOOP before reuse after being idle, and
+  closed after idleClose seconds with nothing to send.
+- A failed delivery closes the connection and the sender backs off exponentially, from backoffBase up to
+  backoffMax seconds, before retrying.  A message which fails maxAttempts times is moved to outbox/failed.
+- Messages with a subject in digestSubjects (the "I2C Bus Failure" alerts) are sent at most once per
+  digestWindow seconds per recipient.  The first is sent straight away, the ones arriving within the window
+  are combined into a single digest message sent when the window closes.
+'''
+from FlexPrint import fprint
+from email.message import EmailMessage
+import json
+import os
+import random
+import smtplib
+import threading
+import time
+
+OUTBOX_SUFFIX    = '.json'
+FAILED_DIRECTORY = 'failed'
+DIGEST_LINES     = 5  # Lines of detail included in a digest, the rest are counted only
+
+
+def timeText(seconds):
+    return time.strftime('%-I:%M:%S%p', time.localtime(seconds))
+
+
+class outbox:
+    """
+    Persistent notification queue and SMTP sender.
+
+    Args:
+        directory (string): outbox directory, created if needed
+        connect (function): returns a connected (and logged in) smtplib.SMTP / SMTP_SSL instance
+        sender (string): From address
+        digestSubjects (tuple): subjects aggregated into digests
+        digestWindow, idleClose, backoffBase, backoffMax (float): seconds
+        maxAttempts (int): deliveries attempted before a message is moved to outbox/failed
+
+    Methods:
+        enqueue(recipient, subject, body) - queues a message, returns without any network I/O
+        start()                           - starts the sender thread
+        pending()                         - number of queued messages
+    """
+    def __init__(self, directory, connect, sender, digestSubjects=(), digestWindow=10 * 60, idleClose=60,
+                 backoffBase=5, backoffMax=15 * 60, maxAttempts=20, clock=time.time):
+        self.directory      = directory
+        self.connect        = connect
+        self.sender         = sender
+        self.digestSubjects = set(digestSubjects)
+        self.digestWindow   = digestWindow
+        self.idleClose      = idleClose
+        self.backoffBase    = backoffBase
+        self.backoffMax     = backoffMax
+        self.maxAttempts    = maxAttempts
+        self.clock          = clock
+        self.condition      = threading.Condition()
+        self.counter        = 0
+        self.queued         = True   # set by enqueue, the sender looks at the outbox before waiting again
+        self.connection     = None
+        self.lastUsed       = 0
+        self.failures       = 0
+        self.retryAt        = 0
+        self.lastDigest     = {}  # (subject, recipient) -> time the last one was sent
+        self.counters       = {'queued': 0, 'sent': 0, 'digests': 0, 'failures': 0, 'connects': 0, 'failed': 0}
+        self.thread         = None
+        os.makedirs(os.path.join(directory, FAILED_DIRECTORY), exist_ok=True)
+
+    def enqueue(self, recipient, subject, body):
+        with self.condition:
+            self.counter += 1
+            name = f"{time.time_ns():020d}-{os.getpid()}-{self.counter}{OUTBOX_SUFFIX}"
+        message = {'recipient': recipient, 'subject': subject, 'body': body, 'time': self.clock(), 'attempts': 0}
+        self.write(name, message)
+        with self.condition:
+            self.counters['queued'] += 1
+            self.queued = True
+            self.condition.notify()
+
+    def write(self, name, message):
+        temporary = os.path.join(self.directory, '.' + name)
+        with open(temporary, 'w') as messageFile:
+            json.dump(message, messageFile)
+        os.replace(temporary, os.path.join(self.directory, name))
+
+    def load(self):
+        messages = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith('.') or not name.endswith(OUTBOX_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as messageFile:
+                    messages.append((name, json.load(messageFile)))
+            except (OSError, ValueError):
+                fprint(f"Outbox message {name} unreadable, moved to {FAILED_DIRECTORY}")
+                self.moveToFailed(name)
+        return messages
+
+    def pending(self):
+        return sum(1 for name in os.listdir(self.directory) if not name.startswith('.') and name.endswith(OUTBOX_SUFFIX))
+
+    def moveToFailed(self, name):
+        try:
+            os.replace(os.path.join(self.directory, name), os.path.join(self.directory, FAILED_DIRECTORY, name))
+        except OSError:
+            pass
+
+    def batches(self, messages, now):
+        '''
+        Groups the queued messages into deliveries, [(names, recipient, subject, body, digestKey)] in queue
+        order, and returns the time the next held digest is due (or None).  digestKey is None for ordinary
+        messages.
+        '''
+        deliveries = []
+        held = {}  # digestKey -> [(name, message)], in the order the first of each was queued
+        nextDue = None
+        for name, message in messages:
+            key = (message['subject'], message['recipient'])
+            if message['subject'] not in self.digestSubjects:
+                deliveries.append(([name], message['recipient'], message['subject'], message['body'], None))
+                continue
+            due = self.lastDigest.get(key, 0) + self.digestWindow
+            if now < due:
+                nextDue = due if nextDue is None else min(nextDue, due)
+                continue
+            if key not in held:
+                held[key] = []
+                deliveries.append((None, message['recipient'], message['subject'], None, key))
+            held[key].append((name, message))
+        result = []
+        for names, recipient, subject, body, key in deliveries:
+            if key is None:
+                result.append((names, recipient, subject, body, None))
+                continue
+            grouped = held[key]
+            if len(grouped) == 1:
+                result.append(([grouped[0][0]], recipient, subject, grouped[0][1]['body'], key))
+                continue
+            first, last = grouped[0][1]['time'], grouped[-1][1]['time']
+            lines = [f"{timeText(message['time'])} {message['body']}" for name, message in grouped[:DIGEST_LINES]]
+            if len(grouped) > DIGEST_LINES:
+                lines.append(f"... and {len(grouped) - DIGEST_LINES} more")
+            body = f"{len(grouped)} alerts between {timeText(first)} and {timeText(last)}\r\n" + "\r\n".join(lines)
+            result.append(([name for name, message in grouped], recipient, f"{subject} (x{len(grouped)})", body, key))
+        return result, nextDue
+
+    def openConnection(self, now):
+        if self.connection is not None and now - self.lastUsed > 5:
+            try:
+                if self.connection.noop()[0] != 250:
+                    raise smtplib.SMTPException("NOOP failed")
+            except (smtplib.SMTPException, OSError):
+                self.closeConnection()
+        if self.connection is None:
+            self.connection = self.connect()
+            self.counters['connects'] += 1
+        return self.connection
+
+    def closeConnection(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+    def deliver(self, recipient, subject, body, now):
+        message = EmailMessage()
+        message['Subject'] = subject
+        message['From'] = self.sender
+        message['To'] = recipient
+        message.set_content(body)
+        self.openConnection(now).sendmail(self.sender, recipient, message.as_string())
+        self.lastUsed = self.clock()
+
+    def sendPending(self):
+        '''
+        Delivers everything that is due, returning the time the sender should next wake up (None to wait for
+        the next message).
+        '''
+        now = self.clock()
+        if now < self.retryAt:
+            return self.retryAt
+        messages = self.load()
+        if not messages:
+            if self.connection is not None and now - self.lastUsed > self.idleClose:
+                self.closeConnection()
+            return self.lastUsed + self.idleClose if self.connection is not None else None
+        deliveries, nextDue = self.batches(messages, now)
+        byName = dict(messages)
+        for names, recipient, subject, body, digestKey in deliveries:
+            try:
+                self.deliver(recipient, subject, body, now)
+            except (smtplib.SMTPException, OSError) as error:
+                self.closeConnection()
+                self.failures += 1
+                self.counters['failures'] += 1
+                delay = min(self.backoffMax, self.backoffBase * 2 ** (self.failures - 1))
+                self.retryAt = self.clock() + delay * random.uniform(0.8, 1.2)
+                fprint(f"Outbox delivery of {subject} to {recipient} failed ({error!r}), retrying in {delay:.0f}s")
+                for name in names:
+                    message = byName[name]
+                    message['attempts'] += 1
+                    if message['attempts'] >= self.maxAttempts:
+                        fprint(f"Outbox message {name} failed {message['attempts']} times, moved to {FAILED_DIRECTORY}")
+                        self.moveToFailed(name)
+                        self.counters['failed'] += 1
+                    else:
+                        self.write(name, message)
+                return self.retryAt
+            for name in names:
+                os.remove(os.path.join(self.directory, name))
+            self.failures = 0
+            self.counters['sent'] += 1
+            if digestKey is not None:
+                self.lastDigest[digestKey] = now
+                if len(names) > 1:
+                    self.counters['digests'] += 1
+            fprint(f"Message Sent: {subject}")
+        if nextDue is not None:
+            return nextDue
+        return self.lastUsed + self.idleClose
+
+    def run(self):
+        wake = None
+        while True:
+            with self.condition:
+                timeout = None if wake is None else wake - self.clock()
+                if not self.queued and (timeout is None or timeout > 0):
+                    self.condition.wait(timeout)
+                self.queued = False
+            try:
+                wake = self.sendPending()
+            except Exception as error:
+                fprint(f"Outbox sender error: {error!r}")
+                wake = self.clock() + self.backoffBase
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='outbox', daemon=True)
+        self.thread.start()
+        return self.thread
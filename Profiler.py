@@ -0,0 +1,194 @@
+#!/usr/bin/python
+'''
+This provides on demand profiling of the running controller, started from /admin/profile or SIGUSR2, so a CPU
+spike or memory growth on a deployed Pi can be looked at without a debugger.  Nothing is installed until a
+profile is started, so there is no overhead otherwise.
+
+Two modes, each running for a fixed number of seconds (or until stopped):
+
+    cpu     - a sampling profiler.  A thread reads the stack of every other thread (timerThread, the Flask
+              request threads, the JSON server's event loop ...) from sys._current_frames() every interval
+              seconds.  Writes <name>.collapsed, one "thread;outer;...;inner count" line per stack, for
+              flamegraph.pl / speedscope, and <name>.pstats which loads with pstats.Stats() / snakeviz.
+              cProfile is not used as it only profiles the thread that enables it.
+    memory  - tracemalloc, started for the duration.  Writes the final snapshot, <name>.tracemalloc (load with
+              tracemalloc.Snapshot.load()), and <name>.txt listing the allocation sites which grew the most.
+
+In the pstats output the call counts are sample counts, and the times are samples multiplied by the interval.
+'''
+from FlexPrint import fprint
+import collections
+import marshal
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+MODES             = ('cpu', 'memory')
+SAMPLE_INTERVAL   = 0.005   # Seconds between stack samples
+MAX_DURATION      = 10 * 60 # Longest profile allowed, seconds
+TRACEMALLOC_DEPTH = 10      # Frames kept per allocation in memory mode
+TOP_ALLOCATIONS   = 40      # Allocation sites listed in the memory report
+
+
+def frameLabel(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+
+
+def codeKey(code):
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class stackSampler:
+    """
+    Samples the stacks of all the other threads, keeping a count per distinct stack.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks   = collections.Counter()  # (thread name, (code, ...) outermost first) -> samples
+        self.samples  = 0
+
+    def sample(self, own):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes.reverse()
+            self.stacks[(names.get(ident, str(ident)), tuple(codes))] += 1
+        self.samples += 1
+
+    def collapsed(self):
+        lines = []
+        for (threadName, codes), count in self.stacks.most_common():
+            lines.append(';'.join([threadName.replace(';', ':')] + [frameLabel(code) for code in codes]) + f" {count}")
+        return '\n'.join(lines) + '\n'
+
+    def pstats(self):
+        '''
+        Returns the samples in the format pstats.Stats loads, {function: (cc, nc, tt, ct, callers)}.
+        '''
+        own       = collections.Counter()
+        inclusive = collections.Counter()
+        callers   = collections.defaultdict(collections.Counter)
+        for (threadName, codes), count in self.stacks.items():
+            keys = [codeKey(code) for code in codes]
+            if not keys:
+                continue
+            own[keys[-1]] += count
+            for key in set(keys):  # once per stack, recursion would otherwise count twice
+                inclusive[key] += count
+            for caller, callee in set(zip(keys, keys[1:])):
+                callers[callee][caller] += count
+        stats = {}
+        for key, count in inclusive.items():
+            callerStats = {caller: (calls, calls, 0.0, calls * self.interval) for caller, calls in callers[key].items()}
+            stats[key] = (count, count, own[key] * self.interval, count * self.interval, callerStats)
+        return stats
+
+
+class profiler:
+    """
+    Runs one profile at a time and writes the results to directory.
+
+    Args:
+        directory (string): where the results are written, created if needed
+
+    Methods:
+        start(mode, seconds, interval) - starts a profile, raises RuntimeError if one is already running
+        stop(wait=True)                - ends the running profile early, returns the files written when waiting
+        status()                       - dictionary describing the running or last profile
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock      = threading.Lock()
+        self.stopped   = threading.Event()
+        self.thread    = None
+        self.current   = None  # {'mode', 'started', 'seconds', 'interval'}
+        self.files     = []
+        self.error     = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, mode='cpu', seconds=30, interval=SAMPLE_INTERVAL):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}")
+        seconds = min(float(seconds), MAX_DURATION)
+        interval = max(float(interval), 0.001)
+        if seconds <= 0:
+            raise ValueError("seconds must be positive")
+        with self.lock:
+            if self.running():
+                raise RuntimeError("a profile is already running")
+            self.stopped.clear()
+            self.current = {'mode': mode, 'started': time.time(), 'seconds': seconds, 'interval': interval}
+            self.files = []
+            self.error = None
+            target = self.sampleCpu if mode == 'cpu' else self.traceMemory
+            self.thread = threading.Thread(target=self.run, args=(target, seconds, interval), name='profiler', daemon=True)
+            self.thread.start()
+        fprint(f"Profiler: {mode} profile started for {seconds:g}s")
+        return self.status()
+
+    def stop(self, wait=True):
+        self.stopped.set()
+        thread = self.thread
+        if wait and thread is not None:
+            thread.join()
+        return list(self.files)
+
+    def status(self):
+        status = dict(self.current or {})
+        status.update(running=self.running(), files=list(self.files), error=self.error)
+        return status
+
+    def run(self, target, seconds, interval):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            name = os.path.join(self.directory, time.strftime(f"profile-%Y%m%d-%H%M%S-{self.current['mode']}"))
+            self.files = target(name, seconds, interval)
+            fprint(f"Profiler: wrote {', '.join(self.files)}")
+        except Exception as error:
+            self.error = repr(error)
+            fprint(f"Profiler: {self.current['mode']} profile failed {error!r}")
+
+    def sampleCpu(self, name, seconds, interval):
+        sampler = stackSampler(interval)
+        own = threading.get_ident()
+        end = time.monotonic() + seconds
+        while not self.stopped.is_set() and time.monotonic() < end:
+            sampler.sample(own)
+            self.stopped.wait(interval)
+        with open(name + '.collapsed', 'w') as collapsedFile:
+            collapsedFile.write(sampler.collapsed())
+        with open(name + '.pstats', 'wb') as pstatsFile:
+            marshal.dump(sampler.pstats(), pstatsFile)
+        return [name + '.collapsed', name + '.pstats']
+
+    def traceMemory(self, name, seconds, interval):
+        alreadyTracing = tracemalloc.is_tracing()
+        if not alreadyTracing:
+            tracemalloc.start(TRACEMALLOC_DEPTH)
+        try:
+            first = tracemalloc.take_snapshot()
+            self.stopped.wait(seconds)
+            last = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if not alreadyTracing:
+                tracemalloc.stop()
+        last.dump(name + '.tracemalloc')
+        with open(name + '.txt', 'w') as reportFile:
+            reportFile.write(f"Traced memory {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n\n")
+            reportFile.write(f"Top {TOP_ALLOCATIONS} allocation sites by growth over the profile:\n")
+            for stat in last.compare_to(first, 'lineno')[:TOP_ALLOCATIONS]:
+                reportFile.write(f"{stat}\n")
+            reportFile.write(f"\nTop {TOP_ALLOCATIONS} allocation sites by size:\n")
+            for stat in last.statistics('lineno')[:TOP_ALLOCATIONS]:
+                reportFile.write(f"{stat}\n")
+        return [name + '.tracemalloc', name + '.txt']
@@ -9,7 +9,8 @@ ordered according the ordering of addresses provided during initialization.  I.e
 
 relays = relayCont([0x3f, 0x3c]) will provide control for 16 relays in a numerical list where relays 1 through 8
 (list indices 0 through 7) will be on card 0 (address 0x3f) and relays 9 through 16 (indices 8 through 15) will
-be on card 1.
+be on card 1.  By default every instance uses the module's bus, I2C1; relayCont(addressList, bus=smbus.SMBus(0))
+gives an instance a bus (and lock) of its own, i.e. one simulated bus per site in Hub.py.
 
 This module is designed to be thread safe,  locking the bus resources  at the beginning of each method and releasing the
 bus resources after the completion of the last bus transaction in the method.
@@ -22,17 +23,31 @@ sudo i2cdetect -y 0
 sudo i2cdetect -y 1
 
 The 7 bit I2C address of all found devices will be shown (ignoring the R/W bit, so I2C address 0000 0110 is displayed as hex 03).
+
+Relay transitions, break before make
+====================================
+Solenoid back EMF when a valve turns off corrupts the PCA9534 registers and the I2C transactions in flight.  So a
+transition is written in phases: the relays turning off first, card by card, each followed by a quiet gap (quietGap
+seconds with no bus traffic) and then a check of that card's registers, the transaction the back EMF is aimed at,
+then the relays turning on.  Cards with nothing to change are not written.  sequencing(False) restores writing every
+card at once followed by a check of every register.  The bus transactions, corruption found and registers rewritten
+are counted in counters, the I2C statistics (sprinkler_i2c_events_total at /metrics).
+
+startTrace(path) records every bus transaction, with its result and timing, to a compact binary trace (I2CTrace.py)
+which Simulation/smbus.py's ReplaySMBus can play back on a development machine.
 '''
 from config import *
-from FlexPrint import fprint
+from FlexPrint import fprint, flog, DEBUG, INFO
+import I2CTrace
 import smbus
 from threading import Lock
+import collections
 import time
 
 #addressList   = [0x3f, 0x3c]
 
-bus = smbus.SMBus(1)    # 0 = /dev/i2c-0 (port I2C0), 1 = /dev/i2c-1 (port I2C1)
-busLock = Lock()
+defaultBus     = smbus.SMBus(1)    # 0 = /dev/i2c-0 (port I2C0), 1 = /dev/i2c-1 (port I2C1)
+defaultBusLock = Lock()
 
 TI_PCA9534A_INPORT_REG_ADD	            = 0x00
 TI_PCA9534A_OUTPORT_REG_ADD	            = 0x01
@@ -61,6 +76,8 @@ ALL_ENABLE_RELAY_CONTROL   = 0x00
 ALL_DISABLE_RELAY_CONTROL  = 0xff
 ALL_CONTROLS_NOT_INVERTED  = 0x00
 
+QUIET_GAP = 0.25 # Seconds without bus traffic after relays turn off, for the solenoids' back EMF to die away
+
 RC_FAIL_TO_WRITE_OUTPORT_REG            = 1
 RC_FAIL_TO_WRITE_POLARITY_INVERSION_REG = 2
 RC_FAIL_TO_WRITE_CONFIG_REG             = 3
@@ -108,11 +125,17 @@ class relayCont:
     Attributes:
         returncode(int)      - see definitions for code interpretation
         verboseness          - varying degree of print statements
+        counters (Counter)   - I2C statistics: reads, writes, turnOffs, corrupt (registers found corrupt), rewrites,
+                               uncorrected and busErrors
 
 
     Methods:
         open()                        - non-preferred method to initialize
+        setAddressList(addressList)   - changes the cards controlled, initializing only the cards added
         closeNOrelays(relayList)      - provided list of integers will have relays enabled, connecting NO to COM
+        checkState()                  - checks every register against its shadow copy, rewriting those corrupted
+        sequencing(breakBeforeMake, quietGap) - how closeNOrelays orders a transition, see above
+        startTrace(path) / stopTrace() - records the bus transactions to an I2C trace file, see above
         close()                       - non-preferred method to disable
         getNumCards()                 - returns the number of cards defined in this header - not discovered on board
         getAddressList()              - returns the address list - the list passed to __init__
@@ -126,9 +149,16 @@ class relayCont:
                                             1 - high level command reporting
                                             2 - register level command reporting
     """
-    def __init__(self, addressList):
+    def __init__(self, addressList, bus=None, busLock=None):
         self.returncode = 0
+        self.bus = bus if bus is not None else defaultBus  # an SMBus per instance lets one process drive several sites
+        self.busLock = busLock if busLock is not None else (defaultBusLock if bus is None else Lock())
         self.verboseness = 0
+        self.breakBeforeMake = True
+        self.quietGap = QUIET_GAP
+        self.counters = collections.Counter()
+        self.unverified = set() # cards whose last write failed, their registers may not match the shadow copies
+        self.trace = None # I2CTrace.traceWriter while recording
         self.shadowCopy = [{} for _ in range(len(addressList))]
         self.addressList = addressList  # 7 bit address (will be left shifted to append the read write bit in
                                         # bus.write_byte_data, bus.write_i2c_block_data and bus.read_i2c_block_data
@@ -139,24 +169,78 @@ class relayCont:
     def __enter__(self):
         if self.verboseness > 0:
            fprint("Initializing TI PCA9534(s) ...")
-        for index, address in enumerate(self.addressList):
-            self.writeReg(card=index, regAdd=addressMap['OutPort'],  value=ALL_RELAYS_IN_NORMAL_STATE) # disconnect all NO relay pins
-            self.writeReg(card=index, regAdd=addressMap['Polarity'], value=ALL_CONTROLS_NOT_INVERTED)  # re-write default value (should be redundant with PoR value)
-            self.writeReg(card=index, regAdd=addressMap['Config'],   value=ALL_ENABLE_RELAY_CONTROL)   # enable control of all relays through Outport
-            # Checking configuration succeeded
-            registerVal = self.readReg(card=index, regAdd=addressMap['InPort'])
-            if registerVal[0] != 0x00:
-                errorString = f'Failed to initialize card {index} at address {hex(address)}.  Expected 0xFF on READ INPORT and read {hex(registerVal[0])}'
-                raise (relayError(errorString))
+        for index in range(len(self.addressList)):
+            self.initCard(index)
         if self.verboseness > 0:
             fprint("Initializing TI PCA9534(s) successful")
         return(self)
 
+    def initCard(self, index):
+        self.writeReg(card=index, regAdd=addressMap['OutPort'],  value=ALL_RELAYS_IN_NORMAL_STATE) # disconnect all NO relay pins
+        self.writeReg(card=index, regAdd=addressMap['Polarity'], value=ALL_CONTROLS_NOT_INVERTED)  # re-write default value (should be redundant with PoR value)
+        self.writeReg(card=index, regAdd=addressMap['Config'],   value=ALL_ENABLE_RELAY_CONTROL)   # enable control of all relays through Outport
+        # Checking configuration succeeded
+        registerVal = self.readReg(card=index, regAdd=addressMap['InPort'])
+        if registerVal[0] != 0x00:
+            errorString = f'Failed to initialize card {index} at address {hex(self.addressList[index])}.  Expected 0xFF on READ INPORT and read {hex(registerVal[0])}'
+            raise (relayError(errorString))
+
+    def disableCard(self, index):
+        self.writeReg(card=index, regAdd=addressMap['Config'],   value=ALL_DISABLE_RELAY_CONTROL)   # disable control of all relays through Outport
+        # Checking configuration succeeded
+        registerVal = self.readReg(card=index, regAdd=addressMap['InPort'])
+        if registerVal[0] != 0x00:
+            raise (relayError(f'Failed to disable card {index} at address {hex(self.addressList[index])}.  Expected 0x00 on READ INPORT and read {hex(registerVal[0])}'))
+
+    def setAddressList(self, addressList):
+        '''
+        Changes the cards controlled without disturbing the relays of the cards kept: cards no longer in addressList
+        are disabled, new ones initialized (all relays open) and the kept ones keep their registers and shadow copies,
+        wherever they move to in the list.  The caller sets the relays afterwards, relay numbers follow the new order.
+
+        Returns:
+            (addresses initialized, addresses disabled)
+        '''
+        addressList = list(addressList)
+        shadows = dict(zip(self.addressList, self.shadowCopy))
+        unverified = {self.addressList[card] for card in self.unverified}
+        removed = [address for address in self.addressList if address not in addressList]
+        added = [address for address in addressList if address not in shadows]
+        for address in removed:
+            try:
+                self.disableCard(self.addressList.index(address))
+            except relayError as error: # the card may be gone already
+                fprint(f"Card at {hex(address)} not disabled: {error}")
+        self.shadowCopy = [shadows.get(address, {}) for address in addressList]
+        self.unverified = {addressList.index(address) for address in unverified if address in addressList}
+        self.addressList = addressList
+        for address in added:
+            self.initCard(addressList.index(address))
+        return added, removed
+
     def reinit(self):
         for index, address in enumerate(self.addressList):
             self.writeReg(card=index, regAdd=addressMap['Polarity'], value=ALL_CONTROLS_NOT_INVERTED)  # re-write default value (should be redundant with PoR value)
             self.writeReg(card=index, regAdd=addressMap['Config'], value=ALL_ENABLE_RELAY_CONTROL)  # enable control of all relays through Outport
 
+    def sequencing(self, breakBeforeMake, quietGap=QUIET_GAP):
+        self.breakBeforeMake = breakBeforeMake
+        self.quietGap = quietGap
+
+    def startTrace(self, path):
+        self.stopTrace()
+        trace = I2CTrace.traceWriter(path)
+        with self.busLock: # the registers' values as recording starts, the reads before their next write compare with them
+            for card, shadow in enumerate(self.shadowCopy):
+                for regAdd, value in shadow.items():
+                    trace.mark(I2CTrace.SHADOW, self.addressList[card], regAdd, value)
+            self.trace = trace
+
+    def stopTrace(self):
+        trace, self.trace = self.trace, None
+        if trace is not None:
+            trace.close()
+
     def closeNOrelays(self, relayList):
         if self.verboseness > 0:
             fprint("Start of Setting Relays")
@@ -167,34 +251,33 @@ class relayCont:
             relayCountFromZero = relay - 1
             registerIndex = int(relayCountFromZero/regSize)
             registerWriteVal[registerIndex] += relayMaskList[relayCountFromZero % regSize]
-        for index, address in enumerate(self.addressList):
-            if registerWriteVal[index] > -1:
-                self.writeReg(card=index, regAdd=addressMap['OutPort'], value=registerWriteVal[index])
-        time.sleep(0.25)
-        # The following was added to handle HW corruption of the TI PCA9534 until the hardware is fixed
-        corruption = False
-        corruptionFixed = False
-        for card, address in enumerate(self.addressList):
-            for regAdd in self.shadowCopy[card]:
-                registerVal = self.readReg(card=card, regAdd=regAdd)
-                if registerVal[0] != self.shadowCopy[card][regAdd]:
-                    corruption = True
-                    fprint(f"Register {revAddressMap[regAdd]} on card at {hex(self.addressList[card])} is corrupt.  Read {hex(registerVal[0])}, expected {hex(self.shadowCopy[card][regAdd])}")
-                    self.writeReg(card=card, regAdd=regAdd, value=self.shadowCopy[card][regAdd])
-        if corruption:
-            corruptionFixed = True
-            for card, address in enumerate(self.addressList):
-                for regAdd in self.shadowCopy[card]:
-                    registerVal = self.readReg(card=card, regAdd=regAdd)
-                    if registerVal[0] != self.shadowCopy[card][regAdd]:
-                        corruptionFixed = False
-                        fprint(f"Register {revAddressMap[regAdd]} on card at {hex(self.addressList[card])} is corrupt.  Read {hex(registerVal[0])}, expected {hex(self.shadowCopy[card][regAdd])}")
-                        fprint("Corruption not corrected")
+        trace = self.trace
+        if trace is not None:
+            for card, value in enumerate(registerWriteVal):
+                trace.mark(I2CTrace.TRANSITION, self.addressList[card], card, value)
+        outPort = addressMap['OutPort']
+        if self.breakBeforeMake:
+            for card, value in enumerate(registerWriteVal): # break: the relays turning off, one card at a time
+                current = self.shadowCopy[card].get(outPort)
+                if card in self.unverified or (current is not None and current & ~value):
+                    self.counters['turnOffs'] += 1 # an unverified card's relays may be on whatever the shadow holds, only turn-offs here
+                    self.writeReg(card=card, regAdd=outPort, value=value & (current or 0))
+                    time.sleep(self.quietGap)
+                    self.checkCards([card]) # the back EMF corrupts the card's registers or the next transaction
+            written = []
+            for card, value in enumerate(registerWriteVal): # make: the relays turning on
+                if self.shadowCopy[card].get(outPort) != value:
+                    self.writeReg(card=card, regAdd=outPort, value=value)
+                    written.append(card)
+            self.checkCards(written)
         else:
-            fprint("No Corrupiton detected")
-        if corruptionFixed:
-            fprint("Corruption Corrected")
-        # END of HW workaround
+            for index, address in enumerate(self.addressList):
+                if self.shadowCopy[index].get(outPort, 0) & ~registerWriteVal[index]:
+                    self.counters['turnOffs'] += 1
+                if registerWriteVal[index] > -1:
+                    self.writeReg(card=index, regAdd=outPort, value=registerWriteVal[index])
+            time.sleep(self.quietGap)
+            self.checkCards(range(len(self.addressList)))
         if self.verboseness > 0:
             relayListString = ''
             for _ in relayList:
@@ -208,29 +291,45 @@ class relayCont:
         # everything should be off to ensure everything is turned off
         if self.verboseness > 0:
             fprint("Checking register values against shadow copies")
+        trace = self.trace
+        if trace is not None:
+            trace.mark(I2CTrace.CHECK)
+        self.checkCards(range(len(self.addressList)))
+
+    def checkCards(self, cards):
+        # The following was added to handle HW corruption of the TI PCA9534 until the hardware is fixed
         corruption = False
         corruptionFixed = False
-        for card, address in enumerate(self.addressList):
+        turnedOff = False
+        for card in cards:
             for regAdd in self.shadowCopy[card]:
                 registerVal = self.readReg(card=card, regAdd=regAdd)
                 if registerVal[0] != self.shadowCopy[card][regAdd]:
                     corruption = True
+                    self.counters['corrupt'] += 1
+                    self.counters['rewrites'] += 1
                     fprint(f"Register {revAddressMap[regAdd]} on card at {hex(self.addressList[card])} is corrupt.  Read {hex(registerVal[0])}, expected {hex(self.shadowCopy[card][regAdd])}")
                     self.writeReg(card=card, regAdd=regAdd, value=self.shadowCopy[card][regAdd])
+                    turnedOff |= regAdd == addressMap['OutPort'] and bool(registerVal[0] & ~self.shadowCopy[card][regAdd])
+        if turnedOff and self.breakBeforeMake: # rewriting a corrupted OutPort turned relays off
+            time.sleep(self.quietGap)
         if corruption:
             corruptionFixed = True
-            for card, address in enumerate(self.addressList):
+            for card in cards:
                 for regAdd in self.shadowCopy[card]:
                     registerVal = self.readReg(card=card, regAdd=regAdd)
                     if registerVal[0] != self.shadowCopy[card][regAdd]:
                         corruptionFixed = False
+                        self.counters['uncorrected'] += 1
                         fprint(f"Register {revAddressMap[regAdd]} on card at {hex(self.addressList[card])} is corrupt.  Read {hex(registerVal[0])}, expected {hex(self.shadowCopy[card][regAdd])}")
                         fprint("Corruption not corrected")
         else:
-            fprint("No Corrupiton detected")
+            fprint("No Corrupiton detected", level=DEBUG)
         if corruptionFixed:
             fprint("Corruption Corrected")
         # END of HW workaround
+        self.unverified.difference_update(cards)
+        return corruption
 
     def getNumCards(self):
         return (len(self.addressList))
@@ -245,48 +344,77 @@ class relayCont:
         return(addressMapDescriptions)
 
     def writeReg(self, card, regAdd, value):
-        busLock.acquire()
+        self.busLock.acquire()
         try:
             if self.verboseness > 1:
-                fprint(f"Writing value: {hex(value)} to Card {card} @ {hex(self.addressList[card])}, {revAddressMap[regAdd]}, {hex(regAdd)}")
+                flog(INFO, "Writing value: %#x to Card %d @ %#x, %s, %#x", value, card, self.addressList[card], revAddressMap[regAdd], regAdd)
             if regAdd in self.shadowCopy[card]:
-                registerVal = bus.read_i2c_block_data(self.addressList[card], regAdd, 1)
+                self.counters['reads'] += 1
+                registerVal = self.busRead(self.addressList[card], regAdd)
                 if registerVal[0] != self.shadowCopy[card][regAdd]:
+                    self.counters['corrupt'] += 1
                     fprint(f"Register {revAddressMap[regAdd]} on card at {hex(self.addressList[card])} is corrupt.  Read {hex(registerVal[0])}, expected {hex(self.shadowCopy[card][regAdd])}")
             self.shadowCopy[card][regAdd] = value
-            rc = bus.write_byte_data(self.addressList[card], regAdd, value)
+            self.counters['writes'] += 1
+            rc = self.busWrite(self.addressList[card], regAdd, value)
         except:
             self.returncode = RC_FAIL_TO_WRITE_OUTPORT_REG
-            busLock.release()
+            self.counters['busErrors'] += 1
+            self.unverified.add(card)
+            self.busLock.release()
             raise (relayError(f'Could not write to {revAddressMap[regAdd]} register on card at {hex(self.addressList[card])}'))
-        busLock.release()
+        self.busLock.release()
 
     def readReg(self, card, regAdd):
-        busLock.acquire()
+        self.busLock.acquire()
         try:
-            registerVal = bus.read_i2c_block_data(self.addressList[card], regAdd, 1)
+            self.counters['reads'] += 1
+            registerVal = self.busRead(self.addressList[card], regAdd)
         except:
             self.returncode = RC_FAIL_TO_WRITE_OUTPORT_REG
-            busLock.release()
+            self.counters['busErrors'] += 1
+            self.unverified.add(card)
+            self.busLock.release()
             raise (relayError(f'Could not read from {revAddressMap[regAdd]} register on card at {self.addressList[card]}'))
         if self.verboseness > 1:
-            registerValHex = [hex(registerVal[_]) for _ in range(len(registerVal))]
-            fprint(f"Read value: {registerValHex} from Card {card} @ {hex(self.addressList[card])}, {revAddressMap[regAdd]}, {hex(regAdd)}")
-        busLock.release()
+            flog(INFO, "Read value: %s from Card %d @ %#x, %s, %#x", [hex(value) for value in registerVal], card, self.addressList[card], revAddressMap[regAdd], regAdd)
+        self.busLock.release()
         return(registerVal)
 
+    def busRead(self, address, regAdd):
+        trace = self.trace
+        if trace is None:
+            return self.bus.read_i2c_block_data(address, regAdd, 1)
+        start = time.perf_counter()
+        try:
+            registerVal = self.bus.read_i2c_block_data(address, regAdd, 1)
+        except:
+            trace.record(I2CTrace.READ_ERROR, address, regAdd, 0, start, time.perf_counter() - start)
+            raise
+        trace.record(I2CTrace.READ, address, regAdd, registerVal[0], start, time.perf_counter() - start)
+        return registerVal
+
+    def busWrite(self, address, regAdd, value):
+        trace = self.trace
+        if trace is None:
+            return self.bus.write_byte_data(address, regAdd, value)
+        start = time.perf_counter()
+        try:
+            rc = self.bus.write_byte_data(address, regAdd, value)
+        except:
+            trace.record(I2CTrace.WRITE_ERROR, address, regAdd, value, start, time.perf_counter() - start)
+            raise
+        trace.record(I2CTrace.WRITE, address, regAdd, value, start, time.perf_counter() - start)
+        return rc
+
     def close(self):
         self.__exit__(None, None, None)
 
     def __exit__(self, exception_type, exception_value, traceback):
         if self.verboseness > 0:
            fprint("Disabling control of all relays through TI PCA9534(s) ...")
-        for index, address in enumerate(self.addressList):
-            self.writeReg(card=index, regAdd=addressMap['Config'],   value=ALL_DISABLE_RELAY_CONTROL)   # disable control of all relays through Outport
-            # Checking configuration succeeded
-            registerVal = self.readReg(card=index, regAdd=addressMap['InPort'])
-            if registerVal[0] != 0x00:
-                raise (relayError(f'Failed to disable card {index} at address {hex(address)}.  Expected 0x00 on READ INPORT and read {hex(registerVal[0])}'))
+        for index in range(len(self.addressList)):
+            self.disableCard(index)
         if self.verboseness > 0:
             fprint("Success, relays disabled.")
         return(self)
@@ -0,0 +1,552 @@
+#!/usr/bin/python
+'''
+This provides the scheduling core of a controller, one pass of what was the body of timerThread: the timer
+triggers, the queue of zones to water, the scheduled down time and the manual override auto shut off.  It works
+on the tables of the state store it is given and sets the relays through a callback, so one process can run a
+scheduler per site (Hub.py) as well as the single one in SprinklerController.py.
+
+    scheduler = Scheduler.wateringScheduler(state, setRelays, sprays=dogMode.sprayed, release=dogMode.release)
+    finished = scheduler.tick(localTime(), localDatetime())
+
+The caller owns the loop, the clock and everything around it (heartbeats, reports, metrics).
+
+Every watering is a job of the priority queue in WateringQueue.py: manual overrides (found from the zones'
+manualStartTime), dog mode sprays (startSpray() / endSpray()), the zones of triggered timers and catch up waterings
+for timers whose start time passed while the scheduler was not running (a restart, at most CATCH_UP_WINDOW ago).
+
+What a restart must not lose is kept in the tables, which the caller persists when a step asks it to (stepResult.save):
+the timers' lastTimeOn, set when they trigger, and each zone's wateringLeft, the seconds of its scheduled watering
+not yet delivered (QUEUED_WATERING while it waits to start) with wateringLeftAt, when that was recorded.  After a
+restart the waterings it interrupted are caught up for the time they had left, not their whole watering times, if
+the last progress recorded is at most CATCH_UP_WINDOW old.
+Manual and dog jobs pause the schedule, the down time and the blackout windows (Blackout.py) hold it, and paused
+waterings resume with the time they had left.  The zones' on state follows the running jobs.  The blackout calendar is
+only asked again when its last answer, allowed or not and until when, runs out.
+
+The decisions themselves are schedulerStep(), a function of the tables, the scheduler's run time state, the time and
+the step inputs only, the dog mode sprays in progress and the weather multipliers, no lock, relays, clock, file or
+logging, so it can be driven and measured on its own (Benchmarks/schedulerBench.py):
+
+    run = Scheduler.schedulerState()
+    result = Scheduler.schedulerStep(tables, run, timeInSeconds, currentDatetime, sprays, multipliers)
+    # result.relayMode: set the relays, result.finished: the last watering has just finished, result.messages: log,
+    # result.released: zones whose dog mode spray the schedule took over
+
+wateringScheduler gathers the inputs from its callbacks before each step and hands the released zones back to dog
+mode after it.
+'''
+from FlexPrint import fprint
+import Blackout
+import collections
+import datetime
+import WateringQueue
+from WateringQueue import MANUAL, DOG, SCHEDULED, CATCH_UP
+
+END_OF_TIME          = 32000000000
+MIN_WATERING_TIME    = 120 # Minimum watering time after dog detection times have been subtracted from scheduled watering time
+DOG_WARNING_DURATION = 60  # Seconds of watering a dog detection counts for
+CATCH_UP_WINDOW      = 2 * 60 * 60 # Seconds after a missed start time a timer's zones are still watered, as catch up
+QUEUED_WATERING      = -1  # wateringLeft of a zone whose scheduled watering is queued but has not started
+SAVE_SOON, SAVE_NOW  = 1, 2 # stepResult.save: the watering progress changed, a timer triggered or a watering started or ended
+
+
+def noSprays():
+    return {}
+
+
+def noSave(now):
+    pass
+
+
+def noRelease(zones):
+    return {}
+
+
+def noAdjust(zone, currentDatetime):
+    return 1.0
+
+
+stepResult = collections.namedtuple('stepResult', 'relayMode finished messages released save')
+
+
+class schedulerState:
+    """
+    Run time state of a scheduler, everything schedulerStep() keeps between steps besides the tables.
+
+    Args:
+        minWateringTime, dogWarningDuration (float): seconds
+
+    Methods:
+        queueDepth()                         - waterings waiting, or paused
+        wateringTime(zone, settings)         - seconds the scheduled watering of zone lasts
+        runningZones(now)                    - {zone: (priority class, seconds left)} of the zones being watered
+        setBlackouts(rows)                   - uses the blackout windows of rows, a blackouts table
+
+    Attributes:
+        queue (wateringQueue) - the watering jobs
+        downTime (boolean)    - the scheduled down time is in progress
+        blackedOut (boolean)  - a blackout window is in progress, until blackoutUntil (seconds)
+        scheduledZones (set)  - zones being watered as scheduled (or catch up), dog mode never turns these on or off
+    """
+    def __init__(self, minWateringTime=MIN_WATERING_TIME, dogWarningDuration=DOG_WARNING_DURATION):
+        self.minWateringTime    = minWateringTime
+        self.dogWarningDuration = dogWarningDuration
+        self.queue              = WateringQueue.wateringQueue()
+        self.manualJobs         = {}  # zone: (job, manualStartTime it was queued for)
+        self.dogJobs            = {}  # zone: job
+        self.scheduledZones     = set()
+        self.zoneEnds           = {}  # zone: (priority class, end time) of the running jobs, replaced whole for other threads
+        self.multipliers        = {}  # zone: weather multiplier fixed when its scheduled watering started
+        self.progressJobs       = []  # scheduled and catch up jobs running at the last settle
+        self.wateringIdle       = True
+        self.downTime           = False
+        self.downTimeStart      = 0
+        self.lastStep           = None
+        self.blackoutRows       = None
+        self.calendar           = Blackout.blackoutCalendar(())
+        self.blackedOut         = False
+        self.blackoutUntil      = 0
+
+    def queueDepth(self):
+        return self.queue.depth()
+
+    def runningZones(self, now):
+        return {zone: (priority, end - now) for zone, (priority, end) in self.zoneEnds.items()}
+
+    def setBlackouts(self, rows):
+        if rows is self.blackoutRows: # snapshot tables are replaced, never modified, when they change
+            return
+        self.blackoutRows  = rows
+        self.calendar      = Blackout.blackoutCalendar(rows)
+        self.blackoutUntil = 0
+        for error in self.calendar.errors:
+            fprint(error)
+
+    def wateringTime(self, zone, settings):
+        '''
+        Returns the seconds a scheduled watering of zone lasts, scaled by its weather multiplier and reduced by the
+        dog mode spraying since the last one.  Zones with a multiplier of 0 (rain enough) are not started at all.
+        '''
+        multiplier = self.multipliers.get(zone, 1.0)
+        return max(self.minWateringTime, 60 * settings['wateringTime'] * multiplier - self.dogWarningDuration * settings['detectCount'])
+
+    def queueTimer(self, timer, zoneTable, timeInSeconds, priority=SCHEDULED):
+        '''
+        Queues the zones of a triggered timer, each single zone on its own and the multi zones as one group.
+        '''
+        zoneList = []
+        for zone in range(len(zoneTable)):
+            if zoneTable[zone]['timer'] - 1 == timer and zoneTable[zone]['wateringTime'] != 0:
+                recordLeft(zoneTable[zone], QUEUED_WATERING, timeInSeconds)
+                if zoneTable[zone]['multiZone']:
+                    zoneList.append(zone)
+                else:
+                    self.queue.push(WateringQueue.wateringJob(priority, [zone], label=f"timer {timer}"), timeInSeconds)
+        if len(zoneList) > 0:
+            self.queue.push(WateringQueue.wateringJob(priority, zoneList, label=f"timer {timer}"), timeInSeconds)
+
+
+def recordLeft(settings, seconds, timeInSeconds):
+    settings['wateringLeft']   = seconds
+    settings['wateringLeftAt'] = timeInSeconds if seconds else 0
+
+
+def resumeWatering(zoneTable, run, timeInSeconds, messages):
+    '''
+    Queues, as catch up, the scheduled waterings a restart interrupted: the zones with wateringLeft, for the seconds
+    they had left, or their whole watering if they had not started.  The single zones of a timer go on their own and
+    its multi zones as one group, those which had started first.  Nothing is resumed if the last progress recorded
+    is more than CATCH_UP_WINDOW old.
+    '''
+    owed = [zone for zone in range(len(zoneTable)) if zoneTable[zone].get('wateringLeft', 0)]
+    if not owed:
+        return
+    if timeInSeconds - max(zoneTable[zone].get('wateringLeftAt', 0) for zone in owed) > CATCH_UP_WINDOW:
+        for zone in owed:
+            recordLeft(zoneTable[zone], 0, 0)
+        return
+    groups = {}
+    for zone in owed:
+        left = zoneTable[zone]['wateringLeft']
+        key = (left == QUEUED_WATERING, zoneTable[zone]['timer'], -1 if zoneTable[zone]['multiZone'] else zone)
+        groups.setdefault(key, {})[zone] = left
+    for (queued, timer, single), zones in sorted(groups.items()):
+        if queued:
+            job = WateringQueue.wateringJob(CATCH_UP, zones, label=f"timer {timer - 1}")
+        else:
+            job = WateringQueue.wateringJob(CATCH_UP, zones, dict(zones), label=f"timer {timer - 1}")
+            for zone in zones:
+                run.multipliers[zone] = 1.0 # started, its detectCount is cleared when it finishes
+            messages.append(f"Resuming timer {timer - 1}, zones {list(zones)} for {[round(seconds) for seconds in zones.values()]}s")
+        run.queue.push(job, timeInSeconds)
+
+
+def recordProgress(zoneTable, run, timeInSeconds, started, finished):
+    '''
+    Brings the zones' wateringLeft up to date with the scheduled and catch up jobs, returns SAVE_NOW when a watering
+    started, ended or was paused or resumed, SAVE_SOON when only the time left of those running changed.
+    '''
+    if not (started or finished or run.progressJobs or run.queue.running): # nothing watering, the common tick
+        return 0
+    running = [job for job in run.queue.running if job.priority in (SCHEDULED, CATCH_UP)]
+    save = 0
+    if started or finished or running != run.progressJobs:
+        save = SAVE_NOW
+    elif running:
+        save = SAVE_SOON
+    stopped = [job for job in run.progressJobs if job.state != WateringQueue.RUNNING] # since the last settle, each job once
+    for job in running + stopped:
+        elapsed = timeInSeconds - job.resumedAt if job.state == WateringQueue.RUNNING else 0
+        for zone, seconds in job.remaining.items():
+            recordLeft(zoneTable[zone], max(seconds - elapsed, 0), timeInSeconds)
+    for job in finished:
+        for zone in job.zones:
+            recordLeft(zoneTable[zone], 0, timeInSeconds)
+    run.progressJobs = running
+    return save
+
+
+def missedTimers(timerTable, since, timeInSeconds, currentDatetime):
+    '''
+    Returns [(timer, start time in seconds)] of the timers which were due to trigger after since and before the
+    current minute.  Timers which have never triggered are not caught up.
+    '''
+    missed = []
+    minute = currentDatetime.replace(second=0, microsecond=0)
+    for timer in range(len(timerTable)):
+        settings = timerTable[timer]
+        if settings['lastTimeOn'] == 0:
+            continue
+        clock = datetime.datetime.strptime(settings['startTime'], '%I:%M%p')
+        start = minute.replace(hour=clock.hour, minute=clock.minute)
+        if start >= minute:
+            start -= datetime.timedelta(days=1)
+        startSeconds = timeInSeconds - (currentDatetime - start).total_seconds()
+        if startSeconds <= since:
+            continue
+        if settings['Type'] == 'INT':
+            due = startSeconds - settings['lastTimeOn'] > 60 * 60 * 24 * (settings['Interval'] - 0.5)
+        else:
+            due = settings[start.strftime("%A")] == 'checked' and startSeconds - settings['lastTimeOn'] > 60 * 60 * 24 * 0.5
+        if due:
+            missed.append((timer, startSeconds))
+    return missed
+
+
+def settle(tables, run, timeInSeconds, inputs, messages):
+    '''
+    Advances the watering queue and makes the zones' on state follow it.  Scheduled waterings get their watering
+    times, with the weather multiplier and dog mode reduction, when they first start.
+
+    Args:
+        inputs (stepInputs): the sprays of the zones taken over are added to inputs.released, inputs.save is raised
+                             when the watering progress changed
+
+    Returns:
+        relay mode, None if no zone's on state changed
+    '''
+    zoneTable = tables['zoneTable']
+
+    def starting(job):
+        for zone in job.zones:
+            if zone in inputs.sprays: # spray so far counts against this watering, dog mode lets go of the zone
+                zoneTable[zone]['detectCount'] += inputs.sprays[zone] / run.dogWarningDuration
+                inputs.released.append(zone)
+        remaining = {}
+        for zone in job.zones:
+            multiplier = inputs.multipliers.get(zone, 1.0)
+            if multiplier <= 0:
+                messages.append(f"Zone {zoneTable[zone]['name']} skipped, recent rain covers its watering")
+                remaining[zone] = 0
+                continue
+            run.multipliers[zone] = multiplier
+            remaining[zone] = run.wateringTime(zone, zoneTable[zone])
+            if remaining[zone] != 60 * zoneTable[zone]['wateringTime']:
+                messages.append(f"Zone {zoneTable[zone]['name']} adjusted watering time from {60 * zoneTable[zone]['wateringTime']}s to {round(remaining[zone])}s")
+        if job.priority == CATCH_UP:
+            messages.append(f"Catching up {job.label}, zones {job.zones}")
+        return remaining
+
+    started, finished, turnedOn, turnedOff = run.queue.advance(timeInSeconds, starting)
+    for job in finished:
+        if job.priority in (SCHEDULED, CATCH_UP):
+            for zone in job.zones:
+                if run.multipliers.pop(zone, None) is not None:
+                    zoneTable[zone]['detectCount'] = 0
+        elif job.priority == MANUAL:
+            for zone in job.zones:
+                run.manualJobs.pop(zone, None)
+                zoneTable[zone]['manualStartTime'] = END_OF_TIME
+                if zone not in run.queue.on: # an override already over when queued, i.e. one saved before a restart
+                    turnedOff.add(zone)
+        else:
+            for zone in job.zones:
+                if run.dogJobs.get(zone) is job:
+                    del run.dogJobs[zone]
+    for zone in turnedOn:
+        zoneTable[zone]['on'] = True
+    for zone in turnedOff:
+        zoneTable[zone]['on'] = False
+    if started or finished or run.progressJobs or run.queue.running:
+        scheduleFinished = [job for job in finished if job.priority in (SCHEDULED, CATCH_UP)]
+        scheduleStarted = [job for job in started if job.priority in (SCHEDULED, CATCH_UP)]
+        inputs.save = max(inputs.save, recordProgress(zoneTable, run, timeInSeconds, scheduleStarted, scheduleFinished))
+
+    zoneEnds = {}
+    for job in run.queue.running:
+        for zone, seconds in job.left(timeInSeconds).items():
+            if seconds > 0:
+                zoneEnds[zone] = (job.priority, timeInSeconds + seconds)
+    run.zoneEnds = zoneEnds
+    run.scheduledZones = {zone for zone, (priority, end) in zoneEnds.items() if priority in (SCHEDULED, CATCH_UP)}
+    if any(job.priority in (SCHEDULED, CATCH_UP) for job in started):
+        return "as scheduled"
+    if turnedOn or turnedOff:
+        return "automatically"
+    return None
+
+
+class stepInputs:
+    """
+    What a step needs from outside the tables and the run: sprays {zone: seconds sprayed so far} of the dog mode
+    sprays in progress and multipliers {zone: weather multiplier} of scheduled waterings starting now, 1 for zones
+    not given.  released collects the zones whose spray a starting watering took over and save whether the tables
+    must be persisted (SAVE_SOON, SAVE_NOW), the outputs of a step besides the tables.
+    """
+    __slots__ = ('sprays', 'multipliers', 'released', 'save')
+
+    def __init__(self, sprays=None, multipliers=None):
+        self.sprays      = sprays or {}
+        self.multipliers = multipliers or {}
+        self.released    = []
+        self.save        = 0
+
+
+def schedulerStep(tables, run, timeInSeconds, currentDatetime, sprays=None, multipliers=None):
+    '''
+    One scheduling pass: the timer triggers, missed start times, manual overrides, the down time and blackouts,
+    then the watering queue.
+
+    Args:
+        tables (dictionary): zoneTable, timerTable, autoShutOff and scheduledDownTime, modified in place, the blackout
+                             windows are the run's (setBlackouts)
+        run (schedulerState): modified in place
+        timeInSeconds (float): now
+        currentDatetime (datetime): now, for the timer start times and days
+        sprays (dictionary): {zone: seconds sprayed so far} of the dog mode sprays in progress
+        multipliers (dictionary): {zone: weather multiplier} of a scheduled watering starting now, 1 if not given
+
+    Returns:
+        stepResult, relayMode is None if no zone's on state changed, released the zones of sprays whose time was
+        counted against a scheduled watering, dog mode stops managing them, save SAVE_NOW when the tables must be
+        persisted at once (a timer triggered, a watering started or ended) and SAVE_SOON when the time left of the
+        watering in progress changed
+    '''
+    inputs = stepInputs(sprays, multipliers)
+    zoneTable, timerTable = tables['zoneTable'], tables['timerTable']
+    scheduledDownTime, autoShutOff = tables['scheduledDownTime'], tables['autoShutOff']
+    textDayOfWeek = currentDatetime.strftime("%A")
+    textTime = currentDatetime.time().strftime("%-I:%M%p")
+    messages = []
+
+    # the waterings a restart interrupted, then start times missed while the scheduler was not running, every
+    # minute is seen while it is
+    if run.lastStep is None:
+        resumeWatering(zoneTable, run, timeInSeconds, messages)
+    if run.lastStep is None or timeInSeconds - run.lastStep > 60:
+        since = max(run.lastStep or 0, timeInSeconds - CATCH_UP_WINDOW)
+        for timer, startSeconds in missedTimers(timerTable, since, timeInSeconds, currentDatetime):
+            messages.append(f"Timer: {timer} missed at {timerTable[timer]['startTime']}, queued to catch up")
+            timerTable[timer]['lastTimeOn'] = startSeconds
+            run.queueTimer(timer, zoneTable, timeInSeconds, CATCH_UP)
+            inputs.save = SAVE_NOW
+    run.lastStep = timeInSeconds
+
+    # find timer trigger events and add jobs to the watering queue, where a job may be a single zone or a collection of multi zones
+    for timer in range(len(timerTable)):
+        if timerTable[timer]['Type'] == 'INT':
+            triggered = (timerTable[timer]['startTime'] == textTime and
+                         (timeInSeconds - timerTable[timer]['lastTimeOn']) > 60 * 60 * 24 * (timerTable[timer]['Interval'] - 0.5))
+        else: #timerTable[timer]['Type'] == 'DoW'
+            triggered = (timerTable[timer]['startTime'] == textTime and timerTable[timer][textDayOfWeek] == 'checked' and
+                         (timeInSeconds - timerTable[timer]['lastTimeOn']) > 60 * 60 * 24 * 0.5)
+            if triggered:
+                messages.append(f"Timer: {timer} Active")
+        if triggered:
+            timerTable[timer]['lastTimeOn'] = timeInSeconds
+            run.queueTimer(timer, zoneTable, timeInSeconds)
+            inputs.save = SAVE_NOW
+            if scheduledDownTime['timer'] - 1 == timer:
+                run.downTimeStart = timeInSeconds
+
+    # manual overrides, queued from the start time set when the user turned the zone on, cancelled if they turned it off
+    for zone in range(len(zoneTable)):
+        manualStartTime = zoneTable[zone]['manualStartTime']
+        queued = run.manualJobs.get(zone)
+        if queued and (queued[1] != manualStartTime or (queued[0].state == WateringQueue.RUNNING and not zoneTable[zone]['on'])):
+            run.queue.cancel(queued[0], timeInSeconds)
+            del run.manualJobs[zone]
+            if queued[1] == manualStartTime:
+                zoneTable[zone]['manualStartTime'] = manualStartTime = END_OF_TIME
+            queued = None
+        if queued is None and manualStartTime != END_OF_TIME:
+            shutOff = autoShutOff['multiZone'] if zoneTable[zone]['multiZone'] else autoShutOff['singleZone']
+            job = WateringQueue.wateringJob(MANUAL, [zone], {zone: manualStartTime + 60 * shutOff - timeInSeconds}, label='manual')
+            run.manualJobs[zone] = (job, manualStartTime)
+            run.queue.push(job, timeInSeconds)
+
+    # blackout windows hold the schedule, the calendar is asked again only once its last answer runs out
+    if timeInSeconds >= run.blackoutUntil:
+        allowed, until = run.calendar.status(currentDatetime)
+        if run.blackedOut == allowed:
+            messages.append(f"Blackout until {until:%-I:%M%p %A %b %-d}" if not allowed and until else
+                            "Blackout indefinitely" if not allowed else "Blackout over")
+        run.blackedOut = not allowed
+        run.blackoutUntil = END_OF_TIME if until is None else timeInSeconds + (until - currentDatetime).total_seconds()
+
+    # the down time and blackouts hold the schedule, the watering in progress resumes where it left off
+    downTimeEnd = run.downTimeStart + 60 * scheduledDownTime['duration']
+    if timeInSeconds > run.downTimeStart and timeInSeconds < downTimeEnd:
+        run.downTime = True
+    elif timeInSeconds > downTimeEnd:
+        run.downTime = False
+    if (run.downTime or run.blackedOut) != run.queue.held:
+        if run.queue.held:
+            run.queue.unhold()
+        else:
+            run.queue.hold()
+
+    relayMode = settle(tables, run, timeInSeconds, inputs, messages)
+    previousWateringIdle = run.wateringIdle
+    run.wateringIdle = all(job.priority == DOG for job in run.queue.running)
+    return stepResult(relayMode, run.wateringIdle and not previousWateringIdle, messages, inputs.released, inputs.save) # finished: just finished all watering
+
+
+def startSpray(tables, run, zones, timeInSeconds, sprays=None, multipliers=None):
+    '''
+    Queues dog mode sprays of the zones which are off, they pause the schedule until endSpray().
+
+    Returns:
+        (zones turned on, stepResult)
+    '''
+    inputs = stepInputs(sprays, multipliers)
+    messages = []
+    queued = []
+    for zone in zones:
+        if not tables['zoneTable'][zone]['on'] and zone not in run.dogJobs:
+            run.dogJobs[zone] = WateringQueue.wateringJob(DOG, [zone], {zone: WateringQueue.FOREVER}, label='dog mode')
+            run.queue.push(run.dogJobs[zone], timeInSeconds)
+            queued.append(zone)
+    relayMode = settle(tables, run, timeInSeconds, inputs, messages)
+    for zone in queued: # a manual job still has the zone, dog mode does not track a spray which did not start
+        if run.dogJobs[zone].state != WateringQueue.RUNNING:
+            run.queue.cancel(run.dogJobs.pop(zone), timeInSeconds)
+    turnedOn = [zone for zone in zones if zone in run.dogJobs and run.dogJobs[zone].state == WateringQueue.RUNNING]
+    return turnedOn, stepResult(relayMode, False, messages, inputs.released, inputs.save)
+
+
+def endSpray(tables, run, sprayed, timeInSeconds, sprays=None, multipliers=None):
+    '''
+    Ends dog mode sprays, the seconds sprayed are added to the zones' detectCount in units of dogWarningDuration so
+    the next scheduled watering is reduced by exactly the time sprayed.
+
+    Args:
+        sprayed (dictionary): {zone: seconds on} of the sprays ending
+        sprays, multipliers: as schedulerStep, for the scheduled watering the end of the sprays lets start
+    '''
+    inputs = stepInputs(sprays, multipliers)
+    messages = []
+    for zone, seconds in sprayed.items():
+        tables['zoneTable'][zone]['detectCount'] += seconds / run.dogWarningDuration
+        job = run.dogJobs.pop(zone, None)
+        if job is not None:
+            run.queue.finish(job, timeInSeconds)
+    relayMode = settle(tables, run, timeInSeconds, inputs, messages)
+    return stepResult(relayMode, False, messages, inputs.released, inputs.save)
+
+
+class wateringScheduler(schedulerState):
+    """
+    Scheduling core of one controller, schedulerStep() on the tables of a state store.
+
+    Args:
+        state (stateStore): the site's tables, zoneTable and timerTable are modified inside a state.mutate() block,
+                            the blackout windows are read from its snapshots
+        setRelays (function): setRelays(mode) sets the relays from the current snapshot, called outside the lock
+        sprays (function): sprays() returns {zone: seconds sprayed so far} of the dog mode sprays in progress
+        release (function): release(zones) stops dog mode managing zones, returns {zone: seconds sprayed} of those
+                            it still had on
+        adjust (function): adjust(zone, currentDatetime) returns the weather multiplier of a scheduled watering
+                           starting now
+        save (function): save(now) persists the tables, at once or within the caller's usual delay, called outside
+                         the lock when a step asks for it (stepResult.save)
+        minWateringTime, dogWarningDuration: see schedulerState
+
+    Methods:
+        tick(timeInSeconds, currentDatetime)                      - one pass, True when the last watering has just finished
+        startSpray(zones, timeInSeconds, currentDatetime, mode)   - dog mode sprays, returns the zones turned on
+        endSpray(sprayed, timeInSeconds, currentDatetime, mode)   - ends dog mode sprays
+        and those of schedulerState
+    """
+    def __init__(self, state, setRelays, sprays=noSprays, release=noRelease, adjust=noAdjust, save=noSave,
+                 minWateringTime=MIN_WATERING_TIME, dogWarningDuration=DOG_WARNING_DURATION):
+        super().__init__(minWateringTime, dogWarningDuration)
+        self.state     = state
+        self.setRelays = setRelays
+        self.sprays    = sprays
+        self.release   = release
+        self.adjust    = adjust
+        self.save      = save
+
+    def inputs(self, zoneTable, currentDatetime):
+        '''
+        Returns the step inputs, (sprays, multipliers), read from the callbacks.
+        '''
+        multipliers = {}
+        if self.adjust is not noAdjust:
+            multipliers = {zone: self.adjust(zone, currentDatetime) for zone in range(len(zoneTable))}
+        return self.sprays(), multipliers
+
+    def letGo(self, zoneTable, sprays, released):
+        '''
+        Hands the zones a step took over back from dog mode.  A spray which ended on its own since the inputs were
+        read is accounted by its endSpray(), so it is taken back out of detectCount.
+        '''
+        if not released:
+            return
+        stillOn = self.release(released)
+        for zone in released:
+            if zone not in stillOn:
+                zoneTable[zone]['detectCount'] -= sprays[zone] / self.dogWarningDuration
+
+    def complete(self, result, mode=None):
+        for message in result.messages:
+            fprint(message)
+        if result.save:
+            self.save(result.save == SAVE_NOW)
+        if result.relayMode:
+            self.setRelays(mode or result.relayMode)
+
+    def tick(self, timeInSeconds, currentDatetime):
+        self.setBlackouts(self.state.snapshot().blackouts)
+        with self.state.mutate('timerTable', 'zoneTable') as tables:
+            sprays, multipliers = self.inputs(tables['zoneTable'], currentDatetime)
+            result = schedulerStep(tables, self, timeInSeconds, currentDatetime, sprays, multipliers)
+            self.letGo(tables['zoneTable'], sprays, result.released)
+        self.complete(result)
+        return result.finished
+
+    def startSpray(self, zones, timeInSeconds, currentDatetime, mode="for dog detect mode"):
+        with self.state.mutate('zoneTable') as tables:
+            sprays, multipliers = self.inputs(tables['zoneTable'], currentDatetime)
+            turnedOn, result = startSpray(tables, self, zones, timeInSeconds, sprays, multipliers)
+            self.letGo(tables['zoneTable'], sprays, result.released)
+        self.complete(result, mode)
+        return turnedOn
+
+    def endSpray(self, sprayed, timeInSeconds, currentDatetime, mode="for dog detect mode"):
+        with self.state.mutate('zoneTable') as tables:
+            sprays, multipliers = self.inputs(tables['zoneTable'], currentDatetime)
+            result = endSpray(tables, self, sprayed, timeInSeconds, sprays, multipliers)
+            self.letGo(tables['zoneTable'], sprays, result.released)
+        self.complete(result, mode)
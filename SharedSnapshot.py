@@ -0,0 +1,111 @@
+#!/usr/bin/python
+'''
+This shares the state store's snapshots between the control core and the web front end when they run as separate
+processes (SprinklerController.py --role core / --role web).
+
+The core's snapshotPublisher subscribes to the state store and writes each new snapshot to a file on the RAM disk
+(tmpfs, so the file is shared memory).  The write is made by the publisher's own thread, so the timer thread and
+the other writers never wait on it, and coalesced, only the latest snapshot is written when several are published
+in quick succession.  Files are written to a temporary name and renamed, a reader always sees a complete file.
+
+The web front end's snapshotReader provides the state store's snapshot() call.  It checks the file's inode and
+modification time and only loads the file when the core has replaced it, readers otherwise get the snapshot they
+loaded last, by reference, as from the state store itself.
+'''
+from FlexPrint import fprint
+import os
+import pickle
+import threading
+import StateStore
+
+
+class snapshotPublisher:
+    """
+    Writes the latest state store snapshot to path.
+
+    Methods:
+        publish(snapshot)          - queues snapshot to be written, use as the state store's subscriber
+        waitFor(version, timeout)  - waits until a snapshot of at least version has been written
+        start()                    - starts the writer thread
+    """
+    def __init__(self, path):
+        self.path      = path
+        self.condition = threading.Condition()
+        self.latest    = None
+        self.written   = -1  # version of the snapshot in the file
+        self.thread    = None
+
+    def publish(self, snapshot):
+        with self.condition:
+            if self.latest is None or snapshot.version > self.latest.version:
+                self.latest = snapshot
+                self.condition.notify_all()
+
+    def waitFor(self, version, timeout=2):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.written >= version, timeout)
+
+    def write(self, snapshot):
+        tables = {name: snapshot.thaw(name) for name in snapshot.tableNames()}
+        directory, name = os.path.split(self.path)
+        temporary = os.path.join(directory, '.' + name)
+        with open(temporary, 'wb') as snapshotFile:
+            pickle.dump((snapshot.version, tables), snapshotFile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.path)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.latest is not None and self.latest.version > self.written)
+                snapshot = self.latest
+            try:
+                self.write(snapshot)
+            except OSError as error:
+                fprint(f"Unable to publish state snapshot {snapshot.version}: {error}")
+                with self.condition:
+                    self.condition.wait(1)
+                continue
+            with self.condition:
+                self.written = snapshot.version
+                self.condition.notify_all()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='snapshotPublisher', daemon=True)
+        self.thread.start()
+        return self.thread
+
+
+class snapshotReader:
+    """
+    Read side of a snapshotPublisher, snapshot() returns the latest StateStore.stateSnapshot the core has written.
+
+    Args:
+        path (string): file written by the core's snapshotPublisher
+        default (stateSnapshot): returned until the core has written its first snapshot
+    """
+    def __init__(self, path, default):
+        self.path     = path
+        self.current  = default
+        self.identity = None  # (inode, modification time, size) of the file self.current was loaded from
+        self.lock     = threading.Lock()
+
+    def snapshot(self):
+        try:
+            status = os.stat(self.path)
+        except OSError:
+            return self.current
+        identity = (status.st_ino, status.st_mtime_ns, status.st_size)
+        if identity == self.identity:
+            return self.current
+        with self.lock:
+            if identity != self.identity:
+                try:
+                    with open(self.path, 'rb') as snapshotFile:
+                        version, tables = pickle.load(snapshotFile)
+                except (OSError, EOFError, pickle.UnpicklingError) as error:
+                    fprint(f"Unable to read state snapshot: {error}")
+                    return self.current
+                self.current = StateStore.stateSnapshot(version, {name: StateStore.freezeTable(table)
+                                                                  for name, table in tables.items()})
+                self.identity = identity
+        return self.current
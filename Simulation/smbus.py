@@ -3,14 +3,28 @@
 This provides a debug smbus module for running on systems without a I2C controller.  This device acts like
 a 256 byte memory, storing writes to each 8-bit address provided in the byte immediately following the
 command byte.
+
+backEmf() adds a model of the solenoid back EMF of the relay hats (see RelayController.py) for exercising and
+benchmarking the corruption handling: a write clearing bits of a PCA9534 OutPort register, relays turning off, may
+flip a bit of the card's registers directly and starts a transient, decay seconds long, in which every transaction
+may be corrupted, a bit of the value written or read flipped or, for a share of them, a bus fault raised.  The
+probabilities are per relay turned off.
+
+ReplaySMBus plays back an I2C trace recorded in the field (I2CTrace.py), see the class.
 '''
 from FlexPrint import fprint
 from config import *
+import I2CTrace
+import collections
+import random
+import time
 
 MEMORY_SIZE = 256
 NUM_DEVICES = 128
 RC_I2C_FAIL_TO_WRITE   = 1
 RC_I2C_FAIL_TO_READ    = 2
+OUTPORT_REGISTER       = 0x01
+CORRUPTIBLE_REGISTERS  = (0x01, 0x02, 0x03) # OutPort, Polarity and Config of a PCA9534
 
 
 class SMBusError(Exception):
@@ -29,21 +43,33 @@ class SMBus:
         self.raiseErrorsEn = False
         self.i2cPort = i2cPort  # i2cPort can be 0 or 1 (nominally 1 on raspberry pi
         self.memory = [[0x00 for _ in range(MEMORY_SIZE)] for address in range(NUM_DEVICES)]
+        self.emf = None # back EMF model, see backEmf()
+        self.emfCounts = collections.Counter()
+        self.transientUntil = 0
+        self.transientRelays = 0
+        self.glitched = False
 
     def write_byte_data(self, i2c_address, reg_address, reg_value):
         if self.verboseness > 0:
             fprint(f"Writing value: {hex(reg_value)} register address {hex(reg_address)} @ i2c address {hex(i2c_address)}")
-        if self.raiseErrorsEn:
+        if self.raiseErrorsEn or self.glitch() == 'fault':
             self.returncode = RC_I2C_FAIL_TO_WRITE
             raise (SMBusError(f'Could not write to {hex(reg_address)} register @ i2c address {hex(i2c_address)}'))
+        if self.emf and self.glitched:
+            reg_value ^= 1 << self.emf['random'].randrange(8)
+        turnedOff = self.memory[i2c_address][reg_address] & ~reg_value if reg_address == OUTPORT_REGISTER else 0
         self.memory[i2c_address][reg_address] = reg_value
+        if self.emf and turnedOff:
+            self.turnOff(i2c_address, bin(turnedOff).count('1'))
         return(0)
 
     def read_i2c_block_data(self, i2c_address, reg_address, length):
-        if self.raiseErrorsEn:
+        if self.raiseErrorsEn or self.glitch() == 'fault':
             self.returncode = RC_I2C_FAIL_TO_READ
             raise (SMBusError(f'Could not read from {hex(reg_address)} register @ i2c address {hex(i2c_address)}'))
         readValue = self.memory[i2c_address][reg_address:reg_address+length]
+        if self.emf and self.glitched:
+            readValue[0] ^= 1 << self.emf['random'].randrange(8)
         readValueString = ''
         for _ in range(len(readValue)):
             readValueString += readValueString + hex(readValue[_])
@@ -56,3 +82,112 @@ class SMBus:
 
     def raiseErrors(self, raiseErrorsEn):
         self.raiseErrorsEn = raiseErrorsEn
+
+    def backEmf(self, transactionRate, registerRate=0.0, faultShare=0.0, decay=0.05, seed=None):
+        '''
+        Enables the back EMF model, see above, transactionRate 0 disables it.
+
+        Args:
+            transactionRate (float): probability a transaction in a transient is corrupted, per relay turned off
+            registerRate (float): probability a register of the card is corrupted by the turn off, per relay
+            faultShare (float): share of the corrupted transactions which are bus faults
+            decay (float): seconds a transient lasts
+            seed: random seed, for repeatable runs
+        '''
+        self.emf = None if not transactionRate and not registerRate else {
+            'transactionRate': transactionRate, 'registerRate': registerRate, 'faultShare': faultShare,
+            'decay': decay, 'random': random.Random(seed)}
+        self.emfCounts.clear()
+        self.transientUntil = 0
+
+    def turnOff(self, i2c_address, relays):
+        generator = self.emf['random']
+        self.emfCounts['transients'] += 1
+        self.transientUntil = time.perf_counter() + self.emf['decay']
+        self.transientRelays = relays
+        if generator.random() < 1 - (1 - self.emf['registerRate']) ** relays:
+            self.emfCounts['corruptRegisters'] += 1
+            register = generator.choice(CORRUPTIBLE_REGISTERS)
+            self.memory[i2c_address][register] ^= 1 << generator.randrange(8)
+
+    def glitch(self):
+        '''
+        Decides whether the transaction starting now is corrupted, returns 'fault' for a bus fault and sets glitched
+        for a flipped bit.
+        '''
+        self.glitched = False
+        if not self.emf or time.perf_counter() >= self.transientUntil:
+            return None
+        generator = self.emf['random']
+        if generator.random() >= 1 - (1 - self.emf['transactionRate']) ** self.transientRelays:
+            return None
+        if generator.random() < self.emf['faultShare']:
+            self.emfCounts['busFaults'] += 1
+            return 'fault'
+        self.emfCounts['corruptTransactions'] += 1
+        self.glitched = True
+        return 'flip'
+
+
+class ReplaySMBus(SMBus):
+    """
+    Plays back an I2C trace, a file or the records of I2CTrace.readTrace().  The transactions of each register are
+    answered in the order they were recorded: a recorded error is raised again, a read returns the value last
+    written to the register by the code under test with the bits in which the recorded read differed from the
+    recorded value last written flipped, so corruption recurs whatever is written around it.  The registers start
+    at the trace's SHADOW values.  Once a register's recorded transactions run out it behaves as SMBus.
+
+    Args:
+        i2cPort: as SMBus
+        trace (string or list): trace file or records
+        realTime (boolean): each transaction takes its recorded duration, default as fast as possible
+
+    Attributes:
+        replayCounts (Counter): transactions replayed, flipped, raised and beyond the trace
+    """
+    def __init__(self, i2cPort, trace, realTime=False):
+        super().__init__(i2cPort)
+        records = I2CTrace.readTrace(trace)[1] if isinstance(trace, str) else trace
+        flips = I2CTrace.deviations(records)
+        self.realTime = realTime
+        self.replayCounts = collections.Counter()
+        self.recorded = collections.defaultdict(collections.deque) # (read, address, register): deque of (record, flip)
+        for address, registers in I2CTrace.shadows(records).items():
+            for register, value in registers.items():
+                self.memory[address][register] = value
+        for index, record in enumerate(records):
+            if record.kind in (I2CTrace.READ, I2CTrace.READ_ERROR):
+                self.recorded[(True, record.address, record.register)].append((record, flips.get(index, 0)))
+            elif record.kind in (I2CTrace.WRITE, I2CTrace.WRITE_ERROR):
+                self.recorded[(False, record.address, record.register)].append((record, 0))
+
+    def next(self, read, i2c_address, reg_address):
+        queue = self.recorded.get((read, i2c_address, reg_address))
+        if not queue:
+            self.replayCounts['beyondTrace'] += 1
+            return None, 0
+        record, flip = queue.popleft()
+        self.replayCounts['replayed'] += 1
+        if self.realTime:
+            time.sleep(record.duration)
+        return record, flip
+
+    def write_byte_data(self, i2c_address, reg_address, reg_value):
+        record, flip = self.next(False, i2c_address, reg_address)
+        if record is not None and record.kind == I2CTrace.WRITE_ERROR:
+            self.replayCounts['raised'] += 1
+            self.returncode = RC_I2C_FAIL_TO_WRITE
+            raise (SMBusError(f'Could not write to {hex(reg_address)} register @ i2c address {hex(i2c_address)}, replayed'))
+        return super().write_byte_data(i2c_address, reg_address, reg_value)
+
+    def read_i2c_block_data(self, i2c_address, reg_address, length):
+        record, flip = self.next(True, i2c_address, reg_address)
+        if record is not None and record.kind == I2CTrace.READ_ERROR:
+            self.replayCounts['raised'] += 1
+            self.returncode = RC_I2C_FAIL_TO_READ
+            raise (SMBusError(f'Could not read from {hex(reg_address)} register @ i2c address {hex(i2c_address)}, replayed'))
+        readValue = super().read_i2c_block_data(i2c_address, reg_address, length)
+        if flip:
+            self.replayCounts['flipped'] += 1
+            readValue[0] ^= flip
+        return readValue
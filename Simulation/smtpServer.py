@@ -0,0 +1,135 @@
+#!/usr/bin/python
+'''
+This provides a local SMTP server standing in for the mail provider when running the simulation, so the
+notification outbox (Outbox.py) can be exercised without sending real e-mail or text messages.  Received
+messages are printed and, with --maildir, written one file per message.  Failures can be injected to exercise
+the outbox's retries and backoff:
+
+    --failRate 0.3      answer 30% of DATA commands with a transient 451 error
+    --dropRate 0.1      close 10% of connections without answering the MAIL command
+    --down 5            refuse to answer for the first 5 seconds of every minute (421 and close)
+
+Only the commands smtplib uses in plain SMTP are implemented (EHLO / HELO, MAIL, RCPT, DATA, NOOP, RSET, QUIT),
+there is no TLS or authentication.  Start SprinklerController.py with --smtp localhost:8025 to use it.
+
+Example:
+    python Simulation/smtpServer.py --port 8025 --failRate 0.2
+'''
+import argparse
+import asyncio
+import email
+import os
+import random
+import time
+
+
+class smtpStandIn:
+    """
+    Minimal asyncio SMTP server.  messages holds (peer, sender, recipients, data) for every message accepted.
+    """
+    def __init__(self, host='127.0.0.1', port=8025, maildir=None, failRate=0, dropRate=0, down=0, quiet=False):
+        self.host     = host
+        self.port     = port
+        self.maildir  = maildir
+        self.failRate = failRate
+        self.dropRate = dropRate
+        self.down     = down
+        self.quiet    = quiet
+        self.messages = []
+        self.sessions = 0
+
+    async def session(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        self.sessions += 1
+
+        def reply(text):
+            writer.write(text.encode('ascii') + b'\r\n')
+
+        if time.time() % 60 < self.down:
+            reply("421 Service not available")
+            await writer.drain()
+            writer.close()
+            return
+        reply("220 localhost SprinklerController SMTP stand-in")
+        sender, recipients = None, []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode('utf-8', 'replace').strip()
+                verb = command[:4].upper()
+                if verb in ('EHLO', 'HELO'):
+                    reply("250-localhost" if verb == 'EHLO' else "250 localhost")
+                    if verb == 'EHLO':
+                        reply("250 8BITMIME")
+                elif verb == 'MAIL':
+                    if random.random() < self.dropRate:
+                        break
+                    sender, recipients = command.partition(':')[2].split()[0].strip('<>'), []
+                    reply("250 OK")
+                elif verb == 'RCPT':
+                    recipients.append(command.partition(':')[2].split()[0].strip('<>'))
+                    reply("250 OK")
+                elif verb == 'DATA':
+                    reply("354 End data with <CR><LF>.<CR><LF>")
+                    await writer.drain()
+                    lines = []
+                    while True:
+                        dataLine = await reader.readline()
+                        if not dataLine or dataLine in (b'.\r\n', b'.\n'):
+                            break
+                        lines.append(dataLine[1:] if dataLine.startswith(b'..') else dataLine)
+                    if random.random() < self.failRate:
+                        reply("451 Requested action aborted: local error in processing")
+                    else:
+                        self.accept(peer, sender, recipients, b''.join(lines))
+                        reply("250 OK: queued")
+                elif verb == 'NOOP':
+                    reply("250 OK")
+                elif verb == 'RSET':
+                    sender, recipients = None, []
+                    reply("250 OK")
+                elif verb == 'QUIT':
+                    reply("221 Bye")
+                    break
+                else:
+                    reply("502 Command not implemented")
+                await writer.drain()
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def accept(self, peer, sender, recipients, data):
+        self.messages.append((peer, sender, recipients, data))
+        message = email.message_from_bytes(data)
+        if not self.quiet:
+            print(f"{time.strftime('%H:%M:%S')} {sender} -> {', '.join(recipients)}: {message['Subject']}")
+            print('    ' + message.get_payload().strip().replace('\n', '\n    '))
+        if self.maildir:
+            os.makedirs(self.maildir, exist_ok=True)
+            with open(os.path.join(self.maildir, f"{time.time_ns()}.eml"), 'wb') as mailFile:
+                mailFile.write(data)
+
+    async def serve(self):
+        server = await asyncio.start_server(self.session, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local SMTP stand-in for the notification outbox')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--maildir', help='directory to write received messages to')
+    parser.add_argument('--failRate', type=float, default=0, help='fraction of messages answered with 451')
+    parser.add_argument('--dropRate', type=float, default=0, help='fraction of messages dropped by closing the connection')
+    parser.add_argument('--down', type=float, default=0, help='seconds at the start of every minute the server is unavailable')
+    args = parser.parse_args()
+
+    standIn = smtpStandIn(args.host, args.port, args.maildir, args.failRate, args.dropRate, args.down)
+    print(f"SMTP stand-in listening on {args.host}:{args.port}")
+    asyncio.run(standIn.serve())
@@ -28,33 +28,47 @@ The 7 bit I2C address of all found devices will be shown (ignoring the R/W bit,
 '''
 from config import *
 from FlexPrint import fprint
+import FlexPrint
 DEBUG = False
 
-from flask import Flask, redirect, url_for, render_template, request, session
+from flask import Flask, redirect, url_for, render_template, request, session, jsonify, make_response, g
 
 from datetime import timedelta
-from threading import Thread
+from threading import Thread, Lock, Event
 import pickle
 import datetime
 import sys
 import os
 import re
 import time
-import copy
-import queue
 import RelayController
-import socket
-import json
+import StateStore
+import StaticAssets
+import ConfigChanges
+import JsonServer
+import DogMode
+import Outbox
+import WatchDog
+import Metrics
+import Profiler
+import ControlRPC
+import SharedSnapshot
+import Scheduler
+import LiveState
+import WeatherAdjust
+import ControllerConfig
+import Blackout
+import hmac
+import signal
+import urllib.request
 import smtplib
 import ssl
 import argparse
-from email.message import EmailMessage
 '''
 Imports from private are constants that need to be created for a specific userID.  You may also wish
 to change the constant name GORDONS_EMAIL (unless your name is Gordon ;).  For obvious reasons private.py
 is not included in the repo.
 '''
-from private import SUDO_PASSWORD as SUDO_PASSWORD  # Sudo password needed to pet the watchdog
 from private import SENDER_EMAIL as SENDER_EMAIL    # E-mail account to use for sending e-mail notifications
 from private import PASSWORD as PASSWORD            # Password for email acount to send notificaitons
 from private import GORDONS_EMAIL as GORDONS_EMAIL  # Recipient email address
@@ -73,13 +87,20 @@ The repository hosting this file will include an excel spreadsheet which generat
 from the 10-digit number.
 '''
 from private import GORDONS_CELL as GORDONS_CELL    # Recipient's cell phone numbers e-mail address
+try:  # Shared HMAC key (string) for Dog Detector UDP events, the UDP fast path is off without it
+    from private import DETECTOR_HMAC_KEY as DETECTOR_HMAC_KEY
+except ImportError:
+    DETECTOR_HMAC_KEY = None
+try:  # Token (string) required by the /admin endpoints, without it they only answer requests from the Pi itself
+    from private import ADMIN_TOKEN as ADMIN_TOKEN
+except ImportError:
+    ADMIN_TOKEN = None
 
 # Need to know what system we are running on.  The "demo" version that runs on ubuntu in the cloud 
 # must have some behavioral differences, especially regarding watchdog and for convenience not use 
 # a ramdisk
 osinfo = os.uname()
-if osinfo[1] == 'raspberrypi':
-    piHost = True
+piHost = osinfo[1] == 'raspberrypi'
 
 if piHost:
     RAM_DISK           = '/var/ramdisk/'
@@ -89,6 +110,11 @@ else:
 # A report file is written to for every watering action taken and the summary is sent to the 
 # specified e-mail at the end of the week.
 REPORT_FILE_NAME       = RAM_DISK + 'report.txt'
+LOG_FILE_NAME          = RAM_DISK + 'sprinkler.log' # Rotated at FlexPrint.LOG_MAX_BYTES, sprinkler-core.log / -web.log with --role
+CONTROL_SOCKET         = RAM_DISK + 'sprinklerControl.sock' # Control RPC from the web front end to the core
+SNAPSHOT_FILE_NAME     = RAM_DISK + 'sprinklerState.pkl'    # State snapshots published by the core to the web front end
+LIVE_STATE_FILE_NAME   = RAM_DISK + 'sprinklerLive.bin'     # Memory mapped relay / zone state for local readers (see LiveState.py)
+LOG_LEVELS             = {}  # Per module log levels, i.e. {'werkzeug': 'WARNING'}, change at runtime with /admin/log
 REPORT_DAY_OF_THE_WEEK = 'Sunday'
 REPORT_TIME_OF_DAY     = '6:00PM'
 
@@ -98,6 +124,11 @@ serviceMode = False
 parser = argparse.ArgumentParser()
 parser.add_argument('--serviceMode', help='enables any internal changes required when running as a service versus running in the debugger',
                     action='store_true')
+parser.add_argument('--nvmFile', help='file to keep the configuration settings in, defaults to sprinklerNVM.pkl next to this script')
+parser.add_argument('--port', type=int, default=5000, help='port for the web interface')
+parser.add_argument('--smtp', help='host:port of a plain SMTP server to send notifications through, i.e. Simulation/smtpServer.py')
+parser.add_argument('--role', choices=('all', 'core', 'web'), default='all',
+                    help='all: one process, core: scheduler, relays, dog mode, NVM and watchdog, web: the web front end of a core')
 args = parser.parse_args()
 if args.serviceMode:
     serviceMode = True
@@ -108,35 +139,67 @@ enabled by the presense of the ENABLE_WATCHDOG flag being set to 1.  Moving or d
 the config file will prevent the watdog from being run the next time the script is called.
 This is useful to be able to disable the watchdog and then take the execution out of 
 service mode.
+
+The config file also holds the relay hat addresses, the watering times and intervals offered and the sample
+intervals (see ControllerConfig.py).  It is watched while the controller runs and changes to them are applied
+live by applyConfig, ENABLE_WATCHDOG only takes effect at the next start.
 '''
-WATCH_DOG_ENABLE       = False
 CONFIG_FILE            = "sc_config.txt"
 if os.path.isfile(CONFIG_FILE):
     workingConfigFile = open(RAM_DISK + 'working_config.txt', "w")
     with open(CONFIG_FILE) as configFile:
-        for line in configFile:
-            workingConfigFile.write(line)
-            parameter = line.rstrip()
-            if parameter == "ENABLE_WATCHDOG=1" and piHost:
-                WATCH_DOG_ENABLE = True
-                fprint("Watch Dog Enabled")
+        workingConfigFile.write(configFile.read())
     workingConfigFile.close()
 else:
     fprint("Running without a config file")
+configWatcher          = ControllerConfig.configWatcher(CONFIG_FILE, lambda old, new, changed: applyConfig(old, new, changed))
+controllerConfig       = configWatcher.settings
+WATCH_DOG_ENABLE       = controllerConfig['ENABLE_WATCHDOG'] and piHost
+if WATCH_DOG_ENABLE:
+    fprint("Watch Dog Enabled")
+LIVE_STATE_INTERVAL    = controllerConfig['LIVE_STATE_INTERVAL'] # Seconds between live state updates, besides the one after every relay change
 
 #WATCH_DOG_ENABLE       = False
 WATCH_DOG_PET_INTERVAL = 5 # Watch Dog Petting inteval (must be less than 15 seconds or system will reboot
+WEB_CHECK_INTERVAL     = 10 # Seconds between requests the web server self check makes to /healthz
+RELAY_DEADLINE         = 10 # Seconds a single setRelays may take, including its retries, before it is a stall
+JSON_SERVER_DEADLINE   = 10 # Seconds the JSON server's event loop may go without running its heartbeat
 keepAlive              = 0
+'''
+Critical threads check into the heartbeat registry with their own deadlines (see WatchDog.py), the watchdog
+is only petted while all of them are healthy.
+'''
+heartbeats             = WatchDog.heartbeatRegistry()
+
+'''
+Application metrics, served at /metrics in the Prometheus text format (see Metrics.py).  Updates on the hot paths
+are lock free, values the other modules already count are read only when /metrics is scraped.
+'''
+timerTickSeconds   = Metrics.registerHistogram('sprinkler_timer_tick_seconds', 'Time the timer thread spends in each tick')
+timerLagSeconds    = Metrics.registerHistogram('sprinkler_timer_lag_seconds', 'Seconds a timer tick started later than TIMER_SAMPLE_INTERVAL after the last one')
+pendingZonesGauge  = Metrics.registerGauge('sprinkler_pending_zone_groups', 'Zone groups queued for scheduled watering')
+activeZonesGauge   = Metrics.registerGauge('sprinkler_active_zones', 'Zones being watered as scheduled')
+setRelaysSeconds   = Metrics.registerHistogram('sprinkler_set_relays_seconds', 'setRelays duration, including I2C retries')
+relayRetries       = Metrics.registerCounter('sprinkler_relay_retries_total', 'Failed attempts to write the relay registers')
+nvmFlushSeconds    = Metrics.registerHistogram('sprinkler_nvm_flush_seconds', 'Time to write the NVM file')
+nvmFlushBytes      = Metrics.registerGauge('sprinkler_nvm_flush_bytes', 'Size of the last NVM file written')
+httpRequestSeconds = Metrics.registerHistogram('sprinkler_http_request_seconds', 'Flask request latency', ('route', 'method', 'status'))
 
 
 SSL_PORT               = 465  # For SSL
 GMAIL_SMTP_SERVER      = "smtp.gmail.com"
+SMTP_TIMEOUT           = 30   # Seconds before a stalled SMTP connection is abandoned and retried
+OUTBOX_DIRECTORY       = RAM_DISK + 'outbox/' # Notifications waiting to be sent
+ALERT_DIGEST_WINDOW    = 10 * 60 # Repeated I2C Bus Failure alerts are combined into one message per window (seconds)
+PROFILE_DIRECTORY      = RAM_DISK + 'profiles/' # Results of on demand profiles (see Profiler.py)
+PROFILE_SIGNAL_SECONDS = 30   # Length of a CPU profile started with SIGUSR2
 
-relaysStackAddressList = [0x3f, 0x3b]  # Configure with the addresses of each stack
+relaysStackAddressList = controllerConfig['RELAY_STACKS']  # Addresses of each stack, RELAY_STACKS in the config file
 
 app = Flask(__name__)
 app.secret_key = b'\x8dc\x83|$\xb9l\x90\x03\xd2<\xbc\xac>\x89\x84'
 app.permanent_session_lifetime = timedelta(minutes=5)
+assets = StaticAssets.assetPipeline(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')).register(app)
 
 END_OF_TIME = 32000000000
 
@@ -151,8 +214,7 @@ zoneTable = [{'name': 'Curbside Lawn',     'relay': 1, 'on': True,  'wateringTim
              {'name': 'Fence Flowers',     'relay': 8, 'on': False, 'wateringTime': 60, 'timer': 1, 'multiZone': False, 'dogDetectOn': False, 'detectCount': 0, 'manualStartTime': END_OF_TIME},
              {'name': 'BKYRD Flowers',     'relay': 9, 'on': False, 'wateringTime': 60, 'timer': 1, 'multiZone': False, 'dogDetectOn': False, 'detectCount': 0, 'manualStartTime': END_OF_TIME}]
 
-dogWarning = False
-wateringTimes = [0, 3, 5, 10, 15, 20, 25, 30, 40, 50, 60, 90, 120]
+wateringTimes = controllerConfig['WATERING_TIMES']
 
 #### timers.html variables ####
 timerTable = [{'labeled': True,   'selected': False, 'startTime': '8:00PM', 'Type': 'INT', 'Interval': 1, 'lastTimeOn': 0,
@@ -171,7 +233,7 @@ timerTypes = ['INT', 'DoW']
 
 daysOfWeek = [('Sunday', 'S'), ('Monday', 'M'), ('Tuesday', 'T'), ('Wednesday', 'W'), ('Thursday', 'T'), ('Friday', 'F'), ('Saturday', 'S')]
 
-intervals = [1, 2, 3, 4, 5, 6, 7, 14]
+intervals = controllerConfig['INTERVALS']
 
 #### settings.html variables ####
 config        = {'allOff'        : False,
@@ -182,15 +244,45 @@ autoShutOff   = {'multiZone'  : 60,
                  'singleZone' : 15}
 
 scheduledDownTime = {'duration' : 60, 'timer': 4}
-downTime          = False
+
+blackouts     = [] # Blackout windows holding the schedule, rows as Blackout.py
+calendarCache = None # (blackouts rows, their Blackout.blackoutCalendar), see blackoutCalendar()
 
 relayShadow   = []
+relayLock     = Lock() # Serializes setRelays so relayShadow and the report file see one transition at a time
+relayBeat     = heartbeats.register('relays', RELAY_DEADLINE, periodic=False)
+
+'''
+All of the tables above are owned by the state store.  They may only be modified inside a state.mutate() block, 
+readers should use state.snapshot(), which is lock free and never changes once it has been taken.
+'''
+state = StateStore.stateStore(zoneTable=zoneTable, timerTable=timerTable, config=config,
+                              autoShutOff=autoShutOff, scheduledDownTime=scheduledDownTime, blackouts=blackouts)
+
+'''
+With --role web the tables are owned by the control core, a separate process (--role core).  The web front end
+reads the snapshots the core publishes (SharedSnapshot.py) and sends its changes to the core over the control
+RPC (ControlRPC.py), so a fault or load in the web server cannot delay or stop the watering.
+'''
+control   = None # ControlRPC.rpcClient to the core, web front end only
+publisher = None # SharedSnapshot.snapshotPublisher, core only
+liveState = None # LiveState.liveStatePublisher, core only
+if args.role == 'web':
+    state   = SharedSnapshot.snapshotReader(SNAPSHOT_FILE_NAME, state.snapshot())
+    control = ControlRPC.rpcClient(CONTROL_SOCKET)
 
 updateNVM             = 0 # Time from the last epoch in seconds since the last change to NVM data
-NVM_UPDATE_INTERVAL   = 10 #NVM structure update interval in seconds
-NVM_FILENAME          = os.path.abspath((os.path.join(os.path.dirname(__file__), 'sprinklerNVM.pkl')))
-TIMER_SAMPLE_INTERVAL = 45 # Set to less than one minute to ensure start times are not missed.
+NVM_UPDATE_INTERVAL   = controllerConfig['NVM_UPDATE_INTERVAL'] #NVM structure update interval in seconds
+NVM_FILENAME          = os.path.abspath(args.nvmFile or os.path.join(os.path.dirname(__file__), 'sprinklerNVM.pkl'))
+WEATHER_DIRECTORY     = os.path.join(os.path.dirname(NVM_FILENAME), 'weather') # Weather files for Weather Adjust (see WeatherAdjust.py)
+nvmLock               = Lock() # Serializes writes of the NVM file
+TIMER_SAMPLE_INTERVAL = controllerConfig['TIMER_SAMPLE_INTERVAL'] # Set to less than one minute to ensure start times are not missed.
+timerWake             = Event() # Ends the timer thread's sleep early, i.e. when TIMER_SAMPLE_INTERVAL changes
 DOG_WARNING_DURATION  = 60 # Dog warning sprinkler on duration in seconds
+DOG_MAX_DURATION      = 5 * 60 # Longest a dog mode zone is kept on by repeated warnings, in seconds
+DOG_COOLDOWN          = 30 # Seconds after a dog mode spray before the zone responds to warnings again
+DOG_BURST             = 3  # Dog mode activations per zone allowed back to back ...
+DOG_RATE_PER_HOUR     = 10 # ... and refilled at this many per hour
 MIN_WATERING_TIME     = 120 # Minimum watering time after dog detection times have been subtracted from scheduled watering time
 
 '''
@@ -210,17 +302,17 @@ def setRelays(mode):
     sufficient protection from back EMF generated by the solenoids in the sprinklers when shut off.  The 
     result is likely damaging to the I2C controller on the board and may affect it's lifetime.  This also
     results in occasional corruption of the relay control registers.  I will design a replacement board based 
-    on triacs which, only switch when the current is zero, avoiding the back EMF problem later.  For now this 
-    function makes three attempts to wire the relays and will send a message if it fails to complete it's
-    objective.   
+    on triacs which, only switch when the current is zero, avoiding the back EMF problem later.  For now the
+    relays turning off are written first, followed by a quiet gap and a check of their card, before those
+    turning on (break before make, see RelayController.py), and this function makes three attempts to wire
+    the relays and will send a message if it fails to complete it's objective.   
 
     Args:
         mode (string): string to indicate type of thread setting the relays.
 
     Globals:
-        zoneTable (list of dictionaries): data structure for per zone settings.
+        state (stateStore): relays are set from the current snapshot of zoneTable and config.
         relays (relayCont): relayCont instance for all, multiple hats with 8 each, relays.
-        config (dictionary): data structure for configuration settings.
         relayShadow (list of ): data structure for per zone settings.
 
     Returns:
@@ -229,41 +321,93 @@ def setRelays(mode):
     Modifies:
         relays, relayShadow
     '''
-    global zoneTable
     global relays
-    global config
     global relayShadow
 
-    newRelayShadow = []
-    relayList      = []
-    if not config['allOff']:
-        for zone in range(len(zoneTable)):
-            if zoneTable[zone]['on']:
-                relayList.append(zoneTable[zone]['relay'])
-                newRelayShadow.append(zone)
-        #fprint("Turning on Relays : ", relayList)
-    currentDatetime = localDatetime()  # datetime.datetime.now()
-    textDayOfWeek = currentDatetime.strftime("%A, %b %-d")
-    currentTime = currentDatetime.time()
-    textTime = currentTime.strftime("%-I:%M%p")
-    for _ in range(3):
+    with relayLock, relayBeat.busy():
+        start          = time.perf_counter()
+        snap           = state.snapshot()
+        newRelayShadow = []
+        relayList      = []
+        if not snap.config['allOff']:
+            for zone in range(len(snap.zoneTable)):
+                if snap.zoneTable[zone]['on']:
+                    relayList.append(snap.zoneTable[zone]['relay'])
+                    newRelayShadow.append(zone)
+            #fprint("Turning on Relays : ", relayList)
+        currentDatetime = localDatetime()  # datetime.datetime.now()
+        textDayOfWeek = currentDatetime.strftime("%A, %b %-d")
+        currentTime = currentDatetime.time()
+        textTime = currentTime.strftime("%-I:%M%p")
+        for _ in range(3):
+            try:
+                relays.closeNOrelays(relayList)
+                break
+            except:
+                relayRetries.inc()
+                fprint(f"Failed attempt {_+1} to set relays")
+                time.sleep(0.25)
+                repeat = True
+            sendTextMessage(messageSubject="I2C Bus Failure", messageText=f"I2C Bus Failur at {textTime}", recipient=GORDONS_CELL)
+        with open(REPORT_FILE_NAME, "a+") as reportFile:
+            for zone in newRelayShadow:
+                if zone not in relayShadow:
+                    reportFile.write(f"Zone {snap.zoneTable[zone]['name']} {mode} turned on at {textTime}, {textDayOfWeek}\r\n")
+            for zone in relayShadow:
+                if zone not in newRelayShadow:
+                    reportFile.write(f"Zone {snap.zoneTable[zone]['name']} {mode} turned off at {textTime}, {textDayOfWeek}\r\n")
+        relayShadow = newRelayShadow
+        setRelaysSeconds.observe(time.perf_counter() - start)
+        #relays.reinit()
+    if liveState is not None:
+        publishLiveState()
+
+def publishLiveState():
+    ''' 
+    Writes the relays, the seconds each zone has left, the queue depth and the down time to the live state file
+    (LiveState.py).  Called after every relay change and every LIVE_STATE_INTERVAL by liveStateThread.
+
+    Globals:
+        state (stateStore): zone table, config and autoShutOff from the current snapshot.
+        relayShadow (list): zones whose relays are closed.
+        scheduler (wateringScheduler): scheduled zones, queue depth and down time.
+        liveState (liveStatePublisher): the live state file.
+
+    Returns:
+        Nothing
+    '''
+    snap = state.snapshot()
+    now = localTime()
+    dogActive = dogMode.status()['active']
+    runningZones = scheduler.runningZones(now)
+    relayBitmap = 0
+    for zone in relayShadow:
+        relayBitmap |= 1 << (snap.zoneTable[zone]['relay'] - 1)
+    zones = []
+    for zone in range(len(snap.zoneTable)):
+        settings = snap.zoneTable[zone]
+        remaining = 0
+        flags = LiveState.ZONE_ON if settings['on'] else 0
+        if zone in runningZones:
+            priority, remaining = runningZones[zone]
+            flags |= {Scheduler.MANUAL: LiveState.ZONE_MANUAL, Scheduler.DOG: LiveState.ZONE_DOG}.get(priority, LiveState.ZONE_SCHEDULED)
+            if priority == Scheduler.DOG:
+                remaining = dogActive.get(zone, 0) * FAKE_TIME_SCALE if FAKE_TIME_EN else dogActive.get(zone, 0)
+        zones.append((max(0, remaining) if settings['on'] else 0, flags))
+    flags = ((LiveState.FLAG_DOWN_TIME if scheduler.downTime else 0) | (LiveState.FLAG_ALL_OFF if snap.config['allOff'] else 0) |
+             (LiveState.FLAG_DOG_MODE if snap.config['dogMode'] else 0) | (LiveState.FLAG_BLACKOUT if scheduler.blackedOut else 0))
+    liveState.publish(snap.version, relayBitmap, scheduler.queueDepth(), flags, zones)
+
+def liveStateThread():
+    ''' 
+    Refreshes the live state every LIVE_STATE_INTERVAL so the seconds remaining count down between relay changes.
+    '''
+    while True:
         try:
-            relays.closeNOrelays(relayList)
-            break
-        except:
-            fprint(f"Failed attempt {_+1} to set relays")
-            time.sleep(0.25)
-            repeat = True
-        sendTextMessage(messageSubject="I2C Bus Failure", messageText=f"I2C Bus Failur at {textTime}", recipient=GORDONS_CELL)
-    with open(REPORT_FILE_NAME, "a+") as reportFile:
-        for zone in newRelayShadow:
-            if zone not in relayShadow:
-                reportFile.write(f"Zone {zoneTable[zone]['name']} {mode} turned on at {textTime}, {textDayOfWeek}\r\n")
-        for zone in relayShadow:
-            if zone not in newRelayShadow:
-                reportFile.write(f"Zone {zoneTable[zone]['name']} {mode} turned off at {textTime}, {textDayOfWeek}\r\n")
-    relayShadow = newRelayShadow
-    #relays.reinit()
+            publishLiveState()
+        except Exception as error:
+            fprint(f"Unable to publish the live state: {error!r}")
+        time.sleep(LIVE_STATE_INTERVAL)
 
 def checkRelays():
     ''' 
@@ -284,20 +428,41 @@ def checkRelays():
     currentTime = currentDatetime.time()
     textTime = currentTime.strftime("%-I:%M%p")
 
-    for _ in range(3):
-        try:
-            relays.checkState()
-            break
-        except:
-            fprint(f"Failed attempt {_} to set relays")
-            time.sleep(0.25)
-            repeat = True
-        sendTextMessage(messageSubject="I2C Bus Failure", messageText=f"I2C Bus Failure at {textTime}", recipient=GORDONS_CELL)
+    with relayLock, relayBeat.busy():
+        for _ in range(3):
+            try:
+                relays.checkState()
+                break
+            except:
+                fprint(f"Failed attempt {_} to set relays")
+                time.sleep(0.25)
+                repeat = True
+            sendTextMessage(messageSubject="I2C Bus Failure", messageText=f"I2C Bus Failure at {textTime}", recipient=GORDONS_CELL)
+
+
+def smtpConnect():
+    ''' 
+    Opens the connection used by the notification outbox, SMTP over SSL to GMAIL_SMTP_SERVER, logged in as
+    SENDER_EMAIL, or a plain connection to the --smtp server when simulating.
+
+    Returns:
+        smtplib.SMTP_SSL or smtplib.SMTP instance
+    '''
+    if args.smtp:
+        host, _, port = args.smtp.rpartition(':')
+        return smtplib.SMTP(host, int(port), timeout=SMTP_TIMEOUT)
+    context = ssl.create_default_context()
+    server = smtplib.SMTP_SSL(GMAIL_SMTP_SERVER, SSL_PORT, context=context, timeout=SMTP_TIMEOUT)
+    server.login(SENDER_EMAIL, PASSWORD)
+    return server
 
+notifications = Outbox.outbox(OUTBOX_DIRECTORY, smtpConnect, SENDER_EMAIL, digestSubjects=("I2C Bus Failure",),
+                              digestWindow=ALERT_DIGEST_WINDOW)
 
 def sendEmail(subject, textFile, recipient):
     ''' 
-    Sends an email with subject and body defined by textFile to recipient.
+    Queues an email with subject and body defined by textFile to recipient.  The file is read now, the
+    message is sent by the notification outbox thread.
 
     Args:
         subject (string): message subjet.
@@ -307,27 +472,16 @@ def sendEmail(subject, textFile, recipient):
     Returns:
         Nothing
     '''
-    # generic email headers
     if MESSAGING:
-        msg = EmailMessage()
-        msg['Subject'] = subject
-        msg['From'] = SENDER_EMAIL
-        msg['To'] = recipient
-
         with open(textFile) as fp:
-            msg.set_content(fp.read())
-        text = msg.as_string()
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(GMAIL_SMTP_SERVER, SSL_PORT, context=context) as server:
-            server.login(SENDER_EMAIL, PASSWORD)
-            server.sendmail(SENDER_EMAIL, recipient, text)
-        fprint("Email Sent")
+            notifications.enqueue(recipient, subject, fp.read())
+        fprint("Email Queued")
 
 
 def sendTextMessage(messageSubject, messageText, recipient):
     ''' 
-    Sends text message (as an outbound e-mail with subject and body defined by messageText to 
-    recipient.
+    Queues a text message (as an outbound e-mail with subject and body defined by messageText to 
+    recipient.  Repeated "I2C Bus Failure" messages are combined into digests by the outbox.
 
     Args:
         messageSubject (string): message subjet.
@@ -338,17 +492,8 @@ def sendTextMessage(messageSubject, messageText, recipient):
         Nothing
     '''
     if MESSAGING:
-        message = "From: %s\r\n" % SENDER_EMAIL \
-                + "To: %s\r\n" % recipient \
-                + "Subject: %s\r\n" % messageSubject \
-                + "\r\n" \
-                + messageText
-
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(GMAIL_SMTP_SERVER, SSL_PORT, context=context) as server:
-            server.login(SENDER_EMAIL, PASSWORD)
-            server.sendmail(SENDER_EMAIL, recipient, message)
-        fprint("Message Sent")
+        notifications.enqueue(recipient, messageSubject, messageText)
+        fprint("Message Queued")
 
 
 def configureTimerLables():
@@ -357,55 +502,94 @@ def configureTimerLables():
     row and prior to any row with a different timer type than the preceding rwo.  This function
     scans through the configurations to set which rows require a header.
     '''
-    timerTable[0]['labeled'] = True
-    for row in range(1, len(timerTable)):
-        if timerTable[row]['Type'] == timerTable[row-1]['Type']:
-            timerTable[row]['labeled'] = False
-        else:
-            timerTable[row]['labeled'] = True
+    with state.mutate('timerTable'):
+        ConfigChanges.configureTimerLabels(timerTable)
 
-def parseTime(timeString, default):
+def changeOptions():
     ''' 
-    parseTime performs some slick handling of user input with a great degree of flexibility
-    to allow users to enter time in the fewest number of characters.  It handles the following:
-    1) entry in 24 hour or AM / PM automatically detected
-    2) AM PM detection on either A, AM, P, PM.
-    3) Automatic completion of times when minutes are not provided
+    Returns the values offered by the user interface, used to validate changes.
+    '''
+    return {'wateringTimes': wateringTimes,
+            'intervals'    : intervals,
+            'timerTypes'   : timerTypes,
+            'days'         : [day for day, abb in daysOfWeek],
+            'relayCount'   : RelayController.regSize * len(relaysStackAddressList)}
 
-    Examples:
-    7:00 AM can be entered as 7, 7:00, 7a, 7A, 7am, 7AM, 7:00a, 7:00A, 7:00am, 7:00AM ...
-    7:30 AM can be entered as 730, 730a, 730A, 730am, 730AM, 7:30, 7:30a, 7:30A, 7:30am, 7:30AM ... 
-    8:30 PM can be entered as 830p, 830pm, 830PM, 8:30p, 8:30pm, 8:30P, 8:30PM, 2030, 20:30
+def remoteChanges(changes, flush):
+    ''' 
+    applyChanges for the web front end, the changes are applied by the control core.  The core answers once
+    the snapshot including the changes has been published, so the page rendered next shows them.
+    '''
+    try:
+        reply = control.call('applyChanges', changes=changes, flush=flush)
+    except ControlRPC.remoteError as error:
+        if error.kind == 'changeError':
+            raise ConfigChanges.changeError(error.value, error.index)
+        raise
+    result = ConfigChanges.changeResult()
+    result.applied     = reply['applied']
+    result.modified    = set(reply['modified'])
+    result.relayChange = reply['relayChange']
+    result.relabeled   = set(reply['relabeled'])
+    return result
+
+def applyChanges(changes, flush=False):
+    ''' 
+    Validates and applies a list of user changes (see ConfigChanges.py) as one transaction.  Either every
+    change is applied or, if any change is invalid, none are.  The relays are set at most once, and only
+    if a change affected them.  The web front end of a separate core passes the changes to the core.
 
     Args:
-        timestring (string): user input
-        default (string): value to return (existing value) should the input not be valid
+        changes (list of dictionaries): changes to apply
+        flush (boolean): write the NVM file now instead of within NVM_UPDATE_INTERVAL
 
     Returns:
-        Time formated as HH:MM{PM/AM}
+        changeResult
+
+    Raises:
+        ConfigChanges.changeError if any change is not valid
     '''
-    regexPM  = re.compile('[^pP]')
-    regexNum = re.compile('[^0-9]')
-    newPM    = regexPM.sub('', timeString)
-    if newPM.upper() == 'P':
-        newTimeString = 'PM'
-    else:
-        newTimeString = 'AM'
-    newTime  = regexNum.sub('', timeString)
-    if len(newTime) == 0:
-        return default
-    else:
-        newTimeInt = int(newTime)
-    if newTimeInt > 0 and newTimeInt < 13:
-        return f"{newTimeInt}:00{newTimeString}"
-    elif newTimeInt > 12 and newTimeInt < 23:
-        return f"{newTimeInt-12}:00PM"
-    elif newTimeInt > 99 and newTimeInt < 1260 and newTimeInt%100 < 60:
-        return f"{int(newTimeInt/100)}:{newTimeInt%100:02d}{newTimeString}"
-    elif newTimeInt > 1299 and newTimeInt < 2360 and newTimeInt%100 < 60:
-        return f"{int((newTimeInt-1200)/100)}:{newTimeInt%100}PM"
-    else:
-        return default
+    global updateNVM
+
+    if control is not None:
+        return remoteChanges(changes, flush)
+    names = {change.get('table') for change in changes if isinstance(change, dict)} & set(ConfigChanges.TABLES)
+    if 'timerTable' in names:
+        names.update(('zoneTable', 'scheduledDownTime'))  # deleting timers re-targets zones and the down time
+    with state.mutate(*names) as tables:
+        result = ConfigChanges.applyChanges(changes, tables, changeOptions(), localTime())
+    if result.modified:
+        if flush:
+            writeNVM()
+            updateNVM = 0
+        else:
+            updateNVM = time.time()
+    if result.relayChange:
+        setRelays("manually")
+    return result
+
+def applyFormChanges(changes):
+    ''' 
+    Applies the changes posted by a page form, skipping (and logging) any invalid field rather than
+    rejecting the whole form.
+    '''
+    while True:
+        try:
+            return applyChanges(changes)
+        except ConfigChanges.changeError as error:
+            fprint(f"Ignoring change {changes[error.index]}: {error}")
+            changes = changes[:error.index] + changes[error.index+1:]
+
+def parseZoneFormField(key, value):
+    ''' 
+    Converts a zones.html form field into a zone change.  Buttons are named zoneButton with a value of
+    "index field state", where state is 'on' or 'off', selections are named "index field".
+    '''
+    if key == 'zoneButton':
+        index, field, buttonState = value.split(' ')
+        return {'table': 'zoneTable', 'index': int(index), 'field': field, 'value': buttonState == 'on'}
+    index, field = key.split(' ')
+    return {'table': 'zoneTable', 'index': int(index), 'field': field, 'value': int(value)}
 
 # Defining the rout page
 @app.route("/")  # this sets the route to this page
@@ -414,102 +598,275 @@ def home():
 
 @app.route("/zones", methods=["POST", "GET"])
 def zones():
-    global updateNVM
-
     if request.method == "POST":
         zoneForm = request.form
+        changes = []
         for key in zoneForm:
             if key == 'saveButton':
-                doNothing = True  # Save simply triggers storage of selection boxes which don't trigger on change
-            elif key == 'zoneButton':
-                keypressed = zoneForm[key].split(' ')  #keypressed[0] = index, keypressed[1] = 'on', 'multizone' or 'dogDetectOn', keypressed[2] = state - 'on or 'off'
-                index = int(keypressed[0])
-                keyBolean = (keypressed[2] == 'on')
-                zoneTable[index][keypressed[1]] = keyBolean
-                if zoneTable[index][keypressed[1]] != 'on': # Manual control has been used to turn on / off a zone
-                    updateNVM = time.time()
-                    if keypressed[2] == 'on': # User has manually turned on zone
-                        zoneTable[index]['manualStartTime'] = localTime()
-            else: # Key is multiselect with key format of "index dict_key", where dict_key = 'timer' or 'wateringTime'
-                multiSelectKey = key.split(' ')
-                index = int(multiSelectKey[0])
-                zoneTable[index][multiSelectKey[1]] = int(zoneForm[key])
-        setRelays("manually")
-        return render_template("zones.html", zoneTable=zoneTable, wateringTimes=wateringTimes, timerTable=timerTable, content="true")
-    else:
-        return render_template("zones.html", zoneTable=zoneTable, wateringTimes=wateringTimes, timerTable=timerTable, content="true")
+                continue  # Save simply triggers storage of selection boxes which don't trigger on change
+            try:
+                changes.append(parseZoneFormField(key, zoneForm[key]))
+            except ValueError:
+                fprint(f"Ignoring zone field {key}")
+        applyFormChanges(changes)
+    snap = state.snapshot()
+    return render_template("zones.html", zoneTable=snap.zoneTable, wateringTimes=wateringTimes, timerTable=snap.timerTable, content="true")
+
+@app.route("/zones/<int:index>", methods=["POST"])
+def zoneRow(index):
+    ''' 
+    Row update for zones.html.  The posted form holds a single zone field, the response is the re-rendered
+    row (zoneRow.html) which the page swaps in place of the existing row.
+    '''
+    if index >= len(state.snapshot().zoneTable):
+        return f"No zone {index}", 404
+    try:
+        changes = [parseZoneFormField(key, request.form[key]) for key in request.form]
+        if any(change['index'] != index for change in changes):
+            raise ValueError(f"Fields do not belong to zone {index}")
+        applyChanges(changes)
+    except ValueError as error:
+        return str(error), 400
+    snap = state.snapshot()
+    return render_template("zoneRow.html", row=snap.zoneTable[index], index=index, wateringTimes=wateringTimes, timerTable=snap.timerTable)
 
 
 @app.route("/timers", methods=["POST", "GET"])
 def timers():
-    global updateNVM
-
     if request.method == "POST":
         timerForm = request.form
-        updateNVM = time.time()
-        fprint("timers upatedNVM : ", updateNVM)
-        for day, abb in daysOfWeek: # checkboxes only return values when checked - so need to reset all checks to off
-            for timer in range(len(timerTable)):
-                timerTable[timer][day] = ''
+        snap = state.snapshot()
+        changes = []
+        for timer in range(len(snap.timerTable)): # checkboxes only return values when checked - so need to reset the checks rendered on the page to off
+            if f"{timer} startTime" in timerForm and snap.timerTable[timer]['Type'] == 'DoW':
+                for day, abb in daysOfWeek:
+                    changes.append({'table': 'timerTable', 'index': timer, 'field': day, 'value': timerForm.get(f"{timer} {day}", '')})
+        buttonChanges = []
         for key in timerForm:
             if key == 'timerButton':
                 keypressed = timerForm[key].split(' ')
-                if keypressed[0] == 'save':
-                    doNothing = True
-                elif keypressed[0] == 'add':
-                    timerTable.append(copy.deepcopy(timerTable[len(timerTable)-1]))
+                if keypressed[0] == 'add':
+                    buttonChanges.append({'table': 'timerTable', 'op': 'add'})
                 elif keypressed[0] == 'delete':
-                    timerTable.pop(int(keypressed[1]))
-                else:
-                    for timer in range(len(timerTable)): # clear all selected timers - only one can be selected at a time (used for deleting timers
-                        if int(keypressed[1]) == timer:
-                            timerTable[timer]['selected'] = not timerTable[timer]['selected']
-                        else:
-                            timerTable[timer]['selected'] = False
-            else:
+                    buttonChanges.append({'table': 'timerTable', 'op': 'delete', 'index': int(keypressed[1])})
+                elif keypressed[0] == 'timer': # only one timer can be selected at a time (used for deleting timers)
+                    for timer in range(len(snap.timerTable)):
+                        selected = int(keypressed[1]) == timer and not snap.timerTable[timer]['selected']
+                        buttonChanges.append({'table': 'timerTable', 'index': timer, 'field': 'selected', 'value': selected})
+            elif timerForm[key] != '' and key.split(' ')[1] not in [day for day, abb in daysOfWeek]:
                 multiSelectKey = key.split(' ')
-                index = int(multiSelectKey[0])
-                if index < len(timerTable):
-                    if multiSelectKey[1] == 'startTime':
-                        timerTable[index]['startTime'] = parseTime(timerForm[key], default=timerTable[index]['startTime'])
-                    elif multiSelectKey[1] == 'Interval':
-                        timerTable[index]['Interval'] = int(timerForm[key])
-                    else:
-                        if timerForm[key] == 'on':  #Necessary as key state is returned as on instead of checked???
-                            storedValue = 'checked'
-                        else:
-                            storedValue = timerForm[key]
-                        timerTable[index][multiSelectKey[1]] = storedValue
-        configureTimerLables()
-        return render_template("timers.html", timerTable=timerTable, timerTypes=timerTypes, daysOfWeek=daysOfWeek, intervals=intervals, content="true")
-    else:
-        return render_template("timers.html", timerTable=timerTable, timerTypes=timerTypes, daysOfWeek=daysOfWeek, intervals=intervals, content="true")
+                changes.append({'table': 'timerTable', 'index': multiSelectKey[0], 'field': multiSelectKey[1], 'value': timerForm[key]})
+        applyFormChanges(changes + buttonChanges) # buttons last as deleting a timer renumbers the rows
+    snap = state.snapshot()
+    return render_template("timers.html", timerTable=snap.timerTable, timerTypes=timerTypes, daysOfWeek=daysOfWeek, intervals=intervals, content="true")
+
+@app.route("/timers/<int:index>", methods=["POST"])
+def timerRow(index):
+    ''' 
+    Row update for timers.html.  The posted form holds a single "index field" timer field, the response is the
+    re-rendered row (timerRow.html).  When the change relabels other rows the X-Refresh-Page header asks the
+    page to reload instead of swapping the row.
+    '''
+    if index >= len(state.snapshot().timerTable):
+        return f"No timer {index}", 404
+    try:
+        changes = []
+        for key in request.form:
+            timer, field = key.split(' ')
+            if int(timer) != index:
+                raise ValueError(f"Field {key} does not belong to timer {index}")
+            changes.append({'table': 'timerTable', 'index': index, 'field': field, 'value': request.form[key]})
+        result = applyChanges(changes)
+    except ValueError as error:
+        return str(error), 400
+    snap = state.snapshot()
+    response = make_response(render_template("timerRow.html", row=snap.timerTable[index], index=index, timerTypes=timerTypes, daysOfWeek=daysOfWeek, intervals=intervals))
+    if result.relabeled:
+        response.headers['X-Refresh-Page'] = '1'
+    return response
 
 @app.route("/settings", methods=["POST", "GET"])
 def settings():
-    global updateNVM
-
     if request.method == "POST":
         settingForm = request.form
-        updateNVM = time.time()
         fprint(settingForm, file=sys.stdout)
-        for key in settingForm:
-            if key == 'settingButton':
-                if settingForm[key] != 'save':
-                    config[settingForm[key]] = not config[settingForm[key]]
-                    if settingForm[key] == 'allOff':
-                        setRelays("manually")
-            elif key.split(' ')[0] == "scheduledDownTime":
-                scheduledDownTime[key.split(' ')[1]] = int(settingForm[key])
-            else: # must be auto-shutoff value
-                autoShutOff[key] = int(settingForm[key])
-        return render_template("settings.html", config=config,
-                               wateringTimes=wateringTimes, autoShutOff=autoShutOff, timerTable=timerTable, scheduledDownTime=scheduledDownTime, content="true")
-    else:
-        return render_template("settings.html", config=config,
-                               wateringTimes=wateringTimes, autoShutOff=autoShutOff, timerTable=timerTable, scheduledDownTime=scheduledDownTime, content="true")
+        snap = state.snapshot()
+        button = settingForm.get('settingButton', '')
+        if button == 'addBlackout': # the blackout form, added as a whole or not at all
+            window = {field: settingForm.get(f"blackout {field}", '') for field in ConfigChanges.BLACKOUT_FIELDS}
+            window['days'] = settingForm.getlist('blackout days')
+            try:
+                applyChanges(blackoutChanges(window, len(snap.blackouts)))
+            except ConfigChanges.changeError as error:
+                fprint(f"Ignoring blackout {window}: {error}")
+        elif button.split(' ')[0] == 'deleteBlackout':
+            applyFormChanges([{'table': 'blackouts', 'op': 'delete', 'index': button.split(' ')[1]}])
+        else:
+            changes = []
+            for key in settingForm:
+                if key == 'settingButton':
+                    if settingForm[key] != 'save':
+                        changes.append({'table': 'config', 'field': settingForm[key], 'value': not snap.config.get(settingForm[key])})
+                elif key.split(' ')[0] == "scheduledDownTime":
+                    changes.append({'table': 'scheduledDownTime', 'field': key.split(' ')[1], 'value': settingForm[key]})
+                else: # must be auto-shutoff value
+                    changes.append({'table': 'autoShutOff', 'field': key, 'value': settingForm[key]})
+            applyFormChanges(changes)
+    snap = state.snapshot()
+    allowed, until = blackoutCalendar().status(localDatetime())
+    return render_template("settings.html", config=snap.config,
+                           wateringTimes=wateringTimes, autoShutOff=snap.autoShutOff, timerTable=snap.timerTable, scheduledDownTime=snap.scheduledDownTime,
+                           blackouts=snap.blackouts, blackoutDays=Blackout.DAYS, blackedOut=not allowed, blackoutUntil=until, content="true")
+
+def blackoutChanges(window, index):
+    ''' 
+    Returns the changes adding a blackout window, a dictionary of the Blackout.py row fields, as row index.
+    '''
+    changes = [{'table': 'blackouts', 'op': 'add'}]
+    for field in ConfigChanges.BLACKOUT_FIELDS:
+        if field in window:
+            changes.append({'table': 'blackouts', 'index': index, 'field': field, 'value': window[field]})
+    return changes
 
-configureTimerLables()
+def blackoutCalendar():
+    ''' 
+    Returns the Blackout.blackoutCalendar of the current blackouts table, only rebuilt when the table changed.
+    '''
+    global calendarCache
+
+    rows = state.snapshot().blackouts
+    if calendarCache is None or calendarCache[0] is not rows:
+        calendarCache = (rows, Blackout.blackoutCalendar(rows))
+    return calendarCache[1]
+
+@app.route("/api/blackouts", methods=["GET", "POST"])
+def apiBlackouts():
+    ''' 
+    The blackout windows (GET), whether scheduled watering is allowed now, until when, and the coming blackouts.
+    POST adds a window, {"name": ..., "repeat": "weekly" or "once", "days": ..., "start": ..., "end": ...}.
+    '''
+    if request.method == "POST":
+        window = request.get_json(silent=True)
+        if not isinstance(window, dict):
+            return jsonify(error="Expected a blackout window"), 400
+        try:
+            applyChanges(blackoutChanges(window, len(state.snapshot().blackouts)), flush=True)
+        except ConfigChanges.changeError as error:
+            return jsonify(error=error.value), 400
+    snap = state.snapshot()
+    calendar = blackoutCalendar()
+    now = localDatetime()
+    allowed, until = calendar.status(now)
+    return jsonify(version=snap.version, blackouts=snap.thaw('blackouts'), allowed=allowed,
+                   until=until.strftime(Blackout.DATE_FORMAT) if until else None, errors=calendar.errors,
+                   upcoming=[[start.strftime(Blackout.DATE_FORMAT), end.strftime(Blackout.DATE_FORMAT)] for start, end in calendar.upcoming(now)])
+
+@app.route("/api/blackouts/<int:index>", methods=["DELETE"])
+def apiBlackout(index):
+    try:
+        applyChanges([{'table': 'blackouts', 'op': 'delete', 'index': index}], flush=True)
+    except ConfigChanges.changeError as error:
+        return jsonify(error=error.value), 400
+    snap = state.snapshot()
+    return jsonify(version=snap.version, blackouts=snap.thaw('blackouts'))
+
+@app.route("/api/weather", methods=["GET"])
+def apiWeather():
+    ''' 
+    Weather adjust status: the weather data range, recent reference ET and the multipliers a scheduled watering
+    starting today would use.
+    '''
+    weather.refresh()
+    return jsonify(enabled=state.snapshot().config['weatherAdjust'], **weather.status(localDatetime().date()))
+
+@app.route("/api/zones", methods=["GET"])
+def apiZones():
+    snap = state.snapshot()
+    return jsonify(version=snap.version, zones=snap.thaw('zoneTable'))
+
+@app.route("/api/zones/<int:index>", methods=["POST"])
+def apiZone(index):
+    ''' 
+    JSON endpoint to change a single zone field.  Expects {"field": <field>, "value": <value>}.  The relays
+    are only set when the on state of the zone actually changed.
+    '''
+    change = request.get_json(silent=True) or {}
+    try:
+        applyChanges([{'table': 'zoneTable', 'index': index, 'field': change.get('field'), 'value': change.get('value')}])
+    except ConfigChanges.changeError as error:
+        return jsonify(error=error.value), 400
+    snap = state.snapshot()
+    return jsonify(version=snap.version, zone=dict(snap.zoneTable[index]))
+
+@app.route("/api/batch", methods=["POST"])
+def apiBatch():
+    ''' 
+    Transactional batch of zone, timer and settings changes: {"changes": [<change>, ...]} (see ConfigChanges.py).
+    All changes are validated before any is applied, the relays are set at most once and the NVM file is
+    written once, immediately.
+    '''
+    body = request.get_json(silent=True) or {}
+    changes = body.get('changes')
+    if not isinstance(changes, list):
+        return jsonify(error="Expected {\"changes\": [...]}"), 400
+    try:
+        result = applyChanges(changes, flush=True)
+    except ConfigChanges.changeError as error:
+        return jsonify(error=error.value, change=error.index), 400
+    return jsonify(version=state.snapshot().version, applied=result.applied, modified=sorted(result.modified), relaysSet=result.relayChange)
+
+@app.route("/api/config", methods=["GET", "POST"])
+def apiConfig():
+    ''' 
+    Export (GET) or import (POST) of the full configuration, as JSON or, with ?format=csv or a text/csv body,
+    as "table,index,field,value" rows.  An import is applied as a single batch.
+    '''
+    if request.method == "GET":
+        document = ConfigChanges.exportConfig(state.snapshot())
+        if request.args.get('format') == 'csv':
+            response = make_response(ConfigChanges.documentToCSV(document))
+            response.mimetype = 'text/csv'
+            response.headers['Content-Disposition'] = 'attachment; filename=sprinklerConfig.csv'
+            return response
+        return jsonify(document)
+    try:
+        if request.mimetype == 'text/csv' or request.args.get('format') == 'csv':
+            document = ConfigChanges.documentFromCSV(request.get_data(as_text=True))
+        else:
+            document = request.get_json(silent=True)
+            if not isinstance(document, dict):
+                return jsonify(error="Expected a configuration document"), 400
+        result = applyChanges(ConfigChanges.importChanges(document, state.snapshot()), flush=True)
+    except (ConfigChanges.changeError, KeyError, ValueError) as error:
+        return jsonify(error=str(getattr(error, 'value', error)), change=getattr(error, 'index', None)), 400
+    return jsonify(version=state.snapshot().version, applied=result.applied, modified=sorted(result.modified), relaysSet=result.relayChange)
+
+@app.route("/manifest.webmanifest")
+def manifest():
+    response = jsonify(name="Sprinkler Controller", short_name="Sprinklers", start_url="/zones", scope="/",
+                       display="standalone", background_color="#ffffff", theme_color="#007bff",
+                       icons=[{"src": assets.url('images/icon-192.png'), "sizes": "192x192", "type": "image/png"},
+                              {"src": assets.url('images/icon-512.png'), "sizes": "512x512", "type": "image/png"},
+                              {"src": assets.url('images/icon.svg'),     "sizes": "any",     "type": "image/svg+xml"}])
+    response.mimetype = 'application/manifest+json'
+    return response
+
+@app.route("/sw.js")
+def serviceWorker():
+    ''' 
+    The service worker must be served from the root to control every page.  It is rendered with the hashed
+    asset urls, so a new asset build produces a new worker (and cache) automatically.
+    '''
+    shellAssets = [assets.url(name) for name in sorted(assets.assets)]
+    cacheName = StaticAssets.hashedName('sprinkler-shell', ''.join(shellAssets).encode())
+    response = make_response(render_template("sw.js", cacheName=cacheName, shellAssets=shellAssets,
+                                             shellPages=["/zones", "/timers", "/settings"]))
+    response.mimetype = 'application/javascript'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+if control is None: # the core labels the tables it owns
+    configureTimerLables()
 
 @app.route("/admin")
 def admin():
@@ -530,10 +887,7 @@ def saveState():
 
     Globals:
         updateNVM (time): time of last update to NVM values
-        zoneTable (list of dictionaries): data structure for per zone settings.
-        timerTable (list of dictionaries): data structure for per timer settings.
-        config (dictionary): data structure for configuration settings.
-        autoShutOff (dictionary): Auto shut-off settings.
+        state (stateStore): the tables are persisted from a snapshot, no copy or lock is required.
 
     Returns:
         Nothing
@@ -542,67 +896,158 @@ def saveState():
         updateNVM
     '''
     global updateNVM
-    global zoneTable
-    global timerTable
-    global config
-    global autoShutOff
-    global scheduledDownTime
 
+    beat = heartbeats.register('nvm', 3 * NVM_UPDATE_INTERVAL)
     while True:
         time.sleep(NVM_UPDATE_INTERVAL)
+        beat.beat(3 * NVM_UPDATE_INTERVAL)
         timeDelta = time.time() - updateNVM
         if timeDelta > NVM_UPDATE_INTERVAL and timeDelta < 2.5 * NVM_UPDATE_INTERVAL:
-            NVMzoneTable = copy.deepcopy(zoneTable)
-            for zone in range(len(zoneTable)):
-                NVMzoneTable[zone]['on'] = False # Turn off all sprinklers (virtually) before saving data structure
-            with open(NVM_FILENAME, 'wb') as NVMfile:
-                pickle.dump(NVMzoneTable, NVMfile)
-                pickle.dump(timerTable,   NVMfile)
-                pickle.dump(config,       NVMfile)
-                pickle.dump(autoShutOff,  NVMfile)
-                pickle.dump(scheduledDownTime,   NVMfile)
+            writeNVM()
             updateNVM = 0
 
+def writeNVM():
+    ''' 
+    Writes the current snapshot of the user set configurations to the NVM file.  Called by the saveState
+    thread and directly by batch changes and imports which flush immediately.
+    '''
+    with nvmLock:
+        start = time.perf_counter()
+        snap = state.snapshot()
+        NVMzoneTable = snap.thaw('zoneTable')
+        for zone in range(len(NVMzoneTable)):
+            NVMzoneTable[zone]['on'] = False # Turn off all sprinklers (virtually) before saving data structure
+        with open(NVM_FILENAME, 'wb') as NVMfile:
+            pickle.dump(NVMzoneTable,                   NVMfile)
+            pickle.dump(snap.thaw('timerTable'),        NVMfile)
+            pickle.dump(snap.thaw('config'),            NVMfile)
+            pickle.dump(snap.thaw('autoShutOff'),       NVMfile)
+            pickle.dump(snap.thaw('scheduledDownTime'), NVMfile)
+            pickle.dump(snap.thaw('blackouts'),         NVMfile)
+            nvmFlushBytes.set(NVMfile.tell())
+        nvmFlushSeconds.observe(time.perf_counter() - start)
+
+def conformTables(zoneTable, timerTable):
+    ''' 
+    Moves the zone and timer settings which are not among the options offered, i.e. after a change of the config
+    file, to the nearest option offered.  Zones on relays beyond the cards configured are turned off.
+
+    Args:
+        zoneTable, timerTable (list): modified in place
+
+    Returns:
+        number of settings changed
+    '''
+    changed = 0
+    relayCount = RelayController.regSize * len(relaysStackAddressList)
+    for zone in range(len(zoneTable)):
+        if zoneTable[zone]['wateringTime'] not in wateringTimes:
+            zoneTable[zone]['wateringTime'] = min(wateringTimes, key=lambda wateringTime : abs(wateringTime - zoneTable[zone]['wateringTime']))
+            changed += 1
+        if zoneTable[zone]['relay'] > relayCount and zoneTable[zone]['on']:
+            zoneTable[zone]['on'] = False
+            changed += 1
+    for timer in range(len(timerTable)):
+        if timerTable[timer]['Type'] not in timerTypes:
+            timerTable[timer]['Type'] = timerTypes[0]
+            changed += 1
+        if timerTable[timer]['Interval'] not in intervals:
+            timerTable[timer]['Interval'] = min(intervals, key=lambda interval : abs(interval - timerTable[timer]['Interval']))
+            changed += 1
+    return changed
+
+def applyConfig(old, new, changed):
+    ''' 
+    configWatcher callback applying a changed config file while the controller runs.  Relay hats added are
+    initialized and those removed disabled, leaving the relays of the others, and the watering in progress, as
+    they are.  The relay sequencing applies from the next transition and the I2C trace starts or stops at once.
+    Zone and timer settings no longer offered move to the nearest option, then the timer thread runs its next pass
+    at once, on the new sample interval.
+
+    Args:
+        old, new (dictionary): settings before and after the change
+        changed (list): keys of the settings which changed
+
+    Globals:
+        relays (relayCont): relayCont instance for all, multiple hats with 8 each, relays.
+        state (stateStore): zoneTable and timerTable modified inside a state.mutate() block.
+
+    Modifies:
+        relaysStackAddressList, wateringTimes, intervals, TIMER_SAMPLE_INTERVAL, LIVE_STATE_INTERVAL,
+        NVM_UPDATE_INTERVAL, zoneTable, timerTable, relays, updateNVM
+    '''
+    global controllerConfig, relaysStackAddressList, wateringTimes, intervals
+    global TIMER_SAMPLE_INTERVAL, LIVE_STATE_INTERVAL, NVM_UPDATE_INTERVAL, updateNVM
+
+    controllerConfig       = new
+    relaysStackAddressList = new['RELAY_STACKS']
+    wateringTimes          = new['WATERING_TIMES']
+    intervals              = new['INTERVALS']
+    TIMER_SAMPLE_INTERVAL  = new['TIMER_SAMPLE_INTERVAL']
+    LIVE_STATE_INTERVAL    = new['LIVE_STATE_INTERVAL']
+    NVM_UPDATE_INTERVAL    = new['NVM_UPDATE_INTERVAL']
+    for key in changed:
+        if key in ControllerConfig.RESTART_SETTINGS:
+            fprint(f"{key} changed, it takes effect the next time the controller starts")
+    if args.role == 'web': # the options offered are all the web front end keeps
+        return
+    if 'RELAY_STACKS' in changed:
+        with relayLock, relayBeat.busy():
+            added, removed = relays.setAddressList(relaysStackAddressList)
+        fprint(f"Relay hats {[hex(address) for address in relaysStackAddressList]}, initialized {[hex(address) for address in added]}, "
+               f"disabled {[hex(address) for address in removed]}")
+    if 'BREAK_BEFORE_MAKE' in changed or 'RELAY_QUIET_GAP' in changed:
+        with relayLock:
+            relays.sequencing(new['BREAK_BEFORE_MAKE'], new['RELAY_QUIET_GAP'])
+    if 'I2C_TRACE' in changed:
+        with relayLock:
+            startTrace(new['I2C_TRACE'])
+    with state.mutate('zoneTable', 'timerTable'):
+        conformed = conformTables(zoneTable, timerTable)
+    if conformed:
+        fprint(f"{conformed} zone / timer settings moved to the options of the config file")
+        updateNVM = time.time()
+    if 'RELAY_STACKS' in changed or conformed:
+        setRelays("for a configuration change")
+    timerWake.set()
+
+def startTrace(path):
+    ''' 
+    Records the relay hats' I2C transactions to the trace file path, I2C_TRACE in the config file, relative to the
+    controller's directory (see I2CTrace.py), or stops recording if path is empty.
+    '''
+    relays.stopTrace()
+    if not path:
+        return
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    try:
+        relays.startTrace(path)
+        fprint(f"Recording the I2C trace to {path}")
+    except OSError as error:
+        fprint(f"Unable to record the I2C trace to {path}: {error}")
+
 def loadState():
     ''' 
     loads user set configurations for the sprinkler system. 
 
     Globals:
         NVM_FILENAME (string): filename constant for configuration settings.
-        zoneTable (list of dictionaries): data structure for per zone settings.
-        timerTable (list of dictionaries): data structure for per timer settings.
-        config (dictionary): data structure for configuration settings.
-        autoShutOff (dictionary): Auto shut-off settings.
+        state (stateStore): loaded tables replace the contents of the working tables.
 
     Returns:
         Nothing
 
     Modifies:
-        zoneTable, timerTable, config, autoShutOff
+        zoneTable, timerTable, config, autoShutOff, scheduledDownTime, blackouts
    '''
-    global NVM_FILENAME
-    global zoneTable
-    global timerTable
-    global config
-    global autoShutOff
-    global scheduledDownTime
-
     try: # Open NVM file if it exists otherwise use defaults
-        with open(NVM_FILENAME, 'rb') as NVMfile:
-            zoneTable   = pickle.load(NVMfile)
-            timerTable  = pickle.load(NVMfile)
-            config      = pickle.load(NVMfile)
-            autoShutOff = pickle.load(NVMfile)
-            scheduledDownTime  = pickle.load(NVMfile)
-        for zone in range(len(zoneTable)):
-            if zoneTable[zone]['wateringTime'] not in wateringTimes:
-                zoneTable[zone]['wateringTime'] = min(wateringTimes, key=lambda wateringTime : abs(wateringTime - zoneTable[zone]['wateringTime']))
-            zoneTable[zone]['manualStartTime'] = 0
-        for timer in range(len(timerTable)):
-            if timerTable[timer]['Type'] not in timerTypes:
-                timerTable[timer]['Type'] = timerTypes[0]
-            if timerTable[timer]['Interval'] not in intervals:
-                timerTable[timer]['Interval'] = min(wateringTimes, key=lambda wateringTime : abs(wateringTime - timerTable[timer]['Interval']))
+        NVMtables = ConfigChanges.readTables(NVM_FILENAME) # the settings of older versions are dropped
+        conformTables(NVMtables['zoneTable'], NVMtables['timerTable'])
+        for zone in range(len(NVMtables['zoneTable'])):
+            NVMtables['zoneTable'][zone]['manualStartTime'] = 0
+        with state.mutate():
+            for name in ConfigChanges.TABLES:
+                state.replace(name, NVMtables[name])
 
     except:
         fprint("config file not found, using defaults")
@@ -654,154 +1099,67 @@ def localTime():
     else:
         return time.time()
 
+def timerTickInterval():
+    '''
+    Returns the seconds the timer thread sleeps between ticks, TIMER_SAMPLE_INTERVAL scaled down while fake time runs.
+    '''
+    return TIMER_SAMPLE_INTERVAL / (FAKE_TIME_SCALE if FAKE_TIME_EN else 1)
+
+def timerDeadline():
+    '''
+    Returns the timer heartbeat's deadline, seconds: three ticks, and at least a tick plus the relay check a tick
+    ending the watering runs (RELAY_DEADLINE).
+    '''
+    return max(3 * timerTickInterval(), timerTickInterval() + RELAY_DEADLINE)
+
 def timerThread():
     ''' 
-    The timerThread loops, sleeping for TIMER_SAMPLE_INTERVAL, every cycle it determines if any timers have
-    triggered, creates a list of zones which should be turned as a result.  The list is then appended to the 
-    queue of zones to be watered.  The queue is created with the understanding that "Multi" zones can be watered
-    at the same time.  This thread also handles the manual overide.  Manual overrides that start watering on 
-    a zone result in an automatic shut off timer being created according to the duration defined in the user 
-    settings depending if the zone is "Multi" or not.  Manual overides to shut off in progress watering delay
-    the watering until the override is removed, at which point watering removes.  Lastly the timer will send 
-    an e-mal with the weekly report should the date / time match the configuration.  This process includes 
-    a keepalive counter the watchdog monitors to ensure this thread is functioning.
+    The timerThread loops, sleeping for TIMER_SAMPLE_INTERVAL, every cycle it runs the scheduler
+    (Scheduler.py), which determines if any timers have triggered, creates a list of zones which should be turned
+    on as a result and appends it to the queue of zones to be watered.  The queue is created with the understanding
+    that "Multi" zones can be watered at the same time.  The scheduler also handles the manual overide.  Manual
+    overrides that start watering on a zone result in an automatic shut off timer being created according to the
+    duration defined in the user settings depending if the zone is "Multi" or not.  Manual overides to shut off
+    in progress watering delay the watering until the override is removed, at which point watering removes.
+    Lastly the timer will send an e-mal with the weekly report should the date / time match the configuration.
+    This process includes a keepalive counter the watchdog monitors to ensure this thread is functioning.
 
     Globals:
-        zoneTable (list of dictionaries): data structure for per zone settings.
-        timerTable (list of dictionaries): data structure for per timer settings.
-        config (dictionary): data structure for configuration settings.
-        autoShutOff (dictionary): Auto shut-off settings.
+        scheduler (wateringScheduler): zoneTable and timerTable are modified inside state.mutate() blocks, the
+                                       lock is released before the relays are set so I2C retries never block
+                                       other writers.
         keepAlive (int): Keep alive counter for watchdog
 
     Returns:
         Nothing
 
     Modifies:
-        zoneTable, relays
+        zoneTable, timerTable, relays
     '''
-    global zoneTable
-    global timerTable
-    global config
-    global autoShutOff
     global keepAlive
-    global scheduledDownTime
-    global downTime
 
-    pendingZones = queue.Queue()
-    activeZones  = []
-    wateringIdle = True
-    endTimer     = 0
-    currentZone  = 0
-    oldQsize     = 0
-    downTimeStart = 0
+    beat = heartbeats.register('timer', timerDeadline())
+    sleepStart = None
 
     while True:
+        tickStart = time.perf_counter()
+        if sleepStart is not None:
+            timerLagSeconds.observe(max(0, tickStart - sleepStart - timerTickInterval()))
 
         # Get date / time and convert into compatible units
         currentDatetime = localDatetime()# datetime.datetime.now()
-
-        #fprint(currentDatetime)
         textDayOfWeek = currentDatetime.strftime("%A")
-        #fprint(textDayOfWeek)
-        currentTime = currentDatetime.time()
-        #fprint(currentTime)
-        textTime = currentTime.strftime("%-I:%M%p")
-        #fprint(textTime)
+        textTime = currentDatetime.time().strftime("%-I:%M%p")
         timeInSeconds = localTime()# time.time()
-        #fprint("time in seconds: ", timeInSeconds)
 
         printEn = False
         if (keepAlive % 4000) == 0 and printEn:
-            fprint(textDayOfWeek, textTime, "  Q", pendingZones.qsize())
+            fprint(textDayOfWeek, textTime, "  Q", scheduler.queueDepth())
         keepAlive += 1
+        beat.beat(timerDeadline())
 
-        # find timer trigger events and add entries to the queue of zones to be enabled, where a queue entry may be a single zone or a collection of multi zones
-        for timer in range(len(timerTable)):
-            if timerTable[timer]['Type'] == 'INT':
-                if timerTable[timer]['startTime'] == textTime and (timeInSeconds - timerTable[timer]['lastTimeOn']) > 60 * 60 * 24 * (timerTable[timer]['Interval'] - 0.5):
-                    timerTable[timer]['lastTimeOn'] = timeInSeconds
-                    zoneList = []
-                    for zone in range(len(zoneTable)):
-                        if zoneTable[zone]['timer']-1 == timer and zoneTable[zone]['wateringTime'] != 0:
-                            if zoneTable[zone]['multiZone']:
-                                zoneList.append(zone)
-                            else:
-                                pendingZones.put([zone])
-                    if scheduledDownTime['timer']-1 == timer:
-                        downTimeStart = timeInSeconds
-                    if len(zoneList) > 0:
-                        pendingZones.put(zoneList)
-            else: #timerTable[timer]['Type'] == 'DoW'
-                if timerTable[timer]['startTime'] == textTime and timerTable[timer][textDayOfWeek] == 'checked' and (timeInSeconds - timerTable[timer]['lastTimeOn']) > 60 * 60 * 24 * 0.5:
-                    timerTable[timer]['lastTimeOn'] = timeInSeconds
-                    fprint("Timer: ", timer, " Active")
-                    zoneList = []
-                    for zone in range(len(zoneTable)):
-                        if zoneTable[zone]['timer'] - 1 == timer and zoneTable[zone]['wateringTime'] != 0:
-                            if zoneTable[zone]['multiZone']:
-                                zoneList.append(zone)
-                            else:
-                                pendingZones.put([zone])
-                    if scheduledDownTime['timer']-1 == timer:
-                        downTimeStart = timeInSeconds
-                    if len(zoneList) > 0:
-                        pendingZones.put(zoneList)
-
-        # Turn on zones, removing one element from the queue, then waiting for the active zone(s) to complete before removing the next element.
-        if timeInSeconds > downTimeStart and timeInSeconds < (downTimeStart + 60 * scheduledDownTime['duration']):
-            if downTime == False:
-                for zone in range(len(zoneTable)):
-                    zoneTable[zone]['on'] = False
-                setRelays("automatically")
-                for zone in range(len(activeZones)): # Adjust starting time of any running zones
-                    activeZones[zone] = (activeZones[zone][0], activeZones[zone][1] + 60 * scheduledDownTime['duration'])
-                zoneTable[zone]['on'] = True
-                downTime = True
-        elif timeInSeconds > (downTimeStart + 60 * scheduledDownTime['duration']):
-            if downTime == True:
-                if len(activeZones) > 0:
-                    for zone in range(len(activeZones)): # Restart interrupted zones
-                        zoneTable[activeZones[zone][0]]['on'] = True
-                    setRelays("automatically")
-                downTime = False
-        
-        manualWatering = False
-        for zone in range(len(zoneTable)):
-            if timeInSeconds > zoneTable[zone]['manualStartTime']:
-                manualWatering = True
-        previousWateringIdle = wateringIdle
-        wateringIdle = len(activeZones) == 0 and not manualWatering
-        if wateringIdle and not previousWateringIdle: # just finished all watering
+        if scheduler.tick(timeInSeconds, currentDatetime): # just finished all watering
             checkRelays()
-        if wateringIdle and not downTime and not pendingZones.empty():
-            activeZones = []
-            currentZones = pendingZones.get()
-            for zone in currentZones:
-                activeZones.append((zone, timeInSeconds))
-                zoneTable[zone]['on'] = True
-            setRelays("as scheduled")
-        if not wateringIdle and not downTime:
-            zoneSetToOff = False
-            for zone, startTime in activeZones:
-                wateringTime = max(MIN_WATERING_TIME, 60 * zoneTable[zone]['wateringTime'] - DOG_WARNING_DURATION * zoneTable[zone]['detectCount'])
-                if wateringTime < 60 * zoneTable[zone]['wateringTime'] and previousWateringIdle:
-                    fprint(f"Zone {zoneTable[zone]['name']} adjusted watering time from {60 * zoneTable[zone]['wateringTime']}s to {wateringTime}s")
-                if timeInSeconds > startTime + wateringTime:
-                    zoneTable[zone]['on'] = False
-                    zoneTable[zone]['detectCount'] = 0
-                    zoneSetToOff = True
-                    activeZones.remove((zone, startTime))
-            for zone in range(len(zoneTable)):
-                if zoneTable[zone]['multiZone']:
-                    wateringTime = autoShutOff['multiZone']
-                else:
-                    wateringTime = autoShutOff['singleZone']
-                if timeInSeconds > zoneTable[zone]['manualStartTime'] + 60 * wateringTime:
-                    zoneTable[zone]['on'] = False
-                    zoneTable[zone]['manualStartTime'] = END_OF_TIME
-                    zoneSetToOff = True
-            if zoneSetToOff:
-                setRelays("automatically")
 
         if textDayOfWeek == REPORT_DAY_OF_THE_WEEK and textTime == REPORT_TIME_OF_DAY and os.path.isfile(REPORT_FILE_NAME):
             try:
@@ -817,180 +1175,398 @@ def timerThread():
             except:
                 fprint("Error e-mailing report file")
 
-    time.sleep(TIMER_SAMPLE_INTERVAL/FAKE_TIME_SCALE)
+        pendingZonesGauge.set(scheduler.queueDepth())
+        activeZonesGauge.set(len(scheduler.scheduledZones))
+        sleepStart = time.perf_counter()
+        timerTickSeconds.observe(sleepStart - tickStart)
+        timerWake.wait(timerTickInterval())
+        timerWake.clear()
 
-def runDogMode():
+def dogModeZones():
     ''' 
-    If config['dogMode'] is True, the RunDogMode thread will turn on the sprinklers set to 
-    dog mode for the duration defined by DOG_WARNING_DURATION, clearing the dogWarning global 
-    when complete.
+    Dog mode scheduler callback returning the zones a Dog Warning may turn on, none while dog mode is
+    off, during the scheduled down time or a blackout window.
 
     Globals:
-        zoneTable (list of dictionaries): data structure for per zone settings.
-        config (dictionary): data structure for configuration settings.
-        dogWarning (boolean): Indicator if a dog has been detected in the front yard
+        state (stateStore): read from the current snapshot.
+        scheduler (wateringScheduler): scheduled down time in progress.
 
     Returns:
-        Nothing
+        list of zone indexes
+    '''
+    snap = state.snapshot()
+    if not snap.config['dogMode'] or scheduler.downTime or scheduler.blackedOut:
+        return []
+    return [zone for zone in range(len(snap.zoneTable)) if snap.zoneTable[zone]['dogDetectOn']]
+
+def dogModeOn(zones):
+    ''' 
+    Dog mode scheduler callback turning on the zones which are not already on, as dog jobs of the watering
+    queue which pause the scheduled watering until dogModeOff.
+
+    Args:
+        zones (list): zone indexes
+
+    Returns:
+        list of the zones turned on
 
     Modifies:
         zoneTable, relays
     '''
-    global zoneTable
-    global dogWarning
-    global config
-    global downTime
-
-    if config['dogMode'] and not downTime:
-        if not dogWarning:
-            zoneList = []
-            for zone in range(len(zoneTable)):
-                if zoneTable[zone]['dogDetectOn'] and not zoneTable[zone]['on']:
-                    zoneList.append(zone)
-                    zoneTable[zone]['on'] = True
-                    zoneTable[zone]['detectCount'] += 1
-                    dogWarning = True
-            if dogWarning:
-                setRelays("for dog detect mode")
-                time.sleep(DOG_WARNING_DURATION)
-                for zone in zoneList:
-                    zoneTable[zone]['on'] = False
-                setRelays("for dog detect mode")
-                dogWarning = False
-
-
-def jsonServer():
-    ''' 
-    The JSON server thread for communicating with the Dog Detector and runs continuously after 
-    initialization.  jsonServer expects to receive two types of messages, a Dog Warning packet 
-    which should trigger the sprinkler system dog mode and a watchdog message which simply 
-    requires an ack to indicate the JSON server is alive to the Dog Detector.
-    '''
-    HOST = '0.0.0.0'  #
-    PORT = 2579  #
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as json_server:
-        json_server.bind((HOST, PORT))
-        while True: # repeatildy open connections
-            json_server.listen()
-            conn, addr = json_server.accept()
-            with conn:
-                fprint('Connected by', addr)
-                while True:
-                    data = conn.recv(1024)
-                    if data:
-                        data_packets = [packet + b"}" for packet in data.split(b"}") if packet]
-                        fprint("Data Packets: ", data_packets)
-                        for index in range(len(data_packets)):
-                            received = json.loads(data_packets[index])
-                            if received["Type"] == "Dog Warning":
-                                response = json.dumps({"Type": "Dog Warning Ack"})
-                                conn.sendall(response.encode('utf-8'))
-                                try:
-                                    runDogModeThread = Thread(target=runDogMode)
-                                    runDogModeThread.start()
-                                except:
-                                    fprint("Error: unable to start Run Dog Mode thread")
-                            elif received["Type"] == "WatchDog":
-                                response = json.dumps({"Type": "WatchDog Ack"})
-                                conn.sendall(response.encode('utf-8'))
-                            else:
-                                response = json.dumps({"Type": "Unknown Message Ack"})
-                                conn.sendall(response.encode('utf-8'))
-                                fprint("Unknown message type")
-                                fprint(received)
-                    if not data:
-                        break
-
-def watchDogPetter():
-    ''' 
-    watchDogPetter is a true watchdog in the embedded sense.  The use of watchdogs in Linux operating systems
-    takes on a different context and purpose.  In Linux severs the overriding purpose of the watchdog is to 
-    prevent bricking of the server itself.  As a result the watchdog has been created so that critical processes
-    such as network communication are monitored and the system is hard reset if those services cease to operate.
-    Verifying operation via process ID is not effective for a multithreaded application, such as this one where 
-    individual threads within the application need to be monitored.  As a result the hardware watchdog is called 
-    through the watchdog driver.  Via an os call.  This is the same hardware which is called through the watchdog
-    deamon (very unfortunately named watchdog as there is namespace colissions between the configuration of the 
-    deamon and the driver, for which I have not found a definitive reference).  This implimentation does not 
-    invoke the watchdog deamon as the hardware does not support competeing resources controlling the hardware.
-    WARNING:  Be very careful to understand any changes made to the configuration of the driver and accidentally
-    invoking the watchdog deamon as this will prevent this thread from operating.
+    return scheduler.startSpray(zones, localTime(), localDatetime())
 
-    Globals:
-        SUDO_PASSWORD (Constant String): sudo password for pi.
-        WATCH_DOG_PET_INTERVAL (Constant Int): Time between petting the dog.
-        keepAlive (Int): Timer counter indicating the timer thread is operating
+def dogModeOff(sprayed):
+    ''' 
+    Dog mode scheduler callback ending a spray.  The seconds sprayed are added to detectCount in units of
+    DOG_WARNING_DURATION, so timerThread reduces the next scheduled watering by exactly the time sprayed.
+    Zones the timer thread or a manual override have since turned on are left on.
 
-    Returns:
-        Nothing
+    Args:
+        sprayed (dict): zone index -> seconds on
 
     Modifies:
         zoneTable, relays
     '''
-    global SUDO_PASSWORD
-    global WATCH_DOG_PET_INTERVAL
-    global keepAlive
+    scheduler.endSpray(sprayed, localTime(), localDatetime())
+
+dogMode = DogMode.dogScheduler(dogModeZones, dogModeOn, dogModeOff, warningDuration=DOG_WARNING_DURATION,
+                               maxDuration=DOG_MAX_DURATION, cooldown=DOG_COOLDOWN, burst=DOG_BURST,
+                               ratePerHour=DOG_RATE_PER_HOUR)
+weather = WeatherAdjust.weatherAdjuster(WEATHER_DIRECTORY)
+
+def weatherMultiplier(zone, currentDatetime):
+    ''' 
+    Scheduler callback returning the weather multiplier of a scheduled watering of zone starting now, 1 unless the
+    Weather Adjust setting is on.
+
+    Args:
+        zone (int): zone index
+        currentDatetime (datetime): start of the watering
+
+    Returns:
+        float, 0 when recent rain covers the watering
+    '''
+    if not state.snapshot().config['weatherAdjust']:
+        return 1.0
+    return weather.multiplier(zone, currentDatetime.date())
 
-    command = 'sh -c "echo \'.\' >> /dev/watchdog"'
-    lastKeepAlive = -1
-    bufferedKeepAlive = -1
-    petCounter = 1
+def saveSchedule(now):
+    ''' 
+    Scheduler callback persisting the timers' last trigger times and the zones' watering progress, so a restart
+    neither waters a timer's zones again nor loses the watering it interrupted.  Triggers and waterings starting or
+    ending are written at once, the progress of the watering in progress by the saveState thread.
+
+    Modifies:
+        updateNVM
+    '''
+    global updateNVM
+
+    if now:
+        writeNVM()
+        updateNVM = 0
+    elif not updateNVM:
+        updateNVM = time.time()
 
+scheduler = Scheduler.wateringScheduler(state, setRelays, sprays=dogMode.sprayed, release=dogMode.release, adjust=weatherMultiplier,
+                                        save=saveSchedule, minWateringTime=MIN_WATERING_TIME, dogWarningDuration=DOG_WARNING_DURATION)
+detectorServer = None # JsonServer.jsonServer, started in main
+
+def dogWarningReceived(message, peer):
+    ''' 
+    JSON server handler for Dog Warning messages, called on the JSON server's event loop.  The warning is
+    passed to the dog mode scheduler which turns on, or extends, the dog mode zones in its own thread.
+
+    Args:
+        message (dict): the Dog Warning message
+        peer (tuple): address of the Dog Detector
+
+    Returns:
+        Nothing
+    '''
+    dogMode.detect()
+
+def webSelfCheck():
+    ''' 
+    The web server self check thread requests /healthz from the Flask server every WEB_CHECK_INTERVAL
+    seconds, beating the 'web' heartbeat each time the server answers.  A web server which stops answering
+    stops the watchdog being petted.
+
+    Globals:
+        heartbeats (heartbeatRegistry): registry of the critical thread heartbeats.
+
+    Returns:
+        Nothing
+    '''
+    beat = heartbeats.register('web', 3 * WEB_CHECK_INTERVAL)
+    url = f"http://127.0.0.1:{args.port}/healthz"
     while True:
-        if keepAlive != lastKeepAlive:
-            p = os.system('echo %s|sudo -S %s' % (SUDO_PASSWORD, command))
-            petCounter += 1
-        if petCounter % int(3 * TIMER_SAMPLE_INTERVAL/WATCH_DOG_PET_INTERVAL) == 0:
-            lastKeepAlive     = bufferedKeepAlive
-            bufferedKeepAlive = keepAlive
-        time.sleep(WATCH_DOG_PET_INTERVAL)
+        time.sleep(WEB_CHECK_INTERVAL)
+        try:
+            with urllib.request.urlopen(url, timeout=WEB_CHECK_INTERVAL) as response:
+                if response.status == 200:
+                    beat.beat()
+        except OSError as error:
+            fprint(f"Web server self check failed: {error}")
+
+@app.route("/healthz")
+def healthz():
+    if control is not None:
+        return jsonify(version=state.snapshot().version, heartbeats=control.call('status')['heartbeats'])
+    return jsonify(version=state.snapshot().version, heartbeats=heartbeats.status())
+
+@app.errorhandler(ControlRPC.rpcUnavailable)
+def coreUnavailable(error):
+    return jsonify(error="Control core unavailable, the web front end will reconnect once it has restarted"), 503
+
+def controlApplyChanges(changes, flush=False):
+    ''' 
+    Control RPC method applying the web front end's changes, the reply is sent once the resulting snapshot has
+    been published.
+    '''
+    result = applyChanges(changes, flush)
+    publisher.waitFor(state.snapshot().version)
+    return {'applied': result.applied, 'modified': sorted(result.modified), 'relayChange': result.relayChange,
+            'relabeled': sorted(result.relabeled)}
+
+def controlStatus():
+    ''' 
+    Control RPC method returning the core's state version and heartbeats.
+    '''
+    return {'version': state.snapshot().version, 'heartbeats': heartbeats.status()}
+
+def detectorCounts():
+    ''' 
+    /metrics function returning the messages received by the JSON server, by transport and message type,
+    including the UDP events it dropped.
+    '''
+    if detectorServer is None:
+        return None
+    counts = {key: value for key, value in list(detectorServer.received.items())}
+    if detectorServer.udp is not None:
+        for name in ('duplicates', 'rejected'):
+            counts[('udp', name)] = detectorServer.udp.counters[name]
+    return counts
+
+Metrics.counterFunction('sprinkler_detector_messages_total', 'Dog Detector messages received', detectorCounts, ('transport', 'type'))
+Metrics.gaugeFunction('sprinkler_detector_connections', 'Dog Detector TCP connections open',
+                      lambda: None if detectorServer is None else detectorServer.connections)
+Metrics.counterFunction('sprinkler_dog_mode_events_total', 'Dog mode scheduler events', lambda: dict(dogMode.counters), ('event',))
+Metrics.gaugeFunction('sprinkler_dog_mode_active_zones', 'Zones on for dog mode', lambda: len(dogMode.active))
+Metrics.counterFunction('sprinkler_notifications_total', 'Notification outbox events', lambda: dict(notifications.counters), ('event',))
+Metrics.counterFunction('sprinkler_i2c_events_total', 'Relay hat I2C transactions, registers found corrupt and rewritten, bus errors',
+                        lambda: dict(relays.counters), ('event',))
+Metrics.gaugeFunction('sprinkler_notifications_pending', 'Notifications waiting in the outbox', notifications.pending)
+Metrics.gaugeFunction('sprinkler_heartbeat_age_seconds', 'Seconds since each critical thread last beat', heartbeats.status, ('thread',))
+Metrics.counterFunction('sprinkler_log_dropped_total', 'Log messages dropped with the log writer behind', FlexPrint.dropped)
+Metrics.gaugeFunction('sprinkler_weather_multiplier', 'Weather multiplier of the scheduled watering of each zone in progress',
+                      lambda: {(str(zone),): multiplier for zone, multiplier in scheduler.multipliers.items()}, ('zone',))
+Metrics.gaugeFunction('sprinkler_state_version', 'State store snapshot version', lambda: state.snapshot().version)
+
+@app.before_request
+def startRequestTimer():
+    g.requestStart = time.perf_counter()
+
+@app.after_request
+def observeRequest(response):
+    start = g.get('requestStart')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        httpRequestSeconds.labels(route, request.method, response.status_code).observe(time.perf_counter() - start)
+    return response
+
+WEB_METRICS = (httpRequestSeconds.name,) # Kept by the web front end, the core keeps the rest
+
+@app.route("/metrics")
+def metrics():
+    if control is not None:
+        text = control.call('metrics') + Metrics.render(include=WEB_METRICS)
+    else:
+        text = Metrics.render()
+    return text, 200, {'Content-Type': Metrics.CONTENT_TYPE}
+
+profiles = Profiler.profiler(PROFILE_DIRECTORY)
+
+def adminAllowed():
+    ''' 
+    Returns True when the request may use the /admin endpoints, it must carry ADMIN_TOKEN (X-Admin-Token
+    header or token parameter) if one is set in private.py, otherwise it must come from the Pi itself.
+    '''
+    if ADMIN_TOKEN:
+        token = request.headers.get('X-Admin-Token') or request.values.get('token') or ''
+        return hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+@app.route("/admin/profile", methods=["GET", "POST"])
+def adminProfile():
+    ''' 
+    GET returns the status of the running or last profile.  POST with action=start (mode cpu / memory,
+    seconds, interval) starts a profile, action=stop ends it early and returns the files written.
+    '''
+    if not adminAllowed():
+        return jsonify(error="forbidden"), 403
+    if request.method == "POST":
+        values = request.get_json(silent=True) or request.values
+        if values.get('action', 'start') == 'stop':
+            return jsonify(files=profiles.stop())
+        try:
+            return jsonify(profiles.start(values.get('mode', 'cpu'), values.get('seconds', 30),
+                                          values.get('interval', Profiler.SAMPLE_INTERVAL)))
+        except (ValueError, TypeError) as error:
+            return jsonify(error=str(error)), 400
+        except RuntimeError as error:
+            return jsonify(error=str(error), status=profiles.status()), 409
+    return jsonify(profiles.status())
+
+@app.route("/admin/log", methods=["GET", "POST"])
+def adminLog():
+    ''' 
+    GET returns the log levels, POST with module (a module name or root) and level (DEBUG, INFO ...) sets one.
+    '''
+    if not adminAllowed():
+        return jsonify(error="forbidden"), 403
+    if request.method == "POST":
+        values = request.get_json(silent=True) or request.values
+        try:
+            FlexPrint.setLevel(values.get('module', 'root'), values.get('level', ''))
+        except ValueError as error:
+            return jsonify(error=str(error)), 400
+    return jsonify(levels=FlexPrint.getLevels(), dropped=FlexPrint.dropped())
+
+@app.route("/admin/config")
+def adminConfig():
+    ''' 
+    Returns the settings applied from the config file, the error if its last change was ignored and when it
+    was last applied.
+    '''
+    if not adminAllowed():
+        return jsonify(error="forbidden"), 403
+    return jsonify(configWatcher.status())
+
+def toggleProfile(signalNumber, frame):
+    ''' 
+    SIGUSR2 handler, starts a PROFILE_SIGNAL_SECONDS CPU profile or ends the one running, i.e.
+    sudo systemctl kill -s USR2 SprinklerController.service
+    '''
+    if profiles.running():
+        profiles.stop(wait=False)
+    else:
+        profiles.start('cpu', PROFILE_SIGNAL_SECONDS)
 
 if __name__ == "__main__":
     '''
     Initialize data structures and launch threads.
     '''
+    FlexPrint.setup(LOG_FILE_NAME if args.role == 'all' else LOG_FILE_NAME.replace('.log', f'-{args.role}.log'), levels=LOG_LEVELS)
+
+    if args.role != 'web':
+        relays = RelayController.relayCont(relaysStackAddressList)
+        relays.verbose(1)
+        relays.sequencing(controllerConfig['BREAK_BEFORE_MAKE'], controllerConfig['RELAY_QUIET_GAP'])
+        startTrace(controllerConfig['I2C_TRACE'])
+        relays.open()
+
+        loadState()
+        #fprint(zoneTable)
+        if DEBUG:
+            for timer in range(len(timerTable)):
+                timerTable[timer]['lastTimeOn'] = 0
 
-    relays = RelayController.relayCont(relaysStackAddressList)
-    relays.verbose(1)
-    relays.open()
+        try:
+            saveStateThread = Thread(target=saveState)
+            saveStateThread.start()
+            fprint("Save State Thread: ", saveStateThread)
+        except:
+             fprint("Error: unable to start save state thread")
 
-    loadState()
-    #fprint(zoneTable)
-    if DEBUG:
-        for timer in range(len(timerTable)):
-            timerTable[timer]['lastTimeOn'] = 0
+        try:
+            timersThread = Thread(target=timerThread)
+            timersThread.start()
+            fprint("Timers Thread: ", timersThread)
+        except:
+             fprint("Error: unable to start timers thread")
 
-    try:
-        saveStateThread = Thread(target=saveState)
-        saveStateThread.start()
-        fprint("Save State Thread: ", saveStateThread)
-    except:
-         fprint("Error: unable to start save state thread")
+        try:
+            liveState = LiveState.liveStatePublisher(LIVE_STATE_FILE_NAME)
+            liveStateUpdateThread = Thread(target=liveStateThread, name='liveState', daemon=True)
+            liveStateUpdateThread.start()
+            fprint("Live State Thread: ", liveStateUpdateThread)
+        except:
+             fprint("Error: unable to start the live state thread")
 
-    try:
-        timersThread = Thread(target=timerThread)
-        timersThread.start()
-        fprint("Timers Thread: ", timersThread)
-    except:
-         fprint("Error: unable to start timers thread")
+        try:
+            outboxThread = notifications.start()
+            fprint("Outbox Thread: ", outboxThread)
+        except:
+             fprint("Error: unable to start outbox thread")
 
-    try:
-        jsonServerThread = Thread(target=jsonServer)
-        jsonServerThread.daemon = True
-        jsonServerThread.start()
-        fprint("Jason Sever Thread: ", jsonServerThread)
-    except:
-         fprint("Error: unable to start JSON server thread")
+        try:
+            dogModeThread = dogMode.start()
+            fprint("Dog Mode Thread: ", dogModeThread)
+        except:
+             fprint("Error: unable to start dog mode thread")
 
-    if WATCH_DOG_ENABLE and piHost:
         try:
-            watchDogPetterThread = Thread(target=watchDogPetter)
-            watchDogPetterThread.daemon = True
-            watchDogPetterThread.start()
-            fprint("Watch Dog Petting Thread: ", watchDogPetterThread)
+            detectorServer = JsonServer.jsonServer({"Dog Warning": dogWarningReceived},
+                                                   udpKey=DETECTOR_HMAC_KEY.encode('utf-8') if DETECTOR_HMAC_KEY else None,
+                                                   heartbeat=heartbeats.register('jsonServer', JSON_SERVER_DEADLINE))
+            jsonServerThread = detectorServer.start()
+            fprint("Jason Sever Thread: ", jsonServerThread)
         except:
-            fprint("Error: unable to start Watch Dog Petting thread")
+             fprint("Error: unable to start JSON server thread")
+
+        if WATCH_DOG_ENABLE and piHost:
+            '''
+            watchDogKeeper is a true watchdog in the embedded sense.  In Linux servers the watchdog daemon
+            mostly prevents bricking of the server by monitoring processes; verifying operation via process ID
+            is not effective for a multithreaded application such as this one, where individual threads need to
+            be monitored.  The hardware watchdog is therefore kept directly through the driver, /dev/watchdog,
+            petted only while every thread's heartbeat is healthy.  The watchdog daemon must not be enabled as
+            the hardware does not support competing users.
+            '''
+            try:
+                if args.role == 'all': # a separate web front end is restarted by systemd instead
+                    webSelfCheckThread = Thread(target=webSelfCheck)
+                    webSelfCheckThread.daemon = True
+                    webSelfCheckThread.start()
+                watchDogKeeper = WatchDog.watchdogKeeper(heartbeats, interval=WATCH_DOG_PET_INTERVAL)
+                watchDogPetterThread = watchDogKeeper.start()
+                fprint("Watch Dog Petting Thread: ", watchDogPetterThread)
+
+                def stopService(signalNumber, frame):
+                    watchDogKeeper.stop() # systemctl stop disarms the watchdog rather than resetting the Pi
+                    FlexPrint.writer.close()
+                    os._exit(0)
+                signal.signal(signal.SIGTERM, stopService)
+            except:
+                fprint("Error: unable to start Watch Dog Petting thread")
+
+        if args.role == 'core':
+            '''
+            The core publishes its snapshots for the web front end and takes its changes over the control RPC.
+            '''
+            try:
+                publisher = SharedSnapshot.snapshotPublisher(SNAPSHOT_FILE_NAME)
+                state.subscribe(publisher.publish)
+                publisher.publish(state.snapshot())
+                publisherThread = publisher.start()
+                fprint("Snapshot Publisher Thread: ", publisherThread)
+                controlServer = ControlRPC.rpcServer(CONTROL_SOCKET, {'applyChanges': controlApplyChanges,
+                                                                      'status'      : controlStatus,
+                                                                      'metrics'     : lambda: Metrics.render(exclude=WEB_METRICS)})
+                controlThread = controlServer.start()
+                fprint("Control RPC Thread: ", controlThread)
+            except:
+                fprint("Error: unable to start the control RPC server")
+
+    try:
+        configWatcherThread = configWatcher.start()
+        fprint("Config Watcher Thread: ", configWatcherThread)
+    except:
+        fprint("Error: unable to start the config watcher thread")
 
-    app.run(host='0.0.0.0', debug=True, use_reloader=False)
+    signal.signal(signal.SIGUSR2, toggleProfile)
 
+    if args.role == 'core':
+        while True:
+            signal.pause()
+    app.run(host='0.0.0.0', port=args.port, debug=True, use_reloader=False)
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+'''
+This provides a single-writer state store for the sprinkler controller tables (zoneTable, timerTable, config,
+autoShutOff and scheduledDownTime).  The Flask handlers, the timer thread, dog mode and the NVM thread all operate on
+these tables concurrently, so every mutation must be made inside a mutate() block, which serializes writers with a
+lock.  When a mutate() block exits the store publishes a new, versioned, read-only snapshot of the tables that were
+named when the block was entered.  Tables that were not named are shared with the previous snapshot (copy-on-write),
+so the cost of publishing is proportional to the tables changed, not the total state.
+
+Readers (page rendering, NVM persistence, the schedule projection, metrics ...) call snapshot() which returns the
+current snapshot by reference - there is no lock and no copy on the read side, every read is O(1).  A snapshot is
+never modified once published, so a reader can hold on to it for as long as it needs a consistent view.
+
+    state = StateStore.stateStore(zoneTable=zoneTable, timerTable=timerTable)
+
+    with state.mutate('zoneTable'):
+        zoneTable[0]['on'] = True
+
+    snap = state.snapshot()
+    snap.version, snap.zoneTable[0]['on']
+
+The working tables passed to the constructor remain owned by the caller and are updated in place, references held
+by the caller stay valid for the life of the store.
+'''
+from threading import RLock
+from types import MappingProxyType
+
+
+def freezeTable(table):
+    '''
+    Returns a read-only copy of a table.  Tables are either a flat dictionary of scalars or a list of flat dictionaries
+    of scalars, so a shallow copy of each row is sufficient to detach the copy from the working table.
+
+    Args:
+        table (dictionary or list of dictionaries): working table.
+
+    Returns:
+        MappingProxyType or tuple of MappingProxyType
+    '''
+    if isinstance(table, dict):
+        return MappingProxyType(dict(table))
+    return tuple(MappingProxyType(dict(row)) for row in table)
+
+
+def thawTable(table):
+    '''
+    Returns a mutable (plain dictionary / list) copy of a frozen table, for pickling or editing.
+    '''
+    if isinstance(table, MappingProxyType):
+        return dict(table)
+    return [dict(row) for row in table]
+
+
+class stateSnapshot:
+    """
+    Immutable, versioned view of the controller tables.  Tables are available as attributes, i.e. snap.zoneTable.
+    """
+    __slots__ = ('version', '_tables')
+
+    def __init__(self, version, tables):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, '_tables', tables)
+
+    def __getattr__(self, name):
+        try:
+            return self._tables[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("stateSnapshot is read-only")
+
+    def tableNames(self):
+        return tuple(self._tables)
+
+    def thaw(self, name):
+        return thawTable(self._tables[name])
+
+
+class stateStore:
+    """
+    Lock-guarded owner of the controller tables.
+
+    Methods:
+        mutate(*names)        - context manager, serializes the writer and publishes a new snapshot of the named
+                                tables on exit.  With no names every table is republished.
+        replace(name, value)  - replace the contents of a working table in place (used when loading NVM)
+        snapshot()            - returns the current stateSnapshot, lock free
+        subscribe(callback)   - callback(snapshot) is called, in the writer's thread, after each publish
+    """
+    def __init__(self, **tables):
+        self._lock        = RLock()
+        self._working     = tables
+        self._depth       = 0
+        self._dirty       = set()
+        self._subscribers = []
+        self._snapshot    = stateSnapshot(0, {name: freezeTable(table) for name, table in tables.items()})
+
+    def snapshot(self):
+        return self._snapshot
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def mutate(self, *names):
+        return _mutation(self, names if names else tuple(self._working))
+
+    def replace(self, name, value):
+        with self.mutate(name):
+            table = self._working[name]
+            if isinstance(table, dict):
+                table.clear()
+                table.update(value)
+            else:
+                table[:] = value
+
+    def _enter(self, names):
+        self._lock.acquire()
+        self._depth += 1
+        self._dirty.update(names)
+
+    def _exit(self):
+        self._depth -= 1
+        snapshot = None
+        if self._depth == 0:
+            tables = dict(self._snapshot._tables)
+            for name in self._dirty:
+                tables[name] = freezeTable(self._working[name])
+            self._dirty.clear()
+            snapshot = stateSnapshot(self._snapshot.version + 1, tables)
+            self._snapshot = snapshot
+        self._lock.release()
+        if snapshot is not None:
+            for callback in self._subscribers:
+                callback(snapshot)
+
+
+class _mutation:
+    def __init__(self, store, names):
+        self.store = store
+        self.names = names
+
+    def __enter__(self):
+        self.store._enter(self.names)
+        return self.store._working
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.store._exit()
+        return False
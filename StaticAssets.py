@@ -0,0 +1,194 @@
+#!/usr/bin/python
+'''
+This provides the static asset pipeline for the Flask pages.  At startup every asset under static/ is read once,
+given a content hashed name (styles/bootstrap.min.css -> styles/bootstrap.min.3f9a0c1d2e4b.css) and precompressed
+with gzip and, when the optional brotli package is installed, brotli.  The variants are held in memory and served
+from /assets/<hashed name> with an immutable, one year Cache-Control header, so a phone that has visited once never
+requests the assets again until their content changes, and the first visit transfers the compressed bytes only.
+
+Templates reference assets through the assetUrl() jinja global:
+
+    <link rel="stylesheet" href="{{ assetUrl('styles/bootstrap.min.css') }}">
+
+Unminified files which have a minified sibling (bootstrap.css next to bootstrap.min.css) and hidden files
+(.DS_Store) are not served.
+
+Running this file directly builds the assets and prints a size report, or, with --out <dir>, writes the hashed and
+precompressed files to <dir> for serving from a front end web server instead of Flask.
+'''
+from FlexPrint import fprint
+import hashlib
+import gzip
+import mimetypes
+import os
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ASSET_URL_PREFIX = '/assets/'
+ASSET_MAX_AGE    = 365 * 24 * 60 * 60  # One year, assets are immutable as their name changes with their content
+HASH_LENGTH      = 12
+COMPRESSIBLE     = ('.css', '.js', '.html', '.json', '.svg', '.txt', '.webmanifest')
+
+# Content-Encoding preference, best first.  identity is always available.
+ENCODINGS        = ('br', 'gzip', 'identity')
+
+
+def hashedName(name, data):
+    '''
+    Inserts a hash of data before the extension of name, i.e. styles/site.css -> styles/site.<hash>.css
+    '''
+    root, ext = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+
+
+def acceptedEncodings(header):
+    '''
+    Parses an Accept-Encoding header into the set of encodings with a non zero quality.
+    '''
+    accepted = set()
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        encoding = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if encoding and quality > 0:
+            accepted.add(encoding)
+    if '*' in accepted:
+        accepted.update(ENCODINGS)
+    accepted.add('identity')
+    return accepted
+
+
+class asset:
+    """
+    A single asset, its hashed name, mimetype and the encoded variants keyed by Content-Encoding.
+    """
+    def __init__(self, name, data):
+        self.name     = name
+        self.hashed   = hashedName(name, data)
+        self.etag     = self.hashed.rsplit('.', 2)[-2]
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.variants = {'identity': data}
+        if name.endswith(COMPRESSIBLE):
+            gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(gzipped) < len(data):
+                self.variants['gzip'] = gzipped
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.variants['br'] = compressed
+
+    def select(self, acceptEncoding):
+        accepted = acceptedEncodings(acceptEncoding)
+        for encoding in ENCODINGS:
+            if encoding in self.variants and encoding in accepted:
+                return encoding, self.variants[encoding]
+
+
+class assetPipeline:
+    """
+    Builds and serves the hashed, precompressed static assets.
+
+    Methods:
+        build()         - (re)reads all of the assets, called by register()
+        url(name)       - returns the hashed url for the asset name relative to static/
+        register(app)   - adds the /assets route and assetUrl jinja global to the Flask app
+        serve(filename) - Flask view for /assets/<hashed name>
+        write(outDir)   - writes the hashed and precompressed files to outDir
+    """
+    def __init__(self, staticFolder):
+        self.staticFolder = staticFolder
+        self.assets       = {}  # name -> asset
+        self.byHash       = {}  # hashed name -> asset
+
+    def sources(self):
+        names = []
+        for directory, subDirectories, files in os.walk(self.staticFolder):
+            subDirectories[:] = [sub for sub in subDirectories if not sub.startswith('.')]
+            for file in files:
+                if file.startswith('.'):
+                    continue
+                root, ext = os.path.splitext(file)
+                if not root.endswith('.min') and os.path.isfile(os.path.join(directory, f"{root}.min{ext}")):
+                    continue  # the minified sibling is served instead
+                names.append(os.path.relpath(os.path.join(directory, file), self.staticFolder).replace(os.sep, '/'))
+        return sorted(names)
+
+    def build(self):
+        assets = {}
+        for name in self.sources():
+            with open(os.path.join(self.staticFolder, name), 'rb') as assetFile:
+                assets[name] = asset(name, assetFile.read())
+        self.assets = assets
+        self.byHash = {item.hashed: item for item in assets.values()}
+        return self
+
+    def url(self, name):
+        item = self.assets.get(name)
+        if item is None:
+            fprint(f"Static asset {name} not found")
+            return ASSET_URL_PREFIX + name
+        return ASSET_URL_PREFIX + item.hashed
+
+    def serve(self, filename):
+        from flask import request, abort, Response
+
+        item = self.byHash.get(filename)
+        if item is None:
+            abort(404)
+        if request.headers.get('If-None-Match', '').strip('"') == item.etag:
+            response = Response(status=304)
+        else:
+            encoding, data = item.select(request.headers.get('Accept-Encoding', ''))
+            response = Response(data, mimetype=item.mimetype)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['ETag'] = f'"{item.etag}"'
+        return response
+
+    def register(self, app):
+        self.build()
+        app.add_url_rule(ASSET_URL_PREFIX + '<path:filename>', 'assets', self.serve)
+        app.jinja_env.globals['assetUrl'] = self.url
+        return self
+
+    def write(self, outDir):
+        suffixes = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+        for item in self.assets.values():
+            path = os.path.join(outDir, item.hashed)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            for encoding, data in item.variants.items():
+                with open(path + suffixes[encoding], 'wb') as outFile:
+                    outFile.write(data)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the hashed, precompressed static assets')
+    parser.add_argument('--static', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+    parser.add_argument('--out', help='directory to write the hashed and precompressed files to')
+    args = parser.parse_args()
+
+    pipeline = assetPipeline(args.static).build()
+    totals = {encoding: 0 for encoding in ENCODINGS}
+    for item in pipeline.assets.values():
+        sizes = {encoding: len(item.variants.get(encoding, item.variants['identity'])) for encoding in ENCODINGS}
+        for encoding in ENCODINGS:
+            totals[encoding] += sizes[encoding]
+        fprint(f"{item.hashed:55s} {sizes['identity']:8d} {sizes['gzip']:8d} {sizes['br']:8d}")
+    fprint(f"{'total (identity / gzip / br)':55s} {totals['identity']:8d} {totals['gzip']:8d} {totals['br']:8d}")
+    if brotli is None:
+        fprint("brotli is not installed, br sizes are uncompressed")
+    if args.out:
+        pipeline.write(args.out)
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+'''
+This provides the hardware watchdog keeper and the heartbeat registry it checks.
+
+Every critical thread registers a heartbeat with its own deadline.  Periodic threads (the timer thread, the NVM
+flusher, the JSON server's event loop, the web server self check) call beat() each time around their loop and
+are stalled if they have not beaten within their deadline.  Work which only runs now and then (setting the
+relays) is wrapped in busy() and is stalled only if a single call runs past its deadline.
+
+The keeper opens /dev/watchdog once and writes to it every interval seconds, but only while every heartbeat is
+healthy.  When a thread stalls the keeper logs which one and stops petting, and the hardware resets the Pi once
+its timeout (15 seconds on the Pi) expires.  stop() writes the magic close character so a deliberate shutdown,
+i.e. systemctl stop, disarms the watchdog instead of resetting the Pi.
+
+The device is opened directly, no sudo or shell is involved.  The user running the controller needs write access
+to /dev/watchdog, see Sprinkler_Controller_README.txt for the udev rule.
+'''
+from FlexPrint import fprint
+import contextlib
+import os
+import threading
+import time
+
+WATCHDOG_DEVICE   = '/dev/watchdog'
+WATCHDOG_INTERVAL = 5     # Seconds between pets, must be well under the hardware timeout
+MAGIC_CLOSE       = b'V'  # Disarms the watchdog when the device is closed (unless the driver was built nowayout)
+
+
+class heartbeat:
+    """
+    A single thread's heartbeat.
+
+    Methods:
+        beat(deadline=None) - records the thread is alive, optionally changing its deadline from now on
+        busy()              - context manager marking a call which must complete within the deadline
+    """
+    def __init__(self, name, deadline, periodic, clock):
+        self.name      = name
+        self.deadline  = deadline
+        self.periodic  = periodic
+        self.clock     = clock
+        self.last      = clock()
+        self.busySince = None
+
+    def beat(self, deadline=None):
+        if deadline is not None:
+            self.deadline = deadline
+        self.last = self.clock()
+
+    @contextlib.contextmanager
+    def busy(self):
+        self.busySince = self.clock()
+        try:
+            yield self
+        finally:
+            self.busySince = None
+            self.last = self.clock()
+
+    def late(self, now):
+        '''
+        Returns the seconds the heartbeat is past its deadline, 0 when healthy.
+        '''
+        busySince = self.busySince
+        if busySince is not None:
+            return max(0, now - busySince - self.deadline)
+        if self.periodic:
+            return max(0, now - self.last - self.deadline)
+        return 0
+
+
+class heartbeatRegistry:
+    """
+    The heartbeats of the critical threads.
+
+    Methods:
+        register(name, deadline, periodic=True) - returns the heartbeat for name, creating it if needed
+        stalled()                               - [(name, seconds late)] for every unhealthy heartbeat
+        status()                                - {name: seconds since the last beat}
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock      = clock
+        self.heartbeats = {}
+        self.lock       = threading.Lock()
+
+    def register(self, name, deadline, periodic=True):
+        with self.lock:
+            if name not in self.heartbeats:
+                self.heartbeats[name] = heartbeat(name, deadline, periodic, self.clock)
+            return self.heartbeats[name]
+
+    def stalled(self):
+        now = self.clock()
+        with self.lock:
+            beats = list(self.heartbeats.values())
+        return [(beat.name, late) for beat in beats for late in (beat.late(now),) if late > 0]
+
+    def status(self):
+        now = self.clock()
+        with self.lock:
+            return {name: now - beat.last for name, beat in self.heartbeats.items()}
+
+
+class watchdogKeeper:
+    """
+    Pets the hardware watchdog while every registered heartbeat is healthy.
+
+    Args:
+        registry (heartbeatRegistry): heartbeats to check
+        device (string): watchdog device
+        interval (float): seconds between pets
+
+    Methods:
+        start() - opens the device and starts the keeper thread, returns the thread
+        stop()  - stops petting and disarms the watchdog with the magic close
+    """
+    def __init__(self, registry, device=WATCHDOG_DEVICE, interval=WATCHDOG_INTERVAL):
+        self.registry = registry
+        self.device   = device
+        self.interval = interval
+        self.fd       = None
+        self.stopped  = threading.Event()
+        self.lock     = threading.Lock()
+        self.thread   = None
+        self.pets     = 0
+
+    def run(self):
+        reported = set()
+        while not self.stopped.is_set():
+            stalled = self.registry.stalled()
+            names = {name for name, late in stalled}
+            for name, late in stalled:
+                if name not in reported:
+                    fprint(f"Watch Dog: {name} thread stalled, {late:.1f}s past its deadline, no longer petting")
+            for name in reported - names:
+                fprint(f"Watch Dog: {name} thread recovered")
+            reported = names
+            if not stalled:
+                with self.lock:
+                    if self.fd is not None and not self.stopped.is_set():
+                        os.write(self.fd, b'.')
+                        self.pets += 1
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.fd = os.open(self.device, os.O_WRONLY)  # arms the watchdog
+        self.thread = threading.Thread(target=self.run, name='watchDog', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            if self.fd is not None:
+                try:
+                    os.write(self.fd, MAGIC_CLOSE)
+                finally:
+                    os.close(self.fd)
+                    self.fd = None
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+'''
+This provides the watering queue of the scheduler: every watering is a job of a priority class,
+
+    MANUAL    - a zone turned on by the user, for the auto shut off time
+    DOG       - a dog mode spray, until dog mode ends it
+    SCHEDULED - a zone, or the multi zones of a timer as one group, for their watering times
+    CATCH_UP  - a scheduled watering whose start time was missed, i.e. while the controller was restarting
+
+Scheduled and catch up jobs are the schedule, they run one at a time in the order they were queued.  Manual and dog
+jobs run as soon as they are queued, alongside each other, except that a manual job takes over a dog job's zones.
+A job of a higher class preempts the running jobs of lower classes it conflicts with: they are paused with their
+exact remaining time and resumed, ahead of the jobs of their class queued after them, once nothing outranks them.
+The scheduled down time holds the schedule the same way, so the water delivered is the scheduled amount whatever
+interrupts it.
+
+The waiting jobs are a heap of (class, sequence) with lazy deletion, so queueing, starting, preempting and
+cancelling a job are O(log n) in the number of waiting jobs.  The queue knows nothing of the tables or relays, the
+caller turns the zones of advance()'s result on and off.
+
+    queue = WateringQueue.wateringQueue()
+    queue.push(WateringQueue.wateringJob(WateringQueue.SCHEDULED, [3]), now)
+    started, finished, turnedOn, turnedOff = queue.advance(now, starting)
+'''
+import heapq
+import itertools
+import math
+
+MANUAL, DOG, SCHEDULED, CATCH_UP = range(4)
+CLASS_NAMES = ('manual', 'dog', 'scheduled', 'catch-up')
+ON_DEMAND   = (MANUAL, DOG)
+FOREVER     = math.inf  # remaining seconds of a job its owner ends, i.e. a dog mode spray
+
+QUEUED, RUNNING, PAUSED, DONE, CANCELLED = 'queued', 'running', 'paused', 'done', 'cancelled'
+
+
+class wateringJob:
+    """
+    One watering.
+
+    Args:
+        priority (int): MANUAL, DOG, SCHEDULED or CATCH_UP
+        zones (list): zone indexes watered together
+        remaining (dictionary): {zone: seconds}, None to have advance()'s starting callback set it when the job
+            first starts
+
+    Methods:
+        left(now)    - {zone: seconds left}
+        zonesOn(now) - zones of a running job which have time left
+    """
+    __slots__ = ('priority', 'zones', 'remaining', 'sequence', 'state', 'resumedAt', 'label')
+
+    def __init__(self, priority, zones, remaining=None, label=''):
+        self.priority  = priority
+        self.zones     = list(zones)
+        self.remaining = remaining
+        self.sequence  = None
+        self.state     = None
+        self.resumedAt = None
+        self.label     = label
+
+    def left(self, now):
+        if self.state != RUNNING:
+            return dict(self.remaining or {})
+        elapsed = now - self.resumedAt
+        return {zone: seconds - elapsed for zone, seconds in self.remaining.items()}
+
+    def zonesOn(self, now):
+        return {zone for zone, seconds in self.left(now).items() if seconds > 0}
+
+    def __repr__(self):
+        return f"wateringJob({CLASS_NAMES[self.priority]}, {self.zones}, {self.state})"
+
+
+class wateringQueue:
+    """
+    Priority queue of watering jobs, see above.  Not thread safe, the caller serializes access (the scheduler holds
+    the state store lock).
+
+    Methods:
+        push(job, now)            - queues a job, it starts at the next advance()
+        cancel(job, now)          - removes a waiting or running job
+        finish(job, now)          - ends a running job (an open ended one), its zones turn off at the next advance()
+        hold() / unhold()         - pause / resume the schedule, scheduled and catch up jobs (down time)
+        advance(now, starting)    - finishes the jobs whose time is up, starts and preempts, returns the changes
+        depth()                   - jobs waiting
+        jobs()                    - running and waiting jobs, running first
+        zonesOn(now)              - zones the running jobs have on
+    """
+    def __init__(self):
+        self.waiting  = []  # heap of (priority, sequence, job), stale entries are skipped
+        self.waits    = 0   # live entries in waiting
+        self.running  = []
+        self.held     = False
+        self.sequence = itertools.count()
+        self.on       = set()
+
+    def depth(self):
+        return self.waits
+
+    def jobs(self):
+        return list(self.running) + [job for priority, sequence, job in sorted(self.waiting) if job.state in (QUEUED, PAUSED)]
+
+    def zonesOn(self, now):
+        zones = set()
+        for job in self.running:
+            zones |= job.zonesOn(now)
+        return zones
+
+    def push(self, job, now):
+        job.sequence = next(self.sequence)
+        job.state = QUEUED
+        heapq.heappush(self.waiting, (job.priority, job.sequence, job))
+        self.waits += 1
+
+    def cancel(self, job, now):
+        if job.state in (QUEUED, PAUSED):
+            self.waits -= 1  # the heap entry is skipped when it reaches the top
+        elif job.state == RUNNING:
+            self.running.remove(job)
+        job.state = CANCELLED
+
+    def finish(self, job, now):
+        if job.state == RUNNING:
+            job.remaining = dict.fromkeys(job.remaining, 0)
+        else:
+            self.cancel(job, now)
+
+    def hold(self):
+        self.held = True
+
+    def unhold(self):
+        self.held = False
+
+    def pause(self, job, now):
+        job.remaining = job.left(now)
+        job.state = PAUSED
+        self.running.remove(job)
+        heapq.heappush(self.waiting, (job.priority, job.sequence, job))  # same sequence, ahead of later jobs
+        self.waits += 1
+
+    def top(self):
+        while self.waiting and self.waiting[0][2].state not in (QUEUED, PAUSED):
+            heapq.heappop(self.waiting)
+        return self.waiting[0][2] if self.waiting else None
+
+    def start(self, job, now, starting, started, finished):
+        heapq.heappop(self.waiting)
+        self.waits -= 1
+        if job.remaining is None:
+            job.remaining = starting(job) if starting else {}
+            started.append(job)
+        if all(seconds <= 0 for seconds in job.remaining.values()):
+            job.state = DONE  # nothing to water, i.e. every zone skipped for rain
+            finished.append(job)
+            return
+        job.state = RUNNING
+        job.resumedAt = now
+        self.running.append(job)
+
+    def advance(self, now, starting=None):
+        '''
+        Brings the running jobs up to date with now.
+
+        Args:
+            now (float): seconds
+            starting (function): starting(job) returns the {zone: seconds} of a job starting for the first time
+
+        Returns:
+            (jobs started for the first time, jobs finished, zones turned on, zones turned off)
+        '''
+        started, finished = [], []
+        blocked = []  # heap entries of the dog jobs whose zones the user has, put back once the rest have started
+        for job in list(self.running):
+            if all(seconds <= 0 for seconds in job.left(now).values()):
+                job.state = DONE
+                self.running.remove(job)
+                finished.append(job)
+        if self.held:
+            for job in [job for job in self.running if job.priority not in ON_DEMAND]:
+                self.pause(job, now)
+        while True:
+            job = self.top()
+            if job is None:
+                break
+            if job.priority in ON_DEMAND:
+                manualZones = set().union(*[other.zones for other in self.running if other.priority == MANUAL])
+                if job.priority == DOG and manualZones & set(job.zones):
+                    blocked.append(heapq.heappop(self.waiting))  # the user has the zone, the jobs behind it may run
+                    continue
+                for other in list(self.running):
+                    if other.priority not in ON_DEMAND or (job.priority == MANUAL and other.priority == DOG and
+                                                           set(other.zones) & set(job.zones)):
+                        self.pause(other, now)
+                self.start(job, now, starting, started, finished)
+            else:
+                if self.held or any(other.priority in ON_DEMAND for other in self.running):
+                    break
+                scheduled = [other for other in self.running if other.priority not in ON_DEMAND]
+                if scheduled:
+                    if scheduled[0].priority <= job.priority:
+                        break
+                    self.pause(scheduled[0], now)
+                self.start(job, now, starting, started, finished)
+        for entry in blocked:
+            heapq.heappush(self.waiting, entry)
+        zones = self.zonesOn(now)
+        turnedOn, turnedOff = zones - self.on, self.on - zones
+        self.on = zones
+        return started, finished, turnedOn, turnedOff
+
+
+if __name__ == "__main__":
+    import datetime
+    import Scheduler
+
+    failures = []
+
+    def check(name, condition):
+        print(f"{name}: {'ok' if condition else 'FAILED'}")
+        if not condition:
+            failures.append(name)
+
+    # a dog job whose zone a manual job still has waits, without holding up the jobs queued behind it
+    queue = wateringQueue()
+    manual = wateringJob(MANUAL, [0], {0: 900})
+    queue.push(manual, 0)
+    queue.advance(0)
+    dogs = [wateringJob(DOG, [zone], {zone: FOREVER}) for zone in (0, 3)]
+    scheduled = wateringJob(SCHEDULED, [5], {5: 600})
+    for job in dogs + [scheduled]:
+        queue.push(job, 5)
+    started, finished, turnedOn, turnedOff = queue.advance(5)
+    check("dog job behind a manual zone waits", dogs[0].state == QUEUED and dogs[1].state == RUNNING and turnedOn == {3})
+    check("schedule held by the running dog job", scheduled.state == QUEUED and queue.depth() == 2)
+    queue.cancel(dogs[0], 10)
+    queue.cancel(manual, 45)
+    queue.finish(dogs[1], 100)
+    queue.advance(100)
+    check("schedule resumes once dog mode ends", scheduled.state == RUNNING and queue.on == {5} and queue.depth() == 0)
+
+    # the scheduler: zone 0 turned on then off, a Dog Warning for zones 0 and 3 before the next tick
+    zoneTable = [{'name': f"Zone {zone + 1}", 'relay': zone + 1, 'on': False, 'wateringTime': 10, 'timer': 0, 'multiZone': False,
+                  'dogDetectOn': True, 'detectCount': 0, 'manualStartTime': Scheduler.END_OF_TIME} for zone in range(4)]
+    tables = {'zoneTable': zoneTable, 'timerTable': [], 'autoShutOff': {'multiZone': 60, 'singleZone': 15},
+              'scheduledDownTime': {'duration': 0, 'timer': 0}}
+    run = Scheduler.schedulerState()
+    moment = datetime.datetime(2026, 6, 1, 10)
+    now = moment.timestamp()
+    zoneTable[0].update(on=True, manualStartTime=now)
+    Scheduler.schedulerStep(tables, run, now, moment)
+    zoneTable[0]['on'] = False
+    sprayed, result = Scheduler.startSpray(tables, run, [0, 3], now + 5)
+    check("spray of a manual zone not started or tracked", sprayed == [3] and set(run.dogJobs) == {3})
+    Scheduler.schedulerStep(tables, run, now + 45, moment + datetime.timedelta(seconds=45))
+    Scheduler.endSpray(tables, run, {3: 95}, now + 100)
+    Scheduler.schedulerStep(tables, run, now + 135, moment + datetime.timedelta(seconds=135))
+    check("every zone off once the spray ends", not any(zone['on'] for zone in zoneTable) and not run.queue.running)
+    raise SystemExit(1 if failures else 0)
@@ -0,0 +1,297 @@
+#!/usr/bin/python
+'''
+This provides the weather adjustment of scheduled watering, used while the Weather Adjust setting is on.  The
+watering time configured for a zone is taken to be right for a dry day at the baseline reference
+evapotranspiration (baselineET, mm/day); each scheduled watering is scaled by the zone's recent water deficit
+relative to that, so hot dry weeks water more and rain waters less, or not at all.
+
+Weather is read from files dropped in the weather directory, no weather service is needed.  Any number of CSV or
+JSON files with one record per day, read in name order, a later file's record for a date replaces an earlier one:
+
+    date,tmin,tmax,rain                                            (YYYY-MM-DD, deg C, deg C, mm)
+    2026-07-01,14.2,31.0,0
+    [{"date": "2026-07-01", "tmin": 14.2, "tmax": 31.0, "rain": 0}, ...]
+
+and optionally weather.json with the settings (defaults below):
+
+    {"latitude": 37.4, "baselineET": 6.0, "window": 7, "rainEfficiency": 0.8, "maxMultiplier": 2.0,
+     "cropCoefficients": [0.8, 0.8, 0.5, ...]}            (per zone, zones without one use DEFAULT_CROP_COEFFICIENT)
+
+For every day, vectorized over the days and zones:
+
+    ET0        Hargreaves-Samani reference evapotranspiration, extraterrestrial radiation from the latitude and day
+               of the year (FAO-56 equation 21)
+    deficit    sum over the trailing window of (crop coefficient * ET0 - rainEfficiency * rain), per zone, so rain
+               in the window offsets demand on the other days of the window
+    multiplier deficit / (crop coefficient * baselineET * days with data), clipped to [0, maxMultiplier]
+
+The multipliers are recomputed, for the whole record, whenever a file in the directory changes and kept per day.
+A watering uses the multiplier of the last day before it with data, if that is at most MAX_STALE_DAYS old,
+otherwise 1.  Without numpy the adjustment is unavailable and every multiplier is 1.
+'''
+from FlexPrint import fprint
+import csv
+import datetime
+import json
+import math
+import os
+import threading
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SETTINGS_FILE            = 'weather.json'
+DEFAULT_LATITUDE         = 37.4
+DEFAULT_BASELINE_ET      = 6.0   # mm/day the configured watering times are meant for
+DEFAULT_WINDOW           = 7     # days of weather a multiplier covers
+DEFAULT_RAIN_EFFICIENCY  = 0.8   # fraction of the rain which reaches the roots
+DEFAULT_MAX_MULTIPLIER   = 2.0
+DEFAULT_CROP_COEFFICIENT = 0.8   # cool season turf
+MAX_ZONES                = 64
+MAX_STALE_DAYS           = 3     # days without weather data before the multiplier reverts to 1
+CHECK_INTERVAL           = 60    # seconds between checks of the weather directory for new files
+SOLAR_CONSTANT           = 0.0820  # MJ m-2 min-1
+RADIATION_TO_MM          = 0.408   # MJ m-2 day-1 to mm/day of evaporation
+
+
+def extraterrestrialRadiation(dayOfYear, latitude):
+    '''
+    Returns Ra, MJ m-2 day-1, for the days of the year (array) at latitude (degrees), FAO-56 equations 21-25.
+    '''
+    phi = math.radians(latitude)
+    angle = 2 * math.pi * dayOfYear / 365
+    distance = 1 + 0.033 * numpy.cos(angle)
+    declination = 0.409 * numpy.sin(angle - 1.39)
+    sunset = numpy.arccos(numpy.clip(-math.tan(phi) * numpy.tan(declination), -1, 1))
+    return (24 * 60 / math.pi) * SOLAR_CONSTANT * distance * (sunset * math.sin(phi) * numpy.sin(declination) +
+                                                             math.cos(phi) * numpy.cos(declination) * numpy.sin(sunset))
+
+
+def referenceET(dayOfYear, tmin, tmax, latitude):
+    '''
+    Returns the Hargreaves-Samani reference evapotranspiration, mm/day, for arrays of days.
+    '''
+    radiation = RADIATION_TO_MM * extraterrestrialRadiation(dayOfYear, latitude)
+    return 0.0023 * radiation * ((tmin + tmax) / 2 + 17.8) * numpy.sqrt(numpy.maximum(tmax - tmin, 0))
+
+
+def computeMultipliers(days, tmin, tmax, rain, settings, zones=MAX_ZONES):
+    '''
+    Computes the daily multipliers for a continuous run of days, NaN where there is no data.
+
+    Args:
+        days (datetime64[D] array): consecutive days
+        tmin, tmax, rain (float arrays): weather for each day, NaN where there is no record
+        settings (dictionary): see weather.json above
+        zones (int): columns of the result
+
+    Returns:
+        (ET0 per day, deficit per day and zone, multiplier per day and zone)
+    '''
+    cropCoefficients = numpy.full(zones, DEFAULT_CROP_COEFFICIENT)
+    configured = numpy.asarray(settings.get('cropCoefficients', [])[:zones], dtype=float)
+    cropCoefficients[:len(configured)] = configured
+    window = int(settings.get('window', DEFAULT_WINDOW))
+
+    dayOfYear = (days - days.astype('datetime64[Y]')).astype(int) + 1
+    et0 = referenceET(dayOfYear, tmin, tmax, settings.get('latitude', DEFAULT_LATITUDE))
+    valid = ~numpy.isnan(et0)
+    effectiveRain = settings.get('rainEfficiency', DEFAULT_RAIN_EFFICIENCY) * numpy.nan_to_num(rain)
+    net = numpy.where(valid[:, None], numpy.outer(numpy.nan_to_num(et0), cropCoefficients) - effectiveRain[:, None], 0)
+
+    # Trailing window sums from cumulative sums, row d covers days d - window + 1 .. d
+    sums = numpy.cumsum(net, axis=0)
+    sums[window:] -= sums[:-window].copy()
+    counts = numpy.cumsum(valid)
+    counts[window:] -= counts[:-window].copy()
+
+    demand = numpy.outer(counts, cropCoefficients) * settings.get('baselineET', DEFAULT_BASELINE_ET)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        multipliers = numpy.clip(sums / demand, 0, settings.get('maxMultiplier', DEFAULT_MAX_MULTIPLIER))
+    multipliers[~valid] = numpy.nan  # a day without data has no multiplier of its own
+    return et0, sums, multipliers
+
+
+def readRecords(path):
+    '''
+    Returns {date: (tmin, tmax, rain)} from a CSV or JSON weather file.
+    '''
+    with open(path, newline='') as weatherFile:
+        if path.endswith('.json'):
+            rows = json.load(weatherFile)
+            rows = rows.get('days', []) if isinstance(rows, dict) else rows
+        else:
+            rows = list(csv.DictReader(weatherFile))
+    records = {}
+    for row in rows:
+        try:
+            records[datetime.date.fromisoformat(str(row['date']).strip())] = (float(row['tmin']), float(row['tmax']),
+                                                                              float(row.get('rain') or 0))
+        except (KeyError, ValueError, TypeError):
+            continue  # headers repeated, blank lines ...
+    return records
+
+
+def weatherFiles(directory):
+    '''
+    Returns the os.DirEntry of every weather file in directory, in name order.
+    '''
+    try:
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+    except OSError:
+        return []
+    return [entry for entry in entries if entry.is_file() and entry.name.endswith(('.csv', '.json'))]
+
+
+def readFiles(paths):
+    '''
+    Reads weather files in the order given, returns (settings, {date: (tmin, tmax, rain)}).  Files which can not be
+    read are logged and skipped.
+    '''
+    settings, records = {}, {}
+    for path in paths:
+        try:
+            if os.path.basename(path) == SETTINGS_FILE:
+                with open(path) as settingsFile:
+                    settings = json.load(settingsFile)
+            else:
+                records.update(readRecords(path))
+        except (OSError, ValueError) as error:
+            fprint(f"Weather adjust: unable to read {os.path.basename(path)}: {error}")
+    return settings, records
+
+
+def dailyWeather(records):
+    '''
+    Returns (days, tmin, tmax, rain) arrays for every day from the first to the last record, NaN on days without one.
+    '''
+    firstDay = min(records)
+    days = numpy.arange(numpy.datetime64(firstDay), numpy.datetime64(max(records)) + 1)
+    weather = numpy.full((len(days), 3), numpy.nan)
+    offsets = numpy.fromiter(((day - firstDay).days for day in records), dtype=int, count=len(records))
+    weather[offsets] = numpy.array(list(records.values()))
+    return days, weather[:, 0], weather[:, 1], weather[:, 2]
+
+
+class weatherAdjuster:
+    """
+    Daily watering time multipliers from the weather files in directory.
+
+    Methods:
+        multiplier(zone, day)  - multiplier for a watering of zone (index) on day (datetime.date)
+        refresh()              - reloads and recomputes if a file has changed, returns True if it did
+        status(day)            - dictionary of the data range, recent ET0 and the multipliers for day
+        published()            - (firstDay, et0, multipliers) of the last computation, None without data
+    """
+    def __init__(self, directory, zones=MAX_ZONES):
+        self.directory   = directory
+        self.zones       = zones
+        self.lock        = threading.Lock()
+        self.identity    = None  # (name, mtime, size) of every file the multipliers were computed from
+        self.checked     = 0
+        self.settings    = {}
+        self.data        = None  # (firstDay, et0, multipliers), replaced whole under the lock, read once per call
+        self.computeSeconds = 0
+        if numpy is None:
+            fprint("Weather adjust needs numpy, watering times will not be adjusted")
+
+    def files(self):
+        return weatherFiles(self.directory)
+
+    def refresh(self):
+        if numpy is None:
+            return False
+        with self.lock:
+            self.checked = time.monotonic()
+            entries = self.files()
+            identity = tuple((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size) for entry in entries)
+            if identity == self.identity:
+                return False
+            settings, records = readFiles([entry.path for entry in entries])
+            self.identity = identity
+            self.settings = settings
+            if not records:
+                self.data = None
+                return True
+            start = time.perf_counter()
+            firstDay, lastDay = min(records), max(records)
+            et0, deficits, multipliers = computeMultipliers(*dailyWeather(records), settings, self.zones)
+            self.data = (firstDay, et0, multipliers)
+            self.computeSeconds = time.perf_counter() - start
+            fprint(f"Weather adjust: {len(records)} days {firstDay} to {lastDay} computed in {1000 * self.computeSeconds:.1f}ms")
+            return True
+
+    def published(self):
+        with self.lock:
+            return self.data
+
+    def row(self, day, data):
+        '''
+        Returns the row of data, published(), of the last day before day with data, None if there is none within
+        MAX_STALE_DAYS.
+        '''
+        if data is None:
+            return None
+        firstDay, et0, multipliers = data
+        last = min((day - firstDay).days - 1, len(multipliers) - 1)
+        for row in range(last, max(last - MAX_STALE_DAYS, -1), -1):
+            if not math.isnan(et0[row]):
+                return row if (day - firstDay).days - row <= MAX_STALE_DAYS else None
+        return None
+
+    def multiplier(self, zone, day):
+        if numpy is None:
+            return 1.0
+        if time.monotonic() - self.checked > CHECK_INTERVAL:
+            self.refresh()
+        data = self.published()
+        row = self.row(day, data)
+        if row is None or zone >= data[2].shape[1]:
+            return 1.0
+        return float(data[2][row, zone])
+
+    def status(self, day):
+        if numpy is None:
+            return {'available': False, 'reason': 'numpy is not installed'}
+        data = self.published()
+        row = self.row(day, data)
+        status = {'available': True, 'settings': self.settings, 'computeMs': round(1000 * self.computeSeconds, 3)}
+        if data is not None:
+            firstDay, et0, multipliers = data
+            status.update(firstDay=str(firstDay), lastDay=str(firstDay + datetime.timedelta(days=len(et0) - 1)),
+                          recentET0=[None if math.isnan(value) else round(float(value), 2) for value in et0[-DEFAULT_WINDOW:]])
+        if row is not None:
+            status.update(multiplierDay=str(firstDay + datetime.timedelta(days=row)),
+                          multipliers=[round(float(value), 3) for value in multipliers[row]])
+        return status
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Print the weather adjust multipliers, or time a season of them')
+    parser.add_argument('directory', nargs='?', default='weather')
+    parser.add_argument('--day', help='YYYY-MM-DD, default today')
+    parser.add_argument('--benchmark', action='store_true', help='time recomputing a 184 day season for 64 zones')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        days = numpy.arange(numpy.datetime64('2026-04-01'), numpy.datetime64('2026-10-02'))
+        generator = numpy.random.default_rng(1)
+        tmin = generator.uniform(5, 18, len(days))
+        tmax = tmin + generator.uniform(5, 18, len(days))
+        rain = numpy.where(generator.random(len(days)) < 0.2, generator.exponential(8, len(days)), 0)
+        settings = {'cropCoefficients': list(generator.uniform(0.3, 1.0, MAX_ZONES))}
+        runs = []
+        for _ in range(50):
+            start = time.perf_counter()
+            computeMultipliers(days, tmin, tmax, rain, settings)
+            runs.append(time.perf_counter() - start)
+        runs.sort()
+        print(f"{len(days)} days x {MAX_ZONES} zones: median {1000 * runs[len(runs) // 2]:.3f}ms, max {1000 * runs[-1]:.3f}ms")
+    else:
+        adjuster = weatherAdjuster(args.directory)
+        adjuster.refresh()
+        print(json.dumps(adjuster.status(datetime.date.fromisoformat(args.day) if args.day else datetime.date.today()), indent=2))
@@ -0,0 +1,149 @@
+/*
+ * Sprinkler Controller client script.
+ *
+ * Registers the service worker (templates/sw.js) and turns single field edits on the zones and timers pages into row
+ * updates.  A changed field is posted on its own to /zones/<index> or /timers/<index> and the returned row fragment
+ * (zoneRow.html / timerRow.html) replaces the row in place - one mutation per click and a few hundred bytes instead of
+ * the whole page.  Zone buttons are redrawn as soon as they are pressed.  When the Pi can not be reached the change is
+ * kept in an outbox in localStorage and replayed, in order, when the connection returns.  Only the latest change for a
+ * given row field is kept in the outbox.  Structural buttons (timer add / select / delete, save) still submit the form.
+ */
+(function () {
+  'use strict';
+
+  const OUTBOX_KEY     = 'sprinklerOutbox';
+  const RETRY_INTERVAL = 15000;  // ms between replay attempts while changes are pending
+  let replaying        = false;
+
+  if ('serviceWorker' in navigator) {
+    window.addEventListener('load', () => navigator.serviceWorker.register('/sw.js'));
+  }
+
+  function loadOutbox() {
+    try {
+      return JSON.parse(localStorage.getItem(OUTBOX_KEY)) || [];
+    } catch (error) {
+      return [];
+    }
+  }
+
+  function saveOutbox(outbox) {
+    localStorage.setItem(OUTBOX_KEY, JSON.stringify(outbox));
+  }
+
+  function changeKey(change) {
+    return change.page + ' ' + change.index + ' ' + (change.name === 'zoneButton' ? change.value.split(' ')[1] : change.name);
+  }
+
+  function queueChange(change) {
+    const outbox = loadOutbox().filter(item => changeKey(item) !== changeKey(change));
+    outbox.push(change);
+    saveOutbox(outbox);
+  }
+
+  function swapRow(change, response) {
+    if (response.headers.get('X-Refresh-Page')) {
+      window.location.reload();
+      return;
+    }
+    return response.text().then(html => {
+      const row = document.getElementById(change.page.slice(0, -1) + '-' + change.index);
+      if (row) {
+        row.outerHTML = html;
+      }
+    });
+  }
+
+  function postChange(change) {
+    return fetch('/' + change.page + '/' + change.index, {
+      method: 'POST',
+      headers: {'Content-Type': 'application/x-www-form-urlencoded'},
+      body: new URLSearchParams([[change.name, change.value]]).toString(),
+      credentials: 'same-origin'
+    }).then(response => {
+      if (response.status >= 500) {
+        throw new Error('server error ' + response.status);
+      }
+      if (response.ok) {
+        return swapRow(change, response);
+      }  // 4xx responses are rejected changes, they are not retried
+    });
+  }
+
+  function sendChange(change) {
+    if (loadOutbox().length > 0) {  // keep ordering behind anything still queued
+      queueChange(change);
+      replayOutbox();
+      return;
+    }
+    postChange(change).catch(() => queueChange(change));
+  }
+
+  function replayOutbox() {
+    if (replaying || !navigator.onLine) {
+      return;
+    }
+    const outbox = loadOutbox();
+    if (outbox.length === 0) {
+      return;
+    }
+    replaying = true;
+    postChange(outbox[0]).then(() => {
+      const remaining = loadOutbox();
+      remaining.shift();
+      saveOutbox(remaining);
+      replaying = false;
+      replayOutbox();
+    }).catch(() => {
+      replaying = false;
+    });
+  }
+
+  function rowOf(element) {
+    const row = element.closest('[id^="zone-"], [id^="timer-"]');
+    if (!row) {
+      return null;
+    }
+    const parts = row.id.split('-');
+    return {page: parts[0] + 's', index: parseInt(parts[1], 10)};
+  }
+
+  function onZoneButton(event) {
+    const button = event.target.closest('button[name="zoneButton"]');
+    const row = button && rowOf(button);
+    if (!row) {
+      return;
+    }
+    event.preventDefault();
+    const parts = button.value.split(' ');  // index field requested-state
+    const active = parts[2] === 'on';
+    sendChange({page: row.page, index: row.index, name: button.name, value: button.value});
+    button.classList.toggle('active', active);  // draw now, the row fragment replaces it when it arrives
+    button.setAttribute('aria-pressed', active ? 'true' : 'false');
+    button.value = parts[0] + ' ' + parts[1] + ' ' + (active ? 'off' : 'on');
+  }
+
+  function onFieldChange(event) {
+    const field = event.target;
+    const row = rowOf(field);
+    if (!row || !field.name || field.name.split(' ').length !== 2) {
+      return;
+    }
+    const value = field.type === 'checkbox' ? (field.checked ? 'on' : '') : field.value;
+    sendChange({page: row.page, index: row.index, name: field.name, value: value});
+  }
+
+  document.addEventListener('DOMContentLoaded', () => {
+    document.addEventListener('click', onZoneButton);
+    document.addEventListener('change', onFieldChange);
+    document.addEventListener('keydown', event => {  // enter in a start time field would submit the whole form
+      if (event.key === 'Enter' && rowOf(event.target) && event.target.name.endsWith(' startTime')) {
+        event.preventDefault();
+        event.target.blur();
+      }
+    });
+    replayOutbox();
+  });
+  window.addEventListener('online', replayOutbox);
+  setInterval(replayOutbox, RETRY_INTERVAL);
+})();
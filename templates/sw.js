@@ -0,0 +1,58 @@
+/*
+ * Sprinkler Controller service worker - rendered by SprinklerController.py at /sw.js
+ *
+ * The app shell (the three pages) and the hashed static assets are cached at install.  Hashed assets never change
+ * so they are served cache first.  Pages are served network first so the zone state is current whenever the Pi
+ * can be reached, falling back to the last cached copy when the WiFi in the yard drops out.  Zone and timer
+ * changes are form-urlencoded POSTs to /zones/<index> and /timers/<index>, which sprinkler.js keeps in its
+ * localStorage outbox while offline - they are never cached here.
+ */
+const CACHE_NAME   = {{ cacheName|tojson }};
+const SHELL_PAGES  = {{ shellPages|tojson }};
+const SHELL_ASSETS = {{ shellAssets|tojson }};
+
+self.addEventListener('install', event => {
+  event.waitUntil(
+    caches.open(CACHE_NAME)
+      .then(cache => cache.addAll(SHELL_ASSETS.concat(SHELL_PAGES)))
+      .then(() => self.skipWaiting())
+  );
+});
+
+self.addEventListener('activate', event => {
+  event.waitUntil(
+    caches.keys()
+      .then(names => Promise.all(names.filter(name => name !== CACHE_NAME).map(name => caches.delete(name))))
+      .then(() => self.clients.claim())
+  );
+});
+
+self.addEventListener('fetch', event => {
+  const request = event.request;
+  if (request.method !== 'GET') {
+    return;
+  }
+  const url = new URL(request.url);
+  if (url.origin !== self.location.origin || url.pathname.startsWith('/api/')) {
+    return;
+  }
+  if (url.pathname.startsWith('/assets/')) {
+    event.respondWith(
+      caches.match(request).then(cached => cached || fetch(request).then(response => {
+        const copy = response.clone();
+        caches.open(CACHE_NAME).then(cache => cache.put(request, copy));
+        return response;
+      }))
+    );
+    return;
+  }
+  if (request.mode === 'navigate') {
+    event.respondWith(
+      fetch(request).then(response => {
+        const copy = response.clone();
+        caches.open(CACHE_NAME).then(cache => cache.put(url.pathname, copy));
+        return response;
+      }).catch(() => caches.match(url.pathname).then(cached => cached || caches.match('/zones')))
+    );
+  }
+});